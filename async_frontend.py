@@ -0,0 +1,416 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An event loop based HTTP front end for update checks and API calls."""
+
+import asynchat
+import asyncore
+import collections
+import cStringIO
+import errno
+import fcntl
+import os
+import socket
+import sys
+import threading
+import time
+import urllib
+from multiprocessing import pool
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('FRONTEND', message, *args)
+
+
+# Path prefixes of the requests handled by the front end.
+DEFAULT_PREFIXES = ('/update', '/api', '/wait_for_status')
+# Maximum size of a request line and headers.
+_MAX_HEADER_SIZE = 64 * 1024
+# Seconds after which idle keep-alive connections are closed.
+_IDLE_TIMEOUT = 60
+
+
+class _Trigger(asyncore.file_dispatcher):
+  """Runs callbacks queued by other threads on the event loop thread."""
+
+  def __init__(self, socket_map):
+    read_fd, self._write_fd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+    # The dispatcher works on a duplicate of the descriptor.
+    os.close(read_fd)
+    flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+    fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    self._callbacks = collections.deque()
+
+  def writable(self):
+    return False
+
+  def Call(self, func, *args):
+    """Schedules func(*args) to run on the event loop thread."""
+    self._callbacks.append((func, args))
+    try:
+      os.write(self._write_fd, 'x')
+    except OSError as e:
+      # A full pipe already guarantees a wake up.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except socket.error:
+      pass
+    while self._callbacks:
+      func, args = self._callbacks.popleft()
+      func(*args)
+
+  def close(self):
+    asyncore.file_dispatcher.close(self)
+    os.close(self._write_fd)
+
+
+class _Request(object):
+  """A parsed HTTP request."""
+
+  def __init__(self, method, uri, version, headers):
+    self.method = method
+    self.uri = uri
+    self.version = version
+    self.headers = headers
+    self.body = ''
+
+  def GetHeader(self, name, default=None):
+    name = name.lower()
+    for key, value in self.headers:
+      if key.lower() == name:
+        return value
+    return default
+
+  def KeepAlive(self):
+    """Returns whether the connection persists after the response."""
+    connection = (self.GetHeader('Connection') or '').lower()
+    if self.version == 'HTTP/1.1':
+      return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def _ParseRequestHead(head):
+  """Parses a request line and headers; returns a _Request or None."""
+  lines = head.split('\r\n')
+  try:
+    method, uri, version = lines[0].split(' ', 2)
+  except ValueError:
+    return None
+  if not version.startswith('HTTP/'):
+    return None
+  headers = []
+  for line in lines[1:]:
+    if not line:
+      continue
+    if line[0] in ' \t' and headers:
+      # A folded continuation of the previous header.
+      headers[-1] = (headers[-1][0], headers[-1][1] + ' ' + line.strip())
+      continue
+    name, colon, value = line.partition(':')
+    if not colon:
+      return None
+    headers.append((name.strip(), value.strip()))
+  return _Request(method, uri, version, headers)
+
+
+class _HttpChannel(asynchat.async_chat):
+  """A client connection; requests on it are answered in order."""
+
+  # Send responses in as few system calls as possible.
+  ac_out_buffer_size = 64 * 1024
+
+  def __init__(self, frontend, sock, address):
+    # Responses are written in one go, so don't hold back their tail until
+    # the client acknowledges the rest, which it may delay.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    asynchat.async_chat.__init__(self, sock, map=frontend.socket_map)
+    self._frontend = frontend
+    self.address = address
+    self._incoming = []
+    self._incoming_size = 0
+    # The request whose body is being read, if any.
+    self._request = None
+    # Complete requests not answered yet; the first one is being handled.
+    self._pending = collections.deque()
+    # Whether the connection is being dropped, after a malformed request.
+    self._aborted = False
+    self.last_activity = time.time()
+    self.set_terminator('\r\n\r\n')
+
+  def readable(self):
+    # Stop reading while requests are being handled, so that a client cannot
+    # queue up an unbounded number of them.
+    return (not self._aborted and not self._pending and
+            asynchat.async_chat.readable(self))
+
+  def IsIdle(self, now):
+    return not self._pending and now - self.last_activity > _IDLE_TIMEOUT
+
+  def collect_incoming_data(self, data):
+    if self._aborted:
+      return
+    self.last_activity = time.time()
+    self._incoming.append(data)
+    self._incoming_size += len(data)
+    if self._request is None and self._incoming_size > _MAX_HEADER_SIZE:
+      self._Abort('431 Request Header Fields Too Large')
+
+  def found_terminator(self):
+    if self._aborted:
+      return
+    data = ''.join(self._incoming)
+    self._incoming = []
+    self._incoming_size = 0
+    if self._request is None:
+      if not data.strip():
+        return
+      request = _ParseRequestHead(data.lstrip('\r\n'))
+      if not request:
+        self._Abort('400 Bad Request')
+        return
+      try:
+        length = int(request.GetHeader('Content-Length', 0))
+      except ValueError:
+        self._Abort('400 Bad Request')
+        return
+      if length > 0:
+        self._request = request
+        self.set_terminator(length)
+        return
+    else:
+      request, self._request = self._request, None
+      request.body = data
+      self.set_terminator('\r\n\r\n')
+    self._pending.append(request)
+    if len(self._pending) == 1:
+      self._frontend.Dispatch(self, request)
+
+  def _Abort(self, status):
+    """Answers a malformed request and drops the connection."""
+    self._aborted = True
+    self._incoming = []
+    self._incoming_size = 0
+    self._request = None
+    self._pending.clear()
+    self.push('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+              % status)
+    self.close_when_done()
+    self.set_terminator(None)
+
+  def SendResponse(self, status, headers, body):
+    """Sends the response to the oldest pending request."""
+    if not self.connected or not self._pending:
+      return
+    request = self._pending.popleft()
+    keep_alive = request.KeepAlive()
+    lines = ['HTTP/1.1 %s' % status]
+    for name, value in headers:
+      if name.lower() not in ('connection', 'content-length',
+                              'transfer-encoding'):
+        lines.append('%s: %s' % (name, value))
+    lines.append('Content-Length: %d' % len(body))
+    if not keep_alive:
+      lines.append('Connection: close')
+    head = '\r\n'.join(lines) + '\r\n\r\n'
+    self.push(head if request.method == 'HEAD' else head + body)
+    self.last_activity = time.time()
+    if not keep_alive:
+      self._pending.clear()
+      self.close_when_done()
+    elif self._pending:
+      self._frontend.Dispatch(self, self._pending[0])
+
+  def handle_error(self):
+    _Log('Error on connection from %s: %s', self.address[0],
+         sys.exc_info()[1])
+    self.close()
+
+
+class AsyncFrontend(asyncore.dispatcher):
+  """Serves requests for a WSGI application from a single event loop.
+
+  Connections, request parsing and response writing are handled by one event
+  loop thread, so thousands of clients keeping connections open between
+  update checks do not tie up any threads. Only requests being handled by the
+  application, which may block on payload generation or remote fetches, run
+  on a bounded pool of worker threads; excess requests wait in a queue.
+  Requests for paths outside of the front end's prefixes are answered with
+  404, so that large downloads stay on the main server.
+
+  Members:
+    port: the port the front end listens on.
+  """
+
+  def __init__(self, app, host, port, server_port=None, workers=16,
+               prefixes=DEFAULT_PREFIXES):
+    """Args:
+      app: the WSGI application handling requests.
+      host: the address to listen on.
+      port: the port to listen on, 0 for any free port.
+      server_port: port of the main server. If given, requests are presented
+                   to the application as if they were sent to it, so that
+                   URLs in responses (e.g. payload URLs) point at it.
+      workers: number of worker threads running the application.
+      prefixes: path prefixes of requests that are handed to the application.
+    """
+    self.socket_map = {}
+    asyncore.dispatcher.__init__(self, map=self.socket_map)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    self.create_socket(family, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(1024)
+    self.port = self.socket.getsockname()[1]
+    self._app = app
+    self._server_port = server_port
+    self._prefixes = prefixes
+    self._trigger = _Trigger(self.socket_map)
+    self._pool = pool.ThreadPool(workers)
+    self._thread = None
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.in_flight = 0
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair:
+      _HttpChannel(self, *pair)
+
+  def handle_error(self):
+    _Log('Error accepting connection: %s', sys.exc_info()[1])
+
+  def _IsRouted(self, path):
+    return any(path == prefix or path.startswith(prefix + '/')
+               for prefix in self._prefixes)
+
+  def _GetEnviron(self, channel, request):
+    """Returns the WSGI environment of |request|."""
+    path, _, query = request.uri.partition('?')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'SERVER_NAME': socket.gethostname(),
+        'SERVER_PORT': str(self._server_port or self.port),
+        'SERVER_PROTOCOL': request.version,
+        'REMOTE_ADDR': channel.address[0],
+        'REMOTE_PORT': str(channel.address[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': cStringIO.StringIO(request.body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers:
+      key = name.upper().replace('-', '_')
+      if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        key = 'HTTP_' + key
+      if key in environ:
+        environ[key] += ', ' + value
+      else:
+        environ[key] = value
+    host = environ.get('HTTP_HOST')
+    if host and self._server_port:
+      if not host.endswith(']'):
+        host = host.rpartition(':')[0] or host
+      environ['HTTP_HOST'] = '%s:%d' % (host, self._server_port)
+    return environ
+
+  def _RunApp(self, environ):
+    """Runs the application; returns the (status, headers, body) it made."""
+    response = []
+
+    def _StartResponse(status, headers, exc_info=None):
+      response[:] = [status, headers]
+      return body.append
+
+    body = []
+    try:
+      result = self._app(environ, _StartResponse)
+      try:
+        body.extend(result)
+      finally:
+        if hasattr(result, 'close'):
+          result.close()
+      return response[0], response[1], ''.join(body)
+    except Exception as e:
+      _Log('Failed to handle %s: %s', environ['PATH_INFO'], e)
+      return ('500 Internal Server Error', [('Content-Type', 'text/plain')],
+              'Internal Server Error')
+
+  def _Handle(self, channel, environ):
+    """Handles a request on a worker thread."""
+    try:
+      status, headers, body = self._RunApp(environ)
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+    self._trigger.Call(channel.SendResponse, status, headers, body)
+
+  def Dispatch(self, channel, request):
+    """Hands |request| to a worker, or answers it right away if not routed."""
+    with self._lock:
+      self.requests += 1
+    environ = self._GetEnviron(channel, request)
+    if not self._IsRouted(environ['PATH_INFO']):
+      channel.SendResponse('404 Not Found', [('Content-Type', 'text/plain')],
+                           'Not Found')
+      return
+    with self._lock:
+      self.in_flight += 1
+    self._pool.apply_async(self._Handle, (channel, environ))
+
+  def _CloseIdleConnections(self):
+    now = time.time()
+    for dispatcher in self.socket_map.values():
+      if isinstance(dispatcher, _HttpChannel) and dispatcher.IsIdle(now):
+        dispatcher.close()
+
+  def Serve(self):
+    """Runs the event loop until the front end is stopped."""
+    _Log('Serving on port %d', self.port)
+    last_sweep = time.time()
+    while self.socket_map:
+      asyncore.loop(timeout=1, use_poll=True, map=self.socket_map, count=1)
+      if time.time() - last_sweep > 1:
+        self._CloseIdleConnections()
+        last_sweep = time.time()
+
+  def Start(self):
+    """Runs the event loop on a background thread."""
+    if not self._thread:
+      self._thread = threading.Thread(target=self.Serve)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _CloseAll(self):
+    asyncore.close_all(map=self.socket_map)
+
+  def Stop(self):
+    """Closes all connections and stops the event loop and workers."""
+    self._trigger.Call(self._CloseAll)
+    if self._thread:
+      self._thread.join()
+      self._thread = None
+    self._pool.terminate()
+
+  def GetStats(self):
+    """Returns a dictionary of front end statistics."""
+    with self._lock:
+      return {'connections': len([
+                  dispatcher for dispatcher in self.socket_map.values()
+                  if isinstance(dispatcher, _HttpChannel)]),
+              'requests': self.requests,
+              'in_flight': self.in_flight}
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for async_frontend module."""
+
+import httplib
+import json
+import socket
+import threading
+import unittest
+
+import async_frontend
+
+
+class AsyncFrontendTest(unittest.TestCase):
+
+  def setUp(self):
+    self._release = threading.Event()
+    self._frontend = async_frontend.AsyncFrontend(
+        self._App, '127.0.0.1', 0, server_port=8080, workers=2)
+    self._frontend.Start()
+
+  def tearDown(self):
+    self._release.set()
+    self._frontend.Stop()
+
+  def _App(self, environ, start_response):
+    """A WSGI application echoing the request back as JSON."""
+    if environ['PATH_INFO'] == '/update/block':
+      self._release.wait(10)
+    if environ['PATH_INFO'] == '/api/fail':
+      raise ValueError('handler failed')
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps({'path': environ['PATH_INFO'],
+                        'query': environ['QUERY_STRING'],
+                        'host': environ.get('HTTP_HOST'),
+                        'body': environ['wsgi.input'].read(length)})]
+
+  def _Connect(self):
+    return httplib.HTTPConnection('127.0.0.1', self._frontend.port, timeout=10)
+
+  def testKeepAliveRequests(self):
+    """Tests several requests on one connection, with and without bodies."""
+    connection = self._Connect()
+    connection.request('POST', '/update/some/label', '<request/>')
+    response = connection.getresponse()
+    self.assertEqual(response.status, 200)
+    self.assertEqual(json.loads(response.read()),
+                     {'path': '/update/some/label', 'query': '',
+                      'host': '127.0.0.1:8080', 'body': '<request/>'})
+
+    connection.request('GET', '/api/hostinfo?ip=1.2.3.4')
+    response = connection.getresponse()
+    self.assertEqual(json.loads(response.read())['query'], 'ip=1.2.3.4')
+    connection.close()
+    self.assertEqual(self._frontend.GetStats()['requests'], 2)
+
+  def testPipelinedRequests(self):
+    """Tests that pipelined requests are answered in order."""
+    sock = socket.create_connection(('127.0.0.1', self._frontend.port), 10)
+    sock.sendall('GET /update/block HTTP/1.1\r\nHost: x\r\n\r\n'
+                 'GET /api/second HTTP/1.1\r\nHost: x\r\n'
+                 'Connection: close\r\n\r\n')
+    self._release.set()
+    data = ''
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        break
+      data += chunk
+    sock.close()
+    self.assertTrue(data.index('/update/block') < data.index('/api/second'))
+
+  def testErrors(self):
+    """Tests unrouted paths, failing handlers and malformed requests."""
+    connection = self._Connect()
+    connection.request('GET', '/static/update.gz')
+    response = connection.getresponse()
+    response.read()
+    self.assertEqual(response.status, 404)
+    connection.request('GET', '/api/fail')
+    self.assertEqual(connection.getresponse().status, 500)
+    connection.close()
+
+    sock = socket.create_connection(('127.0.0.1', self._frontend.port), 10)
+    sock.sendall('garbage\r\n\r\n')
+    self.assertTrue(sock.recv(4096).startswith('HTTP/1.1 400'))
+    sock.close()
+
+  def testOversizedHeaders(self):
+    """Tests that the rest of a request with oversized headers is ignored."""
+    sock = socket.create_connection(('127.0.0.1', self._frontend.port), 10)
+    sock.sendall('GET /api/hostinfo HTTP/1.1\r\nX-Padding: %s\r\n\r\n'
+                 'GET /api/hostinfo HTTP/1.1\r\n\r\n' %
+                 ('x' * async_frontend._MAX_HEADER_SIZE))
+    data = ''
+    while True:
+      chunk = sock.recv(4096)
+      if not chunk:
+        break
+      data += chunk
+    sock.close()
+    self.assertTrue(data.startswith('HTTP/1.1 431'))
+    self.assertEqual(data.count('HTTP/1.1'), 1)
+    self.assertEqual(self._frontend.GetStats()['requests'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,9 +2,13 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import collections
 import json
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import urllib2
 import urlparse
@@ -14,7 +18,11 @@ import cherrypy
 from build_util import BuildObject
 import autoupdate_lib
 import common_util
+import fingerprint_store
+import generation_scheduler
+import host_event_log
 import log_util
+import payload_index
 
 
 # Module-local log function.
@@ -26,6 +34,17 @@ UPDATE_FILE = 'update.gz'
 METADATA_FILE = 'update.meta'
 STATEFUL_FILE = 'stateful.tgz'
 CACHE_DIR = 'cache'
+PAYLOAD_INDEX_FILE = '.payload_index.json'
+FINGERPRINT_STORE_FILE = '.fingerprints.json'
+# Default number of events kept per host.
+HOST_LOG_DEPTH = 1000
+# Number of independently locked shards of the host info table.
+HOST_INFO_SHARDS = 16
+# Approximate size of the chunks host logs are serialized in.
+_HOST_LOG_CHUNK_SIZE = 64 * 1024
+# Default and maximum number of seconds to wait for new host events.
+HOST_EVENTS_TIMEOUT = 30
+HOST_EVENTS_MAX_TIMEOUT = 300
 
 
 class AutoupdateError(Exception):
@@ -33,6 +52,11 @@ class AutoupdateError(Exception):
   pass
 
 
+class PayloadPendingError(AutoupdateError):
+  """Raised when a requested payload is still being generated."""
+  pass
+
+
 def _ChangeUrlPort(url, new_port):
   """Return the URL passed in with a different port"""
   scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
@@ -53,55 +77,139 @@ def _NonePathJoin(*args):
   return os.path.join(*filter(None, args))
 
 
+class _LogSequence(object):
+  """Numbers host log entries across hosts.
+
+  Entries are numbered and appended to their host's log under the sequence
+  lock, so that every entry up to the last number handed out is in its log.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.last = -1
+
+  def GetLast(self):
+    """Returns the number of the latest entry appended to a log."""
+    with self.lock:
+      return self.last
+
+
 class HostInfo(object):
   """Records information about an individual host.
 
+  All access goes through methods holding the lock of the host's table shard,
+  as update checks from many threads update host records concurrently.
+
   Members:
     attrs: Static attributes (legacy)
-    log: Complete log of recorded client entries
+    log: Most recent recorded client entries, oldest first
   """
+  __slots__ = ('attrs', 'log', '_lock', '_sequence')
 
-  def __init__(self):
+  def __init__(self, lock=None, log_depth=HOST_LOG_DEPTH, sequence=None):
     # A dictionary of current attributes pertaining to the host.
     self.attrs = {}
 
-    # A list of pairs consisting of a timestamp and a dictionary of recorded
-    # attributes.
-    self.log = []
+    # A ring of dictionaries of recorded attributes, each with a timestamp.
+    self.log = collections.deque(maxlen=log_depth)
+    self._lock = lock or threading.Lock()
+    # Numbers the log entries.
+    self._sequence = sequence or _LogSequence()
 
   def __repr__(self):
-    return 'attrs=%s, log=%s' % (self.attrs, self.log)
+    return 'attrs=%s, log=%s' % (self.attrs, list(self.log))
+
+  def GetAttrs(self):
+    """Returns a copy of the host's attributes."""
+    with self._lock:
+      return dict(self.attrs)
+
+  def UpdateAttrs(self, attrs):
+    """Sets the given attributes."""
+    with self._lock:
+      self.attrs.update(attrs)
+
+  def PopAttr(self, name):
+    """Removes an attribute, returning its value or None."""
+    with self._lock:
+      return self.attrs.pop(name, None)
 
   def AddLogEntry(self, entry):
-    """Append a new log entry."""
+    """Append a new log entry, dropping the oldest one if the log is full.
+
+    Returns:
+      The sequence number of the entry.
+    """
     # Append a timestamp.
     assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
     entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
     # Add entry to hosts' message log.
-    self.log.append(entry)
+    with self._sequence.lock:
+      with self._lock:
+        entry['seq'] = seq = self._sequence.last + 1
+        self.log.append(entry)
+      self._sequence.last = seq
+    return seq
+
+  def GetLog(self):
+    """Returns a snapshot of the host's log as a list."""
+    with self._lock:
+      return list(self.log)
 
 
 class HostInfoTable(object):
   """Records information about a set of hosts who engage in update activity.
 
-  Members:
-    table: Table of information on hosts.
+  Hosts are spread over shards, each with its own lock, so that update checks
+  from different hosts seldom contend with each other.
   """
 
-  def __init__(self):
-    # A dictionary of host information. Keys are normally IP addresses.
-    self.table = {}
+  def __init__(self, log_depth=HOST_LOG_DEPTH, shards=HOST_INFO_SHARDS):
+    """Args:
+      log_depth: maximum number of log entries kept per host.
+      shards: number of shards of the table.
+    """
+    self._log_depth = log_depth
+    # Pairs of a lock and a dictionary of host information. Keys are normally
+    # IP addresses.
+    self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+    # Log entries are numbered across hosts.
+    self._sequence = _LogSequence()
 
   def __repr__(self):
-    return '%s' % self.table
+    return '%s' % dict((host_id, self.GetHostInfo(host_id))
+                       for host_id in self.GetHostIds())
+
+  def _GetShard(self, host_id):
+    return self._shards[hash(host_id) % len(self._shards)]
 
   def GetInitHostInfo(self, host_id):
     """Return a host's info object, or create a new one if none exists."""
-    return self.table.setdefault(host_id, HostInfo())
+    lock, host_infos = self._GetShard(host_id)
+    with lock:
+      host_info = host_infos.get(host_id)
+      if host_info is None:
+        host_info = host_infos[host_id] = HostInfo(lock, self._log_depth,
+                                                   self._sequence)
+      return host_info
 
   def GetHostInfo(self, host_id):
     """Return an info object for given host, if such exists."""
-    return self.table.get(host_id)
+    lock, host_infos = self._GetShard(host_id)
+    with lock:
+      return host_infos.get(host_id)
+
+  def GetLastSeq(self):
+    """Returns the sequence number of the latest log entry, -1 if none."""
+    return self._sequence.GetLast()
+
+  def GetHostIds(self):
+    """Returns a list of the ids of all known hosts."""
+    host_ids = []
+    for lock, host_infos in self._shards:
+      with lock:
+        host_ids.extend(host_infos)
+    return host_ids
 
 
 class UpdateMetadata(object):
@@ -134,7 +242,16 @@ class Autoupdate(BuildObject):
     critical_update:  whether provisioned payload is critical.
     remote_payload:   whether provisioned payload is remotely staged.
     max_updates:      maximum number of updates we'll try to provision.
-    host_log:         record full history of host update events.
+    host_log:         record history of host update events.
+    host_log_depth:   number of most recent events recorded per host.
+    host_log_dir:     directory to persist host events to; when unset, events
+                      are only kept in memory.
+    fast_cache_keys:  derive cache directories from sampled image fingerprints
+                      rather than full MD5 digests.
+    async_generation: answer update checks with no update while the payload
+                      they need is being generated, instead of waiting for it.
+    generation_workers: maximum number of concurrent payload generations.
+    cache_manager:    CacheManager of the update cache directory, if any.
   """
 
   _PAYLOAD_URL_PREFIX = '/static/'
@@ -150,7 +267,10 @@ class Autoupdate(BuildObject):
                proxy_port=None, src_image='', vm=False, board=None,
                copy_to_static_root=True, private_key=None,
                critical_update=False, remote_payload=False, max_updates= -1,
-               host_log=False, *args, **kwargs):
+               host_log=False, fast_cache_keys=False, async_generation=False,
+               generation_workers=2, cache_manager=None,
+               host_log_depth=HOST_LOG_DEPTH, host_log_dir=None, *args,
+               **kwargs):
     super(Autoupdate, self).__init__(*args, **kwargs)
     self.serve_only = serve_only
     self.use_test_image = test_image
@@ -177,9 +297,46 @@ class Autoupdate(BuildObject):
 
     # Initialize empty host info cache. Used to keep track of various bits of
     # information about a given host.  A host is identified by its IP address.
-    # The info stored for each host includes a complete log of events for this
+    # The info stored for each host includes a log of recent events for this
     # host, as well as a dictionary of current attributes derived from events.
-    self.host_infos = HostInfoTable()
+    self.host_infos = HostInfoTable(log_depth=host_log_depth)
+
+    # Durable log of host events, which replaces the in-memory logs of the
+    # host info table when a directory to keep it in is given.
+    self.host_event_log = None
+    if host_log and host_log_dir:
+      self.host_event_log = host_event_log.HostEventLog(host_log_dir)
+      self.host_event_log.Load()
+
+    # Wakes up clients waiting for host events; guards the sequence number of
+    # the latest logged event.
+    self._host_event_cond = threading.Condition()
+    self._last_host_event_seq = -1
+    if self.host_event_log:
+      self._last_host_event_seq = (
+          self.host_event_log.GetStats()['next_seq'] - 1)
+
+    # Process-wide index of payload metadata, which spares update checks from
+    # hashing payloads that were already seen (or indexed when staged).
+    index_file = (os.path.join(self.static_dir, PAYLOAD_INDEX_FILE)
+                  if self.static_dir else None)
+    self.payload_index = payload_index.PayloadIndex(
+        index_file, self._ComputePayloadAttrs)
+    self.payload_index.Load()
+
+    # Memoized image fingerprints, used for naming cached update directories.
+    store_file = (os.path.join(self.static_dir, FINGERPRINT_STORE_FILE)
+                  if self.static_dir else None)
+    self.fingerprints = fingerprint_store.FingerprintStore(
+        store_file, fast=fast_cache_keys)
+    self.fingerprints.Load()
+
+    # Payload generation runs on a bounded pool of workers, with at most one
+    # in-flight generation per cache directory.
+    self.async_generation = async_generation
+    self.generation_scheduler = generation_scheduler.GenerationScheduler(
+        max_workers=generation_workers)
+    self.cache_manager = cache_manager
 
   @classmethod
   def _ReadMetadataFromStream(cls, stream):
@@ -215,6 +372,21 @@ class Autoupdate(BuildObject):
     with open(metadata_file, 'w') as file_handle:
       json.dump(file_dict, file_handle)
 
+  @classmethod
+  def _ComputePayloadAttrs(cls, filename):
+    """Computes the metadata attributes of the payload in |filename|."""
+    sha1, sha256 = common_util.GetFileSha1Sha256(filename)
+    return {cls.SHA1_ATTR: sha1,
+            cls.SHA256_ATTR: sha256,
+            cls.SIZE_ATTR: common_util.GetFileSize(filename),
+            cls.ISDELTA_ATTR: cls._IsDeltaFormatFile(filename)}
+
+  @classmethod
+  def _MetadataFromAttrs(cls, attrs):
+    """Returns a metadata object for a dictionary of payload attributes."""
+    return UpdateMetadata(attrs.get(cls.SHA1_ATTR), attrs.get(cls.SHA256_ATTR),
+                          attrs.get(cls.SIZE_ATTR), attrs.get(cls.ISDELTA_ATTR))
+
   def _GetDefaultBoardID(self):
     """Returns the default board id stored in .default_board."""
     board_file = '%s/.default_board' % (self.scripts_dir)
@@ -338,7 +510,8 @@ class Autoupdate(BuildObject):
     """Find directory to store a cached update.
 
     Given one, or two images for an update, this finds which cache directory
-    should hold the update files, even if they don't exist yet.
+    should hold the update files, even if they don't exist yet. Image hashes
+    are memoized by file identity, so unchanged images are only read once.
 
     Returns:
       A directory path for storing a cached update, of the following form:
@@ -351,11 +524,11 @@ class Autoupdate(BuildObject):
     """
     update_dir = ''
     if src_image:
-      update_dir += common_util.GetFileMd5(src_image) + '_'
+      update_dir += self.fingerprints.GetFingerprint(src_image) + '_'
 
-    update_dir += common_util.GetFileMd5(dest_image)
+    update_dir += self.fingerprints.GetFingerprint(dest_image)
     if self.private_key:
-      update_dir += '+' + common_util.GetFileMd5(self.private_key)
+      update_dir += '+' + self.fingerprints.GetFingerprint(self.private_key)
 
     if not self.vm:
       update_dir += '+patched_kernel'
@@ -365,6 +538,9 @@ class Autoupdate(BuildObject):
   def GenerateUpdateImage(self, image_path, output_dir):
     """Force generates an update payload based on the given image_path.
 
+    The update and stateful payloads are generated in parallel into a
+    temporary directory, which then atomically replaces output_dir.
+
     Args:
       src_image: image we are updating from (Null/empty for non-delta)
       image_path: full path to the image.
@@ -375,20 +551,50 @@ class Autoupdate(BuildObject):
     """
     _Log('Generating update for image %s', image_path)
 
-    # Delete any previous state in this directory.
-    os.system('rm -rf "%s"' % output_dir)
-    os.makedirs(output_dir)
-
+    parent_dir = os.path.dirname(output_dir.rstrip('/'))
+    if not os.path.isdir(parent_dir):
+      os.makedirs(parent_dir)
+    # Hidden, so that it is never mistaken for a cache entry.
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=parent_dir)
+
+    stateful_error = []
+    def _GenerateStateful():
+      try:
+        self.GenerateStatefulFile(image_path, tmp_dir)
+      except Exception as e:
+        stateful_error.append(e)
+
+    stateful_thread = threading.Thread(target=_GenerateStateful)
+    stateful_thread.start()
     try:
-      self.GenerateUpdateFile(self.src_image, image_path, output_dir)
-      self.GenerateStatefulFile(image_path, output_dir)
-    except subprocess.CalledProcessError:
-      os.system('rm -rf "%s"' % output_dir)
-      raise AutoupdateError('Failed to generate update in %s' % output_dir)
+      try:
+        self.GenerateUpdateFile(self.src_image, image_path, tmp_dir)
+      finally:
+        stateful_thread.join()
+      if stateful_error:
+        raise stateful_error[0]
+
+      # Publish the result, replacing any previous state.
+      if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+      os.rename(tmp_dir, output_dir)
+    except Exception as e:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      raise AutoupdateError('Failed to generate update in %s: %s' %
+                            (output_dir, e))
+
+  def _GenerateCachedUpdateImage(self, image_path, cache_dir):
+    """Generates the payloads in cache_dir unless they are already there."""
+    if not (os.path.exists(os.path.join(cache_dir, UPDATE_FILE)) and
+            os.path.exists(os.path.join(cache_dir, STATEFUL_FILE))):
+      self.GenerateUpdateImage(image_path, cache_dir)
 
   def GenerateUpdateImageWithCache(self, image_path, static_image_dir):
     """Force generates an update payload based on the given image_path.
 
+    Generation is delegated to the generation scheduler, so concurrent
+    requests for the same cached update share a single generation.
+
     Args:
       image_path: full path to the image.
       static_image_dir: the directory to move images to after generating.
@@ -396,18 +602,39 @@ class Autoupdate(BuildObject):
       update directory relative to static_image_dir. None if it should
       serve from the static_image_dir.
     Raises:
+      PayloadPendingError if generation is asynchronous and still running.
       AutoupdateError if it we need to generate a payload and fail to do so.
     """
     _Log('Generating update for src %s image %s', self.src_image, image_path)
 
     # If it was pregenerated_path, don't regenerate
     if self.pregenerated_path:
+      if self.cache_manager:
+        self.cache_manager.Touch(
+            os.path.join(static_image_dir, self.pregenerated_path))
       return self.pregenerated_path
 
     # Which sub_dir of static_image_dir should hold our cached update image
     cache_sub_dir = self.FindCachedUpdateImageSubDir(self.src_image, image_path)
     _Log('Caching in sub_dir "%s"', cache_sub_dir)
-
+    full_cache_dir = os.path.join(static_image_dir, cache_sub_dir)
+    if not self.cache_manager:
+      return self._GenerateUpdateImageWithCache(image_path, static_image_dir,
+                                                cache_sub_dir)
+
+    # Keep the cache entry from being evicted while we are using it.
+    with self.cache_manager.Pinned(full_cache_dir):
+      result = self._GenerateUpdateImageWithCache(image_path, static_image_dir,
+                                                  cache_sub_dir)
+      self.cache_manager.Touch(full_cache_dir)
+    return result
+
+  def _GenerateUpdateImageWithCache(self, image_path, static_image_dir,
+                                    cache_sub_dir):
+    """Generates (if needed) and publishes the update in cache_sub_dir.
+
+    See GenerateUpdateImageWithCache() for details.
+    """
     # The cached payloads exist in a cache dir
     cache_update_payload = os.path.join(static_image_dir,
                                         cache_sub_dir, UPDATE_FILE)
@@ -418,7 +645,21 @@ class Autoupdate(BuildObject):
     # Check to see if this cache directory is valid.
     if not os.path.exists(cache_update_payload) or not os.path.exists(
         cache_stateful_payload):
-      self.GenerateUpdateImage(image_path, full_cache_dir)
+      job = self.generation_scheduler.Submit(
+          full_cache_dir, self._GenerateCachedUpdateImage, image_path,
+          full_cache_dir)
+      if self.async_generation and not job.Wait(0):
+        raise PayloadPendingError('Update in %s is being generated' %
+                                  full_cache_dir)
+      # With async generation, this may report the failure of a previous
+      # attempt; the next request retries.
+      try:
+        job.Result()
+      except AutoupdateError:
+        raise
+      except Exception as e:
+        raise AutoupdateError('Failed to generate update in %s: %r' %
+                              (full_cache_dir, e))
 
     self.pregenerated_path = cache_sub_dir
 
@@ -526,9 +767,15 @@ class Autoupdate(BuildObject):
       AutoupdateError if it failed to generate the payload.
     """
     _Log('Pre-generating the update payload')
-    # Does not work with labels so just use static dir.
-    pregenerated_update = self.GenerateUpdatePayload(self.board, '0.0.0.0',
-                                                     self.static_dir)
+    # Does not work with labels so just use static dir. Pre-generation always
+    # waits for the payload, even if update checks would not.
+    async_generation = self.async_generation
+    self.async_generation = False
+    try:
+      pregenerated_update = self.GenerateUpdatePayload(self.board, '0.0.0.0',
+                                                       self.static_dir)
+    finally:
+      self.async_generation = async_generation
     print 'PREGENERATED_UPDATE=%s' % _NonePathJoin(pregenerated_update,
                                                    UPDATE_FILE)
     return pregenerated_update
@@ -583,15 +830,25 @@ class Autoupdate(BuildObject):
       raise AutoupdateError('update.gz not present in payload dir %s' %
                             payload_dir)
 
+    # Serve from the in-memory index whenever possible.
+    attrs = self.payload_index.Lookup(filename)
+    if attrs is not None:
+      return self._MetadataFromAttrs(attrs)
+
     metadata_obj = Autoupdate._ReadMetadataFromFile(payload_dir)
-    if not metadata_obj or not (metadata_obj.sha1 and
-                                metadata_obj.sha256 and
-                                metadata_obj.size):
-      sha1 = common_util.GetFileSha1(filename)
-      sha256 = common_util.GetFileSha256(filename)
-      size = common_util.GetFileSize(filename)
-      is_delta_format = self._IsDeltaFormatFile(filename)
-      metadata_obj = UpdateMetadata(sha1, sha256, size, is_delta_format)
+    if metadata_obj and (metadata_obj.sha1 and
+                         metadata_obj.sha256 and
+                         metadata_obj.size):
+      self.payload_index.Add(filename, {
+          self.SHA1_ATTR: metadata_obj.sha1,
+          self.SHA256_ATTR: metadata_obj.sha256,
+          self.SIZE_ATTR: metadata_obj.size,
+          self.ISDELTA_ATTR: metadata_obj.is_delta_format})
+    else:
+      # Nothing is known about this payload, so it has to be hashed here;
+      # concurrent update checks for it will wait for a single computation.
+      metadata_obj = self._MetadataFromAttrs(
+          self.payload_index.Compute(filename))
       Autoupdate._StoreMetadataToFile(payload_dir, metadata_obj)
 
     return metadata_obj
@@ -599,7 +856,11 @@ class Autoupdate(BuildObject):
   def _ProcessUpdateComponents(self, app, event):
     """Processes the app and event components of an update request.
 
-    Returns tuple containing forced_update_label, client_version, and board.
+    Args:
+      app: dictionary of the app element attributes, or None.
+      event: dictionary of the event element attributes, or None.
+    Returns:
+      Tuple containing forced_update_label, client_version, and board.
     """
     # Initialize an empty dictionary for event attributes to log.
     log_message = {}
@@ -611,37 +872,43 @@ class Autoupdate(BuildObject):
 
     client_version = 'ForcedUpdate'
     board = None
-    if app:
-      client_version = app.getAttribute('version')
-      channel = app.getAttribute('track')
-      board = (app.hasAttribute('board') and app.getAttribute('board')
-                  or self._GetDefaultBoardID())
+    host_attrs = {}
+    if app is not None:
+      client_version = app.get('version', '')
+      channel = app.get('track', '')
+      board = app.get('board') or self._GetDefaultBoardID()
       # Add attributes to log message
       log_message['version'] = client_version
       log_message['track'] = channel
       log_message['board'] = board
-      curr_host_info.attrs['last_known_version'] = client_version
-
-    if event:
-      event_result = int(event[0].getAttribute('eventresult'))
-      event_type = int(event[0].getAttribute('eventtype'))
-      client_previous_version = (event[0].getAttribute('previousversion')
-                                 if event[0].hasAttribute('previousversion')
-                                 else None)
+      host_attrs['last_known_version'] = client_version
+
+    if event is not None:
+      event_result = int(event.get('eventresult', ''))
+      event_type = int(event.get('eventtype', ''))
+      client_previous_version = event.get('previousversion')
       # Store attributes to legacy host info structure
-      curr_host_info.attrs['last_event_status'] = event_result
-      curr_host_info.attrs['last_event_type'] = event_type
+      host_attrs['last_event_status'] = event_result
+      host_attrs['last_event_type'] = event_type
       # Add attributes to log message
       log_message['event_result'] = event_result
       log_message['event_type'] = event_type
       if client_previous_version is not None:
         log_message['previous_version'] = client_previous_version
 
+    curr_host_info.UpdateAttrs(host_attrs)
+
     # Log host event, if so instructed.
     if self.host_log:
-      curr_host_info.AddLogEntry(log_message)
+      if self.host_event_log:
+        seq = self.host_event_log.Append(client_ip, log_message)
+      else:
+        seq = curr_host_info.AddLogEntry(log_message)
+      with self._host_event_cond:
+        self._last_host_event_seq = max(self._last_host_event_seq, seq)
+        self._host_event_cond.notify_all()
 
-    return (curr_host_info.attrs.pop('forced_update_label', None),
+    return (curr_host_info.PopAttr('forced_update_label'),
             client_version, board)
 
   def _GetStaticUrl(self):
@@ -746,6 +1013,10 @@ class Autoupdate(BuildObject):
         local_payload_dir = _NonePathJoin(static_image_dir, rel_path)
         metadata_obj = self.GetLocalPayloadAttrs(local_payload_dir)
 
+    except PayloadPendingError as e:
+      # The client will check again later, by which time the payload is ready.
+      _Log('Deferring update: %s', e)
+      return autoupdate_lib.GetNoUpdateResponse(protocol)
     except AutoupdateError as e:
       # Raised if we fail to generate an update payload.
       _Log('Failed to process an update: %r', e)
@@ -759,26 +1030,128 @@ class Autoupdate(BuildObject):
   def HandleHostInfoPing(self, ip):
     """Returns host info dictionary for the given IP in JSON format."""
     assert ip, 'No ip provided.'
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).attrs)
+    host_info = self.host_infos.GetHostInfo(ip)
+    if host_info:
+      return json.dumps(host_info.GetAttrs())
+
+  def _GetHostLog(self, host_id, since, limit, event_type):
+    """Returns the filtered list of events logged for a host."""
+    if self.host_event_log:
+      return [event for _, event in self.host_event_log.Query(
+          host_id, since=since, limit=limit, event_type=event_type)]
+
+    host_info = self.host_infos.GetHostInfo(host_id)
+    if not host_info:
+      return []
+    log = host_info.GetLog()
+    if since is not None:
+      log = [entry for entry in log if entry['seq'] > since]
+    if event_type is not None:
+      log = [entry for entry in log if entry.get('event_type') == event_type]
+    return log[:limit]
+
+  def _GetLastHostLogSeq(self):
+    """Returns the sequence number up to which all events are logged."""
+    if self.host_event_log:
+      return self.host_event_log.GetStats()['next_seq'] - 1
+    return self.host_infos.GetLastSeq()
+
+  def _GetHostLogIds(self):
+    if self.host_event_log:
+      return self.host_event_log.GetHostIds()
+    return self.host_infos.GetHostIds()
+
+  def _IterHostLogs(self, since, limit, event_type):
+    """Yields a JSON dictionary of the logs of all hosts, in chunks.
+
+    Hosts are serialized one at a time from snapshots of their logs, so that
+    neither memory use nor lock hold times grow with the number of hosts.
+    """
+    chunk = ['{']
+    chunk_size = 0
+    separator = ''
+    for host_id in self._GetHostLogIds():
+      log = self._GetHostLog(host_id, since, limit, event_type)
+      if not log and (since is not None or event_type is not None):
+        continue
+      encoded = '%s%s: %s' % (separator, json.dumps(host_id), json.dumps(log))
+      separator = ', '
+      chunk.append(encoded)
+      chunk_size += len(encoded)
+      if chunk_size >= _HOST_LOG_CHUNK_SIZE:
+        yield ''.join(chunk)
+        chunk = []
+        chunk_size = 0
+    chunk.append('}')
+    yield ''.join(chunk)
+
+  def HandleHostLogPing(self, ip, since=None, limit=None, event_type=None):
+    """Returns a log of events for host in JSON format.
+
+    Every logged event carries a sequence number, increasing across hosts,
+    which clients can pass back as |since| to only fetch newer events.
 
-  def HandleHostLogPing(self, ip):
-    """Returns a complete log of events for host in JSON format."""
+    Args:
+      ip: address of the host, or 'all' for a dictionary of the logs of all
+          hosts keyed by address, which is returned as an iterator of chunks.
+      since: only return events with a sequence number larger than this.
+      limit: maximum number of events returned per host, oldest first.
+      event_type: only return events of this type.
+    """
     # If all events requested, return a dictionary of logs keyed by IP address.
     if ip == 'all':
-      return json.dumps(
-          dict([(key, self.host_infos.table[key].log)
-                for key in self.host_infos.table]))
+      return self._IterHostLogs(since, limit, event_type)
 
     # Otherwise we're looking for a specific IP address, so find its log.
-    if ip in self.host_infos.table:
-      return json.dumps(self.host_infos.GetHostInfo(ip).log)
+    return json.dumps(self._GetHostLog(ip, since, limit, event_type))
+
+  def HandleHostEventsPing(self, ips, since=None,
+                           timeout=HOST_EVENTS_TIMEOUT):
+    """Waits for events of some hosts, returning them in JSON format.
 
-    # If no events were logged for this IP, return an empty log.
-    return json.dumps([])
+    Returns as soon as any of the hosts has logged events newer than |since|,
+    or when |timeout| expires. The result is a dictionary with the list of
+    `events', each carrying the `ip' of its host, and the `seq' number to
+    pass as |since| to wait for the following events.
+
+    Args:
+      ips: addresses of the hosts to wait for.
+      since: sequence number of the last event already seen; by default,
+             only events logged after the call are returned.
+      timeout: maximum number of seconds to wait.
+    """
+    assert ips, 'No ip provided.'
+    deadline = time.time() + min(timeout, HOST_EVENTS_MAX_TIMEOUT)
+    while True:
+      with self._host_event_cond:
+        last_seq = self._last_host_event_seq
+      # Logs are read one host at a time, so events logged meanwhile may show
+      # up for some hosts but not for others; only events that all logs are
+      # known to hold are returned, lest the returned seq skip over the rest.
+      logged_seq = self._GetLastHostLogSeq()
+      if since is None:
+        since = logged_seq
+      events = []
+      for ip in ips:
+        events.extend(dict(event, ip=ip)
+                      for event in self._GetHostLog(ip, since, None, None)
+                      if event['seq'] <= logged_seq)
+      remaining = deadline - time.time()
+      if events or remaining <= 0:
+        break
+      with self._host_event_cond:
+        # Only wait if no event was logged since the logs were looked at.
+        if self._last_host_event_seq == last_seq:
+          self._host_event_cond.wait(remaining)
+
+    events.sort(key=lambda event: event['seq'])
+    if events:
+      since = events[-1]['seq']
+    return json.dumps({'events': events, 'seq': since})
 
   def HandleSetUpdatePing(self, ip, label):
     """Sets forced_update_label for a given host."""
     assert ip, 'No ip provided.'
     assert label, 'No label provided.'
-    self.host_infos.GetInitHostInfo(ip).attrs['forced_update_label'] = label
+    self.host_infos.GetInitHostInfo(ip).UpdateAttrs(
+        {'forced_update_label': label})
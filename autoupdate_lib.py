@@ -4,10 +4,11 @@
 
 """Module containing common autoupdate utilities and protocol dictionaries."""
 
-import datetime
+import collections
 import os
+import threading
 import time
-from xml.dom import minidom
+from xml.parsers import expat
 
 
 APP_ID = '87efface-864d-49a5-9bb3-4b050a7c227a'
@@ -88,24 +89,32 @@ NO_UPDATE_RESPONSE['3.0'] = """<?xml version="1.0" encoding="UTF-8"?>
   """
 
 
+SUPPORTED_PROTOCOLS = ('2.0', '3.0')
+
+# Stands in for the elapsed seconds when responses are pre-rendered.
+_TIME_ELAPSED_MARKER = '\0time_elapsed\0'
+# Maximum number of pre-rendered responses kept.
+_RESPONSE_CACHE_SIZE = 64
+
+
+# The parts of an update request the devserver cares about. app and event are
+# dictionaries of the attributes of the first respective element (or None if
+# there is no such element), update_check is whether there is an updatecheck
+# element.
+UpdateRequest = collections.namedtuple(
+    'UpdateRequest', ['protocol', 'app', 'event', 'update_check'])
+
+
 class UnknownProtocolRequestedException(Exception):
   """Raised when an supported protocol is specified."""
 
 
-def GetSecondsSinceMidnight():
+def GetSecondsSinceMidnight(now=None):
   """Returns the seconds since midnight as a decimal value."""
-  now = time.localtime()
+  now = now or time.localtime()
   return now[3] * 3600 + now[4] * 60 + now[5]
 
 
-def GetCommonResponseValues():
-  """Returns a dictionary of default values for the response."""
-  response_values = {}
-  response_values['appid'] = APP_ID
-  response_values['time_elapsed'] = GetSecondsSinceMidnight()
-  return response_values
-
-
 def GetSubstitutedResponse(response_dict, protocol, response_values):
   """Substitutes the protocol-specific response with response_values.
 
@@ -120,6 +129,80 @@ def GetSubstitutedResponse(response_dict, protocol, response_values):
   return response_xml
 
 
+class _ResponseCache(object):
+  """A bounded LRU cache of pre-rendered responses.
+
+  Responses are rendered once per key with a marker in place of the elapsed
+  seconds, and kept as the segments around it, so that answering a request
+  only takes joining the segments with the current value. Keys include all
+  the values substituted into a response (e.g. the payload hashes), so a
+  change of payload metadata simply results in a new entry.
+  """
+
+  def __init__(self, max_entries=_RESPONSE_CACHE_SIZE):
+    self._max_entries = max_entries
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+  def GetSegments(self, key, render_func):
+    """Returns the segments of the response for |key|, rendering if needed.
+
+    Args:
+      key: a hashable identifying the response.
+      render_func: function returning the response with _TIME_ELAPSED_MARKER
+                   in place of the elapsed seconds.
+    """
+    with self._lock:
+      segments = self._entries.pop(key, None)
+      if segments is not None:
+        self._entries[key] = segments
+        return segments
+    segments = tuple(render_func().split(_TIME_ELAPSED_MARKER))
+    with self._lock:
+      self._entries[key] = segments
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return segments
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+_response_cache = _ResponseCache()
+
+
+def ClearResponseCache():
+  """Drops all pre-rendered responses."""
+  _response_cache.Clear()
+
+
+def _RenderUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
+                          deadline):
+  """Renders an update response, with a marker for the elapsed seconds."""
+  response_values = {'appid': APP_ID, 'time_elapsed': _TIME_ELAPSED_MARKER}
+  response_values['sha1'] = sha1
+  response_values['sha256'] = sha256
+  response_values['size'] = size
+  response_values['url'] = url
+  (codebase, filename) = os.path.split(url)
+  response_values['codebase'] = codebase
+  response_values['filename'] = filename
+  response_values['is_delta_format'] = is_delta_format
+  extra_attributes = []
+  if deadline:
+    extra_attributes.append('deadline="%s"' % deadline)
+
+  response_values['extra_attr'] = ' '.join(extra_attributes)
+  return GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+
+
+def _RenderNoUpdateResponse(protocol):
+  """Renders a no update response, with a marker for the elapsed seconds."""
+  response_values = {'appid': APP_ID, 'time_elapsed': _TIME_ELAPSED_MARKER}
+  return GetSubstitutedResponse(NO_UPDATE_RESPONSE, protocol, response_values)
+
+
 def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
                       critical_update=False):
   """Returns a protocol-specific response to the client for a new update.
@@ -135,25 +218,18 @@ def GetUpdateResponse(sha1, sha256, size, url, is_delta_format, protocol,
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  response_values['sha1'] = sha1
-  response_values['sha256'] = sha256
-  response_values['size'] = size
-  response_values['url'] = url
-  (codebase, filename) = os.path.split(url)
-  response_values['codebase'] = codebase
-  response_values['filename'] = filename
-  response_values['is_delta_format'] = is_delta_format
-  extra_attributes = []
+  now = time.localtime()
+  deadline = None
   if critical_update:
     # The date string looks like '20111115' (2011-11-15). As of writing,
     # there's no particular format for the deadline value that the
     # client expects -- it's just empty vs. non-empty.
-    date_str = datetime.date.today().strftime('%Y%m%d')
-    extra_attributes.append('deadline="%s"' % date_str)
+    deadline = '%04d%02d%02d' % now[:3]
 
-  response_values['extra_attr'] = ' '.join(extra_attributes)
-  return GetSubstitutedResponse(UPDATE_RESPONSE, protocol, response_values)
+  args = (sha1, sha256, size, url, is_delta_format, protocol, deadline)
+  segments = _response_cache.GetSegments(
+      ('update',) + args, lambda: _RenderUpdateResponse(*args))
+  return str(GetSecondsSinceMidnight(now)).join(segments)
 
 
 def GetNoUpdateResponse(protocol):
@@ -164,33 +240,62 @@ def GetNoUpdateResponse(protocol):
   Returns:
     Xml string to be passed back to client.
   """
-  response_values = GetCommonResponseValues()
-  return GetSubstitutedResponse(NO_UPDATE_RESPONSE, protocol, response_values)
+  segments = _response_cache.GetSegments(
+      ('noupdate', protocol), lambda: _RenderNoUpdateResponse(protocol))
+  return str(GetSecondsSinceMidnight()).join(segments)
+
+
+class _UpdateRequestHandler(object):
+  """Collects the interesting elements of an update request from expat."""
+
+  def __init__(self):
+    self.protocol = None
+    self.app = None
+    self.event = None
+    self.update_check = False
+    self._prefix = ''
+
+  def StartElement(self, name, attrs):
+    if self.protocol is None:
+      # The root element; protocol 2.0 elements live in the o: namespace.
+      self.protocol = attrs.get('protocol', '')
+      if self.protocol == '2.0':
+        self._prefix = 'o:'
+      return
+    if not name.startswith(self._prefix):
+      return
+    name = name[len(self._prefix):]
+    if name == 'app':
+      if self.app is None:
+        self.app = attrs
+    elif name == 'event':
+      if self.event is None:
+        self.event = attrs
+    elif name == 'updatecheck':
+      self.update_check = True
 
 
 def ParseUpdateRequest(request_string):
-  """Returns a tuple containing information parsed from an update request.
+  """Returns the information the devserver uses from an update request.
+
+  The request is parsed in a single streaming pass, without building a DOM.
 
   Args:
-    request_dom: an xml string containing the update request.
-  Returns tuple consisting of protocol string, app element, event element and
-    update_check element.
-  Raises UnknownProtocolRequestedException if we do not understand the
-    protocol.
+    request_string: an xml string containing the update request.
+  Returns:
+    An UpdateRequest tuple of the protocol string, the app and event attribute
+    dictionaries and whether the request contains an update check.
+  Raises:
+    UnknownProtocolRequestedException if we do not understand the protocol.
+    expat.ExpatError if the request is not well-formed XML.
   """
-  request_dom = minidom.parseString(request_string)
-  protocol = request_dom.firstChild.getAttribute('protocol')
-  supported_protocols = '2.0', '3.0'
-  if protocol not in supported_protocols:
+  handler = _UpdateRequestHandler()
+  parser = expat.ParserCreate()
+  parser.StartElementHandler = handler.StartElement
+  parser.Parse(request_string, True)
+  if handler.protocol not in SUPPORTED_PROTOCOLS:
     raise UnknownProtocolRequestedException('Supported protocols are %s' %
-                                            supported_protocols)
-
-  element_dict = {}
-  for name in ['event', 'app', 'updatecheck']:
-    element_dict[name] = 'o:' + name if protocol == '2.0' else name
-
-  app = request_dom.firstChild.getElementsByTagName(element_dict['app'])[0]
-  event = request_dom.getElementsByTagName(element_dict['event'])
-  update_check = request_dom.getElementsByTagName(element_dict['updatecheck'])
+                                            (SUPPORTED_PROTOCOLS,))
 
-  return protocol, app, event, update_check
+  return UpdateRequest(handler.protocol, handler.app, handler.event,
+                       handler.update_check)
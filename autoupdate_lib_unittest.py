@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for autoupdate_lib module."""
+
+import time
+import unittest
+from xml.parsers import expat
+
+import mox
+
+import autoupdate_lib
+
+
+_REQUEST_V2 = """<?xml version="1.0" encoding="UTF-8"?>
+<o:gupdate xmlns:o="http://www.google.com/update2/request" protocol="2.0">
+  <o:os version="Indy" platform="Chrome OS"></o:os>
+  <o:app appid="{DEV-BUILD}" version="1.2.3" track="dev-channel">
+    <o:updatecheck></o:updatecheck>
+    <o:event eventtype="3" eventresult="2" previousversion="1.2.2"></o:event>
+    <o:event eventtype="14" eventresult="1"></o:event>
+  </o:app>
+</o:gupdate>
+"""
+
+_REQUEST_V3 = """<?xml version="1.0" encoding="UTF-8"?>
+<request protocol="3.0">
+  <os version="Indy" platform="Chrome OS"></os>
+  <app appid="{DEV-BUILD}" version="1.2.3" track="dev-channel" board="x86">
+    <event eventtype="3" eventresult="2"></event>
+  </app>
+</request>
+"""
+
+
+class ParseUpdateRequestTest(unittest.TestCase):
+
+  def testProtocol2(self):
+    """Tests parsing of a namespaced 2.0 update check."""
+    request = autoupdate_lib.ParseUpdateRequest(_REQUEST_V2)
+    self.assertEqual(request.protocol, '2.0')
+    self.assertEqual(request.app['version'], '1.2.3')
+    self.assertEqual(request.app['track'], 'dev-channel')
+    self.assertFalse('board' in request.app)
+    self.assertEqual(request.event, {'eventtype': '3', 'eventresult': '2',
+                                     'previousversion': '1.2.2'})
+    self.assertTrue(request.update_check)
+
+  def testProtocol3(self):
+    """Tests parsing of a 3.0 event report without an update check."""
+    protocol, app, event, update_check = autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V3)
+    self.assertEqual(protocol, '3.0')
+    self.assertEqual(app['board'], 'x86')
+    self.assertEqual(event['eventtype'], '3')
+    self.assertFalse(update_check)
+
+  def testNamespaceMismatch(self):
+    """Tests that 3.0 element names are not picked up from 2.0 requests."""
+    request = autoupdate_lib.ParseUpdateRequest(
+        _REQUEST_V3.replace('protocol="3.0"', 'protocol="2.0"'))
+    self.assertEqual((request.app, request.event), (None, None))
+
+  def testBadRequests(self):
+    self.assertRaises(
+        autoupdate_lib.UnknownProtocolRequestedException,
+        autoupdate_lib.ParseUpdateRequest,
+        _REQUEST_V3.replace('protocol="3.0"', 'protocol="4.0"'))
+    self.assertRaises(expat.ExpatError, autoupdate_lib.ParseUpdateRequest,
+                      '<request protocol="3.0"><app></request>')
+
+
+class GetResponseTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    autoupdate_lib.ClearResponseCache()
+    self.mox.StubOutWithMock(time, 'localtime')
+
+  def _GetResponse(self, protocol, sha1='sha1', critical_update=False):
+    return autoupdate_lib.GetUpdateResponse(
+        sha1, 'sha256', 100, 'http://host/static/update.gz', False, protocol,
+        critical_update=critical_update)
+
+  def testUpdateResponse(self):
+    """Tests that cached responses match freshly substituted ones."""
+    for elapsed in (1, 3601):
+      time.localtime().AndReturn((2012, 11, 15, elapsed / 3600, 0,
+                                  elapsed % 3600, 3, 320, 0))
+    self.mox.ReplayAll()
+
+    for elapsed in (1, 3601):
+      expected = autoupdate_lib.UPDATE_RESPONSE['3.0'] % {
+          'time_elapsed': elapsed, 'appid': autoupdate_lib.APP_ID,
+          'sha1': 'sha1', 'sha256': 'sha256', 'size': 100,
+          'url': 'http://host/static/update.gz',
+          'codebase': 'http://host/static', 'filename': 'update.gz',
+          'is_delta_format': False, 'extra_attr': ''}
+      self.assertEqual(self._GetResponse('3.0'), expected)
+    self.mox.VerifyAll()
+
+  def testCriticalAndChangedPayloads(self):
+    """Tests that deadlines and payload changes are reflected."""
+    for day in (15, 15, 16, 16):
+      time.localtime().AndReturn((2012, 11, day, 0, 0, 5, 3, 320, 0))
+    self.mox.ReplayAll()
+
+    self.assertTrue('deadline="20121115"' in
+                    self._GetResponse('2.0', critical_update=True))
+    self.assertTrue('hash="other"' in self._GetResponse('2.0', sha1='other'))
+    self.assertTrue('deadline="20121116"' in
+                    self._GetResponse('2.0', critical_update=True))
+    self.assertFalse('deadline' in self._GetResponse('2.0'))
+    self.mox.VerifyAll()
+
+  def testNoUpdateResponse(self):
+    time.localtime().AndReturn((2012, 11, 15, 0, 1, 2, 3, 320, 0))
+    self.mox.ReplayAll()
+    self.assertEqual(autoupdate_lib.GetNoUpdateResponse('3.0'),
+                     autoupdate_lib.NO_UPDATE_RESPONSE['3.0'] % {
+                         'time_elapsed': 62, 'appid': autoupdate_lib.APP_ID})
+    self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+  unittest.main()
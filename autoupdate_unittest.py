@@ -10,6 +10,7 @@ import json
 import os
 import shutil
 import socket
+import threading
 import unittest
 
 import cherrypy
@@ -32,8 +33,7 @@ class AutoupdateTest(mox.MoxTestBase):
   def setUp(self):
     mox.MoxTestBase.setUp(self)
     self.mox.StubOutWithMock(common_util, 'GetFileSize')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha1')
-    self.mox.StubOutWithMock(common_util, 'GetFileSha256')
+    self.mox.StubOutWithMock(common_util, 'GetFileSha1Sha256')
     self.mox.StubOutWithMock(autoupdate_lib, 'GetUpdateResponse')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetLatestImageDir')
     self.mox.StubOutWithMock(autoupdate.Autoupdate, '_GetRemotePayloadAttrs')
@@ -43,6 +43,7 @@ class AutoupdateTest(mox.MoxTestBase):
     self.latest_dir = '12345_af_12-a1'
     self.latest_verision = '12345_af_12'
     self.static_image_dir = '/tmp/static-dir/'
+    self._updaters = []
     self.hostname = '%s:%s' % (socket.gethostname(), self.port)
     self.test_dict = {
         'client': 'ChromeOSUpdateEngine-1.0',
@@ -63,6 +64,10 @@ class AutoupdateTest(mox.MoxTestBase):
     os.makedirs(self.static_image_dir)
 
   def tearDown(self):
+    # Saves pending on timers, before their directory goes away.
+    for updater in self._updaters:
+      updater.payload_index.Flush()
+      updater.fingerprints.Flush()
     shutil.rmtree(self.static_image_dir)
 
   def _DummyAutoupdateConstructor(self, **kwargs):
@@ -70,6 +75,7 @@ class AutoupdateTest(mox.MoxTestBase):
     dummy = autoupdate.Autoupdate(root_dir=None,
                                   static_dir=self.static_image_dir,
                                   **kwargs)
+    self._updaters.append(dummy)
     return dummy
 
   def testGetRightSignedDeltaPayloadDir(self):
@@ -127,10 +133,8 @@ class AutoupdateTest(mox.MoxTestBase):
     au_mock.GenerateUpdateImageWithCache(
         self.forced_image_path,
         static_image_dir=self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1Sha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
@@ -158,10 +162,8 @@ class AutoupdateTest(mox.MoxTestBase):
 
     au_mock.GenerateLatestUpdateImage(
         self.test_board, 'ForcedUpdate', self.static_image_dir).AndReturn(None)
-    common_util.GetFileSha1(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        self.static_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1Sha256(os.path.join(
+        self.static_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         self.static_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(self.static_image_dir,
@@ -181,6 +183,85 @@ class AutoupdateTest(mox.MoxTestBase):
                      self.test_dict['event_result'])
     self.mox.VerifyAll()
 
+  def testGetLocalPayloadAttrsFromIndex(self):
+    """Tests that indexed payloads are not hashed on the request path."""
+    au_mock = self._DummyAutoupdateConstructor()
+    update_gz = os.path.join(self.static_image_dir, autoupdate.UPDATE_FILE)
+    with open(update_gz, 'w') as fh:
+      fh.write('')
+    au_mock.payload_index.Add(update_gz, {'sha1': self.sha1,
+                                          'sha256': self.sha256,
+                                          'size': self.size,
+                                          'is_delta': False})
+
+    self.mox.ReplayAll()
+    metadata_obj = au_mock.GetLocalPayloadAttrs(self.static_image_dir)
+    self.assertEqual((metadata_obj.sha1, metadata_obj.sha256,
+                      metadata_obj.size, metadata_obj.is_delta_format),
+                     (self.sha1, self.sha256, self.size, False))
+    self.assertEqual(au_mock.payload_index.GetStats()['hits'], 1)
+    self.mox.VerifyAll()
+
+  def testGenerateUpdateImage(self):
+    """Tests that generated payloads are published atomically."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GenerateUpdateFile')
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GenerateStatefulFile')
+    au_mock = self._DummyAutoupdateConstructor()
+    output_dir = os.path.join(self.static_image_dir, 'cache', 'abcde')
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, 'stale'), 'w') as fh:
+      fh.write('')
+
+    def _WritePayload(name):
+      def _Write(*args):
+        with open(os.path.join(args[-1], name), 'w') as fh:
+          fh.write(name)
+      return _Write
+
+    au_mock.GenerateUpdateFile(
+        '', self.forced_image_path, mox.IgnoreArg()).WithSideEffects(
+            _WritePayload(autoupdate.UPDATE_FILE))
+    au_mock.GenerateStatefulFile(
+        self.forced_image_path, mox.IgnoreArg()).WithSideEffects(
+            _WritePayload(autoupdate.STATEFUL_FILE))
+
+    self.mox.ReplayAll()
+    au_mock.GenerateUpdateImage(self.forced_image_path, output_dir)
+    self.assertEqual(sorted(os.listdir(output_dir)),
+                     [autoupdate.STATEFUL_FILE, autoupdate.UPDATE_FILE])
+    self.assertEqual(os.listdir(os.path.dirname(output_dir)), ['abcde'])
+    self.mox.VerifyAll()
+
+  def testHandleUpdatePingWhileGenerating(self):
+    """Tests that async generation answers with no update meanwhile."""
+    self.mox.StubOutWithMock(autoupdate.Autoupdate,
+                             'FindCachedUpdateImageSubDir')
+    self.mox.StubOutWithMock(autoupdate.Autoupdate, 'GenerateUpdateImage')
+    self.mox.StubOutWithMock(autoupdate_lib, 'GetNoUpdateResponse')
+    au_mock = self._DummyAutoupdateConstructor(
+        forced_image=self.forced_image_path, async_generation=True)
+    au_mock.FindCachedUpdateImageSubDir('', self.forced_image_path).AndReturn(
+        'cache/abcde')
+    autoupdate_lib.GetNoUpdateResponse('3.0').AndReturn('noupdate')
+
+    # Keep the generation job busy while the update check is handled.
+    started = threading.Event()
+    release = threading.Event()
+    def _Generate(*_args):
+      started.set()
+      release.wait(10)
+
+    au_mock.GenerateUpdateImage(
+        self.forced_image_path,
+        os.path.join(self.static_image_dir, 'cache/abcde')).WithSideEffects(
+            _Generate)
+
+    self.mox.ReplayAll()
+    self.assertEqual(au_mock.HandleUpdatePing(self.test_data), 'noupdate')
+    self.assertTrue(started.wait(10))
+    release.set()
+    self.mox.VerifyAll()
+
   def testChangeUrlPort(self):
     r = autoupdate._ChangeUrlPort('http://fuzzy:8080/static', 8085)
     self.assertEqual(r, 'http://fuzzy:8085/static')
@@ -204,6 +285,75 @@ class AutoupdateTest(mox.MoxTestBase):
     self.assertEqual(
         json.loads(au_mock.HandleHostInfoPing(test_ip)), self.test_dict)
 
+  def testHostInfoTable(self):
+    """Tests that host logs are bounded and serialized incrementally."""
+    au_mock = self._DummyAutoupdateConstructor(host_log_depth=2)
+    for ip in ('1.2.3.4', '5.6.7.8'):
+      for event_type in range(3):
+        au_mock.host_infos.GetInitHostInfo(ip).AddLogEntry(
+            {'event_type': event_type})
+
+    log = json.loads(au_mock.HandleHostLogPing('1.2.3.4'))
+    self.assertEqual([entry['event_type'] for entry in log], [1, 2])
+    self.assertEqual(json.loads(au_mock.HandleHostLogPing('9.9.9.9')), [])
+    all_logs = json.loads(''.join(au_mock.HandleHostLogPing('all')))
+    self.assertEqual(sorted(all_logs), ['1.2.3.4', '5.6.7.8'])
+    self.assertEqual(all_logs['5.6.7.8'],
+                     json.loads(au_mock.HandleHostLogPing('5.6.7.8')))
+
+    since = log[0]['seq']
+    self.assertEqual(json.loads(au_mock.HandleHostLogPing('1.2.3.4', since)),
+                     log[1:])
+    filtered = json.loads(''.join(au_mock.HandleHostLogPing(
+        'all', limit=1, event_type=2)))
+    self.assertEqual([entry['event_type'] for entry in filtered['5.6.7.8']],
+                     [2])
+
+  def testHandleHostEventsPing(self):
+    """Tests that waiting clients are woken up by new events."""
+    au_mock = self._DummyAutoupdateConstructor(host_log=True)
+    event = {'eventtype': '3', 'eventresult': '1'}
+    au_mock._ProcessUpdateComponents(None, event)
+    self.assertEqual(
+        json.loads(au_mock.HandleHostEventsPing(['127.0.0.1'], timeout=0)),
+        {'events': [], 'seq': 0})
+    result = json.loads(au_mock.HandleHostEventsPing(['127.0.0.1'], since=-1))
+    self.assertEqual([(entry['ip'], entry['seq'], entry['event_type'])
+                      for entry in result['events']], [('127.0.0.1', 0, 3)])
+
+    results = []
+    def _Wait():
+      results.append(json.loads(au_mock.HandleHostEventsPing(
+          ['1.2.3.4', '127.0.0.1'], since=result['seq'], timeout=10)))
+    waiter = threading.Thread(target=_Wait)
+    waiter.start()
+    au_mock._ProcessUpdateComponents(None, event)
+    waiter.join(10)
+    self.assertEqual(results[0]['seq'], 1)
+    self.assertEqual([entry['seq'] for entry in results[0]['events']], [1])
+    self.assertFalse('ip' in au_mock.host_infos.GetHostInfo(
+        '127.0.0.1').GetLog()[0])
+
+  def testHandleHostEventsPingConcurrentEvents(self):
+    """Tests that events logged while logs are read are not skipped."""
+    au_mock = self._DummyAutoupdateConstructor(host_log=True)
+    get_host_log = au_mock._GetHostLog
+    def _GetHostLog(host_id, *args):
+      if host_id == '1.2.3.4' and not au_mock.host_infos.GetHostIds():
+        # Events of both hosts, the host already read first.
+        for ip in ('5.6.7.8', '1.2.3.4'):
+          au_mock.host_infos.GetInitHostInfo(ip).AddLogEntry({})
+      return get_host_log(host_id, *args)
+    au_mock._GetHostLog = _GetHostLog
+
+    ips = ['5.6.7.8', '1.2.3.4']
+    result = json.loads(au_mock.HandleHostEventsPing(ips, since=-1, timeout=0))
+    self.assertEqual(result, {'events': [], 'seq': -1})
+    result = json.loads(au_mock.HandleHostEventsPing(ips, since=-1, timeout=0))
+    self.assertEqual(
+        [(entry['ip'], entry['seq']) for entry in result['events']],
+        [('5.6.7.8', 0), ('1.2.3.4', 1)])
+
   def testHandleSetUpdatePing(self):
     au_mock = self._DummyAutoupdateConstructor()
     test_ip = '1.2.3.4'
@@ -239,10 +389,8 @@ class AutoupdateTest(mox.MoxTestBase):
     with open(update_gz, 'w') as fh:
       fh.write('')
 
-    common_util.GetFileSha1(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha1)
-    common_util.GetFileSha256(os.path.join(
-        new_image_dir, 'update.gz')).AndReturn(self.sha256)
+    common_util.GetFileSha1Sha256(os.path.join(
+        new_image_dir, 'update.gz')).AndReturn((self.sha1, self.sha256))
     common_util.GetFileSize(os.path.join(
         new_image_dir, 'update.gz')).AndReturn(self.size)
     au_mock._StoreMetadataToFile(new_image_dir,
@@ -0,0 +1,245 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Shared watches of the artifacts uploaded to build archives.
+
+All requests waiting for artifacts of the same archive share a single poller
+thread, which reads the manifest of uploaded artifacts of the archive only
+when it changed, backing off while it doesn't.
+"""
+
+import collections
+import random
+import threading
+import time
+
+import gsutil_util
+import log_util
+import uploaded_manifest
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('WATCHER', message, *args)
+
+
+# Name of the manifest of the artifacts uploaded to an archive.
+MANIFEST_NAME = 'UPLOADED'
+# Bounds of the delay between polls of an archive, in seconds.
+MIN_DELAY = 5
+MAX_DELAY = 15
+# Factor the delay grows by while the manifest of an archive doesn't change.
+_BACKOFF = 1.5
+# Number of consecutive failed polls of an archive after which its waiters
+# are given the error.
+_MAX_ERRORS = 3
+# Number of archives whose manifest is kept after their last waiter left.
+_CACHE_SIZE = 256
+
+
+class _ArchiveWatch(object):
+  """The artifacts uploaded to an archive, as last polled for its waiters."""
+
+  def __init__(self, archive_url, uploaded, version, max_delay):
+    self.archive_url = archive_url
+    self.uploaded = uploaded
+    self.version = version
+    self.max_delay = max_delay
+    # Number and time of the polls, and whether a waiter needs one right away.
+    self.polls = 0
+    self.poll_time = 0
+    self.wake = True
+    self.waiters = 0
+    # Number of consecutive failed polls, and the error of the last one once
+    # there were _MAX_ERRORS of them.
+    self.errors = 0
+    self.error = None
+
+
+class AvailabilityWatcher(object):
+  """Coalesces the waits for uploaded artifacts onto one poller per archive.
+
+  A poller reads the manifest of its archive right away, then again after a
+  delay growing from min_delay to max_delay as long as the manifest doesn't
+  change, and stops once no request waits for the archive anymore. The
+  manifest is read conditionally on the version of the last one read, which
+  is kept across pollers of the same archive. Once several polls in a row
+  failed, the waiters are given the error.
+  """
+
+  def __init__(self, min_delay=MIN_DELAY, max_delay=MAX_DELAY):
+    self._min_delay = min_delay
+    self._max_delay = max_delay
+    self._cond = threading.Condition()
+    # Watched archives, by URL.
+    self._watches = {}
+    # Versions and contents of recently polled manifests, by archive URL.
+    self._manifests = collections.OrderedDict()
+    self._stats = dict.fromkeys(('waits', 'polls', 'not_modified', 'listings',
+                                 'errors'), 0)
+
+  def _Count(self, name):
+    with self._cond:
+      self._stats[name] += 1
+
+  def _Poll(self, watch):
+    """Returns the artifacts uploaded to the archive and their version.
+
+    The artifacts are None if the manifest is still at watch.version.
+    """
+    backend = gsutil_util.GetStorageBackend()
+    try:
+      contents, version = backend.CatIfChanged(
+          '%s/%s' % (watch.archive_url, MANIFEST_NAME), watch.version)
+    except gsutil_util.GSUtilError:
+      # For backward compatibility, falling back to listing the archive when
+      # the manifest file is not present.
+      self._Count('listings')
+      names = [url.rsplit('/', 1)[1] for url in backend.List(watch.archive_url)]
+      return uploaded_manifest.UploadedManifest(names), None
+    if contents is None:
+      self._Count('not_modified')
+      return None, version
+    return uploaded_manifest.UploadedManifest(contents.splitlines()), version
+
+  def _Poller(self, watch):
+    """Polls the archive of |watch| until it has no waiters."""
+    try:
+      self._PollUntilUnwatched(watch)
+    finally:
+      with self._cond:
+        # Unless it stopped for lack of waiters, lets the waiters know that
+        # the poller failed.
+        if self._watches.get(watch.archive_url) is watch:
+          del self._watches[watch.archive_url]
+          self._cond.notify_all()
+
+  def _PollUntilUnwatched(self, watch):
+    delay = self._min_delay
+    while True:
+      self._Count('polls')
+      error = None
+      try:
+        uploaded, version = self._Poll(watch)
+      except Exception as e:
+        self._Count('errors')
+        _Log('Failed to poll %s: %s', watch.archive_url, e)
+        uploaded, version = None, watch.version
+        error = e
+
+      with self._cond:
+        if error:
+          watch.errors += 1
+          if watch.errors >= _MAX_ERRORS:
+            watch.error = error
+        else:
+          watch.errors = 0
+          watch.error = None
+        if uploaded is not None and uploaded != watch.uploaded:
+          delay = self._min_delay
+        else:
+          delay = min(delay * _BACKOFF, watch.max_delay)
+        if uploaded is not None:
+          watch.uploaded = uploaded
+          watch.version = version
+          self._manifests.pop(watch.archive_url, None)
+          self._manifests[watch.archive_url] = (uploaded, version)
+          if len(self._manifests) > _CACHE_SIZE:
+            self._manifests.popitem(last=False)
+        watch.polls += 1
+        watch.poll_time = time.time()
+        watch.wake = False
+        self._cond.notify_all()
+
+        next_poll = watch.poll_time + delay * random.uniform(.75, 1.25)
+        while watch.waiters and not watch.wake:
+          remaining = next_poll - time.time()
+          if remaining <= 0:
+            break
+          self._cond.wait(remaining)
+        if not watch.waiters:
+          del self._watches[watch.archive_url]
+          return
+
+  def Wait(self, archive_url, is_available, timeout, max_delay=None):
+    """Waits until the artifacts uploaded to |archive_url| are available.
+
+    Args:
+      archive_url: URL of the Google Storage archive.
+      is_available: function returning whether a list of uploaded artifact
+                    names has the ones waited for.
+      timeout: maximum number of seconds to wait.
+      max_delay: maximum delay between polls of the archive while waiting.
+
+    Returns:
+      The UploadedManifest of the archive polled after the wait started,
+      shared with the other waiters, or None on timeout.
+
+    Raises:
+      GSUtilError: if the archive could not be polled several times in a row,
+                   or the error the polls failed with.
+    """
+    start = time.time()
+    deadline = start + timeout
+    with self._cond:
+      self._stats['waits'] += 1
+      watch = self._watches.get(archive_url)
+      if not watch:
+        uploaded, version = self._manifests.get(archive_url, (None, None))
+        watch = _ArchiveWatch(archive_url, uploaded, version, self._max_delay)
+        self._watches[archive_url] = watch
+        poller = threading.Thread(target=self._Poller, args=(watch,))
+        poller.daemon = True
+        poller.start()
+      if max_delay:
+        watch.max_delay = max(self._min_delay, min(watch.max_delay, max_delay))
+      # Polls from slightly before the wait started are recent enough.
+      fresh_time = start - self._min_delay
+      if watch.poll_time < fresh_time:
+        watch.wake = True
+        self._cond.notify_all()
+
+      watch.waiters += 1
+      checked_polls = None
+      try:
+        while True:
+          # Check each poll recent enough once.
+          if watch.poll_time >= fresh_time and watch.polls != checked_polls:
+            checked_polls = watch.polls
+            if watch.error:
+              raise watch.error
+            if watch.uploaded is not None and is_available(watch.uploaded):
+              return watch.uploaded
+          if self._watches.get(archive_url) is not watch:
+            raise gsutil_util.GSUtilError('Stopped polling %s' % archive_url)
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return None
+          self._cond.wait(remaining)
+      finally:
+        watch.waiters -= 1
+        # Lets the poller stop if this was the last waiter.
+        self._cond.notify_all()
+
+  def GetStats(self):
+    """Returns a dictionary of watcher statistics."""
+    with self._cond:
+      return dict(self._stats,
+                  archives=len(self._watches),
+                  waiters=sum(watch.waiters
+                              for watch in self._watches.itervalues()),
+                  cached=len(self._manifests))
+
+
+_availability_watcher = None
+_availability_watcher_lock = threading.Lock()
+
+
+def GetAvailabilityWatcher():
+  """Returns the watcher artifacts are waited for with, creating it."""
+  global _availability_watcher
+  with _availability_watcher_lock:
+    if not _availability_watcher:
+      _availability_watcher = AvailabilityWatcher()
+    return _availability_watcher
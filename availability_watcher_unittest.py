@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for availability_watcher module."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import availability_watcher
+import gsutil_util
+
+
+ARCHIVE_URL = 'gs://bucket/build'
+
+
+class AvailabilityWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp(prefix='availability_watcher')
+    self._archive_dir = os.path.join(self._tmp_dir, 'bucket', 'build')
+    os.makedirs(self._archive_dir)
+    gsutil_util.SetStorageBackend(gsutil_util.LocalBackend(self._tmp_dir))
+    self._watcher = availability_watcher.AvailabilityWatcher(min_delay=0.05,
+                                                             max_delay=0.2)
+
+  def tearDown(self):
+    # Lets the pollers stop before the storage backend goes away.
+    deadline = time.time() + 5
+    while self._watcher.GetStats()['archives'] and time.time() < deadline:
+      time.sleep(0.05)
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self._tmp_dir)
+
+  def _Upload(self, *names):
+    with open(os.path.join(self._archive_dir,
+                           availability_watcher.MANIFEST_NAME), 'w') as f:
+      f.write(''.join(name + '\n' for name in names))
+
+  def testCoalescedWaiters(self):
+    """Tests that waiters share a poller, and wake up as artifacts arrive."""
+    self._Upload('debug.tgz')
+    results = {}
+
+    def _Wait(name):
+      results[name] = self._watcher.Wait(
+          ARCHIVE_URL, lambda uploaded: name in uploaded, 10)
+
+    threads = [threading.Thread(target=_Wait, args=(name,))
+               for name in ('debug.tgz', 'update.gz', 'update.gz')]
+    for thread in threads:
+      thread.start()
+    threads[0].join()
+    self.assertEqual(results['debug.tgz'], ['debug.tgz'])
+    self.assertEqual(self._watcher.GetStats()['archives'], 1)
+    time.sleep(0.5)
+    self._Upload('debug.tgz', 'update.gz')
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results['update.gz'], ['debug.tgz', 'update.gz'])
+
+    # The poller stops with its last waiter, and backed off while the
+    # manifest did not change.
+    time.sleep(0.1)
+    stats = self._watcher.GetStats()
+    self.assertEqual(stats['archives'], 0)
+    self.assertEqual(stats['waits'], 3)
+    self.assertTrue(stats['not_modified'] > 0)
+    self.assertTrue(stats['polls'] < 0.5 / 0.05)
+
+  def testTimeout(self):
+    self._Upload('debug.tgz')
+    self.assertEqual(self._watcher.Wait(
+        ARCHIVE_URL, lambda uploaded: 'update.gz' in uploaded, 0.2), None)
+
+  def testListingFallback(self):
+    """Tests that archives without a manifest are listed instead."""
+    open(os.path.join(self._archive_dir, 'update.gz'), 'w').close()
+    self.assertEqual(self._watcher.Wait(
+        ARCHIVE_URL, lambda uploaded: 'update.gz' in uploaded, 10),
+                     ['update.gz'])
+    self.assertEqual(self._watcher.GetStats()['listings'], 1)
+
+  def testListingErrors(self):
+    """Tests that waiters are given the error of repeated failed polls."""
+    shutil.rmtree(self._archive_dir)
+    self.assertRaises(gsutil_util.GSUtilError, self._watcher.Wait,
+                      ARCHIVE_URL, lambda uploaded: True, 10)
+    self.assertEqual(self._watcher.GetStats()['errors'], 3)
+
+
+  def testUnexpectedErrors(self):
+    """Tests that unexpected poll errors are counted as failed polls."""
+    def _Poll(watch):
+      raise ValueError('unexpected')
+    self._watcher._Poll = _Poll
+    self.assertRaises(ValueError, self._watcher.Wait,
+                      ARCHIVE_URL, lambda uploaded: True, 10)
+    self.assertEqual(self._watcher.GetStats()['errors'], 3)
+
+  def testPollerFailure(self):
+    """Tests that waiters do not outlive a failed poller."""
+    def _PollUntilUnwatched(watch):
+      raise ValueError('poller failure')
+    self._watcher._PollUntilUnwatched = _PollUntilUnwatched
+    self.assertRaises(gsutil_util.GSUtilError, self._watcher.Wait,
+                      ARCHIVE_URL, lambda uploaded: True, 10)
+    self.assertEqual(self._watcher.GetStats()['archives'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
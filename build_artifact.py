@@ -8,9 +8,14 @@ import os
 import re
 import shutil
 import subprocess
+from distutils import spawn
 
+import control_file_index
+import download_engine
 import gsutil_util
 import log_util
+import remote_zip
+import symbol_store
 
 
 # Names of artifacts we care about.
@@ -26,6 +31,27 @@ TEST_SUITES_PACKAGE = 'test_suites.tar.bz2'
 AU_SUITE_PACKAGE = 'au_control.tar.bz2'
 
 
+# Whether tarballs are extracted while being downloaded, and whether a copy of
+# them is kept in the install directory then.
+_streaming_extraction = False
+_keep_streamed_tarballs = False
+
+
+def SetStreamingExtraction(enabled, keep_tarballs=False):
+  """Sets whether tarballs are piped from storage straight into tar.
+
+  Args:
+    enabled: whether to extract tarballs while downloading them, rather than
+             after they were downloaded to the staging directory.
+    keep_tarballs: whether to also write streamed tarballs to the directory
+                   they are extracted to, i.e. the build directory, which
+                   unlike the staging directory outlives the download.
+  """
+  global _streaming_extraction, _keep_streamed_tarballs
+  _streaming_extraction = enabled
+  _keep_streamed_tarballs = keep_tarballs
+
+
 class ArtifactDownloadError(Exception):
   """Error used to signify an issue processing an artifact."""
   pass
@@ -62,7 +88,8 @@ class BuildArtifact(log_util.Loggable):
 
   def Download(self):
     """Stages the artifact from google storage to a local staging directory."""
-    gsutil_util.DownloadFromGS(self._gs_path, self._tmp_stage_path)
+    download_engine.GetDownloadEngine().Download(self._gs_path,
+                                                 self._tmp_stage_path)
 
   def Synchronous(self):
     """Returns False if this artifact can be downloaded in the background."""
@@ -93,21 +120,44 @@ class AUTestPayloadBuildArtifact(BuildArtifact):
 class TarballBuildArtifact(BuildArtifact):
   """Wrapper around an artifact to download from gsutil which is a tarball."""
 
-  def _ExtractTarball(self, exclude=None):
-    """Detects whether the tarball is compressed or not based on the file
-    extension and extracts the tarball into the install_path with optional
-    exclude path."""
+  # Path excluded from extraction, and members extracted (all by default).
+  _EXCLUDE = None
+  _MEMBERS = ()
+
+  def __init__(self, *args, **kwargs):
+    super(TarballBuildArtifact, self).__init__(*args, **kwargs)
+    # Whether the tarball was extracted while it was downloaded.
+    self._streamed = False
+
+  def _GetTarCommand(self, tarball, exclude=None):
+    """Returns the command extracting |tarball|, or stdin if '-'.
 
+    Compression is detected based on the file extension; bzip2 tarballs are
+    decompressed by pbzip2, gzip ones by pigz where available.
+    """
     exclude_str = '--exclude=%s' % exclude if exclude else ''
-    tarball = os.path.basename(self._tmp_stage_path)
+    name = os.path.basename(self._gs_path)
 
-    if re.search('.tar.bz2$', tarball):
+    if re.search(r'\.tar\.bz2$', name):
       compress_str = '--use-compress-prog=pbzip2'
+    elif re.search(r'\.(tgz|tar\.gz)$', name):
+      compress_str = '--gzip'
+      if spawn.find_executable('pigz'):
+        compress_str = '--use-compress-prog=pigz'
     else:
       compress_str = ''
 
-    cmd = 'tar xf %s %s %s --directory=%s' % (
-        self._tmp_stage_path, exclude_str, compress_str, self._install_path)
+    return 'tar xf %s %s %s --directory=%s %s' % (
+        tarball, exclude_str, compress_str, self._install_path,
+        ' '.join(self._MEMBERS))
+
+  def _ExtractTarball(self, exclude=None):
+    """Extracts the tarball into the install_path with optional exclude path,
+    unless that happened while it was downloaded."""
+    if self._streamed:
+      return
+
+    cmd = self._GetTarCommand(self._tmp_stage_path, exclude)
     msg = 'An error occurred when attempting to untar %s' % self._tmp_stage_path
 
     try:
@@ -115,6 +165,59 @@ class TarballBuildArtifact(BuildArtifact):
     except subprocess.CalledProcessError, e:
       raise ArtifactDownloadError('%s %s' % (msg, e))
 
+  def _StreamTarball(self):
+    """Pipes the tarball from storage into tar as it is downloaded."""
+    if not os.path.isdir(self._install_path):
+      os.makedirs(self._install_path)
+
+    cmd = self._GetTarCommand('-', self._EXCLUDE)
+    msg = 'An error occurred when attempting to untar %s' % self._gs_path
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+    tarball = None
+    if _keep_streamed_tarballs:
+      # Written under a temporary name, so that incomplete copies are never
+      # mistaken for the tarball.
+      tarball_path = os.path.join(self._install_path,
+                                  os.path.basename(self._gs_path))
+      tarball = open(tarball_path + '.tmp', 'wb')
+
+    def _Write(data):
+      proc.stdin.write(data)
+      if tarball:
+        tarball.write(data)
+
+    pipe_error = None
+    try:
+      download_engine.GetDownloadEngine().Stream(self._gs_path, _Write)
+    except IOError, e:
+      # Most likely tar exited early; its status tells why.
+      pipe_error = e
+    except Exception:
+      proc.kill()
+      if tarball:
+        os.remove(tarball.name)
+      raise
+    finally:
+      proc.stdin.close()
+      if tarball:
+        tarball.close()
+      proc.wait()
+    if proc.returncode or pipe_error:
+      if tarball:
+        os.remove(tarball.name)
+      raise ArtifactDownloadError('%s: tar exited with %d (%s)' % (
+          msg, proc.returncode, pipe_error))
+    if tarball:
+      os.rename(tarball.name, tarball_path)
+    self._streamed = True
+
+  def Download(self):
+    """Downloads the tarball, or extracts it on the fly if streaming."""
+    if _streaming_extraction:
+      self._StreamTarball()
+    else:
+      super(TarballBuildArtifact, self).Download()
+
   def Stage(self):
     """Changes directory into the install path and untars the tarball."""
     if not os.path.isdir(self._install_path):
@@ -126,13 +229,15 @@ class TarballBuildArtifact(BuildArtifact):
 class AutotestTarballBuildArtifact(TarballBuildArtifact):
   """Wrapper around the autotest tarball to download from gsutil."""
 
+  _EXCLUDE = 'autotest/test_suites'
+
   def Stage(self):
     """Untars the autotest tarball into the install path excluding test suites.
     """
     if not os.path.isdir(self._install_path):
       os.makedirs(self._install_path)
 
-    self._ExtractTarball(exclude='autotest/test_suites')
+    self._ExtractTarball(exclude=self._EXCLUDE)
     autotest_dir = os.path.join(self._install_path, 'autotest')
     autotest_pkgs_dir = os.path.join(autotest_dir, 'packages')
     if not os.path.exists(autotest_pkgs_dir):
@@ -155,19 +260,27 @@ class AutotestTarballBuildArtifact(TarballBuildArtifact):
     cmd = 'cp %s/* %s' % (autotest_pkgs_dir, autotest_dir)
     subprocess.check_call(cmd, shell=True)
 
+    # The tree is complete, including any test suites staged before it.
+    control_file_index.WriteManifest(self._install_path)
+
 
 class DebugTarballBuildArtifact(TarballBuildArtifact):
   """Wrapper around the debug symbols tarball to download from gsutil."""
 
-  def _ExtractTarball(self, _exclude=None):
-    """Extracts debug/breakpad from the tarball into the install_path."""
-    cmd = 'tar xzf %s --directory=%s debug/breakpad' % (
-        self._tmp_stage_path, self._install_path)
-    msg = 'An error occurred when attempting to untar %s' % self._tmp_stage_path
-    try:
-      subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError, e:
-      raise ArtifactDownloadError('%s %s' % (msg, e))
+  # Only the breakpad symbols are extracted.
+  _MEMBERS = ('debug/breakpad',)
+
+
+class SymbolTarballBuildArtifact(BuildArtifact):
+  """Wrapper around the debug symbols tarball, staged as a symbol pack.
+
+  Breakpad symbols are extracted from the pack as minidumps need them, see
+  symbol_store.
+  """
+
+  def Stage(self):
+    """Repacks the breakpad symbols of the tarball to the install path."""
+    symbol_store.WritePack(self._tmp_stage_path, self._install_path)
 
 
 class ZipfileBuildArtifact(BuildArtifact):
@@ -175,7 +288,9 @@ class ZipfileBuildArtifact(BuildArtifact):
 
   This class defines an extra public method for setting the list of files to be
   extracted upon staging. Staging amounts to unzipping the desired files to the
-  install path.
+  install path. Where the storage backend supports ranged reads, the desired
+  files are extracted straight from storage instead, without downloading the
+  rest of the zipfile.
 
   """
 
@@ -184,9 +299,30 @@ class ZipfileBuildArtifact(BuildArtifact):
     super(ZipfileBuildArtifact, self).__init__(
         gs_path, tmp_staging_dir, install_path, synchronous)
     self._unzip_file_list = unzip_file_list
+    # Whether the files were extracted from storage when downloading.
+    self._extracted = False
+
+  def Download(self):
+    """Extracts the desired files from storage, or downloads the zipfile."""
+    size = gsutil_util.GetStorageBackend().GetSize(self._gs_path)
+    if size is None:
+      super(ZipfileBuildArtifact, self).Download()
+      return
+
+    if not os.path.isdir(self._install_path):
+      os.makedirs(self._install_path)
+    try:
+      remote_zip.RemoteZipFile(self._gs_path, size).Extract(
+          self._install_path, self._unzip_file_list)
+    except remote_zip.RemoteZipError, e:
+      raise ArtifactDownloadError('Failed to extract from %s: %s' % (
+          self._gs_path, e))
+    self._extracted = True
 
   def _Unzip(self):
-    """Unzip files into the install path."""
+    """Unzip files into the install path, unless extracted when downloading."""
+    if self._extracted:
+      return
 
     cmd = 'unzip -o %s -d %s%s' % (
         self._tmp_stage_path,
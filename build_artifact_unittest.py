@@ -14,12 +14,15 @@ run these unittests from within the chroot.  The tools are self-explanatory.
 import os
 import shutil
 import subprocess
+import tarfile
 import tempfile
 import unittest
+import zipfile
 
 import mox
 
 import build_artifact
+import gsutil_util
 
 
 _TEST_GOLO_ARCHIVE = (
@@ -105,5 +108,86 @@ class BuildArtifactTest(mox.MoxTestBase):
         self.work_dir, 'install', 'payload', build_artifact.TEST_IMAGE)))
 
 
+class StreamingExtractionTest(unittest.TestCase):
+  """Tests extraction of tarballs while they are downloaded, from local files.
+  """
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp('build_artifact')
+    build_dir = os.path.join(self.work_dir, 'gs', 'bucket', 'build')
+    os.makedirs(build_dir)
+    os.makedirs(os.path.join(self.work_dir, 'content', 'debug', 'breakpad'))
+    for name in ('debug/breakpad/symbols.sym', 'debug/unwanted.debug'):
+      path = os.path.join(self.work_dir, 'content', name)
+      with open(path, 'w') as f:
+        f.write(name)
+    tarball = tarfile.open(os.path.join(build_dir, 'debug.tgz'), 'w:gz')
+    tarball.add(os.path.join(self.work_dir, 'content', 'debug'), 'debug')
+    tarball.close()
+    gsutil_util.SetStorageBackend(
+        gsutil_util.LocalBackend(os.path.join(self.work_dir, 'gs')))
+    build_artifact.SetStreamingExtraction(True, keep_tarballs=True)
+
+  def tearDown(self):
+    build_artifact.SetStreamingExtraction(False)
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self.work_dir)
+
+  def _CreateArtifact(self, name):
+    return build_artifact.DebugTarballBuildArtifact(
+        'gs://bucket/build/' + name, os.path.join(self.work_dir, 'stage'),
+        os.path.join(self.work_dir, 'install'))
+
+  def testStreamMembers(self):
+    """Tests that only selected members are extracted, while downloading."""
+    artifact = self._CreateArtifact('debug.tgz')
+    artifact.Download()
+    install_dir = os.path.join(self.work_dir, 'install', 'debug')
+    self.assertEqual(os.listdir(install_dir), ['breakpad'])
+    self.assertTrue(os.path.exists(
+        os.path.join(self.work_dir, 'install', 'debug.tgz')))
+    artifact.Stage()
+    self.assertEqual(os.listdir(install_dir), ['breakpad'])
+
+  def testStreamCorruptTarball(self):
+    with open(os.path.join(self.work_dir, 'gs', 'bucket', 'build', 'bad.tgz'),
+              'w') as f:
+      f.write('not a tarball' * 1000)
+    self.assertRaises(build_artifact.ArtifactDownloadError,
+                      self._CreateArtifact('bad.tgz').Download)
+    self.assertEqual(os.listdir(os.path.join(self.work_dir, 'install')), [])
+
+
+class RemoteZipfileTest(unittest.TestCase):
+  """Tests extraction of zipfiles from storage supporting ranged reads."""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp('build_artifact')
+    build_dir = os.path.join(self.work_dir, 'gs', 'bucket', 'build')
+    os.makedirs(build_dir)
+    archive = zipfile.ZipFile(os.path.join(build_dir, 'image.zip'), 'w',
+                              zipfile.ZIP_DEFLATED)
+    archive.writestr('coreos_test_image.bin', 'test image')
+    archive.writestr('coreos_base_image.bin', 'base image')
+    archive.close()
+    gsutil_util.SetStorageBackend(
+        gsutil_util.LocalBackend(os.path.join(self.work_dir, 'gs')))
+
+  def tearDown(self):
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self.work_dir)
+
+  def testExtractFromStorage(self):
+    """Tests that files are extracted without downloading the zipfile."""
+    install_dir = os.path.join(self.work_dir, 'install')
+    artifact = build_artifact.ZipfileBuildArtifact(
+        'gs://bucket/build/image.zip', os.path.join(self.work_dir, 'stage'),
+        install_dir, unzip_file_list=['coreos_test_image.bin'])
+    artifact.Download()
+    artifact.Stage()
+    self.assertEqual(os.listdir(install_dir), ['coreos_test_image.bin'])
+    self.assertEqual(os.listdir(os.path.join(self.work_dir, 'stage')), [])
+
+
 if __name__ == '__main__':
   unittest.main()
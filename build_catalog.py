@@ -0,0 +1,152 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Sorted catalogs of the builds staged for each target.
+
+The builds of a target are kept sorted by version, overall and per milestone,
+so that the latest build is looked up without listing the target directory.
+A catalog is refreshed when a build directory is created or removed by the
+devserver, or when the mtime of the target directory changes, and only the
+builds added or removed since are re-parsed.
+"""
+
+import bisect
+import distutils.version
+import os
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CATALOG', message, *args)
+
+
+# Directory mtimes this close to the time of the last listing may hide later
+# changes on file systems with coarse timestamps, so the directory is listed
+# again once that much time has passed.
+_MTIME_SLACK = 2
+
+
+def GetMilestone(build):
+  """Returns the milestone of |build|, e.g. R17 for R17-1413.0.0-a1-b1346."""
+  return build.split('-', 1)[0].upper()
+
+
+class _TargetCatalog(object):
+  """The builds of a target, sorted overall and per milestone."""
+
+  def __init__(self, target_path):
+    self.target_path = target_path
+    self.stale = True
+    self._mtime = None
+    self._recheck_time = None
+    # Keys (version, build) of the builds, sorted, overall and by milestone.
+    self._keys = {}
+    self._sorted = []
+    self._milestones = {}
+
+  def _Add(self, builds):
+    keys = sorted((distutils.version.LooseVersion(build), build)
+                  for build in builds)
+    self._keys.update((key[1], key) for key in keys)
+    # Merging sorted runs is linear, unlike inserting many keys one by one.
+    self._sorted = sorted(self._sorted + keys)
+    for key in keys:
+      self._milestones.setdefault(GetMilestone(key[1]), []).append(key)
+    for milestone in set(GetMilestone(build) for build in builds):
+      self._milestones[milestone].sort()
+
+  def _Remove(self, build):
+    key = self._keys.pop(build)
+    milestone = GetMilestone(build)
+    for keys in (self._sorted, self._milestones[milestone]):
+      del keys[bisect.bisect_left(keys, key)]
+    if not self._milestones[milestone]:
+      del self._milestones[milestone]
+
+  def Refresh(self):
+    """Brings the catalog up to date, if the target directory changed.
+
+    Returns:
+      Whether the target directory exists.
+    """
+    try:
+      mtime = os.stat(self.target_path).st_mtime
+    except OSError:
+      return False
+    now = time.time()
+    if (not self.stale and mtime == self._mtime and
+        not (self._recheck_time and now >= self._recheck_time)):
+      return True
+
+    self.stale = False
+    self._mtime = mtime
+    self._recheck_time = mtime + _MTIME_SLACK
+    if now >= self._recheck_time:
+      self._recheck_time = None
+    builds = set(os.listdir(self.target_path))
+    added = builds.difference(self._keys)
+    removed = set(self._keys).difference(builds)
+    for build in removed:
+      self._Remove(build)
+    self._Add(added)
+    if added or removed:
+      _Log('Refreshed %s: %d builds added, %d removed', self.target_path,
+           len(added), len(removed))
+    return True
+
+  def GetLatest(self, milestone=None):
+    """Returns the latest build, of |milestone| if given, or None."""
+    if milestone:
+      keys = self._milestones.get(milestone.upper())
+    else:
+      keys = self._sorted
+    return keys[-1][1] if keys else None
+
+
+class BuildCatalog(object):
+  """Catalogs of the builds of the targets served, by target directory."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._catalogs = {}
+
+  def Invalidate(self, target_path):
+    """Notes that builds were added to or removed from |target_path|."""
+    with self._lock:
+      catalog = self._catalogs.get(os.path.normpath(target_path))
+      if catalog:
+        catalog.stale = True
+
+  def GetLatestBuild(self, target_path, milestone=None):
+    """Returns the latest build staged under |target_path|.
+
+    Args:
+      target_path: directory of the builds of a target.
+      milestone: milestone the build must be of, e.g. R16; any by default.
+
+    Returns:
+      The name of the latest build, or None if there is none or
+      |target_path| doesn't exist.
+    """
+    target_path = os.path.normpath(target_path)
+    with self._lock:
+      catalog = self._catalogs.get(target_path)
+      if not catalog:
+        catalog = self._catalogs[target_path] = _TargetCatalog(target_path)
+      if not catalog.Refresh():
+        del self._catalogs[target_path]
+        return None
+      return catalog.GetLatest(milestone)
+
+
+_build_catalog = BuildCatalog()
+
+
+def GetBuildCatalog():
+  """Returns the catalog the builds of all targets are looked up in."""
+  return _build_catalog
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for build_catalog module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import build_catalog
+
+
+class BuildCatalogTest(unittest.TestCase):
+
+  def setUp(self):
+    self._target_path = tempfile.mkdtemp(prefix='build_catalog')
+    self._catalog = build_catalog.BuildCatalog()
+    for build in ('R17-1413.0.0-a1-b1346', 'R17-18.0.0-a1-b1346',
+                  'R16-2241.0.0-a0-b2', 'R160-1.0.0-a0-b1'):
+      os.mkdir(os.path.join(self._target_path, build))
+
+  def tearDown(self):
+    shutil.rmtree(self._target_path)
+
+  def testGetLatestBuild(self):
+    """Tests lookups of the latest build overall and per milestone."""
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path),
+                     'R160-1.0.0-a0-b1')
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path, 'r17'),
+                     'R17-1413.0.0-a1-b1346')
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path, 'R16'),
+                     'R16-2241.0.0-a0-b2')
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path, 'R15'),
+                     None)
+    self.assertEqual(self._catalog.GetLatestBuild(
+        os.path.join(self._target_path, 'missing')), None)
+
+  def testRefresh(self):
+    """Tests that builds added and removed are picked up once invalidated."""
+    self._catalog.GetLatestBuild(self._target_path)
+    shutil.rmtree(os.path.join(self._target_path, 'R160-1.0.0-a0-b1'))
+    os.mkdir(os.path.join(self._target_path, 'R17-1414.0.0-a1-b1347'))
+    self._catalog.Invalidate(self._target_path + '/')
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path),
+                     'R17-1414.0.0-a1-b1347')
+
+    shutil.rmtree(os.path.join(self._target_path, 'R16-2241.0.0-a0-b2'))
+    self._catalog.Invalidate(self._target_path)
+    self.assertEqual(self._catalog.GetLatestBuild(self._target_path, 'R16'),
+                     None)
+
+
+if __name__ == '__main__':
+  unittest.main()
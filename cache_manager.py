@@ -0,0 +1,218 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Size and age aware LRU management of the update payload cache."""
+
+import contextlib
+import os
+import shutil
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CACHE', message, *args)
+
+
+def _GetDirSize(path):
+  """Returns the total size in bytes of the files under |path|."""
+  size = 0
+  for dir_path, _, files in os.walk(path):
+    for file_name in files:
+      try:
+        size += os.lstat(os.path.join(dir_path, file_name)).st_size
+      except OSError:
+        pass
+  return size
+
+
+class CacheManager(object):
+  """Keeps the entries of a cache directory within configurable budgets.
+
+  Each subdirectory of the cache directory is an entry. Entries are ordered
+  by last access, which is recorded in the entry's mtime so that it survives
+  restarts, and evicted least recently used first until the byte, entry count
+  and free space budgets are all met. Entries older than max_age are evicted
+  regardless. Hidden entries (e.g. payloads being generated), pinned entries
+  and entries accessed within the last min_age seconds are never evicted.
+  """
+
+  def __init__(self, cache_dir, max_bytes=None, max_entries=None,
+               min_free_bytes=None, max_age=None, min_age=60, interval=300):
+    """Args:
+      cache_dir: the directory holding the cache entries.
+      max_bytes: maximum total size of the cache entries, None for no limit.
+      max_entries: maximum number of cache entries, None for no limit.
+      min_free_bytes: free space to maintain on the cache file system, None
+                      for no limit.
+      max_age: seconds after their last access entries are evicted, None for
+               no limit.
+      min_age: seconds after their last access entries become evictable.
+      interval: seconds between background eviction runs.
+    """
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.min_free_bytes = min_free_bytes
+    self.max_age = max_age
+    self.min_age = min_age
+    self.interval = interval
+    self._lock = threading.Lock()
+    self._evict_lock = threading.Lock()
+    # Pin counts, keyed by entry name.
+    self._pins = {}
+    # Sizes of entries, keyed by name; entries do not change once published.
+    self._sizes = {}
+    self._thread = None
+    self.evicted_entries = 0
+    self.evicted_bytes = 0
+    self.last_run = None
+
+  def _GetEntryName(self, path):
+    """Returns the entry name of |path| if it is in the cache, else None."""
+    path = os.path.abspath(path)
+    if os.path.dirname(path.rstrip('/')) != os.path.abspath(self.cache_dir):
+      return None
+    return os.path.basename(path.rstrip('/'))
+
+  def Touch(self, path):
+    """Records an access to the cache entry at |path|."""
+    if self._GetEntryName(path) is None:
+      return
+    try:
+      os.utime(path, None)
+    except OSError as e:
+      _Log('Failed to touch cache entry %s: %s', path, e)
+
+  def Pin(self, path):
+    """Protects the cache entry at |path| from eviction until unpinned."""
+    name = self._GetEntryName(path)
+    if name is not None:
+      with self._lock:
+        self._pins[name] = self._pins.get(name, 0) + 1
+
+  def Unpin(self, path):
+    """Releases a pin taken with Pin()."""
+    name = self._GetEntryName(path)
+    if name is not None:
+      with self._lock:
+        self._pins[name] -= 1
+        if not self._pins[name]:
+          del self._pins[name]
+
+  @contextlib.contextmanager
+  def Pinned(self, path):
+    """Context manager pinning the cache entry at |path|."""
+    self.Pin(path)
+    try:
+      yield
+    finally:
+      self.Unpin(path)
+
+  def _ListEntries(self):
+    """Returns a list of (last access, name, size) tuples, oldest first."""
+    entries = []
+    for name in os.listdir(self.cache_dir):
+      path = os.path.join(self.cache_dir, name)
+      if name.startswith('.') or not os.path.isdir(path):
+        continue
+      try:
+        mtime = os.stat(path).st_mtime
+      except OSError:
+        continue
+      if name not in self._sizes:
+        self._sizes[name] = _GetDirSize(path)
+      entries.append((mtime, name, self._sizes[name]))
+    return sorted(entries)
+
+  def _GetFreeBytes(self):
+    stat = os.statvfs(self.cache_dir)
+    return stat.f_bavail * stat.f_frsize
+
+  def _IsOverBudget(self, entry_count, total_bytes, freed_bytes, age):
+    """Returns whether an entry of the given age should be evicted."""
+    return ((self.max_entries is not None and
+             entry_count > self.max_entries) or
+            (self.max_bytes is not None and total_bytes > self.max_bytes) or
+            (self.min_free_bytes is not None and
+             self._GetFreeBytes() + freed_bytes < self.min_free_bytes) or
+            (self.max_age is not None and age > self.max_age))
+
+  def Evict(self):
+    """Evicts entries until the cache is within its budgets.
+
+    Returns:
+      A list of the names of evicted entries.
+    """
+    evicted = []
+    with self._evict_lock:
+      if not os.path.isdir(self.cache_dir):
+        return evicted
+      now = time.time()
+      entries = self._ListEntries()
+      total_bytes = sum(size for _, _, size in entries)
+      freed_bytes = 0
+      for mtime, name, size in entries:
+        if not self._IsOverBudget(len(entries) - len(evicted), total_bytes,
+                                  freed_bytes, now - mtime):
+          break
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+          if name in self._pins or now - mtime < self.min_age:
+            continue
+          # Take the entry out of the cache namespace while holding the lock,
+          # so that it cannot be pinned while half removed.
+          doomed_path = os.path.join(self.cache_dir, '.evict-' + name)
+          try:
+            os.rename(path, doomed_path)
+          except OSError as e:
+            _Log('Failed to evict %s: %s', path, e)
+            continue
+        shutil.rmtree(doomed_path, ignore_errors=True)
+        self._sizes.pop(name, None)
+        total_bytes -= size
+        freed_bytes += size
+        evicted.append(name)
+        self.evicted_entries += 1
+        self.evicted_bytes += size
+        _Log('Evicted cache entry %s (%d bytes)', name, size)
+      self.last_run = now
+    return evicted
+
+  def _EvictionLoop(self):
+    """Runs Evict() every interval seconds, forever."""
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.Evict()
+      except Exception as e:
+        _Log('Cache eviction failed: %s', e)
+
+  def Start(self):
+    """Starts evicting entries in the background."""
+    if not self._thread:
+      self._thread = threading.Thread(target=self._EvictionLoop)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def GetStats(self):
+    """Returns a dictionary of cache statistics and budgets."""
+    with self._evict_lock:
+      entries = self._ListEntries() if os.path.isdir(self.cache_dir) else []
+    with self._lock:
+      pinned = len(self._pins)
+    return {'entries': len(entries),
+            'bytes': sum(size for _, _, size in entries),
+            'free_bytes': self._GetFreeBytes(),
+            'pinned': pinned,
+            'evicted_entries': self.evicted_entries,
+            'evicted_bytes': self.evicted_bytes,
+            'last_run': self.last_run,
+            'max_bytes': self.max_bytes,
+            'max_entries': self.max_entries,
+            'min_free_bytes': self.min_free_bytes,
+            'max_age': self.max_age}
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for cache_manager module."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import cache_manager
+
+
+class CacheManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._cache_dir = tempfile.mkdtemp('cache_manager_unittest')
+
+  def tearDown(self):
+    shutil.rmtree(self._cache_dir)
+
+  def _AddEntry(self, name, size, age):
+    """Creates a cache entry of |size| bytes last accessed |age| seconds ago."""
+    path = os.path.join(self._cache_dir, name)
+    os.mkdir(path)
+    with open(os.path.join(path, 'update.gz'), 'w') as f:
+      f.write('x' * size)
+    access_time = time.time() - age
+    os.utime(path, (access_time, access_time))
+    return path
+
+  def testEvictByEntryCount(self):
+    """Tests that least recently used entries are evicted first."""
+    for i in range(4):
+      self._AddEntry('entry%d' % i, 10, 1000 - i)
+    manager = cache_manager.CacheManager(self._cache_dir, max_entries=2)
+    self.assertEqual(manager.Evict(), ['entry0', 'entry1'])
+    self.assertEqual(sorted(os.listdir(self._cache_dir)), ['entry2', 'entry3'])
+
+  def testEvictByBytes(self):
+    """Tests that entries are evicted until the byte budget is met."""
+    self._AddEntry('old', 100, 3000)
+    self._AddEntry('mid', 100, 2000)
+    self._AddEntry('new', 100, 1000)
+    manager = cache_manager.CacheManager(self._cache_dir, max_bytes=150)
+    self.assertEqual(manager.Evict(), ['old', 'mid'])
+    stats = manager.GetStats()
+    self.assertEqual((stats['entries'], stats['bytes']), (1, 100))
+    self.assertEqual(stats['evicted_bytes'], 200)
+
+  def testEvictByAge(self):
+    """Tests that entries past max_age are evicted regardless of budgets."""
+    self._AddEntry('old', 10, 3000)
+    self._AddEntry('new', 10, 100)
+    manager = cache_manager.CacheManager(self._cache_dir, max_age=1000)
+    self.assertEqual(manager.Evict(), ['old'])
+
+  def testPinnedAndRecentEntries(self):
+    """Tests that pinned, recently used and hidden entries are kept."""
+    pinned = self._AddEntry('pinned', 10, 3000)
+    self._AddEntry('unpinned', 10, 2000)
+    recent = self._AddEntry('recent', 10, 1000)
+    self._AddEntry('.tmp-generating', 10, 5000)
+    manager = cache_manager.CacheManager(self._cache_dir, max_entries=0,
+                                         min_age=60)
+    manager.Touch(recent)
+    with manager.Pinned(pinned):
+      self.assertEqual(manager.Evict(), ['unpinned'])
+    self.assertEqual(manager.Evict(), ['pinned'])
+    self.assertEqual(sorted(os.listdir(self._cache_dir)),
+                     ['.tmp-generating', 'recent'])
+
+
+if __name__ == '__main__':
+  unittest.main()
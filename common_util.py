@@ -4,22 +4,30 @@
 
 """Helper class for interacting with the Dev Server."""
 
+import Queue
 import base64
 import binascii
-import distutils.version
 import errno
+import fnmatch
 import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
-import random
-import re
 import shutil
+import tarfile
+import threading
 import time
 
 import lockfile
 
+import availability_watcher
 import build_artifact
+import build_catalog
+import control_file_index
 import gsutil_util
 import log_util
+import symbol_store
+import uploaded_manifest
 
 
 # Module-local log function.
@@ -30,10 +38,16 @@ def _Log(message, *args):
 AU_BASE = 'au'
 NTON_DIR_SUFFIX = '_nton'
 MTON_DIR_SUFFIX = '_mton'
-UPLOADED_LIST = 'UPLOADED'
+UPLOADED_LIST = availability_watcher.MANIFEST_NAME
 DEVSERVER_LOCK_FILE = 'devserver'
 
-_HASH_BLOCK_SIZE = 8192
+# Files are hashed in large blocks, read into a small set of reused buffers.
+_HASH_BLOCK_SIZE = 1024 * 1024
+_HASH_BUFFER_COUNT = 3
+# Number of files hashed concurrently by GetFilesHashes().
+_HASH_BATCH_WORKERS = 4
+# Maximum number of control files read concurrently for one request.
+_CONTROL_FILE_READ_WORKERS = 8
 
 
 def CommaSeparatedList(value_list, is_quoted=False):
@@ -71,23 +85,25 @@ def ParsePayloadList(archive_url, payload_list):
   Raises:
     CommonUtilError: If full payload is missing or invalid.
   """
+  classes = uploaded_manifest.GetManifest(payload_list).Classify()
   full_payload_url = None
   mton_payload_url = None
   nton_payload_url = None
   firmware_payload_url = None
 
-  for payload in payload_list:
-    if '_full_' in payload:
-      full_payload_url = '/'.join([archive_url, payload])
-    elif '_delta_' in payload:
-      # e.g. chromeos_{from_version}_{to_version}_x86-generic_delta_dev.bin
-      from_version, to_version = payload.split('_')[1:3]
-      if from_version == to_version:
-        nton_payload_url = '/'.join([archive_url, payload])
-      else:
-        mton_payload_url = '/'.join([archive_url, payload])
-    elif build_artifact.FIRMWARE_ARCHIVE in payload:
-      firmware_payload_url = '/'.join([archive_url, payload])
+  if classes[uploaded_manifest.FULL]:
+    full_payload_url = '/'.join([archive_url,
+                                 classes[uploaded_manifest.FULL][-1]])
+  for payload in classes[uploaded_manifest.DELTA]:
+    # e.g. chromeos_{from_version}_{to_version}_x86-generic_delta_dev.bin
+    from_version, to_version = payload.split('_')[1:3]
+    if from_version == to_version:
+      nton_payload_url = '/'.join([archive_url, payload])
+    else:
+      mton_payload_url = '/'.join([archive_url, payload])
+  if classes[uploaded_manifest.FIRMWARE]:
+    firmware_payload_url = '/'.join([archive_url,
+                                     classes[uploaded_manifest.FIRMWARE][-1]])
 
   if not full_payload_url:
     raise CommonUtilError(
@@ -101,8 +117,7 @@ def IsAvailable(pattern_list, uploaded_list):
   """Checks whether the target artifacts we wait for are available.
 
   This method searches the uploaded_list for a match for every pattern
-  in the pattern_list. It aborts and returns false if no filename
-  matches a given pattern.
+  in the pattern_list, with a single scan of the whole list per pattern.
 
   Args:
     pattern_list: List of regular expression patterns to identify
@@ -113,21 +128,7 @@ def IsAvailable(pattern_list, uploaded_list):
     True if there is a match for every pattern; false otherwise.
   """
 
-  # Pre-compile the regular expression patterns
-  compiled_patterns = []
-  for p in pattern_list:
-    compiled_patterns.append(re.compile(p))
-
-  for pattern in compiled_patterns:
-    found = False
-    for filename in uploaded_list:
-      if re.search(pattern, filename):
-        found = True
-        break
-    if not found:
-      return False
-
-  return True
+  return uploaded_manifest.IsAvailable(pattern_list, uploaded_list)
 
 
 def WaitUntilAvailable(to_wait_list, archive_url, err_str, timeout=600,
@@ -135,8 +136,9 @@ def WaitUntilAvailable(to_wait_list, archive_url, err_str, timeout=600,
   """Waits until all target artifacts are available in Google Storage or
   until the request times out.
 
-  This method polls Google Storage until all target artifacts are
-  available or until the timeout occurs. Because we may not know the
+  This method waits until all target artifacts are available in Google
+  Storage, as polled by the availability watcher shared by all requests, or
+  until the timeout occurs. Because we may not know the
   exact name of the target artifacts, the method accepts to_wait_list, a
   list of filename patterns, to identify whether an artifact whose name
   matches the pattern exists (e.g. use pattern '_full_' to search for
@@ -147,40 +149,23 @@ def WaitUntilAvailable(to_wait_list, archive_url, err_str, timeout=600,
         the target artifacts.
     archive_url: URL of the Google Storage bucket.
     err_str: String to display in the error message.
+    timeout: Maximum number of seconds to wait.
+    delay: Maximum number of seconds between polls of Google Storage.
 
   Returns:
     The list of artifacts in the Google Storage bucket.
 
   Raises:
     CommonUtilError: If timeout occurs.
+    gsutil_util.GSUtilError: If Google Storage could not be polled.
   """
-
-  cmd = 'gsutil cat %s/%s' % (archive_url, UPLOADED_LIST)
-  msg = 'Failed to get a list of uploaded files.'
-
-  deadline = time.time() + timeout
-  while time.time() < deadline:
-    uploaded_list = []
-    to_delay = delay + random.uniform(.5 * delay, 1.5 * delay)
-    try:
-      # Run "gsutil cat" to retrieve the list.
-      uploaded_list = gsutil_util.GSUtilRun(cmd, msg).splitlines()
-    except gsutil_util.GSUtilError:
-      # For backward compatibility, fallling back to use "gsutil ls"
-      # when the manifest file is not present.
-      cmd = 'gsutil ls %s/*' % archive_url
-      msg = 'Failed to list payloads.'
-      payload_list = gsutil_util.GSUtilRun(cmd, msg).splitlines()
-      for payload in payload_list:
-        uploaded_list.append(payload.rsplit('/', 1)[1])
-
-    # Check if all target artifacts are available.
-    if IsAvailable(to_wait_list, uploaded_list):
-      return uploaded_list
-    _Log('Retrying in %f seconds...%s' % (to_delay, err_str))
-    time.sleep(to_delay)
-
-  raise CommonUtilError('Missing %s for %s.' % (err_str, archive_url))
+  _Log('Waiting for %s of %s', err_str, archive_url)
+  uploaded_list = availability_watcher.GetAvailabilityWatcher().Wait(
+      archive_url, lambda uploaded: IsAvailable(to_wait_list, uploaded),
+      timeout, max_delay=delay)
+  if uploaded_list is None:
+    raise CommonUtilError('Missing %s for %s.' % (err_str, archive_url))
+  return uploaded_list
 
 
 def GatherArtifactDownloads(main_staging_dir, archive_url, build_dir, build,
@@ -233,7 +218,9 @@ def GatherArtifactDownloads(main_staging_dir, archive_url, build_dir, build,
         fw_url, main_staging_dir, build_dir))
 
   # Gather information about autotest tarballs. Use autotest.tar if available.
-  if build_artifact.AUTOTEST_PACKAGE in uploaded_list:
+  autotest_packages = uploaded_manifest.GetManifest(uploaded_list).Classify()[
+      uploaded_manifest.AUTOTEST]
+  if build_artifact.AUTOTEST_PACKAGE in autotest_packages:
     autotest_url = '%s/%s' % (archive_url, build_artifact.AUTOTEST_PACKAGE)
   else:
     # Use autotest.tar.bz for backward compatibility. This can be
@@ -273,7 +260,7 @@ def GatherSymbolArtifactDownloads(temp_download_dir, archive_url, staging_dir,
                       symbols for the desired build are stored.
   @param staging_dir: the dir into which to stage the symbols
 
-  @return an iterable of one DebugTarballBuildArtifact pointing to the right
+  @return an iterable of one SymbolTarballBuildArtifact pointing to the right
           debug symbols.  This is an iterable so that it's similar to
           GatherArtifactDownloads.  Also, it's possible that someday we might
           have more than one.
@@ -282,10 +269,11 @@ def GatherSymbolArtifactDownloads(temp_download_dir, archive_url, staging_dir,
   artifact_name = build_artifact.DEBUG_SYMBOLS
   WaitUntilAvailable([artifact_name], archive_url, 'debug symbols',
                      timeout=timeout, delay=delay)
-  artifact = build_artifact.DebugTarballBuildArtifact(
+  artifact = build_artifact.SymbolTarballBuildArtifact(
       archive_url + '/' + artifact_name,
       temp_download_dir,
-      staging_dir)
+      os.path.join(staging_dir, symbol_store.PACK_DIR,
+                   symbol_store.GetPackName(archive_url)))
   return [artifact]
 
 
@@ -349,6 +337,12 @@ def SafeSandboxAccess(static_dir, path):
   return (path.startswith(static_dir) and path != static_dir)
 
 
+def _IsStaged(build_dir):
+  """Returns whether |build_dir| is no longer locked for staging."""
+  return not lockfile.FileLock(
+      os.path.join(build_dir, DEVSERVER_LOCK_FILE)).is_locked()
+
+
 def AcquireLock(static_dir, tag, create_once=True):
   """Acquires a lock for a given tag.
 
@@ -377,6 +371,7 @@ def AcquireLock(static_dir, tag, create_once=True):
   try:
     os.makedirs(build_dir)
     is_created = True
+    build_catalog.GetBuildCatalog().Invalidate(os.path.dirname(build_dir))
   except OSError, e:
     if e.errno == errno.EEXIST:
       if create_once:
@@ -395,6 +390,7 @@ def AcquireLock(static_dir, tag, create_once=True):
     # that subsequent attempts won't fail to re-create it.
     if is_created:
       shutil.rmtree(build_dir)
+      build_catalog.GetBuildCatalog().Invalidate(os.path.dirname(build_dir))
     raise
 
   return build_dir
@@ -423,6 +419,7 @@ def ReleaseLock(static_dir, tag, destroy=False):
     lock.break_lock()
     if destroy:
       shutil.rmtree(build_dir)
+      build_catalog.GetBuildCatalog().Invalidate(os.path.dirname(build_dir))
   except Exception, e:
     raise CommonUtilError(str(e))
 
@@ -435,7 +432,8 @@ def GetLatestBuildVersion(static_dir, target, milestone=None):
     target: The build target, typically a combination of the board and the
         type of build e.g. x86-mario-release.
     milestone: For latest build set to None, for builds only in a specific
-        milestone set to a str of format Rxx (e.g. R16). Default: None.
+        milestone set to a str of format Rxx (e.g. R16), which builds
+        start with. Default: None.
 
   Returns:
     If latest found, a full build string is returned e.g. R17-1234.0.0-a1-b983.
@@ -450,21 +448,16 @@ def GetLatestBuildVersion(static_dir, target, milestone=None):
   if not os.path.isdir(target_path):
     raise CommonUtilError('Cannot find path %s' % target_path)
 
-  builds = [distutils.version.LooseVersion(build) for build in
-            os.listdir(target_path)]
-
-  if milestone and builds:
-    # Check if milestone Rxx is in the string representation of the build.
-    builds = filter(lambda x: milestone.upper() in str(x), builds)
-
-  if not builds:
+  build = build_catalog.GetBuildCatalog().GetLatestBuild(target_path,
+                                                         milestone)
+  if not build:
     raise CommonUtilError('Could not determine build for %s' % target)
 
-  return str(max(builds))
+  return build
 
 
-def GetControlFile(static_dir, build, control_path):
-  """Attempts to pull the requested control file from the Dev Server.
+def _ReadControlFile(static_dir, build, control_path):
+  """Returns the contents of a file of the autotest tree of a build.
 
   Args:
     static_dir: Directory where builds are served from.
@@ -472,33 +465,160 @@ def GetControlFile(static_dir, build, control_path):
     control_path: Path to control file on Dev Server relative to Autotest root.
 
   Raises:
-    CommonUtilError: If lock can't be acquired.
+    CommonUtilError: If the path is outside of the sandbox.
 
   Returns:
-    Content of the requested control file.
+    The contents of the file, or None if it doesn't exist.
   """
   # Be forgiving if the user passes in the control_path with a leading /
   control_path = control_path.lstrip('/')
+  normalized_build = os.path.normpath(build)
+  if not (os.path.isabs(normalized_build) or
+          normalized_build.split(os.sep)[0] == os.pardir):
+    # Control files of staged builds are served from the index, without
+    # resolving their path again; build directories are only staged once
+    # AcquireLock checked they are in the sandbox.
+    build_dir = os.path.join(static_dir, normalized_build)
+    contents = control_file_index.GetControlFileIndex().GetContents(
+        build_dir, control_path, is_staged=lambda: _IsStaged(build_dir))
+    if contents is not None:
+      return contents
+
   control_path = os.path.join(static_dir, build, 'autotest',
                               control_path)
   if not SafeSandboxAccess(static_dir, control_path):
     raise CommonUtilError('Invalid control file "%s".' % control_path)
 
   if not os.path.exists(control_path):
-    # TODO(scottz): Come up with some sort of error mechanism.
-    # crosbug.com/25040
-    return 'Unknown control path %s' % control_path
+    return None
 
   with open(control_path, 'r') as control_file:
     return control_file.read()
 
 
-def GetControlFileList(static_dir, build):
+def GetControlFile(static_dir, build, control_path):
+  """Attempts to pull the requested control file from the Dev Server.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    control_path: Path to control file on Dev Server relative to Autotest root.
+
+  Raises:
+    CommonUtilError: If lock can't be acquired.
+
+  Returns:
+    Content of the requested control file.
+  """
+  contents = _ReadControlFile(static_dir, build, control_path)
+  if contents is None:
+    # TODO(scottz): Come up with some sort of error mechanism.
+    # crosbug.com/25040
+    return 'Unknown control path %s' % os.path.join(
+        static_dir, build, 'autotest', control_path.lstrip('/'))
+  return contents
+
+
+def _TarMember(name, data, mtime):
+  """Returns |data| framed as a member of an uncompressed tarball."""
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  info.mtime = mtime
+  info.mode = 0644
+  return [info.tobuf(tarfile.GNU_FORMAT), data,
+          '\0' * (-len(data) % tarfile.BLOCKSIZE)]
+
+
+def GetControlFileTarball(static_dir, build, control_paths=(), pattern=None,
+                          workers=_CONTROL_FILE_READ_WORKERS):
+  """Returns many control files of a build at once, as a tarball.
+
+  The control files are read concurrently, through the control file index,
+  before any of the tarball is returned.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    control_paths: Paths to control files relative to Autotest root.
+    pattern: Shell pattern matching the paths of further control files to
+        return; e.g. client/site_tests/*/control.
+    workers: Maximum number of control files read concurrently.
+
+  Raises:
+    CommonUtilError: If a path is outside of the sandbox, or a control file
+        or the build doesn't exist.
+
+  Returns:
+    A list of strings, which concatenated are an uncompressed tarball of the
+    control files, named after their path.
+  """
+  control_paths = [path.lstrip('/') for path in control_paths]
+  if pattern:
+    control_list = GetControlFileList(static_dir, build)
+    if not os.path.isdir(os.path.join(static_dir, build, 'autotest')):
+      raise CommonUtilError(control_list)
+    requested = set(control_paths)
+    control_paths.extend(path for path in control_list.splitlines()
+                         if fnmatch.fnmatchcase(path, pattern) and
+                         path not in requested)
+  if not control_paths:
+    return []
+
+  # Plain threads rather than a ThreadPool, whose shutdown takes a tenth of a
+  # second, more than reading hundreds of cached control files.
+  contents = [None] * len(control_paths)
+  indexes = Queue.Queue()
+  for index in range(len(control_paths)):
+    indexes.put(index)
+  errors = []
+
+  def _Read():
+    while True:
+      try:
+        index = indexes.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        contents[index] = _ReadControlFile(static_dir, build,
+                                           control_paths[index])
+      except Exception as e:
+        errors.append(e)
+
+  threads = [threading.Thread(target=_Read)
+             for _ in range(min(workers, len(control_paths)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+  missing = [path for path, data in zip(control_paths, contents)
+             if data is None]
+  if missing:
+    raise CommonUtilError('Unknown control paths %s of %s.' % (
+        ', '.join(missing), build))
+
+  mtime = int(time.time())
+  chunks = []
+  for path, data in zip(control_paths, contents):
+    chunks.extend(_TarMember(path, data, mtime))
+  chunks.append('\0' * (2 * tarfile.BLOCKSIZE))
+  return chunks
+
+
+def GetControlFileList(static_dir, build, prefix=None, suite=None):
   """List all control|control. files in the specified board/build path.
 
+  The list is read from the manifest of the control files of the build, which
+  is written when its autotest tree is staged. The tree is walked instead
+  while the build is still being staged.
+
   Args:
     static_dir: Directory where builds are served from.
     build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    prefix: Only list the control files whose path starts with this prefix;
+        e.g. server/site_tests/.
+    suite: Only list the control files that declare this suite; e.g. bvt.
 
   Raises:
     CommonUtilError: If path is outside of sandbox.
@@ -510,33 +630,157 @@ def GetControlFileList(static_dir, build):
   if not SafeSandboxAccess(static_dir, autotest_dir):
     raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
 
-  control_files = set()
   if not os.path.exists(autotest_dir):
     # TODO(scottz): Come up with some sort of error mechanism.
     # crosbug.com/25040
     return 'Unknown build path %s' % autotest_dir
 
-  for entry in os.walk(autotest_dir):
-    dir_path, _, files = entry
-    for file_entry in files:
-      if file_entry.startswith('control.') or file_entry == 'control':
-        control_files.add(os.path.join(dir_path,
-                                       file_entry).replace(autotest_dir, ''))
+  build_dir = os.path.join(static_dir, os.path.normpath(build))
+  control_files = control_file_index.GetControlFileIndex().GetControlFiles(
+      build_dir, prefix=prefix, suite=suite,
+      is_staged=lambda: _IsStaged(build_dir))
+  if control_files is None:
+    control_files = []
+    for dir_path, _, files in os.walk(autotest_dir):
+      for file_entry in files:
+        if control_file_index.IsControlFile(file_entry):
+          path = os.path.relpath(os.path.join(dir_path, file_entry),
+                                 autotest_dir)
+          if path.startswith(prefix or ''):
+            control_files.append(path)
+    if suite:
+      control_files = [path for path in control_files if suite in
+                       control_file_index.ReadEntry(
+                           os.path.join(autotest_dir, path))['suites']]
+    control_files.sort()
 
   return '\n'.join(control_files)
 
 
+def GetSuiteControlFiles(static_dir, build, suite):
+  """Returns the metadata of the control files of a suite, in one go.
+
+  Args:
+    static_dir: Directory where builds are served from.
+    build: Fully qualified build string; e.g. R17-1234.0.0-a1-b983.
+    suite: Name of the suite; e.g. bvt.
+
+  Raises:
+    CommonUtilError: If path is outside of sandbox, or the build has no
+        autotest tree.
+
+  Returns:
+    A dictionary with the suite name under 'suite', the path of the control
+    file of the suite itself, if staged, under 'suite_control_file', and a
+    dictionary mapping the path of each control file declaring the suite to
+    its 'suites', 'dependencies' and 'time' under 'control_files'. Paths are
+    relative to the autotest tree.
+  """
+  autotest_dir = os.path.join(static_dir, build, 'autotest/')
+  if not SafeSandboxAccess(static_dir, autotest_dir):
+    raise CommonUtilError('Autotest dir not in sandbox "%s".' % autotest_dir)
+  if not os.path.exists(autotest_dir):
+    raise CommonUtilError('Unknown build path %s' % autotest_dir)
+
+  build_dir = os.path.join(static_dir, os.path.normpath(build))
+  entries = control_file_index.GetControlFileIndex().GetEntries(
+      build_dir, suite, is_staged=lambda: _IsStaged(build_dir))
+  if entries is None:
+    # The build is being staged; parse its control files as they are now.
+    entries = {}
+    for path in GetControlFileList(static_dir, build,
+                                   suite=suite).splitlines():
+      entries[path] = control_file_index.ReadEntry(
+          os.path.join(autotest_dir, path))
+
+  suite_control_file = os.path.join('test_suites', 'control.' + suite)
+  if os.sep in suite or not os.path.exists(os.path.join(autotest_dir,
+                                                      suite_control_file)):
+    suite_control_file = None
+  return {'suite': suite,
+          'suite_control_file': suite_control_file,
+          'control_files': entries}
+
+
 def GetFileSize(file_path):
   """Returns the size in bytes of the file given."""
   return os.path.getsize(file_path)
 
 
+class _HasherThread(threading.Thread):
+  """Feeds file blocks to a single hasher.
+
+  Hashlib releases the GIL while digesting large blocks, so one such thread per
+  requested digest lets a single pass over a file use several cores.
+  """
+
+  def __init__(self, hasher, done_queue):
+    super(_HasherThread, self).__init__()
+    self.daemon = True
+    self.hasher = hasher
+    self.block_queue = Queue.Queue()
+    self._done_queue = done_queue
+
+  def run(self):
+    while True:
+      item = self.block_queue.get()
+      if item is None:
+        break
+      buffer_index, block = item
+      self.hasher.update(block)
+      self._done_queue.put(buffer_index)
+
+
+def _HashStream(fd, hashers):
+  """Updates all |hashers| with the content of |fd| in a single pass."""
+  buffers = [bytearray(_HASH_BLOCK_SIZE) for _ in range(_HASH_BUFFER_COUNT)]
+  # Hasher threads only pay off when there are cores to run them on.
+  if len(hashers) == 1 or multiprocessing.cpu_count() == 1:
+    view = memoryview(buffers[0])
+    while True:
+      length = fd.readinto(buffers[0])
+      if not length:
+        break
+      block = view[:length]
+      for hasher in hashers:
+        hasher.update(block)
+    return
+
+  done_queue = Queue.Queue()
+  threads = [_HasherThread(hasher, done_queue) for hasher in hashers]
+  for thread in threads:
+    thread.start()
+  # Number of hashers yet to consume the block held by each buffer.
+  pending = [0] * len(buffers)
+  buffer_index = 0
+  try:
+    while True:
+      # Wait until all hashers are done with the buffer we are about to reuse.
+      while pending[buffer_index]:
+        pending[done_queue.get()] -= 1
+      length = fd.readinto(buffers[buffer_index])
+      if not length:
+        break
+      block = memoryview(buffers[buffer_index])[:length]
+      for thread in threads:
+        thread.block_queue.put((buffer_index, block))
+      pending[buffer_index] = len(threads)
+      buffer_index = (buffer_index + 1) % len(buffers)
+  finally:
+    for thread in threads:
+      thread.block_queue.put(None)
+    for thread in threads:
+      thread.join()
+
+
 # Hashlib is strange and doesn't actually define these in a sane way that
 # pylint can find them. Disable checks for them.
-# pylint: disable=E1101,W0106
+# pylint: disable=E1101
 def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
   """Computes and returns a list of requested hashes.
 
+  All requested hashes are computed in a single pass over the file.
+
   Args:
     file_path: path to file to be hashed
     do_sha1:   whether or not to compute a SHA1 hash
@@ -546,32 +790,47 @@ def GetFileHashes(file_path, do_sha1=False, do_sha256=False, do_md5=False):
     A dictionary containing binary hash values, keyed by 'sha1', 'sha256' and
     'md5', respectively.
   """
-  hashes = {}
-  if (do_sha1 or do_sha256 or do_md5):
-    # Initialize hashers.
-    hasher_sha1 = hashlib.sha1() if do_sha1 else None
-    hasher_sha256 = hashlib.sha256() if do_sha256 else None
-    hasher_md5 = hashlib.md5() if do_md5 else None
-
-    # Read blocks from file, update hashes.
-    with open(file_path, 'rb') as fd:
-      while True:
-        block = fd.read(_HASH_BLOCK_SIZE)
-        if not block:
-          break
-        hasher_sha1 and hasher_sha1.update(block)
-        hasher_sha256 and hasher_sha256.update(block)
-        hasher_md5 and hasher_md5.update(block)
-
-    # Update return values.
-    if hasher_sha1:
-      hashes['sha1'] = hasher_sha1.digest()
-    if hasher_sha256:
-      hashes['sha256'] = hasher_sha256.digest()
-    if hasher_md5:
-      hashes['md5'] = hasher_md5.digest()
-
-  return hashes
+  hashers = {}
+  if do_sha1:
+    hashers['sha1'] = hashlib.sha1()
+  if do_sha256:
+    hashers['sha256'] = hashlib.sha256()
+  if do_md5:
+    hashers['md5'] = hashlib.md5()
+  if not hashers:
+    return {}
+
+  with open(file_path, 'rb') as fd:
+    _HashStream(fd, hashers.values())
+
+  return dict((name, hasher.digest()) for name, hasher in hashers.iteritems())
+
+
+def GetFilesHashes(file_paths, do_sha1=False, do_sha256=False, do_md5=False,
+                   workers=_HASH_BATCH_WORKERS):
+  """Computes requested hashes for many files at once.
+
+  Args:
+    file_paths: list of paths to files to be hashed
+    do_sha1:    whether or not to compute SHA1 hashes
+    do_sha256:  whether or not to compute SHA256 hashes
+    do_md5:     whether or not to compute MD5 hashes
+    workers:    maximum number of files hashed concurrently
+  Returns:
+    A dictionary mapping each file path to a dictionary of hashes, as returned
+    by GetFileHashes().
+  """
+  if not file_paths:
+    return {}
+  pool = multiprocessing.pool.ThreadPool(min(workers, len(file_paths)))
+  try:
+    results = pool.map(
+        lambda path: GetFileHashes(path, do_sha1, do_sha256, do_md5),
+        file_paths)
+  finally:
+    pool.close()
+    pool.join()
+  return dict(zip(file_paths, results))
 
 
 def GetFileSha1(file_path):
@@ -584,6 +843,15 @@ def GetFileSha256(file_path):
   return base64.b64encode(GetFileHashes(file_path, do_sha256=True)['sha256'])
 
 
+def GetFileSha1Sha256(file_path):
+  """Returns the SHA1 and SHA256 checksums of the file given (base64 encoded).
+
+  Both checksums are computed in a single pass over the file.
+  """
+  hashes = GetFileHashes(file_path, do_sha1=True, do_sha256=True)
+  return base64.b64encode(hashes['sha1']), base64.b64encode(hashes['sha256'])
+
+
 def GetFileMd5(file_path):
   """Returns the MD5 checksum of the file given (hex encoded)."""
   return binascii.hexlify(GetFileHashes(file_path, do_md5=True)['md5'])
@@ -6,16 +6,22 @@
 
 """Unit tests for common_util module."""
 
+import hashlib
+import multiprocessing
 import os
 import shutil
+import StringIO
 import subprocess
+import tarfile
 import tempfile
 import unittest
 
 import mox
 
+import availability_watcher
 import build_artifact
 import common_util
+import control_file_index
 import gsutil_util
 
 
@@ -65,6 +71,11 @@ class CommonUtilTest(mox.MoxTestBase):
     self._good_mock_process.returncode = 0
     self._bad_mock_process = self.mox.CreateMock(subprocess.Popen)
     self._bad_mock_process.returncode = 1
+    # A watcher of its own, so that no test sees the polls of another. It
+    # polls faster than the default, yet not twice within a second.
+    self.stubs.Set(availability_watcher, '_availability_watcher',
+                   availability_watcher.AvailabilityWatcher(min_delay=1.5,
+                                                            max_delay=3))
 
   def tearDown(self):
     shutil.rmtree(self._static_dir)
@@ -203,6 +214,85 @@ class CommonUtilTest(mox.MoxTestBase):
         os.path.join('server', 'site_tests', 'network_VPN', 'control'))
     self.assertEqual(control_content, 'hello!')
 
+  def testGetControlFileList(self):
+    """Tests listings of control files of builds, staged or being staged."""
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    for path, contents in (('client/site_tests/sleeptest/control',
+                            'SUITE = "bvt"'),
+                           ('server/site_tests/reboot/control.long', '')):
+      path = os.path.join(self._static_dir, build, 'autotest', path)
+      os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(contents)
+
+    common_util.AcquireLock(self._static_dir, build, create_once=False)
+    self.assertEqual(common_util.GetControlFileList(self._static_dir, build,
+                                                    suite='bvt'),
+                     'client/site_tests/sleeptest/control')
+    self.assertFalse(os.path.exists(os.path.join(
+        self._static_dir, build, control_file_index.MANIFEST_NAME)))
+
+    common_util.ReleaseLock(self._static_dir, build)
+    self.assertEqual(common_util.GetControlFileList(self._static_dir, build),
+                     'client/site_tests/sleeptest/control\n'
+                     'server/site_tests/reboot/control.long')
+    self.assertEqual(common_util.GetControlFileList(self._static_dir, build,
+                                                    prefix='server/'),
+                     'server/site_tests/reboot/control.long')
+    self.assertTrue(os.path.exists(os.path.join(
+        self._static_dir, build, control_file_index.MANIFEST_NAME)))
+
+  def testGetSuiteControlFiles(self):
+    """Tests the metadata of the control files of a suite."""
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    autotest_dir = os.path.join(self._static_dir, build, 'autotest')
+    for path, contents in (('client/site_tests/sleeptest/control',
+                            'SUITE = "bvt"\nDEPENDENCIES = "wifi"'),
+                           ('test_suites/control.bvt', 'NAME = "bvt"')):
+      os.makedirs(os.path.dirname(os.path.join(autotest_dir, path)))
+      with open(os.path.join(autotest_dir, path), 'w') as f:
+        f.write(contents)
+
+    self.assertEqual(
+        common_util.GetSuiteControlFiles(self._static_dir, build, 'bvt'),
+        {'suite': 'bvt', 'suite_control_file': 'test_suites/control.bvt',
+         'control_files': {'client/site_tests/sleeptest/control': {
+             'suites': ['bvt'], 'dependencies': ['wifi'], 'time': None}}})
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetSuiteControlFiles, self._static_dir,
+                      'test-board-1/missing', 'bvt')
+
+  def testGetControlFileTarball(self):
+    """Tests fetching control files by path and pattern, as a tarball."""
+    build = 'test-board-1/R17-1413.0.0-a1-b1346'
+    autotest_dir = os.path.join(self._static_dir, build, 'autotest')
+    control_files = {'client/site_tests/sleeptest/control': 'sleep',
+                     'client/site_tests/login/control': 'x' * 1000,
+                     'server/site_tests/reboot/control': 'reboot'}
+    for path, contents in control_files.iteritems():
+      os.makedirs(os.path.dirname(os.path.join(autotest_dir, path)))
+      with open(os.path.join(autotest_dir, path), 'w') as f:
+        f.write(contents)
+
+    chunks = common_util.GetControlFileTarball(
+        self._static_dir, build, ['/server/site_tests/reboot/control',
+                                  'client/site_tests/login/control'],
+        pattern='client/*/control')
+    tarball = tarfile.open(fileobj=StringIO.StringIO(''.join(chunks)))
+    self.assertEqual(tarball.getnames(),
+                     ['server/site_tests/reboot/control',
+                      'client/site_tests/login/control',
+                      'client/site_tests/sleeptest/control'])
+    for name in tarball.getnames():
+      self.assertEqual(tarball.extractfile(name).read(), control_files[name])
+
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetControlFileTarball, self._static_dir,
+                      build, ['client/site_tests/missing/control'])
+    self.assertRaises(common_util.CommonUtilError,
+                      common_util.GetControlFileTarball, self._static_dir,
+                      'test-board-1/missing', [], pattern='*')
+
   def commonGatherArtifactDownloads(self, payload_names):
     """Tests that we can gather the correct download requirements."""
     build = 'R17-1413.0.0-a1-b1346'
@@ -366,5 +456,47 @@ class CommonUtilTest(mox.MoxTestBase):
                       timeout=1)
     self.mox.VerifyAll()
 
+  def testGetFileHashes(self):
+    """Tests that all requested hashes are computed in a single pass."""
+    file_path = os.path.join(self._install_dir, 'payload')
+    # Span several hashing blocks, with a partial one at the end.
+    content = ''.join(chr(i % 251) for i in range(
+        common_util._HASH_BLOCK_SIZE * 4 + 17))
+    with open(file_path, 'wb') as f:
+      f.write(content)
+
+    expected_hashes = {'sha1': hashlib.sha1(content).digest(),
+                       'sha256': hashlib.sha256(content).digest(),
+                       'md5': hashlib.md5(content).digest()}
+    # Exercise both the sequential and the threaded hashing paths.
+    self.mox.StubOutWithMock(multiprocessing, 'cpu_count')
+    multiprocessing.cpu_count().AndReturn(1)
+    multiprocessing.cpu_count().AndReturn(4)
+    self.mox.ReplayAll()
+    for _ in range(2):
+      hashes = common_util.GetFileHashes(file_path, do_sha1=True,
+                                         do_sha256=True, do_md5=True)
+      self.assertEqual(hashes, expected_hashes)
+    self.mox.VerifyAll()
+    self.assertEqual(common_util.GetFileHashes(file_path, do_md5=True),
+                     {'md5': hashlib.md5(content).digest()})
+    self.assertEqual(common_util.GetFileHashes(file_path), {})
+
+  def testGetFilesHashes(self):
+    """Tests that a batch of files is hashed correctly."""
+    file_paths = []
+    for i in range(6):
+      file_path = os.path.join(self._install_dir, 'file%d' % i)
+      with open(file_path, 'w') as f:
+        f.write('content %d' % i)
+      file_paths.append(file_path)
+
+    hashes = common_util.GetFilesHashes(file_paths, do_sha1=True, workers=3)
+    self.assertEqual(sorted(hashes.keys()), sorted(file_paths))
+    for i, file_path in enumerate(file_paths):
+      self.assertEqual(hashes[file_path],
+                       {'sha1': hashlib.sha1('content %d' % i).digest()})
+
+
 if __name__ == '__main__':
   unittest.main()
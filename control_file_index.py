@@ -0,0 +1,287 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Manifests of the control files of staged builds, and caches of them.
+
+The autotest tree of a build is walked once, when it is staged, into a
+manifest of its control files stored in the build directory. Manifests are
+loaded on first use into a bounded cache, and the contents of control files
+read through it are cached as well.
+"""
+
+import bisect
+import collections
+import json
+import os
+import re
+import tempfile
+import threading
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('CONTROL_FILES', message, *args)
+
+
+# Name of the manifest in build directories, and of their autotest tree.
+MANIFEST_NAME = 'control_files.json'
+AUTOTEST_DIR = 'autotest'
+# Version of the manifest format; manifests of other versions are rewritten.
+_MANIFEST_VERSION = 2
+# Number of builds whose manifest is cached.
+_BUILD_CACHE_SIZE = 32
+# Bytes of control file contents cached, and the largest file cached.
+_CONTENTS_CACHE_SIZE = 16 << 20
+_MAX_CACHED_FILE_SIZE = 256 << 10
+
+# Fields of control files recorded in manifests.
+_FIELDS = ('SUITE', 'DEPENDENCIES', 'TIME')
+_FIELD_RE = re.compile(r'^(%s)\s*=\s*([\'"])(.*?)\2' % '|'.join(_FIELDS),
+                       re.MULTILINE)
+
+
+def IsControlFile(name):
+  """Returns whether |name| is the name of a control file."""
+  return name == 'control' or name.startswith('control.')
+
+
+def _ParseEntry(contents):
+  """Returns the manifest entry of a control file.
+
+  Returns:
+    A dictionary of the suites the control file declares itself part of, the
+    labels it depends on, and its expected duration, if declared, under
+    'suites', 'dependencies' and 'time'.
+  """
+  fields = {}
+  for match in _FIELD_RE.finditer(contents):
+    fields.setdefault(match.group(1), match.group(3))
+  entry = {'time': fields.get('TIME')}
+  for name, key in (('SUITE', 'suites'), ('DEPENDENCIES', 'dependencies')):
+    entry[key] = [value.strip() for value in fields.get(name, '').split(',')
+                  if value.strip()]
+  return entry
+
+
+def ReadEntry(path):
+  """Returns the manifest entry of the control file at |path|."""
+  with open(path) as control_file:
+    return _ParseEntry(control_file.read())
+
+
+def WriteManifest(build_dir):
+  """Walks the autotest tree of |build_dir| into a manifest of control files.
+
+  Control files that resolve outside of |build_dir| are left out.
+
+  Returns:
+    The manifest, a dictionary mapping the path of each control file relative
+    to the autotest tree to its entry; see ReadEntry.
+  """
+  autotest_dir = os.path.join(build_dir, AUTOTEST_DIR)
+  real_build_dir = os.path.join(os.path.realpath(build_dir), '')
+  control_files = {}
+  for dir_path, _, files in os.walk(autotest_dir):
+    for name in files:
+      if not IsControlFile(name):
+        continue
+      path = os.path.join(dir_path, name)
+      if not os.path.realpath(path).startswith(real_build_dir):
+        continue
+      try:
+        entry = ReadEntry(path)
+      except IOError as e:
+        _Log('Skipping unreadable control file %s: %s', path, e)
+        continue
+      control_files[os.path.relpath(path, autotest_dir)] = entry
+
+  fd, temp_path = tempfile.mkstemp(prefix=MANIFEST_NAME, dir=build_dir)
+  with os.fdopen(fd, 'w') as f:
+    json.dump({'version': _MANIFEST_VERSION,
+               'control_files': control_files}, f)
+  os.chmod(temp_path, 0644)
+  os.rename(temp_path, os.path.join(build_dir, MANIFEST_NAME))
+  _Log('Indexed %d control files of %s', len(control_files), build_dir)
+  return control_files
+
+
+class _BuildControlFiles(object):
+  """The control files of a build, sorted and by suite."""
+
+  def __init__(self, control_files, mtime):
+    self.mtime = mtime
+    self.entries = control_files
+    self.paths = sorted(control_files)
+    self.path_set = frozenset(self.paths)
+    self.suites = collections.defaultdict(list)
+    for path in self.paths:
+      for suite in control_files[path]['suites']:
+        self.suites[suite].append(path)
+
+  def GetList(self, prefix=None, suite=None):
+    """Returns the sorted paths starting with |prefix|, of |suite|."""
+    paths = self.suites.get(suite, []) if suite else self.paths
+    if prefix:
+      start = bisect.bisect_left(paths, prefix)
+      end = start
+      while end < len(paths) and paths[end].startswith(prefix):
+        end += 1
+      paths = paths[start:end]
+    return paths
+
+
+class ControlFileIndex(object):
+  """Caches the control file manifests of builds, and control files."""
+
+  def __init__(self, build_cache_size=_BUILD_CACHE_SIZE,
+               contents_cache_size=_CONTENTS_CACHE_SIZE):
+    self._build_cache_size = build_cache_size
+    self._contents_cache_size = contents_cache_size
+    self._lock = threading.Lock()
+    # Loaded manifests and cached contents, least recently used first.
+    self._builds = collections.OrderedDict()
+    self._contents = collections.OrderedDict()
+    self._contents_size = 0
+    self._stats = dict.fromkeys(('loads', 'writes', 'content_hits',
+                                 'content_misses'), 0)
+
+  def _LoadBuild(self, build_dir, is_staged):
+    """Returns the control files of |build_dir|, or None without a manifest.
+
+    Args:
+      build_dir: directory of a staged build.
+      is_staged: function returning whether the build is fully staged, in
+                 which case its manifest is written if it has none.
+    """
+    manifest_path = os.path.join(build_dir, MANIFEST_NAME)
+    try:
+      mtime = os.stat(manifest_path).st_mtime
+    except OSError:
+      mtime = None
+
+    with self._lock:
+      build = self._builds.pop(build_dir, None)
+      if build and build.mtime == mtime:
+        self._builds[build_dir] = build
+        return build
+
+    control_files = None
+    if mtime is not None:
+      try:
+        with open(manifest_path) as f:
+          manifest = json.load(f)
+      except (IOError, ValueError) as e:
+        _Log('Ignoring unreadable manifest %s: %s', manifest_path, e)
+        manifest = {}
+      if manifest.get('version') == _MANIFEST_VERSION:
+        # Paths are served as read from the file system, not as unicode.
+        control_files = dict((path.encode('utf-8'), entry) for path, entry in
+                             manifest['control_files'].iteritems())
+    if control_files is None:
+      if not (is_staged and is_staged()):
+        return None
+      control_files = WriteManifest(build_dir)
+      mtime = os.stat(manifest_path).st_mtime
+      self._Count('writes')
+
+    build = _BuildControlFiles(control_files, mtime)
+    with self._lock:
+      self._stats['loads'] += 1
+      self._builds[build_dir] = build
+      while len(self._builds) > self._build_cache_size:
+        self._builds.popitem(last=False)
+    return build
+
+  def _Count(self, name):
+    with self._lock:
+      self._stats[name] += 1
+
+  def GetControlFiles(self, build_dir, prefix=None, suite=None,
+                      is_staged=None):
+    """Returns the paths of the control files of a build.
+
+    Args:
+      build_dir: directory of a staged build.
+      prefix: prefix of the paths to return, e.g. server/site_tests/.
+      suite: suite the control files returned must declare.
+      is_staged: function returning whether the build is fully staged, in
+                 which case its manifest is written if it has none.
+
+    Returns:
+      A sorted list of paths relative to the autotest tree, or None if the
+      build has no manifest.
+    """
+    build = self._LoadBuild(build_dir, is_staged)
+    return build and build.GetList(prefix, suite)
+
+  def GetEntries(self, build_dir, suite, is_staged=None):
+    """Returns the manifest entries of the control files of a suite.
+
+    Args:
+      build_dir: directory of a staged build.
+      suite: name of the suite, e.g. bvt.
+      is_staged: as for GetControlFiles.
+
+    Returns:
+      A dictionary mapping the path of each control file declaring |suite|
+      to its entry (see ReadEntry), or None if the build has no manifest.
+    """
+    build = self._LoadBuild(build_dir, is_staged)
+    return build and dict((path, build.entries[path])
+                          for path in build.GetList(suite=suite))
+
+  def GetContents(self, build_dir, control_path, is_staged=None):
+    """Returns the contents of an indexed control file of a build.
+
+    Args:
+      build_dir: directory of a staged build.
+      control_path: path of the control file relative to the autotest tree.
+      is_staged: as for GetControlFiles.
+
+    Returns:
+      The contents of the control file, or None if the build has no manifest
+      or |control_path| isn't in it.
+    """
+    build = self._LoadBuild(build_dir, is_staged)
+    control_path = os.path.normpath(control_path)
+    if not build or control_path not in build.path_set:
+      return None
+
+    key = (build_dir, build.mtime, control_path)
+    with self._lock:
+      contents = self._contents.pop(key, None)
+      if contents is not None:
+        self._contents[key] = contents
+        self._stats['content_hits'] += 1
+        return contents
+      self._stats['content_misses'] += 1
+
+    with open(os.path.join(build_dir, AUTOTEST_DIR, control_path)) as f:
+      contents = f.read()
+    if len(contents) <= _MAX_CACHED_FILE_SIZE:
+      with self._lock:
+        if key not in self._contents:
+          self._contents[key] = contents
+          self._contents_size += len(contents)
+        while self._contents_size > self._contents_cache_size:
+          _, evicted = self._contents.popitem(last=False)
+          self._contents_size -= len(evicted)
+    return contents
+
+  def GetStats(self):
+    """Returns a dictionary of index statistics."""
+    with self._lock:
+      return dict(self._stats, builds=len(self._builds),
+                  cached_files=len(self._contents),
+                  cached_bytes=self._contents_size)
+
+
+_control_file_index = ControlFileIndex()
+
+
+def GetControlFileIndex():
+  """Returns the index control files of all builds are looked up in."""
+  return _control_file_index
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for control_file_index module."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import control_file_index
+
+
+# Control files of the fake autotest tree, and their contents.
+CONTROL_FILES = {
+    'client/site_tests/sleeptest/control':
+        'SUITE = "bvt, smoke"\nDEPENDENCIES = "wifi, bluetooth"\n'
+        'TIME = "SHORT"\n',
+    'client/site_tests/sleeptest/control.long': 'TIME = "LONG"\n',
+    'server/site_tests/reboot/control': "SUITE = 'bvt'\n",
+    'test_suites/control.bvt': 'NAME = "bvt"\n',
+}
+
+
+class ControlFileIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self._build_dir = tempfile.mkdtemp(prefix='control_file_index')
+    autotest_dir = os.path.join(self._build_dir, 'autotest')
+    for path, contents in CONTROL_FILES.iteritems():
+      path = os.path.join(autotest_dir, path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(contents)
+    with open(os.path.join(autotest_dir, 'client', 'common.py'), 'w') as f:
+      f.write('# Not a control file.\n')
+    os.symlink('/etc/passwd', os.path.join(autotest_dir, 'control.outside'))
+    self._index = control_file_index.ControlFileIndex()
+
+  def tearDown(self):
+    shutil.rmtree(self._build_dir)
+
+  def testGetControlFiles(self):
+    """Tests listings of a manifest, whole and filtered."""
+    self.assertEqual(self._index.GetControlFiles(self._build_dir), None)
+    control_file_index.WriteManifest(self._build_dir)
+    self.assertEqual(self._index.GetControlFiles(self._build_dir),
+                     sorted(CONTROL_FILES))
+    self.assertEqual(self._index.GetControlFiles(self._build_dir,
+                                                 prefix='client/'),
+                     ['client/site_tests/sleeptest/control',
+                      'client/site_tests/sleeptest/control.long'])
+    self.assertEqual(self._index.GetControlFiles(self._build_dir, suite='bvt'),
+                     ['client/site_tests/sleeptest/control',
+                      'server/site_tests/reboot/control'])
+    self.assertEqual(self._index.GetControlFiles(
+        self._build_dir, prefix='server/', suite='smoke'), [])
+    self.assertEqual(self._index.GetStats()['loads'], 1)
+
+  def testGetEntries(self):
+    """Tests the metadata of suites, and the rewrite of older manifests."""
+    with open(os.path.join(self._build_dir,
+                           control_file_index.MANIFEST_NAME), 'w') as f:
+      json.dump({'version': 1, 'control_files': {}}, f)
+    self.assertEqual(self._index.GetEntries(self._build_dir, 'bvt'), None)
+    self.assertEqual(
+        self._index.GetEntries(self._build_dir, 'bvt',
+                               is_staged=lambda: True),
+        {'client/site_tests/sleeptest/control': {
+            'suites': ['bvt', 'smoke'], 'dependencies': ['wifi', 'bluetooth'],
+            'time': 'SHORT'},
+         'server/site_tests/reboot/control': {
+             'suites': ['bvt'], 'dependencies': [], 'time': None}})
+    self.assertEqual(self._index.GetEntries(self._build_dir, 'missing'), {})
+
+  def testGetContents(self):
+    """Tests that contents are cached, and manifests written on demand."""
+    path = 'server/site_tests/reboot/control'
+    self.assertEqual(self._index.GetContents(self._build_dir, path), None)
+    self.assertEqual(self._index.GetContents(self._build_dir, path,
+                                             is_staged=lambda: True),
+                     CONTROL_FILES[path])
+    with open(os.path.join(self._build_dir, 'autotest', path), 'w') as f:
+      f.write('changed')
+    self.assertEqual(self._index.GetContents(self._build_dir, path),
+                     CONTROL_FILES[path])
+    self.assertEqual(self._index.GetContents(self._build_dir,
+                                             'control.outside'), None)
+    self.assertEqual(self._index.GetContents(self._build_dir,
+                                             'client/common.py'), None)
+    stats = self._index.GetStats()
+    self.assertEqual((stats['writes'], stats['content_hits'],
+                      stats['content_misses']), (1, 1, 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
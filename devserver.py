@@ -14,15 +14,23 @@ import os
 import re
 import socket
 import sys
-import subprocess
-import tempfile
 import threading
 import types
 
+import async_frontend
 import autoupdate
+import availability_watcher
+import build_artifact
+import cache_manager
 import common_util
+import download_engine
 import downloader
+import gsutil_util
 import log_util
+import payload_server
+import staging_scheduler
+import symbol_store
+import symbolicator
 
 
 # Module-local log function.
@@ -32,8 +40,11 @@ def _Log(message, *args):
 
 CACHED_ENTRIES = 12
 
-# Sets up global to share between classes.
+# Sets up globals to share between classes.
 updater = None
+static_server = None
+stager = None
+dump_symbolicator = None
 
 
 class DevServerError(Exception):
@@ -124,28 +135,35 @@ def _GetConfig(options):
                     'response.timeout': 6000,
                     'request.show_tracebacks': True,
                     'server.socket_timeout': 60,
-                    'tools.staticdir.root':
-                      os.path.dirname(os.path.abspath(sys.argv[0])),
                   },
                   '/api':
                   {
                     # Gets rid of cherrypy parsing post file for args.
                     'request.process_request_body': False,
                   },
+                  '/api/hostlog':
+                  {
+                    # Logs of all hosts are serialized incrementally.
+                    'response.stream': True,
+                  },
                   '/build':
                   {
                     'response.timeout': 100000,
                   },
+                  # Control files are read whole, then streamed in pieces.
+                  '/controlfiles_batch':
+                  {
+                    'response.stream': True,
+                  },
                   '/update':
                   {
                     # Gets rid of cherrypy parsing post file for args.
                     'request.process_request_body': False,
                     'response.timeout': 10000,
                   },
-                  # Sets up the static dir for file hosting.
+                  # Payloads are streamed by DevServerRoot.static.
                   '/static':
-                  { 'tools.staticdir.dir': 'static',
-                    'tools.staticdir.on': True,
+                  { 'response.stream': True,
                     'response.timeout': 10000,
                   },
                 }
@@ -266,20 +284,101 @@ class ApiRoot(object):
     return updater.HandleHostInfoPing(ip)
 
   @cherrypy.expose
-  def hostlog(self, ip):
+  def hostlog(self, ip, since=None, limit=None, event_type=None):
     """Returns a JSON object containing a log of host event.
 
     Args:
       ip: address of host whose event log is requested, or `all'
+      since: only return events with a `seq' larger than this one
+      limit: maximum number of events to return per host
+      event_type: only return events of this type
     Returns:
       A JSON encoded list (log) of dictionaries (events), each of which
-      containing a `timestamp' and other event fields, as described under
-      /api/hostinfo.
+      containing a `timestamp', a `seq' number and other event fields, as
+      described under /api/hostinfo. Events are kept in segment files under
+      --host_log_dir, which are rotated as they grow; without it, only the
+      most recent events of each host are kept (see --host_log_depth).
+
+    Example URL:
+      http://myhost/api/hostlog?ip=192.168.1.5&since=1234&event_type=3
+    """
+    try:
+      since, limit, event_type = [None if value is None else int(value)
+                                  for value in (since, limit, event_type)]
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'Non-numeric since, limit or event_type.')
+    return updater.HandleHostLogPing(ip, since=since, limit=limit,
+                                     event_type=event_type)
+
+  @cherrypy.expose
+  def hostevents(self, ip, since=None, timeout=None):
+    """Waits for new events of some hosts, instead of polling /api/hostlog.
+
+    Args:
+      ip: comma separated addresses of the hosts to wait for
+      since: `seq' of the last event already seen; by default, only events
+             logged after the request are returned
+      timeout: maximum number of seconds to wait (default: 30, at most 300)
+    Returns:
+      A JSON encoded dictionary with the list of new `events', as described
+      under /api/hostlog plus the `ip' of their host, which is empty if the
+      timeout expired, and the `seq' to pass as `since' in the next request.
+
+    Example URL:
+      http://myhost/api/hostevents?ip=192.168.1.5,192.168.1.6&since=1234
+    """
+    if not updater.host_log:
+      raise cherrypy.HTTPError(400, 'Host events are not recorded, '
+                               'see --host_log.')
+    try:
+      since = None if since is None else int(since)
+      timeout = (autoupdate.HOST_EVENTS_TIMEOUT if timeout is None
+                 else float(timeout))
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'Non-numeric since or timeout.')
+    return updater.HandleHostEventsPing(ip.split(','), since=since,
+                                        timeout=timeout)
+
+  @cherrypy.expose
+  def jobs(self):
+    """Returns the queued, running and recently finished staging jobs.
+
+    Returns:
+      A JSON encoded dictionary mapping `queued', `running' and `finished' to
+      lists of jobs, each a dictionary with the following keys/values:
+        id (int):                job number, as returned by async requests
+        key (string):            what is staged, e.g. download:ARCHIVE_URL
+        priority (int):          jobs with lower priorities run first
+        state (string):          queued, running, succeeded, failed or
+                                 cancelled
+        submit_time, start_time, end_time (float): timings of the job
+        queued_seconds, running_seconds (float):   time spent in each state
+        error (string):          why the job failed, if it did
 
     Example URL:
-      http://myhost/api/hostlog?ip=192.168.1.5
+      http://myhost/api/jobs
     """
-    return updater.HandleHostLogPing(ip)
+    return json.dumps(stager.GetJobs())
+
+  @cherrypy.expose
+  def canceljob(self, job_id):
+    """Cancels a queued staging job; running jobs can't be cancelled.
+
+    Args:
+      job_id: id of the job, as listed by /api/jobs
+    Returns:
+      `Cancelled' if the job was cancelled.
+
+    Example URL:
+      http://myhost/api/canceljob?job_id=12
+    """
+    try:
+      job_id = int(job_id)
+    except ValueError:
+      raise cherrypy.HTTPError(400, 'Non-numeric job_id.')
+    if not stager.Cancel(job_id):
+      raise cherrypy.HTTPError(409, 'Job %d is not queued.' % job_id)
+    return 'Cancelled'
 
   @cherrypy.expose
   def setnextupdate(self, ip):
@@ -298,6 +397,117 @@ class ApiRoot(object):
     raise cherrypy.HTTPError(400, 'No label provided.')
 
 
+  @cherrypy.expose
+  def payloadindex(self):
+    """Returns statistics of the payload metadata index.
+
+    Returns:
+      A JSON encoded dictionary with the following keys/values:
+        entries (int): number of payloads currently indexed
+        pending (int): number of payloads queued for background indexing
+        hits (int):    update checks answered from the index
+        misses (int):  update checks for payloads that were not indexed
+        stale (int):   update checks for payloads whose entry was outdated
+
+    Example URL:
+      http://myhost/api/payloadindex
+    """
+    return json.dumps(updater.payload_index.GetStats())
+
+  @cherrypy.expose
+  def cachestats(self):
+    """Returns statistics and budgets of the update payload cache.
+
+    Returns:
+      A JSON encoded dictionary with the following keys/values:
+        entries (int):         number of cached updates
+        bytes (int):           total size of cached updates
+        free_bytes (int):      free space on the cache file system
+        pinned (int):          number of cached updates currently in use
+        evicted_entries (int): number of cached updates evicted so far
+        evicted_bytes (int):   total size of cached updates evicted so far
+        last_run (float):      time of the last eviction run
+        max_bytes, max_entries, min_free_bytes, max_age: configured budgets
+      If the devserver does not manage a cache, an empty dictionary.
+
+    Example URL:
+      http://myhost/api/cachestats
+    """
+    if not updater.cache_manager:
+      return json.dumps({})
+    return json.dumps(updater.cache_manager.GetStats())
+
+  @cherrypy.expose
+  def servestats(self):
+    """Returns statistics of files served from the static directory.
+
+    Returns:
+      A JSON encoded dictionary with the following keys/values:
+        active (int):     number of transfers in progress
+        transfers (int):  number of finished transfers
+        bytes_sent (int): total number of bytes sent by finished transfers
+        recent (list):    the most recent transfers, each a dictionary with
+                          the served path, bytes sent, seconds and MB/s
+
+    Example URL:
+      http://myhost/api/servestats
+    """
+    return json.dumps(static_server.GetStats())
+
+  @cherrypy.expose
+  def watchstats(self):
+    """Returns statistics of the polls of archives for uploaded artifacts.
+
+    Returns:
+      A JSON encoded dictionary with the following keys/values:
+        archives (int):     number of archives being polled
+        waiters (int):      number of requests waiting for artifacts
+        waits (int):        number of waits for artifacts so far
+        polls (int):        number of polls of archives so far
+        not_modified (int): polls finding the manifest of uploaded artifacts
+                            unchanged
+        listings (int):     polls listing archives without a manifest
+        errors (int):       failed polls
+        cached (int):       number of archives whose manifest is cached
+
+    Example URL:
+      http://myhost/api/watchstats
+    """
+    return json.dumps(
+        availability_watcher.GetAvailabilityWatcher().GetStats())
+
+  @cherrypy.expose
+  def symbolicatestats(self):
+    """Returns statistics of the symbolication of minidumps.
+
+    Returns:
+      A JSON encoded dictionary with the following keys/values:
+        requests (int):       minidumps symbolicated so far
+        cache_hits (int):     minidumps whose stack trace was cached
+        coalesced (int):      minidumps sharing the symbolication of an
+                              identical one in flight
+        unparsable (int):     minidumps whose modules couldn't be read
+        queued (int):         symbolications waiting for a worker
+        running (int):        symbolications in progress
+        completed (int):      symbolications that succeeded
+        failed (int):         symbolications that failed
+        cached_results (int): number of stack traces cached
+        cached_symbols (int): number of module symbol lookups cached
+        symbol_hits (int):    symbol lookups answered from the cache
+        symbol_misses (int):  symbol lookups of the symbol directory
+        latency_mean, latency_p50, latency_p90, latency_max (float):
+                              seconds taken by recent symbolications that
+                              weren't cached, if any
+        symbol_store (dict):  symbols extracted from symbol packs: indexed
+                              packs and symbol files, symbol files and
+                              bytes extracted, and counts of hits,
+                              extractions, evictions and errors
+
+    Example URL:
+      http://myhost/api/symbolicatestats
+    """
+    return json.dumps(dump_symbolicator.GetStats())
+
   @cherrypy.expose
   def fileinfo(self, *path_args):
     """Returns information about a given staged file.
@@ -319,8 +529,7 @@ class ApiRoot(object):
       raise DevServerError('file not found: %s' % file_path)
     try:
       file_size = os.path.getsize(file_path)
-      file_sha1 = common_util.GetFileSha1(file_path)
-      file_sha256 = common_util.GetFileSha256(file_path)
+      file_sha1, file_sha256 = common_util.GetFileSha1Sha256(file_path)
     except os.error, e:
       raise DevServerError('failed to get info for file %s: %s' %
                            (file_path, str(e)))
@@ -356,6 +565,28 @@ class DevServerRoot(object):
       self._builder = builder.Builder()
     return self._builder.Build(board, pkg, kwargs)
 
+  @staticmethod
+  def _RunStagingJob(kwargs, key, priority, func, *args):
+    """Submits a staging job to the scheduler, and waits for its result.
+
+    Args:
+      kwargs: arguments of the staging request, which may override the
+              priority of the job, or set `async' to return the id of the job
+              instead of waiting for it.
+      key: key of the job; requests for in-flight keys share their job.
+      priority: default priority of the job.
+      func, args: the staging work.
+    """
+    if kwargs.get('priority') is not None:
+      try:
+        priority = int(kwargs['priority'])
+      except ValueError:
+        raise cherrypy.HTTPError(400, 'Non-numeric priority.')
+    job = stager.Submit(key, func, args, priority=priority)
+    if kwargs.get('async') in ('1', 'true', 'True'):
+      return str(job.job_id)
+    return job.Result()
+
   @staticmethod
   def _canonicalize_archive_url(archive_url):
     """Canonicalizes archive_url strings.
@@ -377,15 +608,25 @@ class DevServerRoot(object):
     the status of the background artifact downloads. They should use the same
     args passed to download.
 
+    Downloads run as staging jobs (see /api/jobs), ahead of the background
+    downloads of other builds.
+
     Args:
       archive_url: Google Storage URL for the build.
+      async: if true, return the id of the staging job right away.
+      priority: priority of the staging job, overriding the default (0).
 
     Example URL:
       http://myhost/download?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338
     """
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
+    return self._RunStagingJob(
+        kwargs, 'download:' + archive_url, staging_scheduler.PRIORITY_PAYLOADS,
+        self._Download, archive_url)
 
+  def _Download(self, archive_url):
+    """Downloads the foreground artifacts of a build, see download."""
     # Guarantees that no two downloads for the same url can run this code
     # at the same time.
     with self._download_lock_dict.lock(archive_url):
@@ -398,7 +639,9 @@ class DevServerRoot(object):
           _Log('Build %s has already been processed.' % archive_url)
           return 'Success'
 
-        downloader_instance = downloader.Downloader(updater.static_dir)
+        downloader_instance = downloader.Downloader(
+            updater.static_dir, payload_index=updater.payload_index,
+            scheduler=stager)
         self._downloader_dict[archive_url] = downloader_instance
         return downloader_instance.Download(archive_url, background=True)
 
@@ -419,6 +662,10 @@ class DevServerRoot(object):
       x86-generic/R17-1208.0.0-a1-b338
     """
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
+    # Downloads requested with async may not have started yet.
+    job = stager.FindJob('download:' + archive_url)
+    if job:
+      job.Result()
     downloader_instance = self._downloader_dict.get(archive_url)
     if downloader_instance:
       status = downloader_instance.GetStatusOfBackgroundDownloads()
@@ -439,17 +686,23 @@ class DevServerRoot(object):
     """Downloads and stages debug symbol payloads from Google Storage.
 
     This methods downloads the debug symbol build artifact synchronously,
-    and then stages it for use by symbolicate_dump/.
+    and then stages it for use by symbolicate_dump/. The symbols are not
+    extracted until minidumps referencing them are symbolicated.
 
     Args:
       archive_url: Google Storage URL for the build.
+      async: if true, return the id of the staging job right away.
+      priority: priority of the staging job, overriding the default (2).
 
     Example URL:
       http://myhost/stage_debug?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338
     """
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
-    return downloader.SymbolDownloader(updater.static_dir).Download(archive_url)
+    return self._RunStagingJob(
+        kwargs, 'stage_debug:' + archive_url,
+        staging_scheduler.PRIORITY_SYMBOLS,
+        downloader.SymbolDownloader(updater.static_dir).Download, archive_url)
 
   @cherrypy.expose
   def symbolicate_dump(self, minidump):
@@ -466,25 +719,37 @@ class DevServerRoot(object):
     Args:
       minidump: The binary minidump file to symbolicate.
     """
-    to_return = ''
-    with tempfile.NamedTemporaryFile() as local:
-      while True:
-        data = minidump.file.read(8192)
-        if not data:
-          break
-        local.write(data)
-      local.flush()
-      stackwalk = subprocess.Popen(['minidump_stackwalk',
-                                    local.name,
-                                    updater.static_dir + '/debug/breakpad'],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-      to_return, error_text = stackwalk.communicate()
-      if stackwalk.returncode != 0:
-        raise DevServerError("Can't generate stack trace: %s (rc=%d)" % (
-            error_text, stackwalk.returncode))
-
-    return to_return
+    try:
+      return dump_symbolicator.Symbolicate(minidump.file.read())
+    except symbolicator.SymbolicationError as e:
+      raise DevServerError(str(e))
+
+  @cherrypy.expose
+  def symbolicate_dumps(self, minidump):
+    """Symbolicates several minidumps concurrently, returns their stacks.
+
+    Callers will need to POST to this URL with a body of MIME-type
+    "multipart/form-data", including one 'minidump' argument per
+    binary-formatted minidump to symbolicate.
+
+    Args:
+      minidump: The binary minidump file(s) to symbolicate.
+
+    Returns:
+      A JSON encoded list with, for each minidump in order, a dictionary with
+      either its stack trace under 'stack', or the reason it couldn't be
+      symbolicated under 'error'.
+    """
+    if not isinstance(minidump, list):
+      minidump = [minidump]
+    results = []
+    for result in dump_symbolicator.SymbolicateMany(
+        [part.file.read() for part in minidump]):
+      if isinstance(result, symbolicator.SymbolicationError):
+        results.append({'error': str(result)})
+      else:
+        results.append({'stack': result})
+    return json.dumps(results)
 
   @cherrypy.expose
   def latestbuild(self, **params):
@@ -522,15 +787,28 @@ class DevServerRoot(object):
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0
       To return the contents of a path:
       http://dev-server/controlfiles?board=x86-alex-release&build=R18-1514.0.0&control_path=client/sleeptest/control
+      To return the metadata of the control files of a suite:
+      http://dev-server/controlfiles?build=x86-alex-release/R18-1514.0.0&suite=bvt&metadata=true
 
     Args:
       build: The build i.e. x86-alex-release/R18-1514.0.0-a1-b1450.
       control_path: If you want the contents of a control file set this
         to the path. E.g. client/site_tests/sleeptest/control
         Optional, if not provided return a list of control files is returned.
+      prefix: Only list the control files whose path starts with this prefix.
+        E.g. server/site_tests/. Optional.
+      suite: Only list the control files that declare this suite. E.g. bvt.
+        Optional.
+      metadata: If true, return the metadata of the control files of suite
+        rather than their list. Optional.
     Returns:
       Contents of a control file if control_path is provided.
-      A list of control files if no control_path is provided.
+      If metadata is set, a JSON object with the suite name under 'suite',
+        the path of the control file of the suite itself, or null, under
+        'suite_control_file', and an object mapping the path of each control
+        file of the suite to its 'suites', 'dependencies' and 'time' under
+        'control_files'.
+      A list of control files otherwise.
     """
     if not params:
       return _PrintDocStringAsHTML(self.controlfiles)
@@ -539,36 +817,89 @@ class DevServerRoot(object):
       raise cherrypy.HTTPError('500 Internal Server Error',
                                'Error: build= is required!')
 
-    if 'control_path' not in params:
+    if params.get('metadata') in ('1', 'true', 'True'):
+      if 'suite' not in params:
+        raise cherrypy.HTTPError('500 Internal Server Error',
+                                 'Error: suite= is required for metadata!')
+      try:
+        return json.dumps(common_util.GetSuiteControlFiles(
+            updater.static_dir, params['build'], params['suite']),
+                          separators=(',', ':'))
+      except common_util.CommonUtilError as e:
+        raise cherrypy.HTTPError('500 Internal Server Error', str(e))
+    elif 'control_path' not in params:
       return common_util.GetControlFileList(
-          updater.static_dir, params['build'])
+          updater.static_dir, params['build'], prefix=params.get('prefix'),
+          suite=params.get('suite'))
     else:
       return common_util.GetControlFile(
           updater.static_dir, params['build'], params['control_path'])
 
+  @cherrypy.expose
+  def controlfiles_batch(self, **params):
+    """Return many control files of a build at once, as a tarball.
+
+    Example URL:
+      http://dev-server/controlfiles_batch?build=x86-alex-release/R18-1514.0.0-a1-b1450&control_path=client/site_tests/sleeptest/control&control_path=server/site_tests/reboot/control
+      http://dev-server/controlfiles_batch?build=x86-alex-release/R18-1514.0.0-a1-b1450&pattern=client/site_tests/*/control
+
+    Args:
+      build: The build i.e. x86-alex-release/R18-1514.0.0-a1-b1450.
+      control_path: The path of a control file, e.g.
+        client/site_tests/sleeptest/control. May be repeated.
+      pattern: A shell pattern matching the paths of further control files.
+        Optional.
+    Returns:
+      An uncompressed tarball of the control files, named after their path.
+    """
+    if not params:
+      return _PrintDocStringAsHTML(self.controlfiles_batch)
+
+    if 'build' not in params:
+      raise cherrypy.HTTPError('500 Internal Server Error',
+                               'Error: build= is required!')
+
+    control_paths = params.get('control_path', [])
+    if isinstance(control_paths, basestring):
+      control_paths = [control_paths]
+    try:
+      chunks = common_util.GetControlFileTarball(
+          updater.static_dir, params['build'], control_paths,
+          pattern=params.get('pattern'))
+    except common_util.CommonUtilError as e:
+      raise cherrypy.HTTPError('500 Internal Server Error', str(e))
+    cherrypy.response.headers['Content-Type'] = 'application/x-tar'
+    cherrypy.response.headers['Content-Length'] = str(
+        sum(len(chunk) for chunk in chunks))
+    return chunks
+
   @cherrypy.expose
   def stage_images(self, **kwargs):
     """Downloads and stages a Chrome OS image from Google Storage.
 
     This method downloads a zipped archive from a specified GS location, then
     extracts and stages the specified list of images and stages them under
-    static/images/BOARD/BUILD/. Download is synchronous.
+    static/images/BOARD/BUILD/. Download is synchronous, unless async is set.
 
     Args:
       archive_url: Google Storage URL for the build.
       image_types: comma-separated list of images to download, may include
                    'test', 'recovery', and 'base'
+      async: if true, return the id of the staging job right away.
+      priority: priority of the staging job, overriding the default (1).
 
     Example URL:
       http://myhost/stage_images?archive_url=gs://chromeos-image-archive/
       x86-generic/R17-1208.0.0-a1-b338&image_types=test,base
     """
-    # TODO(garnold) This needs to turn into an async operation, to avoid
-    # unnecessary failure of concurrent secondary requests (chromium-os:34661).
     archive_url = self._canonicalize_archive_url(kwargs.get('archive_url'))
     image_types = kwargs.get('image_types').split(',')
-    return (downloader.ImagesDownloader(
-        updater.static_dir).Download(archive_url, image_types))
+    return self._RunStagingJob(
+        kwargs, 'stage_images:%s:%s' % (archive_url,
+                                        ','.join(sorted(set(image_types)))),
+        staging_scheduler.PRIORITY_IMAGES,
+        downloader.ImagesDownloader(updater.static_dir).Download, archive_url,
+        image_types)
 
   @cherrypy.expose
   def index(self):
@@ -613,27 +944,27 @@ class DevServerRoot(object):
     data = cherrypy.request.rfile.read(body_length)
     return updater.HandleUpdatePing(data, label)
 
+  @cherrypy.expose
+  def static(self, *args):
+    """Serves staged files, supporting byte ranges and conditional requests.
 
-def _CleanCache(cache_dir, wipe):
-  """Wipes any excess cached items in the cache_dir.
+    Example:
+      http://myhost/static/archive/update.gz
+    """
+    return static_server.Serve(args)
+
+
+def _CleanCache(cache_dir):
+  """Wipes all cached items in the cache_dir.
 
   Args:
     cache_dir: the directory we are wiping from.
-    wipe: If True, wipe all the contents -- not just the excess.
   """
-  if wipe:
-    # Clear the cache and exit on error.
-    cmd = 'rm -rf %s/*' % cache_dir
-    if os.system(cmd) != 0:
-      _Log('Failed to clear the cache with %s' % cmd)
-      sys.exit(1)
-  else:
-    # Clear all but the last N cached updates
-    cmd = ('cd %s; ls -tr | head --lines=-%d | xargs rm -rf' %
-           (cache_dir, CACHED_ENTRIES))
-    if os.system(cmd) != 0:
-      _Log('Failed to clean up old delta cache files with %s' % cmd)
-      sys.exit(1)
+  # Clear the cache and exit on error.
+  cmd = 'rm -rf %s/*' % cache_dir
+  if os.system(cmd) != 0:
+    _Log('Failed to clear the cache with %s' % cmd)
+    sys.exit(1)
 
 
 def main():
@@ -642,8 +973,42 @@ def main():
   parser.add_option('--archive_dir',
                     metavar='PATH',
                     help='Enables serve-only mode. Serves archived builds only')
+  parser.add_option('--async_generation',
+                    action='store_true', default=False,
+                    help='answer update checks with no update while their '
+                    'payload is being generated, instead of blocking')
+  parser.add_option('--async_port',
+                    metavar='PORT', default=None, type='int',
+                    help='also serve update checks and API calls from an '
+                    'event loop based front end on this port')
+  parser.add_option('--async_workers',
+                    metavar='NUM', default=16, type='int',
+                    help='number of threads handling requests received by '
+                    'the event loop front end (default: 16)')
+  parser.add_option('--background_staging_workers',
+                    metavar='NUM',
+                    default=staging_scheduler.MAX_BACKGROUND_WORKERS,
+                    type='int',
+                    help='maximum number of concurrent background staging '
+                    'jobs (default: %d)' %
+                    staging_scheduler.MAX_BACKGROUND_WORKERS)
   parser.add_option('--board',
                     help='when pre-generating update, board for latest image')
+  parser.add_option('--cache_max_age',
+                    metavar='SECONDS', default=None, type='int',
+                    help='evict cached updates unused for this long '
+                         '(default: no limit)')
+  parser.add_option('--cache_max_bytes',
+                    metavar='BYTES', default=None, type='int',
+                    help='maximum size of cached updates (default: no limit)')
+  parser.add_option('--cache_max_entries',
+                    metavar='NUM', default=CACHED_ENTRIES, type='int',
+                    help='maximum number of cached updates (default: %d)' %
+                         CACHED_ENTRIES)
+  parser.add_option('--cache_min_free_bytes',
+                    metavar='BYTES', default=None, type='int',
+                    help='evict cached updates to keep this much disk space '
+                         'free (default: no limit)')
   parser.add_option('--clear_cache',
                     action='store_true', default=False,
                     help='clear out all cached updates and exit')
@@ -654,20 +1019,56 @@ def main():
                     metavar='PATH',
                     default=os.path.dirname(os.path.abspath(sys.argv[0])),
                     help='writable directory where static lives')
+  parser.add_option('--download_bandwidth_mb',
+                    metavar='MB', default=0, type='int',
+                    help='budget of all artifact downloads, in megabytes per '
+                    'second (default: unlimited)')
+  parser.add_option('--download_chunk_mb',
+                    metavar='MB', default=download_engine.CHUNK_SIZE >> 20,
+                    type='int',
+                    help='size of the byte ranges large artifacts are fetched '
+                    'in concurrently (default: %d)'
+                    % (download_engine.CHUNK_SIZE >> 20))
+  parser.add_option('--download_transfers',
+                    metavar='NUM', default=download_engine.MAX_TRANSFERS,
+                    type='int',
+                    help='maximum number of concurrent artifact transfers '
+                    '(default: %d)' % download_engine.MAX_TRANSFERS)
   parser.add_option('--exit',
                     action='store_true',
                     help='do not start server (yet pregenerate/clear cache)')
+  parser.add_option('--fast_cache_keys',
+                    action='store_true', default=False,
+                    help='key cached updates by sampled image fingerprints '
+                    'instead of full MD5 digests')
   parser.add_option('--for_vm',
                     dest='vm', action='store_true',
                     help='update is for a vm image')
+  parser.add_option('--generation_workers',
+                    metavar='NUM', default=2, type='int',
+                    help='maximum number of concurrent payload generations '
+                         '(default: 2)')
   parser.add_option('--host_log',
                     action='store_true', default=False,
                     help='record history of host update events (/api/hostlog)')
+  parser.add_option('--host_log_depth',
+                    metavar='NUM', default=autoupdate.HOST_LOG_DEPTH,
+                    type='int',
+                    help='number of most recent events recorded per host '
+                    '(default: %d)' % autoupdate.HOST_LOG_DEPTH)
+  parser.add_option('--host_log_dir',
+                    metavar='PATH',
+                    help='directory to persist host update events to, '
+                    'rather than keeping the most recent ones in memory')
   parser.add_option('--image',
                     metavar='FILE',
                     help='Force update using this image. Can only be used when '
                     'not in serve-only mode as it is used to generate a '
                     'payload.')
+  parser.add_option('--keep_tarballs',
+                    action='store_true', default=False,
+                    help='keep a copy of tarballs extracted with '
+                    '--stream_tarballs in the build directory')
   parser.add_option('--logfile',
                     metavar='PATH',
                     help='log output to this file instead of stdout')
@@ -701,6 +1102,42 @@ def main():
   parser.add_option('--src_image',
                     metavar='PATH', default='',
                     help='source image for generating delta updates from')
+  parser.add_option('--staging_workers',
+                    metavar='NUM', default=staging_scheduler.MAX_WORKERS,
+                    type='int',
+                    help='maximum number of concurrent staging jobs, other '
+                    'than background ones, see /api/jobs (default: %d)' %
+                    staging_scheduler.MAX_WORKERS)
+  parser.add_option('--storage_auth_file',
+                    metavar='PATH',
+                    help='file holding the Authorization header of requests '
+                    'of the http storage backend, e.g. "Bearer <token>"; it '
+                    'is read again when it changes (default: anonymous '
+                    'access, to public buckets only)')
+  parser.add_option('--storage_backend',
+                    type='choice', choices=gsutil_util.STORAGE_BACKENDS,
+                    default='gsutil',
+                    help='how to access Google Storage: by running gsutil, '
+                    'in-process over HTTP, or from a local directory standing '
+                    'in for it (default: gsutil)')
+  parser.add_option('--storage_location',
+                    metavar='URL_OR_PATH',
+                    help='endpoint of the http storage backend (default: %s), '
+                    'or root directory of the local one'
+                    % gsutil_util.GS_HTTP_ENDPOINT)
+  parser.add_option('--stream_tarballs',
+                    action='store_true', default=False,
+                    help='extract tarball artifacts while downloading them')
+  parser.add_option('--symbol_cache_mb',
+                    metavar='NUM', default=symbol_store.MAX_BYTES >> 20,
+                    type='int',
+                    help='megabytes of symbols extracted from symbol packs '
+                    'to keep (default: %d)' % (symbol_store.MAX_BYTES >> 20))
+  parser.add_option('--symbolicate_workers',
+                    metavar='NUM', default=symbolicator.MAX_WORKERS,
+                    type='int',
+                    help='maximum number of concurrent symbolications of '
+                    'minidumps (default: %d)' % symbolicator.MAX_WORKERS)
   parser.add_option('-t', '--test_image',
                     action='store_true',
                     help='whether or not to use test images')
@@ -709,6 +1146,20 @@ def main():
                     help='base URL for update images, other than the devserver')
   (options, _) = parser.parse_args()
 
+  try:
+    gsutil_util.SetStorageBackend(gsutil_util.CreateStorageBackend(
+        options.storage_backend, options.storage_location,
+        options.storage_auth_file))
+  except gsutil_util.GSUtilError as e:
+    parser.error(str(e))
+  download_engine.SetDownloadEngine(download_engine.DownloadEngine(
+      max_transfers=options.download_transfers,
+      chunk_size=options.download_chunk_mb << 20,
+      max_bytes_per_second=options.download_bandwidth_mb << 20,
+      partial_dir=os.path.join(options.data_dir, 'partial_downloads')))
+  build_artifact.SetStreamingExtraction(options.stream_tarballs,
+                                        keep_tarballs=options.keep_tarballs)
+
   devserver_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
   root_dir = os.path.realpath('%s/../..' % devserver_dir)
   serve_only = False
@@ -742,10 +1193,21 @@ def main():
       parser.error('Incompatible flags detected for serve_only mode.')
 
   elif os.path.exists(cache_dir):
-    _CleanCache(cache_dir, options.clear_cache)
+    if options.clear_cache:
+      _CleanCache(cache_dir)
   else:
     os.makedirs(cache_dir)
 
+  update_cache = None
+  if not serve_only:
+    update_cache = cache_manager.CacheManager(
+        cache_dir,
+        max_bytes=options.cache_max_bytes,
+        max_entries=options.cache_max_entries,
+        min_free_bytes=options.cache_min_free_bytes,
+        max_age=options.cache_max_age)
+    update_cache.Evict()
+
   _Log('Using cache directory %s' % cache_dir)
   _Log('Data dir is %s' % options.data_dir)
   _Log('Source root is %s' % root_dir)
@@ -753,7 +1215,7 @@ def main():
 
   # We allow global use here to share with cherrypy classes.
   # pylint: disable=W0603
-  global updater
+  global updater, static_server, stager, dump_symbolicator
   updater = autoupdate.Autoupdate(
       root_dir=root_dir,
       static_dir=static_dir,
@@ -772,13 +1234,32 @@ def main():
       remote_payload=options.remote_payload,
       max_updates=options.max_updates,
       host_log=options.host_log,
+      host_log_depth=options.host_log_depth,
+      host_log_dir=options.host_log_dir,
+      fast_cache_keys=options.fast_cache_keys,
+      async_generation=options.async_generation,
+      generation_workers=options.generation_workers,
+      cache_manager=update_cache,
   )
+  stager = staging_scheduler.StagingScheduler(
+      max_workers=options.staging_workers,
+      max_background_workers=options.background_staging_workers)
+  dump_symbolicator = symbolicator.Symbolicator(
+      os.path.join(static_dir, 'debug', 'breakpad'),
+      max_workers=options.symbolicate_workers,
+      symbol_store=symbol_store.SymbolStore(
+          static_dir, max_bytes=options.symbol_cache_mb << 20))
+  static_server = payload_server.PayloadServer(
+      os.path.join(devserver_dir, 'static'), cache_manager=update_cache)
 
   if options.pregenerate_update:
     updater.PreGenerateUpdate()
 
   # If the command line requested after setup, it's time to do it.
   if not options.exit:
+    if update_cache:
+      update_cache.Start()
+
     # Handle options that must be set globally in cherrypy.
     if options.production:
       cherrypy.config.update({'environment': 'production'})
@@ -788,7 +1269,20 @@ def main():
       cherrypy.config.update({'log.error_file': options.logfile,
                               'log.access_file': options.logfile})
 
-    cherrypy.quickstart(DevServerRoot(), config=_GetConfig(options))
+    config = _GetConfig(options)
+    if options.async_port:
+      frontend = async_frontend.AsyncFrontend(
+          cherrypy.tree, config['global']['server.socket_host'],
+          options.async_port, server_port=options.port,
+          workers=options.async_workers)
+      cherrypy.engine.subscribe('start', frontend.Start)
+      cherrypy.engine.subscribe('stop', frontend.Stop)
+    # Save what was indexed since the last saves of the payload index and of
+    # the fingerprint store.
+    cherrypy.engine.subscribe('stop', updater.payload_index.Flush)
+    cherrypy.engine.subscribe('stop', updater.fingerprints.Flush)
+
+    cherrypy.quickstart(DevServerRoot(), config=config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1085 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmarks for performance sensitive devserver code paths.
+
+Usage:
+  devserver_benchmark.py BENCHMARK [options] [args]
+
+Run with --help for the list of available benchmarks and their options.
+"""
+
+import datetime
+import distutils.version
+import gc
+import hashlib
+import httplib
+import json
+import optparse
+import os
+import random
+import re
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import zipfile
+from xml.dom import minidom
+
+import cherrypy
+
+import autoupdate_lib
+import build_artifact
+import build_catalog
+import common_util
+import control_file_index
+import download_engine
+import gsutil_util
+import minidump
+import payload_server
+import symbol_store
+import symbolicator
+import uploaded_manifest
+
+
+# An Omaha v3 update check, as sent by update_engine.
+_UPDATE_REQUEST = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="ChromeOSUpdateEngine-0.1.0.0" updaterversion="ChromeOSUpdateEngine-0.1.0.0" protocol="3.0" ismachine="1">
+    <os version="Indy" platform="Chrome OS" sp="0.11.254.2011_03_09_1814_i686"></os>
+    <app appid="{DEV-BUILD}" version="0.11.254.2011_03_09_1814" lang="en-US" track="developer-build" board="x86-generic" hardware_class="BETA DVT" delta_okay="true">
+        <updatecheck></updatecheck>
+        <event eventtype="3" eventresult="2" previousversion="0.11.216.2011_03_02_1358"></event>
+    </app>
+</request>
+"""
+
+
+def _Report(name, seconds, count=1, size=None):
+  """Prints the outcome of a single timed run."""
+  line = '%-40s %10.3f s' % (name, seconds)
+  if count > 1:
+    line += '  %12.1f ops/s' % (count / seconds)
+  if size is not None:
+    line += '  %10.1f MB/s' % (size / seconds / (1 << 20))
+  print line
+
+
+def _Time(func, *args, **kwargs):
+  """Returns the wall clock time it took to run func(*args, **kwargs)."""
+  start = time.time()
+  func(*args, **kwargs)
+  return time.time() - start
+
+
+def _CreateTestFile(size_mb):
+  """Creates a temporary file of random-ish content; returns its path."""
+  fd, path = tempfile.mkstemp(prefix='devserver_benchmark')
+  block = os.urandom(1 << 20)
+  with os.fdopen(fd, 'wb') as f:
+    for _ in range(size_mb):
+      f.write(block)
+  return path
+
+
+def _LegacyFileHash(file_path, hasher):
+  """Hashes a file in 8 KiB blocks, one digest per pass (the former path)."""
+  with open(file_path, 'rb') as fd:
+    while True:
+      block = fd.read(8192)
+      if not block:
+        break
+      hasher.update(block)
+  return hasher.digest()
+
+
+def _LegacyWaitUntilAvailable(to_wait_list, archive_url, delay):
+  """Polls for artifacts every 5-15 seconds, per request (the former path)."""
+  while True:
+    uploaded_list = gsutil_util.CatGS(
+        '%s/%s' % (archive_url, common_util.UPLOADED_LIST)).splitlines()
+    if common_util.IsAvailable(to_wait_list, uploaded_list):
+      return uploaded_list
+    time.sleep(delay + random.uniform(.5 * delay, 1.5 * delay))
+
+
+def _LegacyIsAvailable(pattern_list, uploaded_list):
+  """Searches each name for each pattern (the former path)."""
+  compiled_patterns = [re.compile(p) for p in pattern_list]
+  for pattern in compiled_patterns:
+    if not any(re.search(pattern, name) for name in uploaded_list):
+      return False
+  return True
+
+
+def _LegacyParsePayloadList(archive_url, payload_list):
+  """Scans the names for payloads with substring checks (the former path)."""
+  full_url = nton_url = mton_url = firmware_url = None
+  for payload in payload_list:
+    if '_full_' in payload:
+      full_url = '/'.join([archive_url, payload])
+    elif '_delta_' in payload:
+      from_version, to_version = payload.split('_')[1:3]
+      if from_version == to_version:
+        nton_url = '/'.join([archive_url, payload])
+      else:
+        mton_url = '/'.join([archive_url, payload])
+    elif build_artifact.FIRMWARE_ARCHIVE in payload:
+      firmware_url = '/'.join([archive_url, payload])
+  return full_url, nton_url, mton_url, firmware_url
+
+
+def _LegacyGetLatestBuildVersion(target_path, milestone=None):
+  """Parses every build of a target, per lookup (the former path)."""
+  builds = [distutils.version.LooseVersion(build) for build in
+            os.listdir(target_path)]
+  if milestone and builds:
+    builds = filter(lambda x: milestone.upper() in str(x), builds)
+  return str(max(builds))
+
+
+def _LegacySymbolicate(data, symbol_dir, stackwalk):
+  """Copy of the symbolication symbolicate_dump used to run per request."""
+  with tempfile.NamedTemporaryFile() as local:
+    local.write(data)
+    local.flush()
+    process = subprocess.Popen([stackwalk, local.name, symbol_dir],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stack, _ = process.communicate()
+  return stack
+
+
+def _LegacyGetControlFileList(static_dir, build):
+  """Walks the autotest tree of a build, per listing (the former path)."""
+  autotest_dir = os.path.join(static_dir, build, 'autotest/')
+  control_files = set()
+  for dir_path, _, files in os.walk(autotest_dir):
+    for file_entry in files:
+      if file_entry.startswith('control.') or file_entry == 'control':
+        control_files.add(os.path.join(dir_path,
+                                       file_entry).replace(autotest_dir, ''))
+  return '\n'.join(control_files)
+
+
+def _LegacyGetControlFile(static_dir, build, control_path):
+  """Resolves and reads a control file, per request (the former path)."""
+  control_path = os.path.join(static_dir, build, 'autotest', control_path)
+  if not common_util.SafeSandboxAccess(static_dir, control_path):
+    raise common_util.CommonUtilError('Invalid control file.')
+  with open(control_path, 'r') as control_file:
+    return control_file.read()
+
+
+class _CountingBackend(gsutil_util.LocalBackend):
+  """Counts the reads of objects."""
+
+  def __init__(self, root_dir):
+    gsutil_util.LocalBackend.__init__(self, root_dir)
+    self.reads = 0
+
+  def Cat(self, url):
+    self.reads += 1
+    return gsutil_util.LocalBackend.Cat(self, url)
+
+
+def BenchmarkBatch(options, _):
+  """Compares fetching control files one by one with one batch request.
+
+  Starts a devserver serving a build of --requests control files, and fetches
+  them all from it with a request each, then with one controlfiles_batch
+  request.
+  """
+  devserver_dir = os.path.dirname(os.path.abspath(__file__))
+  static_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  build = 'x86-mario-release/R30-4000.0.0-a1-b1'
+  control_paths = ['client/site_tests/test_%d/control' % i
+                   for i in range(options.requests)]
+  for path in control_paths:
+    path = os.path.join(static_dir, build, 'autotest', path)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write('SUITE = "bvt"\n' + 'x' * 2000)
+  with open(os.devnull, 'w') as devnull:
+    process = subprocess.Popen(
+        ['python', os.path.join(devserver_dir, 'devserver.py'),
+         '--archive_dir', static_dir, '--port', str(options.port),
+         '--production'],
+        stdout=devnull, stderr=devnull)
+  url = 'http://127.0.0.1:%d/' % options.port
+  try:
+    time.sleep(2)
+
+    def _FetchEach():
+      for path in control_paths:
+        urllib2.urlopen('%scontrolfiles?build=%s&control_path=%s' % (
+            url, build, path)).read()
+
+    def _FetchBatch():
+      urllib2.urlopen('%scontrolfiles_batch?build=%s&pattern=%s' % (
+          url, build, 'client/site_tests/*/control')).read()
+
+    # Warms up the control file index of the build.
+    _FetchBatch()
+    _Report('request per control file', _Time(_FetchEach))
+    _Report('controlfiles_batch', _Time(_FetchBatch))
+  finally:
+    os.kill(process.pid, signal.SIGKILL)
+    shutil.rmtree(static_dir)
+
+
+def BenchmarkControlFiles(options, _):
+  """Compares walking autotest trees with the control file index.
+
+  Lists the control files of a build whose autotest tree has --names files,
+  a tenth of them control files, then reads each control file; all of it
+  --requests times. Then expands a suite --requests times, first as the
+  scheduler does, fetching and parsing each control file, then in one go.
+  """
+  static_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  build = 'x86-mario-release/R30-4000.0.0-a1-b1'
+  autotest_dir = os.path.join(static_dir, build, 'autotest')
+  try:
+    control_paths = []
+    for i in range(options.names):
+      test_dir = os.path.join(autotest_dir, 'client', 'site_tests',
+                              'test_%d' % (i / 10))
+      if not os.path.isdir(test_dir):
+        os.makedirs(test_dir)
+      name = 'control' if i % 10 == 0 else 'file_%d.py' % i
+      with open(os.path.join(test_dir, name), 'w') as f:
+        f.write('SUITE = "bvt"\n' if name == 'control' else '\n')
+      if name == 'control':
+        control_paths.append(os.path.relpath(os.path.join(test_dir, name),
+                                             autotest_dir))
+
+    def _Requests(get_list, get_file):
+      for _ in range(options.requests):
+        get_list(static_dir, build)
+        for path in control_paths:
+          get_file(static_dir, build, path)
+
+    _Report('tree walk per listing',
+            _Time(_Requests, _LegacyGetControlFileList, _LegacyGetControlFile),
+            options.requests)
+    _Report('index, manifest written at staging',
+            _Time(control_file_index.WriteManifest,
+                  os.path.join(static_dir, build)))
+    _Report('control file index',
+            _Time(_Requests, common_util.GetControlFileList,
+                  common_util.GetControlFile), options.requests)
+
+    def _ExpandSuite():
+      for _ in range(options.requests):
+        suite = {}
+        for path in common_util.GetControlFileList(static_dir,
+                                                   build).splitlines():
+          contents = common_util.GetControlFile(static_dir, build, path)
+          if re.search(r'^SUITE\s*=\s*[\'"]bvt', contents, re.MULTILINE):
+            suite[path] = contents
+
+    def _GetSuite():
+      for _ in range(options.requests):
+        json.dumps(common_util.GetSuiteControlFiles(static_dir, build, 'bvt'))
+
+    _Report('suite expansion, per control file', _Time(_ExpandSuite),
+            options.requests)
+    _Report('suite expansion, suite metadata', _Time(_GetSuite),
+            options.requests)
+  finally:
+    shutil.rmtree(static_dir)
+
+
+def BenchmarkHash(options, args):
+  """Compares per-digest hashing passes with the single-pass hashing engine.
+
+  Args are files to hash; if none are given, a temporary file of --size_mb
+  megabytes is created. Run each case on a warm page cache (or drop caches in
+  between) to compare hashing rather than disk throughput.
+  """
+  files = args
+  temp_file = None
+  if not files:
+    temp_file = _CreateTestFile(options.size_mb)
+    files = [temp_file]
+
+  try:
+    total_size = sum(os.path.getsize(path) for path in files)
+    # Warm up the page cache so that the first case is not penalized.
+    for path in files:
+      _LegacyFileHash(path, hashlib.md5())
+
+    _Report('legacy sha1+sha256 (2 passes, 8 KiB)', _Time(
+        lambda: [(_LegacyFileHash(path, hashlib.sha1()),
+                  _LegacyFileHash(path, hashlib.sha256())) for path in files]),
+            size=total_size)
+    _Report('legacy sha1+sha256+md5 (3 passes)', _Time(
+        lambda: [(_LegacyFileHash(path, hashlib.sha1()),
+                  _LegacyFileHash(path, hashlib.sha256()),
+                  _LegacyFileHash(path, hashlib.md5())) for path in files]),
+            size=total_size)
+    _Report('GetFileSha1Sha256 (1 pass)', _Time(
+        lambda: [common_util.GetFileSha1Sha256(path) for path in files]),
+            size=total_size)
+    _Report('GetFileHashes sha1+sha256+md5 (1 pass)', _Time(
+        lambda: [common_util.GetFileHashes(path, True, True, True)
+                 for path in files]),
+            size=total_size)
+    if len(files) > 1:
+      _Report('GetFilesHashes sha1+sha256+md5 (batch)', _Time(
+          common_util.GetFilesHashes, files, True, True, True),
+              size=total_size)
+  finally:
+    if temp_file:
+      os.remove(temp_file)
+
+
+class _ServeRoot(object):
+  """Serves the benchmark directory through the payload server."""
+
+  def __init__(self, root_dir):
+    self._server = payload_server.PayloadServer(root_dir)
+
+  @cherrypy.expose
+  def payload(self, *args):
+    return self._server.Serve(args)
+
+
+def _Download(url, count, chunk_size=1 << 20):
+  """Downloads |url| |count| times, discarding the content."""
+  for _ in range(count):
+    connection = urllib2.urlopen(url)
+    while connection.read(chunk_size):
+      pass
+    connection.close()
+
+
+def BenchmarkServe(options, args):
+  """Compares payload downloads from staticdir and the payload server.
+
+  Serves a temporary file of --size_mb megabytes (or the file given as
+  argument) from an in-process server, and downloads it --requests times
+  over --clients concurrent connections from each handler.
+  """
+  temp_file = None
+  if args:
+    path = os.path.abspath(args[0])
+  else:
+    path = temp_file = _CreateTestFile(options.size_mb)
+  root_dir, name = os.path.split(path)
+  cherrypy.config.update({'environment': 'embedded',
+                          'server.socket_host': '127.0.0.1',
+                          'server.socket_port': options.port,
+                          'server.thread_pool': options.clients})
+  cherrypy.tree.mount(_ServeRoot(root_dir), '/', config={
+      '/payload': {'response.stream': True},
+      '/staticdir': {'tools.staticdir.on': True,
+                     'tools.staticdir.dir': root_dir}})
+  cherrypy.engine.start()
+  try:
+    size = os.path.getsize(path) * options.requests
+    for handler in ('staticdir', 'payload'):
+      url = 'http://127.0.0.1:%d/%s/%s' % (options.port, handler, name)
+      _Download(url, 1)
+      per_client = options.requests / options.clients
+      clients = [threading.Thread(target=_Download, args=(url, per_client))
+                 for _ in range(options.clients)]
+      start = time.time()
+      for client in clients:
+        client.start()
+      for client in clients:
+        client.join()
+      _Report('%s (%d clients)' % (handler, options.clients),
+              time.time() - start, count=options.requests, size=size)
+  finally:
+    cherrypy.engine.exit()
+    if temp_file:
+      os.remove(temp_file)
+
+
+def _Ping(port, deadline, latencies):
+  """Sends update checks over one connection until |deadline|."""
+  connection = httplib.HTTPConnection('127.0.0.1', port)
+  while time.time() < deadline:
+    start = time.time()
+    try:
+      connection.request('POST', '/update', _UPDATE_REQUEST)
+      connection.getresponse().read()
+    except (httplib.HTTPException, IOError):
+      connection.close()
+      connection = httplib.HTTPConnection('127.0.0.1', port)
+      continue
+    latencies.append(time.time() - start)
+  connection.close()
+
+
+def BenchmarkPing(options, args):
+  """Measures update check throughput and latency of both front ends.
+
+  Starts a devserver serving the payload given as argument (or the test
+  payload) with the event loop front end enabled, and keeps --clients
+  connections sending update checks for --duration seconds to the CherryPy
+  server, then to the event loop front end.
+  """
+  devserver_dir = os.path.dirname(os.path.abspath(__file__))
+  payload = (args[0] if args else
+             os.path.join(devserver_dir, 'testdata', 'devserver', 'update.gz'))
+  archive_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  shutil.copy(payload, os.path.join(archive_dir, 'update.gz'))
+  async_port = options.port + 1
+  with open(os.devnull, 'w') as devnull:
+    process = subprocess.Popen(
+        ['python', os.path.join(devserver_dir, 'devserver.py'),
+         '--archive_dir', archive_dir, '--port', str(options.port),
+         '--async_port', str(async_port), '--production'],
+        stdout=devnull, stderr=devnull)
+  try:
+    time.sleep(2)
+    for name, port in (('cherrypy', options.port), ('event loop', async_port)):
+      latencies = []
+      deadline = time.time() + options.duration
+      clients = [threading.Thread(target=_Ping,
+                                  args=(port, deadline, latencies))
+                 for _ in range(options.clients)]
+      start = time.time()
+      for client in clients:
+        client.start()
+      for client in clients:
+        client.join()
+      elapsed = time.time() - start
+      latencies.sort()
+      if not latencies:
+        print '%-40s no update checks answered' % name
+        continue
+      _Report('%s (%d clients)' % (name, options.clients), elapsed,
+              count=len(latencies))
+      print '%-40s p50 %8.1f ms  p99 %8.1f ms' % (
+          '', latencies[len(latencies) / 2] * 1000,
+          latencies[int(len(latencies) * 0.99)] * 1000)
+  finally:
+    os.kill(process.pid, signal.SIGKILL)
+    shutil.rmtree(archive_dir)
+
+
+def _LegacyParseUpdateRequest(request_string):
+  """Parses an update request into a minidom DOM (the former path)."""
+  request_dom = minidom.parseString(request_string)
+  protocol = request_dom.firstChild.getAttribute('protocol')
+  app = request_dom.firstChild.getElementsByTagName('app')[0]
+  event = request_dom.getElementsByTagName('event')
+  update_check = request_dom.getElementsByTagName('updatecheck')
+  return protocol, app, event, update_check
+
+
+def _CountRetainedObjects(func, *args):
+  """Returns how many objects the result of func(*args) keeps alive."""
+  gc.collect()
+  before = len(gc.get_objects())
+  result = func(*args)
+  gc.collect()
+  retained = len(gc.get_objects()) - before
+  del result
+  return retained
+
+
+def BenchmarkParse(options, args):
+  """Compares the cost of parsing update requests with minidom and expat.
+
+  Parses the update request in the file given as argument (or a canned 3.0
+  update check) --requests times with each parser.
+  """
+  request = _UPDATE_REQUEST
+  if args:
+    with open(args[0]) as request_file:
+      request = request_file.read()
+  for name, parser in (('minidom', _LegacyParseUpdateRequest),
+                       ('expat', autoupdate_lib.ParseUpdateRequest)):
+    seconds = _Time(lambda: [parser(request)
+                             for _ in xrange(options.requests)])
+    _Report(name, seconds, count=options.requests)
+    print '%-40s %8.1f us/request  %6d objects retained/request' % (
+        '', seconds / options.requests * 1000000,
+        _CountRetainedObjects(parser, request))
+
+
+def _LegacyGetUpdateResponse(sha1, sha256, size, url, is_delta_format,
+                             protocol, critical_update=False):
+  """Substitutes the whole response template per call (the former path)."""
+  response_values = {'appid': autoupdate_lib.APP_ID,
+                     'time_elapsed': autoupdate_lib.GetSecondsSinceMidnight()}
+  response_values['sha1'] = sha1
+  response_values['sha256'] = sha256
+  response_values['size'] = size
+  response_values['url'] = url
+  (codebase, filename) = os.path.split(url)
+  response_values['codebase'] = codebase
+  response_values['filename'] = filename
+  response_values['is_delta_format'] = is_delta_format
+  extra_attributes = []
+  if critical_update:
+    date_str = datetime.date.today().strftime('%Y%m%d')
+    extra_attributes.append('deadline="%s"' % date_str)
+  response_values['extra_attr'] = ' '.join(extra_attributes)
+  return autoupdate_lib.GetSubstitutedResponse(
+      autoupdate_lib.UPDATE_RESPONSE, protocol, response_values)
+
+
+def BenchmarkRespond(options, _):
+  """Compares per-call and pre-rendered update response generation.
+
+  Renders --requests critical 3.0 update responses for one payload with each
+  implementation.
+  """
+  args = ('kGcOinJ0vA8vdYX53FN0F5BdwfY=',
+          'ZwlZ2vNsKAaC7ExXtSl7t+vuT3GuwUoXpyDrRuqvw8Q=', 36,
+          'http://devserver:8080/static/archive/update.gz', False, '3.0', True)
+  for name, func in (('substituted per call', _LegacyGetUpdateResponse),
+                     ('pre-rendered', autoupdate_lib.GetUpdateResponse)):
+    _Report(name, _Time(lambda: [func(*args)
+                                 for _ in xrange(options.requests)]),
+            count=options.requests)
+
+
+# Stands in for gsutil in the storage benchmark: a Python interpreter that
+# fetches gs://PATH from the benchmark server at http://127.0.0.1:PORT/PATH.
+_GSUTIL_STAND_IN = '''
+import sys, urllib2
+sys.stdout.write(urllib2.urlopen(
+    'http://127.0.0.1:%d/' + sys.argv[2][len('gs://'):]).read())
+'''
+
+
+def BenchmarkStorage(options, _):
+  """Compares the per-call overhead of the storage backends.
+
+  Reads a small object --requests times from an in-process HTTP server, by
+  running a Python interpreter standing in for gsutil for each read, and
+  through the HTTP backend with and without connection reuse.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  os.mkdir(os.path.join(root_dir, 'bucket'))
+  with open(os.path.join(root_dir, 'bucket', 'UPLOADED'), 'w') as f:
+    f.write('chromeos_R24-3000.0.0_x86-generic_full_dev.bin\n' * 20)
+  stand_in = os.path.join(root_dir, 'gsutil.py')
+  with open(stand_in, 'w') as f:
+    f.write(_GSUTIL_STAND_IN % options.port)
+  cherrypy.config.update({'environment': 'embedded',
+                          'server.socket_host': '127.0.0.1',
+                          'server.socket_port': options.port})
+  cherrypy.tree.mount(None, '/', config={
+      '/': {'tools.staticdir.on': True, 'tools.staticdir.dir': root_dir}})
+  cherrypy.engine.start()
+  try:
+    url = 'gs://bucket/UPLOADED'
+    endpoint = 'http://127.0.0.1:%d' % options.port
+    for name, backend in (
+        ('gsutil process', gsutil_util.GSUtilBackend(
+            '%s %s' % (sys.executable, stand_in))),
+        ('http, connection per call', gsutil_util.HttpBackend(
+            endpoint, max_idle=0)),
+        ('http, pooled connection', gsutil_util.HttpBackend(endpoint))):
+      backend.Cat(url)
+      _Report(name, _Time(lambda: [backend.Cat(url)
+                                   for _ in xrange(options.requests)]),
+              count=options.requests)
+  finally:
+    cherrypy.engine.exit()
+    shutil.rmtree(root_dir)
+
+
+class _ThrottledStorageRoot(object):
+  """Serves files with byte ranges, each response at a limited rate.
+
+  This mimics the per-stream throughput limit of Google Storage downloads.
+  """
+
+  def __init__(self, root_dir, bytes_per_second):
+    self._root_dir = root_dir
+    self._bytes_per_second = bytes_per_second
+
+  @cherrypy.expose
+  def default(self, *args):
+    path = os.path.join(self._root_dir, *args)
+    size = os.path.getsize(path)
+    ranges = payload_server.ParseRange(
+        cherrypy.request.headers.get('Range'), size)
+    start, stop = ranges[0] if ranges else (0, size)
+    if ranges:
+      cherrypy.response.status = 206
+    cherrypy.response.headers['Content-Length'] = str(stop - start)
+    if cherrypy.request.method == 'HEAD':
+      return ''
+
+    def _Stream():
+      block_size = 256 << 10
+      with open(path, 'rb') as f:
+        f.seek(start)
+        for offset in xrange(start, stop, block_size):
+          data = f.read(min(block_size, stop - offset))
+          time.sleep(len(data) / float(self._bytes_per_second))
+          yield data
+    return _Stream()
+
+
+def BenchmarkStage(options, _):
+  """Compares serial whole-object and concurrent chunked artifact downloads.
+
+  Downloads an artifact of --size_mb megabytes and three of a quarter of
+  that from an in-process server limiting each response to --stream_mb
+  megabytes per second, one after the other and with the download engine.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  bucket_dir = os.path.join(root_dir, 'bucket')
+  os.mkdir(bucket_dir)
+  sizes = [options.size_mb] + [options.size_mb / 4] * 3
+  for index, size_mb in enumerate(sizes):
+    with open(os.path.join(bucket_dir, 'artifact%d' % index), 'wb') as f:
+      f.truncate(size_mb << 20)
+  urls = ['gs://bucket/artifact%d' % index for index in range(len(sizes))]
+  dst_dir = os.path.join(root_dir, 'dst')
+  os.mkdir(dst_dir)
+  cherrypy.config.update({'environment': 'embedded',
+                          'server.socket_host': '127.0.0.1',
+                          'server.socket_port': options.port,
+                          'server.thread_pool': 16})
+  cherrypy.tree.mount(_ThrottledStorageRoot(
+      root_dir, options.stream_mb << 20), '/', config={
+          '/': {'response.stream': True}})
+  cherrypy.engine.start()
+  try:
+    backend = gsutil_util.HttpBackend('http://127.0.0.1:%d' % options.port)
+    gsutil_util.SetStorageBackend(backend)
+    _Report('serial, whole objects', _Time(
+        lambda: [backend.Copy(url, dst_dir) for url in urls]),
+            size=sum(sizes) << 20)
+
+    engine = download_engine.DownloadEngine(
+        max_transfers=options.clients, chunk_size=16 << 20)
+    def _DownloadAll():
+      threads = [threading.Thread(target=engine.Download,
+                                  args=(url, os.path.join(dst_dir, str(index))))
+                 for index, url in enumerate(urls)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+    _Report('engine, %d transfers' % options.clients, _Time(_DownloadAll),
+            size=sum(sizes) << 20)
+  finally:
+    cherrypy.engine.exit()
+    shutil.rmtree(root_dir)
+
+
+def _StartStorageServer(options, root_dir):
+  """Serves root_dir as throttled storage, and downloads artifacts from it."""
+  cherrypy.config.update({'environment': 'embedded',
+                          'server.socket_host': '127.0.0.1',
+                          'server.socket_port': options.port})
+  cherrypy.tree.mount(_ThrottledStorageRoot(
+      root_dir, options.stream_mb << 20), '/', config={
+          '/': {'response.stream': True}})
+  cherrypy.engine.start()
+  gsutil_util.SetStorageBackend(
+      gsutil_util.HttpBackend('http://127.0.0.1:%d' % options.port))
+  download_engine.SetDownloadEngine(download_engine.DownloadEngine())
+
+
+def BenchmarkExtract(options, _):
+  """Compares extracting a tarball after and while downloading it.
+
+  Stages a gzipped tarball of about --size_mb megabytes from an in-process
+  server limiting each response to --stream_mb megabytes per second.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  bucket_dir = os.path.join(root_dir, 'bucket')
+  os.mkdir(bucket_dir)
+  content = _CreateTestFile(options.size_mb)
+  try:
+    subprocess.check_call(['tar', 'czf', os.path.join(bucket_dir, 'test.tgz'),
+                           '-C', os.path.dirname(content),
+                           os.path.basename(content)])
+  finally:
+    os.remove(content)
+  _StartStorageServer(options, root_dir)
+  try:
+    size = os.path.getsize(os.path.join(bucket_dir, 'test.tgz'))
+    for name, streaming in (('download, then extract', False),
+                            ('extract while downloading', True)):
+      build_artifact.SetStreamingExtraction(streaming)
+      stage_dir = tempfile.mkdtemp(dir=root_dir)
+      artifact = build_artifact.TarballBuildArtifact(
+          'gs://bucket/test.tgz', os.path.join(stage_dir, 'tmp'),
+          os.path.join(stage_dir, 'install'))
+      _Report(name, _Time(lambda: (artifact.Download(), artifact.Stage())),
+              size=size)
+      shutil.rmtree(stage_dir)
+  finally:
+    cherrypy.engine.exit()
+    shutil.rmtree(root_dir)
+
+
+def BenchmarkImages(options, _):
+  """Compares staging one image after and without downloading image.zip.
+
+  The archive holds three images of --size_mb / 3 megabytes, served by an
+  in-process server limiting each response to --stream_mb megabytes per
+  second.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  bucket_dir = os.path.join(root_dir, 'bucket')
+  os.mkdir(bucket_dir)
+  archive_path = os.path.join(bucket_dir, build_artifact.IMAGE_ARCHIVE)
+  archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED,
+                            allowZip64=True)
+  for name in ('coreos_base_image.bin', 'coreos_test_image.bin',
+               'recovery_image.bin'):
+    image = _CreateTestFile(max(1, options.size_mb / 3))
+    try:
+      archive.write(image, name)
+    finally:
+      os.remove(image)
+  archive.close()
+
+  _StartStorageServer(options, root_dir)
+  try:
+    for name, download in (
+        ('download, then unzip', build_artifact.BuildArtifact.Download),
+        ('extract from storage', build_artifact.ZipfileBuildArtifact.Download)):
+      stage_dir = tempfile.mkdtemp(dir=root_dir)
+      artifact = build_artifact.ZipfileBuildArtifact(
+          'gs://bucket/' + build_artifact.IMAGE_ARCHIVE,
+          os.path.join(stage_dir, 'tmp'), os.path.join(stage_dir, 'install'),
+          unzip_file_list=[build_artifact.TEST_IMAGE])
+      _Report(name, _Time(lambda: (download(artifact), artifact.Stage())))
+      shutil.rmtree(stage_dir)
+  finally:
+    cherrypy.engine.exit()
+    shutil.rmtree(root_dir)
+
+
+def BenchmarkWait(options, _):
+  """Compares per-request polling with the shared availability watcher.
+
+  --clients requests wait for an artifact uploaded 3 seconds after they
+  start; reports the mean latency after the upload and the storage reads.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  archive_dir = os.path.join(root_dir, 'bucket', 'build')
+  os.makedirs(archive_dir)
+  manifest_path = os.path.join(archive_dir, common_util.UPLOADED_LIST)
+  backend = _CountingBackend(root_dir)
+  gsutil_util.SetStorageBackend(backend)
+  try:
+    for name, wait in (
+        ('per-request polling', lambda: _LegacyWaitUntilAvailable(
+            ['update.gz'], 'gs://bucket/build', 10)),
+        ('availability watcher', lambda: common_util.WaitUntilAvailable(
+            ['update.gz'], 'gs://bucket/build', 'update'))):
+      with open(manifest_path, 'w') as f:
+        f.write('debug.tgz\n')
+      backend.reads = 0
+      latencies = []
+      upload_time = time.time() + 3
+
+      def _Client():
+        wait()
+        latencies.append(time.time() - upload_time)
+
+      clients = [threading.Thread(target=_Client)
+                 for _ in range(options.clients)]
+      for client in clients:
+        client.start()
+      time.sleep(upload_time - time.time())
+      with open(manifest_path, 'w') as f:
+        f.write('debug.tgz\nupdate.gz\n')
+      for client in clients:
+        client.join()
+      print '%-40s %10.3f s  %12d reads' % (
+          name, sum(latencies) / len(latencies), backend.reads)
+  finally:
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(root_dir)
+
+
+def BenchmarkLatest(options, _):
+  """Compares listing builds per lookup with the indexed build catalog.
+
+  Looks up --requests times the latest build of a target of --names builds,
+  and the latest build of one of its milestones.
+  """
+  target_path = tempfile.mkdtemp(prefix='devserver_benchmark')
+  try:
+    for i in range(options.names):
+      os.mkdir(os.path.join(target_path, 'R%d-%d.%d.0-a1-b%d' % (
+          20 + i % 10, 2000 + i / 10, i % 10, i)))
+    # Lets the catalog trust the mtime of the target directory right away.
+    os.utime(target_path, (time.time() - 60,) * 2)
+    catalog = build_catalog.BuildCatalog()
+
+    def _Lookups(get_latest):
+      for _ in range(options.requests):
+        get_latest(target_path)
+        get_latest(target_path, 'R25')
+
+    _Report('per-lookup listing', _Time(_Lookups, _LegacyGetLatestBuildVersion),
+            options.requests * 2)
+    _Report('build catalog, first lookup',
+            _Time(catalog.GetLatestBuild, target_path))
+    _Report('build catalog', _Time(_Lookups, catalog.GetLatestBuild),
+            options.requests * 2)
+  finally:
+    shutil.rmtree(target_path)
+
+
+def BenchmarkMatch(options, _):
+  """Compares per-name pattern matching with the compiled manifest matcher.
+
+  Checks --requests times whether the artifacts a staging request waits for
+  are in a manifest of --names artifacts, as polls of an unchanged manifest
+  do, and parses its payloads each time.
+  """
+  names = ['autotest/packages/client-test-test_%d.tar.bz2' % i
+           for i in range(options.names - 6)]
+  names += ['chromeos_R30-4000.0.0_x86-mario_full_dev.bin',
+            'chromeos_R30-4000.0.0_R30-4000.0.0_x86-mario_delta_dev.bin',
+            'chromeos_R29-3900.0.0_R30-4000.0.0_x86-mario_delta_dev.bin',
+            'debug.tgz', build_artifact.FIRMWARE_ARCHIVE,
+            build_artifact.AUTOTEST_PACKAGE]
+  random.shuffle(names)
+  to_wait_list = ['_full_', build_artifact.AUTOTEST_PACKAGE, r'\.tgz$']
+  archive_url = 'gs://bucket/build'
+
+  def _Legacy():
+    for _ in range(options.requests):
+      _LegacyIsAvailable(to_wait_list, names)
+      _LegacyParsePayloadList(archive_url, names)
+
+  def _Matcher():
+    manifest = uploaded_manifest.UploadedManifest(names)
+    for _ in range(options.requests):
+      common_util.IsAvailable(to_wait_list, manifest)
+      common_util.ParsePayloadList(archive_url, manifest)
+
+  _Report('per-name matching', _Time(_Legacy), options.requests)
+  _Report('compiled manifest matcher', _Time(_Matcher), options.requests)
+
+
+def _BuildMinidump(modules):
+  """Returns a minidump with a module list stream of ELF |modules|.
+
+  Args:
+    modules: list of (code file, build id) of the modules.
+  """
+  header_size = 32 + 12
+  list_size = 4 + len(modules) * 108
+  data_offset = header_size + list_size
+  module_entries = []
+  blobs = ''
+  for code_file, build_id in modules:
+    name_rva = data_offset + len(blobs)
+    encoded = code_file.encode('utf-16-le')
+    blobs += struct.pack('<I', len(encoded)) + encoded
+    cv_rva = data_offset + len(blobs)
+    cv_record = struct.pack('<I', 0x4270454c) + build_id  # BpEL
+    blobs += cv_record
+    module_entries.append(struct.pack(
+        '<QIIII52xII8x16x', 0x1000, 0x100, 0, 0, name_rva, len(cv_record),
+        cv_rva))
+  return (struct.pack('<IIIIIIQ', 0x504d444d, 0xa793, 1, 32, 0, 0, 0) +
+          struct.pack('<III', 4, list_size, header_size) +
+          struct.pack('<I', len(modules)) + ''.join(module_entries) + blobs)
+
+
+def BenchmarkSymbolicate(options, _):
+  """Compares a stackwalk per request with the symbolication service.
+
+  --clients clients symbolicate --requests minidumps between them, a burst of
+  crashes of 4 distinct minidumps, with a stand-in for minidump_stackwalk
+  taking 0.1 seconds per minidump. The minidumps reference 6 of 12 modules,
+  half of whose symbols are staged, the other half only packed, so that the
+  service looks them up in the symbol cache and extracts them from the
+  symbol pack.
+  """
+  temp_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  stackwalk = os.path.join(temp_dir, 'stackwalk')
+  with open(stackwalk, 'w') as f:
+    f.write('#!/bin/sh\nsleep 0.1\nwc -c < "$1"\n')
+  os.chmod(stackwalk, 0755)
+  code_files = [('/usr/lib/lib%d.so' % i, os.urandom(20)) for i in range(12)]
+  minidumps = [_BuildMinidump(random.sample(code_files, 6)) for _ in range(4)]
+  modules = set(module for data in minidumps
+                for module in minidump.GetModules(data))
+  dumps = [minidumps[i / options.clients % 4]
+           for i in range(options.requests)]
+
+  # Symbols of all modules as staged before symbol packs, of half of them
+  # as staged now, and a symbol pack with those of the other half.
+  legacy_dir = os.path.join(temp_dir, 'legacy')
+  symbol_dir = os.path.join(temp_dir, 'breakpad')
+  content_dir = os.path.join(temp_dir, 'content')
+  for i, module in enumerate(sorted(modules)):
+    for root_dir in (legacy_dir,
+                     symbol_dir if i % 2 else
+                     os.path.join(content_dir, 'debug', 'breakpad')):
+      path = os.path.join(root_dir, minidump.GetSymbolPath(module))
+      os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write('MODULE Linux x86_64 %s %s\n' % (module.debug_id,
+                                                 module.debug_file))
+        f.write('FUNC 0 400 0 Function(int)\n' * 1000)
+  tarball_path = os.path.join(temp_dir, 'debug.tgz')
+  subprocess.check_call(['tar', 'czf', tarball_path, '-C', content_dir,
+                         'debug'])
+  static_dir = os.path.join(temp_dir, 'static')
+  os.makedirs(os.path.join(static_dir, symbol_store.PACK_DIR))
+  symbol_store.WritePack(tarball_path, os.path.join(
+      static_dir, symbol_store.PACK_DIR, 'build.pack'))
+
+  def _Clients(symbolicate):
+    threads = [threading.Thread(target=lambda i=i: [
+        symbolicate(data) for data in dumps[i::options.clients]])
+               for i in range(options.clients)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  try:
+    _Report('stackwalk per request', _Time(
+        _Clients, lambda data: _LegacySymbolicate(data, legacy_dir,
+                                                  stackwalk)),
+            options.requests)
+    service = symbolicator.Symbolicator(
+        symbol_dir, stackwalk=stackwalk,
+        symbol_store=symbol_store.SymbolStore(static_dir))
+    _Report('symbolication service', _Time(_Clients, service.Symbolicate),
+            options.requests)
+    _Report('symbolication service, warm', _Time(_Clients,
+                                                 service.Symbolicate),
+            options.requests)
+    print json.dumps(service.GetStats(), sort_keys=True)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def BenchmarkSymbols(options, _):
+  """Compares extracting all debug symbols with extracting them on demand.
+
+  Stages a debug tarball of --names / 50 modules with about 1 MB of breakpad
+  symbols and 2 MB of debug information each, then makes the symbols of 8 of
+  them available, as for a minidump.
+  """
+  root_dir = tempfile.mkdtemp(prefix='devserver_benchmark')
+  content_dir = os.path.join(root_dir, 'content')
+  tarball_path = os.path.join(root_dir, 'debug.tgz')
+  modules = [minidump.Module('lib%d.so' % i, 'lib%d.so' % i, '%033X' % i)
+             for i in range(max(options.names / 50, 8))]
+  for module in modules:
+    path = os.path.join(content_dir, 'debug', 'breakpad',
+                        minidump.GetSymbolPath(module))
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write('MODULE Linux x86_64 %s %s\n' % (module.debug_id,
+                                               module.debug_file))
+      for address in range(0, 1 << 21, 64):
+        if not address % 1024:
+          f.write('FUNC %x 400 0 Namespace::Function%d(int)\n' % (
+              address, random.randint(0, 1 << 16)))
+        f.write('%x %x %d %d\n' % (address, random.randint(1, 64),
+                                    random.randint(1, 5000),
+                                    random.randint(1, 200)))
+    with open(os.path.join(content_dir, 'debug',
+                           module.debug_file + '.debug'), 'w') as f:
+      f.write(os.urandom(1 << 20) + '\0' * (1 << 20))
+  subprocess.check_call(['tar', 'czf', tarball_path, '-C', content_dir,
+                         'debug'])
+  shutil.rmtree(content_dir)
+  wanted = random.sample(modules, 8)
+
+  try:
+    stage_dir = os.path.join(root_dir, 'legacy')
+    artifact = build_artifact.DebugTarballBuildArtifact(
+        'gs://bucket/build/debug.tgz', os.path.join(stage_dir, 'tmp'),
+        os.path.join(stage_dir, 'install'))
+    shutil.copy(tarball_path, os.path.join(stage_dir, 'tmp'))
+    _Report('stage, extracting all symbols', _Time(artifact.Stage))
+
+    static_dir = os.path.join(root_dir, 'static')
+    artifact = build_artifact.SymbolTarballBuildArtifact(
+        'gs://bucket/build/debug.tgz', os.path.join(static_dir, 'tmp'),
+        os.path.join(static_dir, symbol_store.PACK_DIR, 'build.pack'))
+    shutil.copy(tarball_path, os.path.join(static_dir, 'tmp'))
+    _Report('stage, packing symbols', _Time(artifact.Stage))
+    store = symbol_store.SymbolStore(static_dir)
+    _Report('extract symbols of 8 modules', _Time(store.Fetch, wanted))
+    _Report('extracted symbols of 8 modules', _Time(store.Fetch, wanted))
+    print json.dumps(store.GetStats(), sort_keys=True)
+  finally:
+    shutil.rmtree(root_dir)
+
+
+# Available benchmarks, keyed by name.
+_BENCHMARKS = {
+    'batch': BenchmarkBatch,
+    'controlfiles': BenchmarkControlFiles,
+    'extract': BenchmarkExtract,
+    'hash': BenchmarkHash,
+    'images': BenchmarkImages,
+    'latest': BenchmarkLatest,
+    'match': BenchmarkMatch,
+    'parse': BenchmarkParse,
+    'ping': BenchmarkPing,
+    'respond': BenchmarkRespond,
+    'serve': BenchmarkServe,
+    'stage': BenchmarkStage,
+    'storage': BenchmarkStorage,
+    'symbols': BenchmarkSymbols,
+    'symbolicate': BenchmarkSymbolicate,
+    'wait': BenchmarkWait,
+}
+
+
+def main():
+  usage = ('usage: %prog BENCHMARK [options] [args]\n\nBenchmarks:\n' +
+           '\n'.join('  %-10s %s' % (name, func.__doc__.splitlines()[0])
+                     for name, func in sorted(_BENCHMARKS.iteritems())))
+  parser = optparse.OptionParser(usage=usage)
+  parser.add_option('--clients',
+                    default=4, type='int',
+                    help='number of concurrent clients (default: 4)')
+  parser.add_option('--duration',
+                    default=10, type='int',
+                    help='seconds to run load benchmarks for (default: 10)')
+  parser.add_option('--names',
+                    default=5000, type='int',
+                    help='number of artifacts in generated manifests, or '
+                    'builds in generated targets (default: 5000)')
+  parser.add_option('--port',
+                    default=18080, type='int',
+                    help='port for benchmark servers to use (default: 18080)')
+  parser.add_option('--requests',
+                    default=16, type='int',
+                    help='number of requests to send (default: 16)')
+  parser.add_option('--size_mb',
+                    default=1024, type='int',
+                    help='size of generated test files (default: 1024)')
+  parser.add_option('--stream_mb',
+                    default=16, type='int',
+                    help='throughput of each simulated storage download, in '
+                    'megabytes per second (default: 16)')
+  (options, args) = parser.parse_args()
+
+  if not args or args[0] not in _BENCHMARKS:
+    parser.error('Please specify one of the available benchmarks.')
+
+  _BENCHMARKS[args[0]](options, args[1:])
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -58,6 +58,9 @@ API_SET_UPDATE_BAD_URL = 'http://127.0.0.1:8080/api/setnextupdate/'
 API_SET_UPDATE_URL = API_SET_UPDATE_BAD_URL + '127.0.0.1'
 
 API_SET_UPDATE_REQUEST = 'new_update-test/the-new-update'
+
+API_JOBS_URL = 'http://127.0.0.1:8080/api/jobs'
+API_CANCEL_JOB_URL = 'http://127.0.0.1:8080/api/canceljob?job_id=1'
 DEVSERVER_STARTUP_DELAY = 1
 
 
@@ -160,6 +163,24 @@ class DevserverTest(unittest.TestCase):
   def testHandleUpdateV3(self):
     self.VerifyHandleUpdate('3.0')
 
+  def testStaticRangeRequest(self):
+    """Tests resuming a payload download with a validated range request."""
+    pid = self._StartServer()
+    try:
+      connection = urllib2.urlopen(STATIC_URL + TEST_IMAGE_NAME)
+      etag = connection.info()['ETag']
+      connection.close()
+
+      request = urllib2.Request(
+          STATIC_URL + TEST_IMAGE_NAME,
+          headers={'Range': 'bytes=12-', 'If-Range': etag})
+      connection = urllib2.urlopen(request)
+      self.assertEqual(206, connection.getcode())
+      self.assertEqual('developers, developers!\n', connection.read())
+      connection.close()
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
   def testApiBadSetNextUpdateRequest(self):
     """Tests sending a bad setnextupdate request."""
     pid = self._StartServer()
@@ -226,6 +247,24 @@ class DevserverTest(unittest.TestCase):
     finally:
       os.kill(pid, signal.SIGKILL)
 
+  def testApiJobs(self):
+    """Tests listing staging jobs, and cancelling one that is not queued."""
+    pid = self._StartServer()
+    try:
+      connection = urllib2.urlopen(API_JOBS_URL)
+      response = connection.read()
+      connection.close()
+      self.assertEqual(json.loads(response),
+                       {'queued': [], 'running': [], 'finished': []})
+
+      try:
+        urllib2.urlopen(API_CANCEL_JOB_URL)
+        self.fail('Cancelling an unknown job did not fail!')
+      except urllib2.HTTPError, e:
+        self.assertEqual(e.code, 409)
+    finally:
+      os.kill(pid, signal.SIGKILL)
+
 
 if __name__ == '__main__':
   unittest.main()
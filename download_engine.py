@@ -0,0 +1,310 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Concurrent, chunked and resumable downloads from Google Storage."""
+
+import cStringIO
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from multiprocessing import pool
+
+import gsutil_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('DOWNLOAD', message, *args)
+
+
+# Default size of the byte ranges large objects are fetched in.
+CHUNK_SIZE = 32 << 20
+# Default number of concurrent transfers.
+MAX_TRANSFERS = 8
+# Size of the byte ranges streamed objects are fetched in.
+STREAM_CHUNK_SIZE = 8 << 20
+# Number of times the missing chunks of an object are fetched again.
+_CHUNK_ROUNDS = 3
+# Age after which abandoned partial downloads are removed.
+_PARTIAL_MAX_AGE = 24 * 60 * 60
+_CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+class _RateLimiter(object):
+  """A token bucket shared by all transfers of an engine."""
+
+  def __init__(self, bytes_per_second):
+    self._rate = float(bytes_per_second)
+    self._lock = threading.Lock()
+    self._available = self._rate
+    self._last = time.time()
+
+  def Consume(self, count):
+    """Blocks until |count| bytes may be transferred."""
+    with self._lock:
+      now = time.time()
+      self._available = min(self._rate,
+                            self._available + (now - self._last) * self._rate)
+      self._last = now
+      self._available -= count
+      delay = -self._available / self._rate
+    if delay > 0:
+      time.sleep(delay)
+
+
+class _ThrottledFile(object):
+  """Wraps a file, metering the writes to it through a rate limiter."""
+
+  def __init__(self, file_obj, limiter):
+    self._file = file_obj
+    self._limiter = limiter
+
+  def seek(self, offset):
+    self._file.seek(offset)
+
+  def write(self, data):
+    self._limiter.Consume(len(data))
+    self._file.write(data)
+
+
+class _RangeBuffer(object):
+  """Holds a byte range of an object, written at its offset in the object."""
+
+  def __init__(self, offset):
+    self._offset = offset
+    self._buffer = cStringIO.StringIO()
+
+  def seek(self, offset):
+    # Rewinding, as done on retries, drops what was written past the offset.
+    self._buffer.seek(offset - self._offset)
+    self._buffer.truncate()
+
+  def write(self, data):
+    self._buffer.write(data)
+
+  def getvalue(self):
+    return self._buffer.getvalue()
+
+
+class _Checkpoint(object):
+  """Records the chunks of a partial download that were written to disk."""
+
+  def __init__(self, path, src, size, chunk_size):
+    self._path = path
+    self._lock = threading.Lock()
+    self._state = {'src': src, 'size': size, 'chunk_size': chunk_size,
+                   'done': []}
+
+  def Load(self):
+    """Returns the offsets of the chunks done by an earlier attempt."""
+    try:
+      with open(self._path) as checkpoint_file:
+        state = json.load(checkpoint_file)
+    except (IOError, ValueError):
+      return set()
+    if any(state.get(key) != self._state[key]
+           for key in ('src', 'size', 'chunk_size')):
+      return set()
+    self._state['done'] = state['done']
+    return set(state['done'])
+
+  def MarkDone(self, offset):
+    with self._lock:
+      self._state['done'].append(offset)
+      temp_path = self._path + '.tmp'
+      with open(temp_path, 'w') as checkpoint_file:
+        json.dump(self._state, checkpoint_file)
+      os.rename(temp_path, self._path)
+
+  def Remove(self):
+    if os.path.exists(self._path):
+      os.remove(self._path)
+
+
+class DownloadEngine(object):
+  """Downloads objects over a bounded number of concurrent transfers.
+
+  Objects larger than a chunk, on storage backends supporting ranged reads,
+  are fetched as concurrent byte ranges written into a sparse file of their
+  final size. The chunks written so far are recorded in a checkpoint file
+  next to it, so that chunks failing all retries of the backend are fetched
+  again, and, when a partial_dir is given, a later download of the same
+  object resumes where an interrupted one left off.
+  """
+
+  def __init__(self, max_transfers=MAX_TRANSFERS, chunk_size=CHUNK_SIZE,
+               max_bytes_per_second=None, partial_dir=None):
+    """Args:
+      max_transfers: maximum number of concurrent transfers, across objects.
+      chunk_size: size of the byte ranges large objects are fetched in.
+      max_bytes_per_second: bandwidth budget of all transfers, if any.
+      partial_dir: directory keeping partial downloads across attempts;
+                   by default objects are downloaded in place.
+    """
+    self.chunk_size = chunk_size
+    self._max_transfers = max_transfers
+    self._pool = pool.ThreadPool(max_transfers)
+    self._limiter = (_RateLimiter(max_bytes_per_second)
+                     if max_bytes_per_second else None)
+    self._partial_dir = partial_dir
+    if partial_dir:
+      self._PrunePartials()
+
+  def _PrunePartials(self):
+    """Removes partial downloads that were abandoned long ago."""
+    if not os.path.isdir(self._partial_dir):
+      os.makedirs(self._partial_dir)
+      return
+    deadline = time.time() - _PARTIAL_MAX_AGE
+    for name in os.listdir(self._partial_dir):
+      path = os.path.join(self._partial_dir, name)
+      try:
+        if os.path.getmtime(path) < deadline:
+          os.remove(path)
+      except OSError as e:
+        _Log('Failed to remove %s: %s', path, e)
+
+  def _FetchChunk(self, backend, src, path, offset, size, checkpoint):
+    """Fetches the chunk of |src| at |offset| into the file at |path|."""
+    end = min(offset + self.chunk_size, size) - 1
+    with open(path, 'r+b') as dst_file:
+      backend.CopyRange(src, offset, end, _ThrottledFile(
+          dst_file, self._limiter) if self._limiter else dst_file)
+    checkpoint.MarkDone(offset)
+
+  def _DownloadChunks(self, backend, src, path, size):
+    """Fetches the chunks of |src| missing from the file at |path|."""
+    checkpoint = _Checkpoint(path + _CHECKPOINT_SUFFIX, src, size,
+                             self.chunk_size)
+    done = checkpoint.Load() if os.path.exists(path) else set()
+    if done:
+      _Log('Resuming download of %s with %d bytes done', src,
+           len(done) * self.chunk_size)
+    else:
+      # Allocate the file sparsely; chunks fill it in any order.
+      with open(path, 'wb') as dst_file:
+        dst_file.truncate(size)
+
+    for round_number in range(_CHUNK_ROUNDS):
+      results = [self._pool.apply_async(
+          self._FetchChunk, (backend, src, path, offset, size, checkpoint))
+                 for offset in range(0, size, self.chunk_size)
+                 if offset not in done]
+      error = None
+      for result in results:
+        # Wait for all chunks, so none is written after a failure is raised.
+        try:
+          result.get()
+        except Exception as e:
+          error = error or e
+      if not error:
+        break
+      _Log('Round %d of chunks of %s failed: %s', round_number + 1, src, error)
+      done = checkpoint.Load()
+    else:
+      raise error
+    checkpoint.Remove()
+
+  def Download(self, src, dst):
+    """Downloads the object at gs_url |src| to the file |dst|.
+
+    Raises:
+      GSUtilError: if the download fails.
+    """
+    backend = gsutil_util.GetStorageBackend()
+    size = backend.GetSize(src)
+    if size is None or size <= self.chunk_size:
+      self._pool.apply(backend.Copy, (src, dst))
+      return
+
+    start = time.time()
+    path = dst
+    if self._partial_dir:
+      path = os.path.join(self._partial_dir, hashlib.sha1(src).hexdigest())
+    self._DownloadChunks(backend, src, path, size)
+    if path != dst:
+      shutil.move(path, dst)
+    _Log('Downloaded %s (%d bytes) in %.1f seconds', src, size,
+         time.time() - start)
+
+  def _FetchRange(self, backend, src, offset, end):
+    """Returns the chunk of |src| at |offset|, up to |end|, for streaming."""
+    end = min(offset + STREAM_CHUNK_SIZE - 1, end)
+    range_buffer = _RangeBuffer(offset)
+    backend.CopyRange(src, offset, end, _ThrottledFile(
+        range_buffer, self._limiter) if self._limiter else range_buffer)
+    return range_buffer.getvalue()
+
+  def Stream(self, src, write, start=0, end=None):
+    """Passes the contents of the object at gs_url |src| to |write|.
+
+    Large objects are fetched as concurrent byte ranges, up to one per
+    transfer ahead of the one being passed on. The transfers count against
+    the concurrency and bandwidth budgets.
+
+    Args:
+      src: gs_url of the object.
+      write: function called with the successive parts of the contents.
+      start: offset of the first byte passed on.
+      end: offset of the last byte passed on; the end of the object if None.
+
+    Raises:
+      GSUtilError: if the download fails.
+    """
+    backend = gsutil_util.GetStorageBackend()
+    if end is None:
+      size = backend.GetSize(src)
+      if size is None and start:
+        raise gsutil_util.GSUtilError('Ranged read of "%s" not supported.' %
+                                      src)
+      if size is None or (not start and size <= STREAM_CHUNK_SIZE):
+        if self._limiter:
+          limiter = self._limiter
+          unthrottled_write = write
+
+          def write(data):
+            limiter.Consume(len(data))
+            unthrottled_write(data)
+
+        self._pool.apply(backend.Stream, (src, write))
+        return
+      end = size - 1
+
+    pending = collections.deque()
+    try:
+      for offset in range(start, end + 1, STREAM_CHUNK_SIZE):
+        pending.append(self._pool.apply_async(
+            self._FetchRange, (backend, src, offset, end)))
+        if len(pending) == self._max_transfers:
+          write(pending.popleft().get())
+      while pending:
+        write(pending.popleft().get())
+    finally:
+      # Don't leave transfers behind when failing.
+      for result in pending:
+        result.wait()
+
+
+_download_engine = None
+_download_engine_lock = threading.Lock()
+
+
+def SetDownloadEngine(engine):
+  """Sets the engine artifacts are downloaded with."""
+  global _download_engine
+  _download_engine = engine
+
+
+def GetDownloadEngine():
+  """Returns the engine artifacts are downloaded with, creating a default."""
+  global _download_engine
+  with _download_engine_lock:
+    if not _download_engine:
+      _download_engine = DownloadEngine()
+    return _download_engine
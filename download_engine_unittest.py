@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for download_engine module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import download_engine
+import gsutil_util
+
+
+class _FlakyBackend(gsutil_util.LocalBackend):
+  """Fails ranged reads at some offsets, recording the ones requested.
+
+  Reads at failing_offsets fail once, those at broken_offsets always do.
+  """
+
+  def __init__(self, root_dir, failing_offsets=(), broken_offsets=()):
+    gsutil_util.LocalBackend.__init__(self, root_dir)
+    self.failing_offsets = set(failing_offsets)
+    self.broken_offsets = set(broken_offsets)
+    self.ranges = []
+
+  def CopyRange(self, url, start, end, dst_file):
+    self.ranges.append(start)
+    if start in self.failing_offsets or start in self.broken_offsets:
+      self.failing_offsets.discard(start)
+      raise gsutil_util.GSUtilError('flaky')
+    gsutil_util.LocalBackend.CopyRange(self, url, start, end, dst_file)
+
+
+class DownloadEngineTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp(prefix='download_engine')
+    self._data = ''.join(chr(i) for i in range(95))
+    os.makedirs(os.path.join(self._tmp_dir, 'gs', 'bucket'))
+    with open(os.path.join(self._tmp_dir, 'gs', 'bucket', 'payload'),
+              'wb') as f:
+      f.write(self._data)
+    self._partial_dir = os.path.join(self._tmp_dir, 'partial')
+    self._dst = os.path.join(self._tmp_dir, 'payload')
+
+  def tearDown(self):
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self._tmp_dir)
+
+  def _Download(self, backend, **kwargs):
+    gsutil_util.SetStorageBackend(backend)
+    engine = download_engine.DownloadEngine(
+        max_transfers=3, chunk_size=10, partial_dir=self._partial_dir,
+        **kwargs)
+    engine.Download('gs://bucket/payload', self._dst)
+
+  def _ReadDestination(self):
+    with open(self._dst, 'rb') as f:
+      return f.read()
+
+  def testChunkedDownload(self):
+    """Tests that chunks are assembled and failed ones fetched again."""
+    backend = _FlakyBackend(os.path.join(self._tmp_dir, 'gs'), [20, 90])
+    self._Download(backend, max_bytes_per_second=1 << 20)
+    self.assertEqual(self._ReadDestination(), self._data)
+    self.assertEqual(sorted(backend.ranges),
+                     sorted(range(0, 95, 10) + [20, 90]))
+    self.assertEqual(os.listdir(self._partial_dir), [])
+
+  def testResume(self):
+    """Tests that a later download only fetches the missing chunks."""
+    backend = _FlakyBackend(os.path.join(self._tmp_dir, 'gs'),
+                            broken_offsets=[30])
+    self.assertRaises(gsutil_util.GSUtilError, self._Download, backend)
+    self.assertFalse(os.path.exists(self._dst))
+    self.assertEqual(len(os.listdir(self._partial_dir)), 2)
+
+    backend = _FlakyBackend(os.path.join(self._tmp_dir, 'gs'))
+    self._Download(backend)
+    self.assertEqual(backend.ranges, [30])
+    self.assertEqual(self._ReadDestination(), self._data)
+
+  def testSmallObject(self):
+    """Tests that objects within a chunk are copied whole."""
+    backend = _FlakyBackend(os.path.join(self._tmp_dir, 'gs'))
+    gsutil_util.SetStorageBackend(backend)
+    download_engine.DownloadEngine(chunk_size=100).Download(
+        'gs://bucket/payload', self._dst)
+    self.assertEqual(self._ReadDestination(), self._data)
+    self.assertEqual(backend.ranges, [])
+
+  def _Stream(self, start=0, end=None, **kwargs):
+    chunks = []
+    stream_chunk_size = download_engine.STREAM_CHUNK_SIZE
+    download_engine.STREAM_CHUNK_SIZE = 10
+    try:
+      download_engine.DownloadEngine(max_transfers=3, **kwargs).Stream(
+          'gs://bucket/payload', chunks.append, start, end)
+    finally:
+      download_engine.STREAM_CHUNK_SIZE = stream_chunk_size
+    return chunks
+
+  def testStream(self):
+    """Tests that ranges streamed concurrently are passed on in order."""
+    backend = _FlakyBackend(os.path.join(self._tmp_dir, 'gs'))
+    gsutil_util.SetStorageBackend(backend)
+    self.assertEqual(self._Stream(max_bytes_per_second=1 << 20),
+                     [self._data[i:i + 10] for i in range(0, 95, 10)])
+    self.assertEqual(''.join(self._Stream(start=15, end=44)),
+                     self._data[15:45])
+
+  def testStreamFailure(self):
+    """Tests that a failing range stops the stream."""
+    gsutil_util.SetStorageBackend(_FlakyBackend(
+        os.path.join(self._tmp_dir, 'gs'), broken_offsets=[20]))
+    self.assertRaises(gsutil_util.GSUtilError, self._Stream)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,13 +5,16 @@
 # found in the LICENSE file.
 
 import Queue
+import glob
 import os
 import shutil
 import tempfile
 import threading
 
+import build_artifact
 import common_util
 import log_util
+import staging_scheduler
 
 
 class Downloader(log_util.Loggable):
@@ -28,8 +31,16 @@ class Downloader(log_util.Loggable):
   # This filename must be kept in sync with clean_staged_images.py
   _TIMESTAMP_FILENAME = 'staged.timestamp'
 
-  def __init__(self, static_dir):
+  def __init__(self, static_dir, payload_index=None, scheduler=None):
+    """Args:
+      static_dir: directory builds are staged under.
+      payload_index: PayloadIndex the staged update payloads are added to.
+      scheduler: StagingScheduler running background downloads; without one,
+                 they run on a thread of their own.
+    """
     self._static_dir = static_dir
+    self._payload_index = payload_index
+    self._scheduler = scheduler
     self._build_dir = None
     self._staging_dir = None
     self._status_queue = Queue.Queue(maxsize=1)
@@ -129,10 +140,11 @@ class Downloader(log_util.Loggable):
         else:
           background_artifacts.append(artifact)
 
+      self._IndexStagedPayloads()
       if background:
         self._DownloadArtifactsInBackground(background_artifacts)
       else:
-        self._DownloadArtifactsSerially(background_artifacts)
+        self._DownloadArtifactsConcurrently(background_artifacts)
 
     except Exception, e:
       # Release processing lock, which will remove build components directory
@@ -154,14 +166,34 @@ class Downloader(log_util.Loggable):
 
     self._staging_dir = None
 
-  def _DownloadArtifactsSerially(self, artifacts):
-    """Simple function to download all the given artifacts serially."""
-    self._Log('Downloading artifacts serially.')
+  def _DownloadArtifactsConcurrently(self, artifacts):
+    """Downloads the given artifacts concurrently, staging them in order.
+
+    The number of concurrent transfers is bounded by the download engine.
+    """
+    self._Log('Downloading %d artifacts concurrently.' % len(artifacts))
+    errors = [None] * len(artifacts)
+
+    def _Download(index):
+      try:
+        artifacts[index].Download()
+      except Exception, e:
+        errors[index] = e
+
+    threads = [threading.Thread(target=_Download, args=(index,))
+               for index in range(len(artifacts))]
     try:
-      for artifact in artifacts:
-        artifact.Download()
-        artifact.Stage()
+      for thread in threads:
+        thread.start()
+      for index, thread in enumerate(threads):
+        thread.join()
+        if errors[index]:
+          raise errors[index]
+        artifacts[index].Stage()
     except Exception, e:
+      # Let the other downloads finish before their files are cleaned up.
+      for thread in threads:
+        thread.join()
       self._status_queue.put(e)
 
       # Release processing lock, which will remove build components directory
@@ -173,17 +205,47 @@ class Downloader(log_util.Loggable):
       # Release processing lock, keeping directory intact.
       if self._build_dir:
         common_util.ReleaseLock(static_dir=self._static_dir, tag=self._lock_tag)
+      self._IndexStagedPayloads()
       self._status_queue.put('Success')
     finally:
       self._Cleanup()
 
+  def _IndexStagedPayloads(self):
+    """Queues update payloads staged so far for background metadata indexing.
+
+    This way update checks against this build find the payload hashes ready.
+    """
+    if not (self._payload_index and self._build_dir):
+      return
+    payloads = [os.path.join(self._build_dir, build_artifact.ROOT_UPDATE)]
+    payloads += glob.glob(os.path.join(self._build_dir, common_util.AU_BASE,
+                                       '*', build_artifact.ROOT_UPDATE))
+    self._payload_index.IndexInBackground(
+        [payload for payload in payloads if os.path.exists(payload)])
+
   def _DownloadArtifactsInBackground(self, artifacts):
     """Downloads |artifacts| in the background and signals when complete."""
     self._Log('Invoking background download of artifacts')
-    thread = threading.Thread(target=self._DownloadArtifactsSerially,
+    if self._scheduler:
+      self._scheduler.Submit(
+          'background:' + self._lock_tag, self._DownloadArtifactsConcurrently,
+          (artifacts,), priority=staging_scheduler.PRIORITY_BACKGROUND,
+          cancel_func=self._CancelBackgroundDownloads)
+      return
+    thread = threading.Thread(target=self._DownloadArtifactsConcurrently,
                               args=(artifacts,))
     thread.start()
 
+  def _CancelBackgroundDownloads(self):
+    """Gives up on background downloads that were cancelled before starting.
+    """
+    if self._build_dir:
+      common_util.ReleaseLock(static_dir=self._static_dir, tag=self._lock_tag,
+                              destroy=True)
+    self._status_queue.put(staging_scheduler.StagingJobCancelled(
+        'Background downloads of %s were cancelled.' % self._lock_tag))
+    self._Cleanup()
+
   def GatherArtifactDownloads(self, main_staging_dir, archive_url, build_dir,
                               short_build):
     """Wrapper around common_util.GatherArtifactDownloads().
@@ -219,8 +281,8 @@ class SymbolDownloader(Downloader):
   Given a URL to a build on the archive server:
 
     - Determine if the build already exists.
-    - Download and extract the debug symbols to a staging directory.
-    - Install symbols to static dir.
+    - Download the debug symbols tarball to a staging directory.
+    - Repack its symbols to static dir, for them to be extracted as needed.
   """
 
   _DONE_FLAG = 'done'
@@ -293,7 +355,7 @@ class SymbolDownloader(Downloader):
     @param staging_dir: the dir into which to stage the symbols
     @param short_build: (ignored)
 
-    @return an iterable of one DebugTarballBuildArtifact pointing to the right
+    @return an iterable of one SymbolTarballBuildArtifact pointing to the right
             debug symbols.  This is an iterable so that it's similar to
             GatherArtifactDownloads.  Also, it's possible that someday we might
             have more than one.
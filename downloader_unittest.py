@@ -8,7 +8,9 @@
 
 import os
 import shutil
+import tarfile
 import tempfile
+import threading
 import unittest
 
 import mox
@@ -17,6 +19,8 @@ import build_artifact
 import common_util
 import devserver
 import downloader
+import gsutil_util
+import staging_scheduler
 
 
 # Fake Dev Server Layout:
@@ -163,6 +167,39 @@ class DownloaderTest(DownloaderTestBase):
     self.assertEqual(d.GetStatusOfBackgroundDownloads(), 'Success')
     self.mox.VerifyAll()
 
+  def testCancelBackgroundDownloads(self):
+    """Tests cancelling background downloads queued in a scheduler."""
+    artifacts = self._GenerateArtifacts(ignore_background=True)
+    self.mox.StubOutWithMock(common_util, 'AcquireLock')
+    self.mox.StubOutWithMock(common_util, 'ReleaseLock')
+    lock_tag = downloader.Downloader.GenerateLockTag('x86-mario-release',
+                                                     self.build)
+    common_util.AcquireLock(static_dir=self._work_dir,
+                            tag=lock_tag).AndReturn(self._work_dir)
+    common_util.ReleaseLock(static_dir=self._work_dir, tag=lock_tag,
+                            destroy=True)
+    self.mox.StubOutWithMock(tempfile, 'mkdtemp')
+    tempfile.mkdtemp(suffix=mox.IgnoreArg()).AndReturn(self._work_dir)
+
+    scheduler = staging_scheduler.StagingScheduler(max_workers=1,
+                                                   max_background_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+    blocker = scheduler.Submit(
+        'blocker', lambda: (started.set(), release.wait(10)))
+    started.wait(10)
+    d = self._CreateArtifactDownloader(artifacts)
+    d._scheduler = scheduler
+    self.mox.ReplayAll()
+    d.Download(self.archive_url_prefix, background=True)
+    [job] = scheduler.GetJobs()['queued']
+    self.assertTrue(scheduler.Cancel(job['id']))
+    self.assertRaises(staging_scheduler.StagingJobCancelled,
+                      d.GetStatusOfBackgroundDownloads)
+    release.set()
+    blocker.Result()
+    self.mox.VerifyAll()
+
   def testInteractionWithDevserver(self):
     """Tests interaction between the downloader and devserver methods."""
     artifacts = self._CommonDownloaderSetup(ignore_background=True)
@@ -172,8 +209,10 @@ class DownloaderTest(DownloaderTestBase):
 
     class FakeUpdater():
       static_dir = self._work_dir
+      payload_index = None
 
     devserver.updater = FakeUpdater()
+    devserver.stager = staging_scheduler.StagingScheduler()
 
     self.mox.ReplayAll()
     dev = devserver.DevServerRoot()
@@ -233,7 +272,7 @@ class SymbolDownloaderTest(DownloaderTestBase):
   def _GenerateArtifacts(self, unused_ignore_background):
     """Instantiate artifact mocks and set expectations on them.
 
-    Sets up a DebugTarballBuildArtifact and sets up expectation that it will be
+    Sets up a SymbolTarballBuildArtifact and sets up expectation that it will be
     downloaded and staged.
 
     @return iterable of one artifact object with appropriate expectations.
@@ -253,5 +292,52 @@ class SymbolDownloaderTest(DownloaderTestBase):
     self.mox.VerifyAll()
 
 
+class StreamingDownloadTest(unittest.TestCase):
+  """Tests downloads extracting tarballs while they are downloaded."""
+
+  def setUp(self):
+    self._work_dir = tempfile.mkdtemp('downloader-test')
+    self._static_dir = os.path.join(self._work_dir, 'static')
+    self._archive_url = 'gs://bucket/x86-mario-release/R17-1413.0.0-a1-b1346'
+    archive_dir = os.path.join(self._work_dir, 'gs', 'bucket',
+                               'x86-mario-release', 'R17-1413.0.0-a1-b1346')
+    os.makedirs(archive_dir)
+    content_dir = os.path.join(self._work_dir, 'content')
+    os.makedirs(os.path.join(content_dir, 'suites'))
+    with open(os.path.join(content_dir, 'suites', 'control.bvt'), 'w') as f:
+      f.write('SUITE = "bvt"\n')
+    tarball = tarfile.open(os.path.join(archive_dir, 'suites.tgz'), 'w:gz')
+    tarball.add(os.path.join(content_dir, 'suites'), 'suites')
+    tarball.close()
+    gsutil_util.SetStorageBackend(
+        gsutil_util.LocalBackend(os.path.join(self._work_dir, 'gs')))
+    build_artifact.SetStreamingExtraction(True, keep_tarballs=True)
+
+  def tearDown(self):
+    build_artifact.SetStreamingExtraction(False)
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self._work_dir)
+
+  def testKeptTarballs(self):
+    """Tests that kept tarballs outlive the staging directory."""
+    staging_dirs = []
+
+    def _GatherArtifactDownloads(staging_dir, archive_url, build_dir, _build):
+      staging_dirs.append(staging_dir)
+      return [build_artifact.TarballBuildArtifact(
+          archive_url + '/suites.tgz', staging_dir, build_dir,
+          synchronous=True)]
+
+    d = downloader.Downloader(self._static_dir)
+    d.GatherArtifactDownloads = _GatherArtifactDownloads
+    self.assertEqual(d.Download(self._archive_url), 'Success')
+    build_dir = os.path.join(self._static_dir, 'x86-mario-release',
+                             'R17-1413.0.0-a1-b1346')
+    self.assertTrue(os.path.exists(
+        os.path.join(build_dir, 'suites', 'control.bvt')))
+    self.assertTrue(os.path.exists(os.path.join(build_dir, 'suites.tgz')))
+    self.assertFalse(os.path.exists(staging_dirs[0]))
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,183 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A persistent store of file fingerprints, keyed by file identity."""
+
+import hashlib
+import json
+import os
+import threading
+
+import common_util
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('FINGERPRINT', message, *args)
+
+
+# Fast fingerprints digest the file size along with this many evenly spaced
+# sample blocks of the given size, instead of the whole file.
+_SAMPLE_COUNT = 16
+_SAMPLE_SIZE = 64 * 1024
+# Seconds changes to the store are batched for before it is persisted.
+_SAVE_DELAY = 1
+
+
+def GetFastFingerprint(file_path):
+  """Returns a hex fingerprint of a file derived from its size and samples.
+
+  Files small enough to be covered by the samples are digested completely.
+  """
+  size = os.path.getsize(file_path)
+  hasher = hashlib.md5()
+  hasher.update('%d:' % size)
+  with open(file_path, 'rb') as fd:
+    if size <= _SAMPLE_COUNT * _SAMPLE_SIZE:
+      hasher.update(fd.read())
+    else:
+      stride = (size - _SAMPLE_SIZE) / (_SAMPLE_COUNT - 1)
+      for sample in range(_SAMPLE_COUNT):
+        fd.seek(sample * stride)
+        hasher.update(fd.read(_SAMPLE_SIZE))
+  return hasher.hexdigest()
+
+
+class FingerprintStore(object):
+  """Memoizes file fingerprints across requests and server restarts.
+
+  Fingerprints are keyed by the (device, inode, size, mtime) identity of a
+  file, so a file that was not modified is never digested twice, even when it
+  is reached through a different path. The store is persisted at most once
+  per _SAVE_DELAY seconds.
+  """
+
+  def __init__(self, store_file, fast=False):
+    """Args:
+      store_file: path to the file the store is persisted to; None disables
+                  persistence.
+      fast: whether to use sampled fingerprints instead of full MD5 digests.
+    """
+    self._store_file = store_file
+    self._fast = fast
+    self._lock = threading.Lock()
+    self._save_lock = threading.Lock()
+    # A dictionary mapping identity keys to {'path':, <kind>: <fingerprint>}.
+    self._entries = {}
+    # Identity keys of the entries, by path.
+    self._keys = {}
+    # Per-key locks and the number of their users, used for making sure a
+    # file is only digested once; dropped once unused.
+    self._key_locks = {}
+    # Timer saving the store, while a save is scheduled.
+    self._save_timer = None
+
+  @staticmethod
+  def _GetFileKey(path):
+    """Returns the identity key of a file, None if it cannot be stat'ed."""
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    return '%d:%d:%d:%d' % (stat.st_dev, stat.st_ino, stat.st_size,
+                            int(stat.st_mtime * 1000000000))
+
+  def Load(self):
+    """Loads persisted fingerprints, dropping those of changed files."""
+    if not (self._store_file and os.path.exists(self._store_file)):
+      return
+    try:
+      with open(self._store_file) as store_stream:
+        entries = json.load(store_stream)
+    except (IOError, ValueError) as e:
+      _Log('Ignoring unreadable fingerprint store %s: %s', self._store_file, e)
+      return
+    entries = dict((key, entry) for key, entry in entries.iteritems()
+                   if self._GetFileKey(entry.get('path', '')) == key)
+    with self._lock:
+      self._entries.update(entries)
+      self._keys.update((entry['path'], key)
+                        for key, entry in entries.iteritems())
+    _Log('Loaded %d fingerprints from %s', len(entries), self._store_file)
+
+  def _ScheduleSave(self):
+    """Saves the store after a while, batching the changes made meanwhile.
+
+    Must be called with the lock held.
+    """
+    if not self._store_file or self._save_timer:
+      return
+    self._save_timer = threading.Timer(_SAVE_DELAY, self.Flush)
+    self._save_timer.daemon = True
+    self._save_timer.start()
+
+  def Flush(self):
+    """Atomically writes the store to its backing file, if it changed."""
+    with self._save_lock:
+      with self._lock:
+        if not self._save_timer:
+          return
+        self._save_timer.cancel()
+        self._save_timer = None
+        data = json.dumps(self._entries)
+      tmp_file = self._store_file + '.tmp'
+      try:
+        with open(tmp_file, 'w') as store_stream:
+          store_stream.write(data)
+        os.rename(tmp_file, self._store_file)
+      except (IOError, OSError) as e:
+        _Log('Failed to persist fingerprints to %s: %s', self._store_file, e)
+
+  def _Lookup(self, path, key, kind):
+    """Returns the memoized fingerprint of |path|, or None.
+
+    The entry of a previous version of the file is dropped. Must be called
+    with the lock held.
+    """
+    old_key = self._keys.get(path)
+    if old_key and old_key != key:
+      del self._keys[path]
+      if self._entries.get(old_key, {}).get('path') == path:
+        del self._entries[old_key]
+        self._ScheduleSave()
+    return self._entries.get(key, {}).get(kind)
+
+  def GetFingerprint(self, path):
+    """Returns the (possibly memoized) hex fingerprint of |path|.
+
+    Concurrent calls for the same file digest it only once.
+    """
+    kind = 'fast' if self._fast else 'md5'
+    key = self._GetFileKey(path)
+    if not key:
+      return self._ComputeFingerprint(path)
+
+    with self._lock:
+      fingerprint = self._Lookup(path, key, kind)
+      if fingerprint:
+        return fingerprint
+      key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+      key_lock[1] += 1
+    try:
+      with key_lock[0]:
+        with self._lock:
+          fingerprint = self._entries.get(key, {}).get(kind)
+        if not fingerprint:
+          fingerprint = self._ComputeFingerprint(path)
+          with self._lock:
+            self._entries.setdefault(key, {'path': path})[kind] = fingerprint
+            self._keys[path] = key
+            self._ScheduleSave()
+    finally:
+      with self._lock:
+        key_lock[1] -= 1
+        if not key_lock[1]:
+          del self._key_locks[key]
+    return fingerprint
+
+  def _ComputeFingerprint(self, path):
+    if self._fast:
+      return GetFastFingerprint(path)
+    return common_util.GetFileMd5(path)
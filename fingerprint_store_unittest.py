@@ -0,0 +1,121 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for fingerprint_store module."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mox
+
+import common_util
+import fingerprint_store
+
+
+class FingerprintStoreTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._work_dir = tempfile.mkdtemp('fingerprint_store_unittest')
+    self._store_file = os.path.join(self._work_dir, 'fingerprints.json')
+    self._image = os.path.join(self._work_dir, 'coreos_test_image.bin')
+    with open(self._image, 'w') as f:
+      f.write('IMAGE')
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def testMemoizedAcrossRestarts(self):
+    """Tests that an unchanged image is digested only once."""
+    self.mox.StubOutWithMock(common_util, 'GetFileMd5')
+    common_util.GetFileMd5(self._image).AndReturn('abcdef')
+    self.mox.ReplayAll()
+
+    store = fingerprint_store.FingerprintStore(self._store_file)
+    self.assertEqual(store.GetFingerprint(self._image), 'abcdef')
+    self.assertEqual(store.GetFingerprint(self._image), 'abcdef')
+    store.Flush()
+    store = fingerprint_store.FingerprintStore(self._store_file)
+    store.Load()
+    self.assertEqual(store.GetFingerprint(self._image), 'abcdef')
+    self.mox.VerifyAll()
+
+  def testModifiedImage(self):
+    """Tests that modifying an image changes its fingerprint."""
+    store = fingerprint_store.FingerprintStore(self._store_file)
+    self.assertEqual(store.GetFingerprint(self._image),
+                     hashlib.md5('IMAGE').hexdigest())
+    with open(self._image, 'a') as f:
+      f.write('MORE')
+    self.assertEqual(store.GetFingerprint(self._image),
+                     hashlib.md5('IMAGEMORE').hexdigest())
+    # The fingerprint of the previous version is forgotten.
+    store.Flush()
+    with open(self._store_file) as f:
+      self.assertEqual(len(json.load(f)), 1)
+
+  def testConcurrentFingerprints(self):
+    """Tests that concurrent requests for an image digest it once."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def _SlowMd5(path):
+      started.set()
+      release.wait(10)
+      return 'abcdef'
+
+    self.stubs.Set(common_util, 'GetFileMd5', _SlowMd5)
+    store = fingerprint_store.FingerprintStore(None)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        store.GetFingerprint(self._image))) for _ in range(2)]
+    threads[0].start()
+    started.wait(10)
+    started.clear()
+    threads[1].start()
+    # Lets the second request wait for the digest of the first one.
+    deadline = time.time() + 10
+    while (sum(users for _, users in store._key_locks.values()) < 2 and
+           time.time() < deadline):
+      time.sleep(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, ['abcdef', 'abcdef'])
+    self.assertFalse(started.is_set())
+
+  def testFastFingerprint(self):
+    """Tests that fast fingerprints depend on sampled content and size."""
+    store = fingerprint_store.FingerprintStore(self._store_file, fast=True)
+    size = (fingerprint_store._SAMPLE_COUNT *
+            fingerprint_store._SAMPLE_SIZE * 4)
+    with open(self._image, 'wb') as f:
+      f.write('\0' * size)
+    fingerprint = store.GetFingerprint(self._image)
+    self.assertEqual(len(fingerprint), 32)
+
+    # A change inside the first sample block is detected.
+    with open(self._image, 'r+b') as f:
+      f.write('X')
+    self.assertNotEqual(
+        fingerprint_store.GetFastFingerprint(self._image), fingerprint)
+
+    # So is a change of size.
+    with open(self._image, 'wb') as f:
+      f.write('\0' * (size + 1))
+    self.assertNotEqual(
+        fingerprint_store.GetFastFingerprint(self._image), fingerprint)
+    store.Flush()
+
+
+if __name__ == '__main__':
+  unittest.main()
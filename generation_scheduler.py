@@ -0,0 +1,156 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A bounded pool of workers for deduplicated payload generation jobs."""
+
+import Queue
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('GENERATION', message, *args)
+
+
+class GenerationJob(object):
+  """A unit of work submitted to the scheduler.
+
+  Members:
+    key:         the key the job is deduplicated by.
+    submit_time: time the job was submitted at.
+    start_time:  time a worker started running the job, or None.
+    end_time:    time the job finished, or None.
+  """
+
+  def __init__(self, key, func, args):
+    self.key = key
+    self._func = func
+    self._args = args
+    self._done = threading.Event()
+    self._error = None
+    # Whether the outcome of the job was passed on to anybody.
+    self.reported = False
+    self.submit_time = time.time()
+    self.start_time = None
+    self.end_time = None
+
+  def Run(self, finish_func=None):
+    """Runs the job, recording any exception it raises.
+
+    Args:
+      finish_func: function called with the job after it ran, but before
+                   anybody waiting for it is woken up.
+    """
+    self.start_time = time.time()
+    try:
+      self._func(*self._args)
+    except Exception as e:
+      _Log('Generation job %s failed: %r', self.key, e)
+      self._error = e
+    finally:
+      self.end_time = time.time()
+      if finish_func:
+        finish_func(self)
+      self._done.set()
+
+  def Wait(self, timeout=None):
+    """Waits for the job to finish; returns whether it did."""
+    self._done.wait(timeout)
+    return self._done.is_set()
+
+  def Failed(self):
+    """Returns whether the job finished with an exception."""
+    return self.end_time is not None and self._error is not None
+
+  def Result(self):
+    """Waits for the job and re-raises the exception it failed with, if any."""
+    self.Wait()
+    self.reported = True
+    if self._error:
+      raise self._error
+
+
+class GenerationScheduler(object):
+  """Runs generation jobs on a bounded set of worker threads.
+
+  Jobs are deduplicated by key: while a job for a given key is queued or
+  running, submitting another one for the same key returns the in-flight job
+  (single-flight), so callers share its outcome instead of racing each other.
+  A job that failed without anybody waiting for its result, e.g. because it
+  was submitted asynchronously, is returned to the next submission for its
+  key, so that its error is reported before generation is retried.
+  """
+
+  def __init__(self, max_workers=2):
+    self._max_workers = max_workers
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+    self._workers = []
+    # In-flight jobs, keyed by their deduplication key.
+    self._jobs = {}
+    # Failed jobs, keyed by their deduplication key, until resubmitted.
+    self._failed_jobs = {}
+    self.completed = 0
+    self.failed = 0
+
+  def _Worker(self):
+    """Runs queued jobs, forever."""
+    while True:
+      job = self._queue.get()
+      _Log('Running generation job %s', job.key)
+      job.Run(finish_func=self._FinishJob)
+      _Log('Finished generation job %s in %.1f seconds', job.key,
+           job.end_time - job.start_time)
+
+  def _FinishJob(self, job):
+    """Retires a job that ran, so that its key can be submitted again."""
+    with self._lock:
+      del self._jobs[job.key]
+      if job.Failed():
+        self.failed += 1
+        self._failed_jobs[job.key] = job
+      else:
+        self.completed += 1
+
+  def Submit(self, key, func, *args):
+    """Schedules func(*args) under |key|, unless a job for it is in flight.
+
+    Returns:
+      The GenerationJob object that is in charge of |key|, which is a failed
+      one whose error was not reported yet, if any.
+    """
+    with self._lock:
+      job = self._jobs.get(key)
+      if job:
+        return job
+      job = self._failed_jobs.pop(key, None)
+      if job and not job.reported:
+        return job
+      job = GenerationJob(key, func, args)
+      self._jobs[key] = job
+      if len(self._workers) < self._max_workers:
+        worker = threading.Thread(target=self._Worker)
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+    self._queue.put(job)
+    return job
+
+  def GetJob(self, key):
+    """Returns the in-flight job for |key|, or None."""
+    with self._lock:
+      return self._jobs.get(key)
+
+  def GetStats(self):
+    """Returns a dictionary of scheduler statistics."""
+    with self._lock:
+      running = len([job for job in self._jobs.itervalues()
+                     if job.start_time])
+      return {'queued': len(self._jobs) - running,
+              'running': running,
+              'completed': self.completed,
+              'failed': self.failed}
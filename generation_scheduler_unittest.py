@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for generation_scheduler module."""
+
+import threading
+import unittest
+
+import generation_scheduler
+
+
+class GenerationSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._release = threading.Event()
+    self._calls = []
+
+  def _BlockingJob(self, name):
+    """Fake generation that waits until the test releases it."""
+    self._calls.append(name)
+    self._release.wait(10)
+
+  def testSingleFlight(self):
+    """Tests that concurrent submissions for one key share a single job."""
+    scheduler = generation_scheduler.GenerationScheduler(max_workers=2)
+    job = scheduler.Submit('key', self._BlockingJob, 'first')
+    self.assertTrue(scheduler.Submit('key', self._BlockingJob, 'second') is job)
+    self.assertFalse(job.Wait(0))
+    self._release.set()
+    job.Result()
+    self.assertEqual(self._calls, ['first'])
+
+    # Once finished, a new submission for the same key runs again.
+    scheduler.Submit('key', self._BlockingJob, 'third').Result()
+    self.assertEqual(self._calls, ['first', 'third'])
+    self.assertEqual(scheduler.GetStats()['completed'], 2)
+
+  def testBoundedWorkers(self):
+    """Tests that no more than max_workers jobs run at the same time."""
+    scheduler = generation_scheduler.GenerationScheduler(max_workers=1)
+    first = scheduler.Submit('first', self._BlockingJob, 'first')
+    second = scheduler.Submit('second', self._BlockingJob, 'second')
+    self.assertFalse(second.Wait(0.1))
+    self.assertEqual(scheduler.GetStats()['queued'], 1)
+    self._release.set()
+    first.Result()
+    second.Result()
+    self.assertEqual(self._calls, ['first', 'second'])
+
+  def testFailure(self):
+    """Tests that job failures are propagated to all waiters."""
+    def _FailingJob():
+      raise ValueError('generation failed')
+
+    scheduler = generation_scheduler.GenerationScheduler()
+    job = scheduler.Submit('key', _FailingJob)
+    self.assertRaises(ValueError, job.Result)
+    self.assertTrue(job.Failed())
+    self.assertEqual(scheduler.GetStats()['failed'], 1)
+    # The error was reported, so generation is retried.
+    self.assertFalse(scheduler.Submit('key', _FailingJob) is job)
+
+  def testUnreportedFailure(self):
+    """Tests that a failure nobody waited for goes to the next submitter."""
+    def _FailingJob():
+      raise ValueError('generation failed')
+
+    scheduler = generation_scheduler.GenerationScheduler()
+    job = scheduler.Submit('key', _FailingJob)
+    job.Wait()
+    self.assertTrue(scheduler.Submit('key', self._BlockingJob, 'retry') is job)
+    self.assertRaises(ValueError, job.Result)
+    self._release.set()
+    scheduler.Submit('key', self._BlockingJob, 'retry').Result()
+    self.assertEqual(self._calls, ['retry'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,13 +2,43 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""Module containing gsutil helper methods."""
+"""Module containing gsutil helper methods.
 
+Google Storage is accessed through a pluggable storage backend: by default
+the gsutil command line tool, optionally an in-process HTTP client of the
+Google Storage XML API that reuses its connections, or a local directory
+standing in for Google Storage in tests.
+"""
+
+import hashlib
+import httplib
+import os
+import shutil
+import socket
 import subprocess
+import threading
 import time
+import urllib
+import urlparse
+from xml.etree import cElementTree as ElementTree
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('GSUTIL', message, *args)
 
 
 GSUTIL_ATTEMPTS = 5
+# Endpoint of the Google Storage XML API.
+GS_HTTP_ENDPOINT = 'https://storage.googleapis.com'
+# Names of the available storage backends.
+STORAGE_BACKENDS = ('gsutil', 'http', 'local')
+
+_GS_URL_PREFIX = 'gs://'
+# Size of the chunks objects are downloaded in.
+_COPY_CHUNK_SIZE = 1 << 20
 
 
 class GSUtilError(Exception):
@@ -44,12 +74,506 @@ def GSUtilRun(cmd, err_msg):
         err_msg, cmd, proc.returncode))
 
 
+def _SplitGSUrl(url):
+  """Splits a gs://bucket/path URL into its bucket and path."""
+  if not url.startswith(_GS_URL_PREFIX):
+    raise GSUtilError('Not a Google Storage URL: %s' % url)
+  bucket, _, path = url[len(_GS_URL_PREFIX):].partition('/')
+  return bucket, path
+
+
+def _GetCopyDestination(src, dst):
+  """Returns the file |src| is copied to, which is in |dst| if a directory."""
+  if os.path.isdir(dst):
+    return os.path.join(dst, src.rstrip('/').rsplit('/', 1)[-1])
+  return dst
+
+
+def _GetLocalName(element):
+  """Returns the name of an XML element without its namespace."""
+  return element.tag.rsplit('}', 1)[-1]
+
+
+class StorageBackend(object):
+  """Interface of the ways to access Google Storage."""
+
+  def Cat(self, url):
+    """Returns the contents of the object at |url|.
+
+    Raises:
+      GSUtilError: if the object cannot be read.
+    """
+    raise NotImplementedError()
+
+  def CatIfChanged(self, url, version=None):
+    """Returns the contents of the object at |url| unless at |version|.
+
+    Versions are opaque strings identifying contents of objects, e.g. their
+    ETag. By default they are digests of the contents, which are read anyway.
+
+    Returns:
+      A tuple of the contents, or None if the object is still at |version|,
+      and of the version of the object.
+
+    Raises:
+      GSUtilError: if the object cannot be read.
+    """
+    contents = self.Cat(url)
+    new_version = hashlib.md5(contents).hexdigest()
+    if new_version == version:
+      return None, version
+    return contents, new_version
+
+  def List(self, url):
+    """Returns the URLs of the objects and directories under |url|.
+
+    Directories are returned with a trailing slash, as by `gsutil ls'.
+
+    Raises:
+      GSUtilError: if the listing fails.
+    """
+    raise NotImplementedError()
+
+  def Copy(self, src, dst):
+    """Downloads the object at |src| to the file or directory |dst|.
+
+    Raises:
+      GSUtilError: if the download fails.
+    """
+    raise NotImplementedError()
+
+  def Stream(self, url, write):
+    """Passes the contents of the object at |url| to |write|, in chunks.
+
+    Raises:
+      GSUtilError: if the download fails.
+    """
+    raise NotImplementedError()
+
+  def GetSize(self, url):
+    """Returns the size of the object at |url|.
+
+    Backends returning None do not support CopyRange.
+
+    Raises:
+      GSUtilError: if the object cannot be found.
+    """
+    return None
+
+  def CopyRange(self, url, start, end, dst_file):
+    """Writes bytes |start| to |end| (inclusive) of |url| to |dst_file|.
+
+    The bytes are written at offset |start| of the file.
+
+    Raises:
+      GSUtilError: if the download fails.
+    """
+    raise NotImplementedError()
+
+
+class GSUtilBackend(StorageBackend):
+  """Runs a gsutil process for every operation."""
+
+  def __init__(self, gsutil='gsutil'):
+    """Args:
+      gsutil: command line invoking gsutil.
+    """
+    self.gsutil = gsutil
+
+  def Cat(self, url):
+    return GSUtilRun('%s cat %s' % (self.gsutil, url),
+                     'Failed to read "%s".' % url)
+
+  def List(self, url):
+    return GSUtilRun('%s ls %s/*' % (self.gsutil, url.rstrip('/')),
+                     'Failed to list "%s".' % url).splitlines()
+
+  def Copy(self, src, dst):
+    GSUtilRun('%s cp %s %s' % (self.gsutil, src, dst),
+              'Failed to download "%s".' % src)
+
+  def Stream(self, url, write):
+    # Not retried, as the stream may have been passed on partially.
+    cmd = '%s cat %s' % (self.gsutil, url)
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+    try:
+      for data in iter(lambda: proc.stdout.read(_COPY_CHUNK_SIZE), ''):
+        write(data)
+    except Exception:
+      proc.kill()
+      raise
+    finally:
+      proc.stdout.close()
+    if proc.wait():
+      raise GSUtilError('Failed to stream "%s". GSUTIL cmd %s failed with '
+                        'return code %d' % (url, cmd, proc.returncode))
+
+  def GetSize(self, url):
+    output = GSUtilRun('%s stat %s' % (self.gsutil, url),
+                       'Failed to stat "%s".' % url)
+    for line in output.splitlines():
+      name, _, value = line.partition(':')
+      if name.strip() == 'Content-Length':
+        return int(value)
+    raise GSUtilError('No size in the stat output of "%s".' % url)
+
+  def CopyRange(self, url, start, end, dst_file):
+    data = GSUtilRun('%s cat -r %d-%d %s' % (self.gsutil, start, end, url),
+                     'Failed to download "%s".' % url)
+    if len(data) != end + 1 - start:
+      raise GSUtilError('Ranged read of "%s" returned %d bytes.' % (
+          url, len(data)))
+    dst_file.seek(start)
+    dst_file.write(data)
+
+
+class _ConnectionPool(object):
+  """Keeps idle persistent HTTP connections for reuse."""
+
+  def __init__(self, scheme, netloc, max_idle=8, timeout=60):
+    self._connection_class = (httplib.HTTPSConnection if scheme == 'https'
+                              else httplib.HTTPConnection)
+    self._netloc = netloc
+    self._max_idle = max_idle
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._idle = []
+    self.connections = 0
+
+  def Get(self):
+    """Returns a connection and whether it was used before."""
+    with self._lock:
+      if self._idle:
+        return self._idle.pop(), True
+      self.connections += 1
+    return self._connection_class(self._netloc, timeout=self._timeout), False
+
+  def Put(self, connection):
+    """Returns a connection whose last response was read completely."""
+    with self._lock:
+      if len(self._idle) < self._max_idle:
+        self._idle.append(connection)
+        return
+    connection.close()
+
+
+class HttpBackend(StorageBackend):
+  """Accesses Google Storage in-process through its XML API.
+
+  Requests are issued over a pool of keep-alive connections and retried
+  with exponential backoff like gsutil commands, except for client errors
+  such as missing objects, which fail right away.
+  """
+
+  def __init__(self, endpoint=GS_HTTP_ENDPOINT, headers=None, max_idle=8,
+               timeout=60, auth_file=None):
+    """Args:
+      endpoint: base URL of the XML API.
+      headers: additional request headers, e.g. for authorization.
+      max_idle: maximum number of idle connections kept open.
+      timeout: socket timeout of the connections, in seconds.
+      auth_file: file holding the Authorization header of the requests, such
+                 as "Bearer <OAuth2 access token>"; it is read again whenever
+                 it changes, so that tokens can be refreshed by another
+                 process. Without it, only public objects can be read.
+    """
+    scheme, netloc, path, _, _ = urlparse.urlsplit(endpoint)
+    self._base_path = path.rstrip('/')
+    self._headers = headers or {}
+    self._auth_file = auth_file
+    self._auth_lock = threading.Lock()
+    # Modification time and contents of the auth file, as last read.
+    self._auth_mtime = None
+    self._auth = None
+    self._pool = _ConnectionPool(scheme, netloc, max_idle=max_idle,
+                                 timeout=timeout)
+
+  def _GetHeaders(self):
+    """Returns the headers of the backend, including the authorization."""
+    if not self._auth_file:
+      return self._headers
+    with self._auth_lock:
+      try:
+        mtime = os.stat(self._auth_file).st_mtime
+        if mtime != self._auth_mtime:
+          with open(self._auth_file) as auth_stream:
+            self._auth = auth_stream.read().strip()
+          self._auth_mtime = mtime
+      except EnvironmentError as e:
+        raise GSUtilError('Failed to read %s: %s' % (self._auth_file, e))
+      return dict(self._headers, Authorization=self._auth)
+
+  def _Request(self, method, path, err_msg, handle_response, headers=None):
+    """Issues a request, retrying failures with exponential backoff.
+
+    Args:
+      method: HTTP method of the request.
+      path: path and query of the request.
+      err_msg: message prefix of raised errors.
+      handle_response: function consuming a successful response, whose
+                       return value is returned.
+      headers: request headers besides the backend ones, read again for
+               every attempt.
+    Raises:
+      GSUtilError: on client errors, or when all attempts failed.
+    """
+    sleep_timeout = 1
+    attempt = 0
+    while True:
+      request_headers = dict(self._GetHeaders(), **(headers or {}))
+      connection, reused = self._pool.Get()
+      try:
+        connection.request(method, path, headers=request_headers)
+        response = connection.getresponse()
+        if response.status in (httplib.OK, httplib.PARTIAL_CONTENT,
+                               httplib.NOT_MODIFIED):
+          result = handle_response(response)
+          # Drain what is left, e.g. of HEAD responses, to reuse the connection.
+          response.read()
+          self._pool.Put(connection)
+          return result
+        response.read()
+        self._pool.Put(connection)
+        error = 'status %d' % response.status
+        if response.status < httplib.INTERNAL_SERVER_ERROR:
+          raise GSUtilError('%s %s %s failed with %s' % (err_msg, method, path,
+                                                         error))
+      except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        # The server may have closed an idle connection in the meantime.
+        if reused:
+          continue
+        error = str(e) or e.__class__.__name__
+      except Exception:
+        # The response was not consumed, so the connection can't be reused.
+        connection.close()
+        raise
+
+      attempt += 1
+      if attempt == GSUTIL_ATTEMPTS:
+        raise GSUtilError('%s %s %s failed with %s' % (err_msg, method, path,
+                                                       error))
+      _Log('%s %s failed with %s, retrying in %d seconds', method, path, error,
+           sleep_timeout)
+      time.sleep(sleep_timeout)
+      sleep_timeout *= 2
+
+  def _Get(self, path, err_msg, handle_response, headers=None):
+    return self._Request('GET', path, err_msg, handle_response, headers)
+
+  def _GetObjectPath(self, url):
+    bucket, path = _SplitGSUrl(url)
+    return '%s/%s/%s' % (self._base_path, bucket, urllib.quote(path))
+
+  def Cat(self, url):
+    return self._Get(self._GetObjectPath(url), 'Failed to read "%s".' % url,
+                     lambda response: response.read())
+
+  def CatIfChanged(self, url, version=None):
+    def _Read(response):
+      if response.status == httplib.NOT_MODIFIED:
+        return None, version
+      return response.read(), response.getheader('etag')
+
+    return self._Get(self._GetObjectPath(url), 'Failed to read "%s".' % url,
+                     _Read, headers={'If-None-Match': version} if version
+                     else None)
+
+  def List(self, url):
+    bucket, prefix = _SplitGSUrl(url.rstrip('/'))
+    if prefix:
+      prefix += '/'
+    urls = []
+    marker = ''
+    while True:
+      query = urllib.urlencode({'prefix': prefix, 'delimiter': '/',
+                                'marker': marker})
+      listing = ElementTree.fromstring(self._Get(
+          '%s/%s?%s' % (self._base_path, bucket, query),
+          'Failed to list "%s".' % url, lambda response: response.read()))
+      keys = []
+      truncated = False
+      next_marker = None
+      for element in listing:
+        tag = _GetLocalName(element)
+        if tag in ('Contents', 'CommonPrefixes'):
+          keys.extend(child.text for child in element
+                      if _GetLocalName(child) in ('Key', 'Prefix'))
+        elif tag == 'IsTruncated':
+          truncated = element.text == 'true'
+        elif tag == 'NextMarker':
+          next_marker = element.text
+      urls.extend('%s%s/%s' % (_GS_URL_PREFIX, bucket, key) for key in keys)
+      if not truncated or not keys:
+        return urls
+      marker = next_marker or keys[-1]
+
+  def Copy(self, src, dst):
+    def _Save(response):
+      with open(_GetCopyDestination(src, dst), 'wb') as dst_file:
+        shutil.copyfileobj(response, dst_file, _COPY_CHUNK_SIZE)
+
+    self._Get(self._GetObjectPath(src), 'Failed to download "%s".' % src,
+              _Save)
+
+  def GetSize(self, url):
+    return self._Request(
+        'HEAD', self._GetObjectPath(url), 'Failed to stat "%s".' % url,
+        lambda response: int(response.getheader('content-length')))
+
+  def CopyRange(self, url, start, end, dst_file):
+    def _Save(response):
+      if response.status != httplib.PARTIAL_CONTENT:
+        raise GSUtilError('Ranged read of "%s" not supported.' % url)
+      dst_file.seek(start)
+      shutil.copyfileobj(response, dst_file, _COPY_CHUNK_SIZE)
+
+    self._Get(self._GetObjectPath(url), 'Failed to download "%s".' % url,
+              _Save, headers={'Range': 'bytes=%d-%d' % (start, end)})
+
+  def Stream(self, url, write):
+    # Attempts after the first one resume after the bytes passed on so far,
+    # as the headers are read again for every attempt.
+    headers = {}
+    written = [0]
+
+    def _Forward(response):
+      if headers and response.status != httplib.PARTIAL_CONTENT:
+        raise GSUtilError('Ranged read of "%s" not supported.' % url)
+      for data in iter(lambda: response.read(_COPY_CHUNK_SIZE), ''):
+        write(data)
+        written[0] += len(data)
+        headers['Range'] = 'bytes=%d-' % written[0]
+
+    self._Get(self._GetObjectPath(url), 'Failed to download "%s".' % url,
+              _Forward, headers=headers)
+
+  def GetStats(self):
+    """Returns the number of connections opened so far."""
+    return {'connections': self._pool.connections}
+
+
+class LocalBackend(StorageBackend):
+  """Serves gs://bucket/path URLs from root_dir/bucket/path, for tests."""
+
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+
+  def _GetPath(self, url):
+    return os.path.join(self.root_dir, *_SplitGSUrl(url))
+
+  def Cat(self, url):
+    try:
+      with open(self._GetPath(url), 'rb') as gs_file:
+        return gs_file.read()
+    except IOError as e:
+      raise GSUtilError('Failed to read "%s": %s' % (url, e))
+
+  def List(self, url):
+    url = url.rstrip('/')
+    try:
+      names = sorted(os.listdir(self._GetPath(url)))
+    except OSError as e:
+      raise GSUtilError('Failed to list "%s": %s' % (url, e))
+    return ['%s/%s%s' % (url, name,
+                         '/' if os.path.isdir(self._GetPath(url + '/' + name))
+                         else '')
+            for name in names]
+
+  def Copy(self, src, dst):
+    try:
+      shutil.copyfile(self._GetPath(src), _GetCopyDestination(src, dst))
+    except IOError as e:
+      raise GSUtilError('Failed to download "%s": %s' % (src, e))
+
+  def Stream(self, url, write):
+    try:
+      with open(self._GetPath(url), 'rb') as src_file:
+        for data in iter(lambda: src_file.read(_COPY_CHUNK_SIZE), ''):
+          write(data)
+    except IOError as e:
+      raise GSUtilError('Failed to download "%s": %s' % (url, e))
+
+  def GetSize(self, url):
+    try:
+      return os.path.getsize(self._GetPath(url))
+    except OSError as e:
+      raise GSUtilError('Failed to stat "%s": %s' % (url, e))
+
+  def CopyRange(self, url, start, end, dst_file):
+    try:
+      with open(self._GetPath(url), 'rb') as src_file:
+        src_file.seek(start)
+        dst_file.seek(start)
+        remaining = end + 1 - start
+        while remaining:
+          data = src_file.read(min(remaining, _COPY_CHUNK_SIZE))
+          if not data:
+            raise GSUtilError('"%s" ends before byte %d.' % (url, end))
+          dst_file.write(data)
+          remaining -= len(data)
+    except IOError as e:
+      raise GSUtilError('Failed to download "%s": %s' % (url, e))
+
+
+_storage_backend = GSUtilBackend()
+
+
+def CreateStorageBackend(name, location=None, auth_file=None):
+  """Returns a storage backend by name.
+
+  Args:
+    name: one of STORAGE_BACKENDS.
+    location: endpoint URL of the http backend, or root directory of the
+              local backend.
+    auth_file: file holding the Authorization header of the requests of the
+               http backend, see HttpBackend.
+  """
+  if auth_file and name != 'http':
+    raise GSUtilError('Only the http storage backend takes an auth file.')
+  if name == 'gsutil':
+    return GSUtilBackend()
+  if name == 'http':
+    return HttpBackend(location or GS_HTTP_ENDPOINT, auth_file=auth_file)
+  if name == 'local':
+    if not location:
+      raise GSUtilError('The local storage backend needs a root directory.')
+    return LocalBackend(location)
+  raise GSUtilError('Unknown storage backend: %s' % name)
+
+
+def SetStorageBackend(backend):
+  """Sets the backend of the module functions accessing Google Storage."""
+  global _storage_backend
+  _storage_backend = backend
+
+
+def GetStorageBackend():
+  return _storage_backend
+
+
+def CatGS(url):
+  """Returns the contents of the object at gs_url |url|.
+
+  Raises:
+    GSUtilError: if the object cannot be read.
+  """
+  return _storage_backend.Cat(url)
+
+
+def ListGS(url):
+  """Returns the URLs of the objects under gs_url |url|.
+
+  Raises:
+    GSUtilError: if the listing fails.
+  """
+  return _storage_backend.List(url)
+
+
 def DownloadFromGS(src, dst):
   """Downloads object from gs_url |src| to |dst|.
 
   Raises:
     GSUtilError: if an error occurs during the download.
   """
-  cmd = 'gsutil cp %s %s' % (src, dst)
-  msg = 'Failed to download "%s".' % src
-  GSUtilRun(cmd, msg)
+  _storage_backend.Copy(src, dst)
@@ -6,9 +6,17 @@
 
 """Unit tests for gsutil_util module."""
 
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SocketServer
 import subprocess
+import tempfile
+import threading
 import time
 import unittest
+import urlparse
 
 import mox
 
@@ -67,5 +75,205 @@ class GSUtilUtilTest(mox.MoxTestBase):
     self.mox.VerifyAll()
 
 
+  def testRangedDownload(self):
+    """Tests that sizes and byte ranges of objects are read with gsutil."""
+    self.mox.StubOutWithMock(subprocess, 'Popen', use_mock_anything=True)
+    subprocess.Popen('gsutil stat gs://bucket/object', shell=True,
+                     stdout=subprocess.PIPE).AndReturn(self._bad_mock_process)
+    self._bad_mock_process.communicate().AndReturn(('', None))
+    subprocess.Popen('gsutil stat gs://bucket/object', shell=True,
+                     stdout=subprocess.PIPE).AndReturn(self._good_mock_process)
+    self._good_mock_process.communicate().AndReturn((
+        'gs://bucket/object:\n'
+        '    Creation time:    Tue, 01 May 2012 10:00:00 GMT\n'
+        '    Content-Length:   1234\n'
+        '    Content-Type:     application/octet-stream\n', None))
+    subprocess.Popen('gsutil cat -r 2-4 gs://bucket/object', shell=True,
+                     stdout=subprocess.PIPE).AndReturn(self._good_mock_process)
+    self._good_mock_process.communicate().AndReturn(('abc', None))
+    self.mox.ReplayAll()
+    backend = gsutil_util.GSUtilBackend()
+    self.assertEqual(backend.GetSize('gs://bucket/object'), 1234)
+    with tempfile.TemporaryFile() as dst_file:
+      dst_file.write('_' * 6)
+      backend.CopyRange('gs://bucket/object', 2, 4, dst_file)
+      dst_file.seek(0)
+      self.assertEqual(dst_file.read(), '__abc_')
+    self.mox.VerifyAll()
+
+
+class _FakeGSHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves objects from a dictionary, and listings of them in pages of 2."""
+  protocol_version = 'HTTP/1.1'
+  objects = {}
+  connections = 0
+  failures = 0
+  # Authorization headers of the GET requests.
+  authorizations = []
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    _FakeGSHandler.connections += 1
+
+  def do_GET(self):
+    _FakeGSHandler.authorizations.append(self.headers.get('Authorization'))
+    path, _, query = self.path.partition('?')
+    if _FakeGSHandler.failures:
+      _FakeGSHandler.failures -= 1
+      self._Reply(503, 'busy')
+    elif query:
+      params = urlparse.parse_qs(query)
+      keys = sorted(key for key in self.objects
+                    if key.startswith(params['prefix'][0]) and
+                    key > params.get('marker', [''])[0])
+      self._Reply(200, '<ListBucketResult xmlns="urn:test">'
+                  '<IsTruncated>%s</IsTruncated>%s</ListBucketResult>' % (
+                      'true' if len(keys) > 2 else 'false',
+                      ''.join('<Contents><Key>%s</Key></Contents>' % key
+                              for key in keys[:2])))
+    elif path[len('/bucket/'):] in self.objects:
+      body = self.objects[path[len('/bucket/'):]]
+      etag = '"%s"' % hashlib.md5(body).hexdigest()
+      if self.headers.get('If-None-Match') == etag:
+        self._Reply(304, '', send_body=False)
+      elif 'Range' in self.headers:
+        start, end = self.headers['Range'][len('bytes='):].split('-')
+        self._Reply(206, body[int(start):int(end) + 1])
+      else:
+        self._Reply(200, body, headers={'ETag': etag})
+    else:
+      self._Reply(404, 'missing')
+
+  def do_HEAD(self):
+    body = self.objects.get(self.path[len('/bucket/'):])
+    self._Reply(404 if body is None else 200, body or '', send_body=False)
+
+  def _Reply(self, status, body, send_body=True, headers=None):
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.end_headers()
+    if send_body:
+      self.wfile.write(body)
+
+  def log_message(self, *_args):
+    pass
+
+
+class _FakeGSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class StorageBackendTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._tmp_dir = tempfile.mkdtemp(prefix='gsutil_util')
+
+  def tearDown(self):
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self._tmp_dir)
+
+  def testLocalBackend(self):
+    """Tests the module functions on a local directory."""
+    os.makedirs(os.path.join(self._tmp_dir, 'bucket', 'build', 'au'))
+    with open(os.path.join(self._tmp_dir, 'bucket', 'build', 'UPLOADED'),
+              'w') as f:
+      f.write('UPLOADED\n')
+    gsutil_util.SetStorageBackend(
+        gsutil_util.CreateStorageBackend('local', self._tmp_dir))
+
+    self.assertEqual(gsutil_util.CatGS('gs://bucket/build/UPLOADED'),
+                     'UPLOADED\n')
+    backend = gsutil_util.GetStorageBackend()
+    _, version = backend.CatIfChanged('gs://bucket/build/UPLOADED')
+    self.assertEqual(backend.CatIfChanged('gs://bucket/build/UPLOADED',
+                                          version), (None, version))
+    self.assertEqual(gsutil_util.ListGS('gs://bucket/build/'),
+                     ['gs://bucket/build/UPLOADED', 'gs://bucket/build/au/'])
+    gsutil_util.DownloadFromGS('gs://bucket/build/UPLOADED', self._tmp_dir)
+    self.assertTrue(os.path.exists(os.path.join(self._tmp_dir, 'UPLOADED')))
+    self.assertRaises(gsutil_util.GSUtilError, gsutil_util.CatGS,
+                      'gs://bucket/build/missing')
+
+  def testHttpBackend(self):
+    """Tests reads, paginated listings and errors over one connection."""
+    _FakeGSHandler.objects = {'build/a': 'A', 'build/b': 'B', 'build/c': 'C',
+                              'other/d': 'D'}
+    server = _FakeGSServer(('127.0.0.1', 0), _FakeGSHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    self.mox.StubOutWithMock(time, 'sleep')
+    time.sleep(1)
+    self.mox.ReplayAll()
+    try:
+      backend = gsutil_util.HttpBackend(
+          'http://127.0.0.1:%d' % server.server_address[1])
+      self.assertEqual(backend.Cat('gs://bucket/build/a'), 'A')
+      contents, version = backend.CatIfChanged('gs://bucket/build/a')
+      self.assertEqual(contents, 'A')
+      self.assertEqual(backend.CatIfChanged('gs://bucket/build/a', version),
+                       (None, version))
+      self.assertEqual(backend.List('gs://bucket/build'),
+                       ['gs://bucket/build/a', 'gs://bucket/build/b',
+                        'gs://bucket/build/c'])
+      backend.Copy('gs://bucket/build/b', self._tmp_dir)
+      with open(os.path.join(self._tmp_dir, 'b')) as f:
+        self.assertEqual(f.read(), 'B')
+
+      self.assertEqual(backend.GetSize('gs://bucket/other/d'), 1)
+      chunks = []
+      backend.Stream('gs://bucket/build/a', chunks.append)
+      self.assertEqual(chunks, ['A'])
+      with open(os.path.join(self._tmp_dir, 'b'), 'r+b') as f:
+        backend.CopyRange('gs://bucket/build/c', 0, 0, f)
+        f.seek(0)
+        self.assertEqual(f.read(), 'C')
+
+      _FakeGSHandler.failures = 1
+      self.assertEqual(backend.Cat('gs://bucket/other/d'), 'D')
+      self.assertRaises(gsutil_util.GSUtilError, backend.Cat,
+                        'gs://bucket/build/missing')
+      self.assertEqual(backend.GetStats()['connections'], 1)
+    finally:
+      server.shutdown()
+      server.server_close()
+      thread.join()
+    self.mox.VerifyAll()
+
+
+  def testHttpBackendAuthorization(self):
+    """Tests that requests carry the current contents of the auth file."""
+    _FakeGSHandler.objects = {'build/a': 'A'}
+    _FakeGSHandler.authorizations = []
+    server = _FakeGSServer(('127.0.0.1', 0), _FakeGSHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    auth_file = os.path.join(self._tmp_dir, 'auth')
+    try:
+      backend = gsutil_util.CreateStorageBackend(
+          'http', 'http://127.0.0.1:%d' % server.server_address[1],
+          auth_file)
+      self.assertRaises(gsutil_util.GSUtilError, backend.Cat,
+                        'gs://bucket/build/a')
+      with open(auth_file, 'w') as f:
+        f.write('Bearer token1\n')
+      self.assertEqual(backend.Cat('gs://bucket/build/a'), 'A')
+      backend.Cat('gs://bucket/build/a')
+      with open(auth_file, 'w') as f:
+        f.write('Bearer token2\n')
+      os.utime(auth_file, (0, 0))
+      backend.Cat('gs://bucket/build/a')
+      self.assertEqual(_FakeGSHandler.authorizations,
+                       ['Bearer token1', 'Bearer token1', 'Bearer token2'])
+    finally:
+      server.shutdown()
+      server.server_close()
+      thread.join()
+    self.assertRaises(gsutil_util.GSUtilError,
+                      gsutil_util.CreateStorageBackend, 'gsutil', None,
+                      auth_file)
+
 if __name__ == '__main__':
   unittest.main()
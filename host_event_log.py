@@ -0,0 +1,254 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A durable log of host update events, stored in append-only segments."""
+
+import array
+import bisect
+import heapq
+import json
+import os
+import re
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('HOST_LOG', message, *args)
+
+
+_SEGMENT_NAME = 'events-%08d.jsonl'
+_SEGMENT_RE = re.compile(r'^events-(\d{8})\.jsonl$')
+# Stands in for events without an event type in the index.
+_NO_EVENT_TYPE = -1
+
+
+class _HostIndex(object):
+  """Locations of the events of one host, in sequence number order."""
+  __slots__ = ('seqs', 'event_types', 'segments', 'offsets')
+
+  def __init__(self):
+    self.seqs = array.array('l')
+    self.event_types = array.array('l')
+    self.segments = array.array('l')
+    self.offsets = array.array('l')
+
+  def Append(self, seq, event_type, segment, offset):
+    self.seqs.append(seq)
+    self.event_types.append(
+        _NO_EVENT_TYPE if event_type is None else event_type)
+    self.segments.append(segment)
+    self.offsets.append(offset)
+
+  def DropSegmentsUpTo(self, segment):
+    """Forgets the events stored in segments up to |segment|."""
+    count = bisect.bisect_right(self.segments, segment)
+    for column in (self.seqs, self.event_types, self.segments, self.offsets):
+      del column[:count]
+
+  def Find(self, since, event_type, limit):
+    """Returns (seq, segment, offset) of matching events, oldest first."""
+    matches = []
+    for i in xrange(bisect.bisect_right(self.seqs, since), len(self.seqs)):
+      if event_type is None or self.event_types[i] == event_type:
+        matches.append((self.seqs[i], self.segments[i], self.offsets[i]))
+        if len(matches) == limit:
+          break
+    return matches
+
+
+class HostEventLog(object):
+  """Persists host events to size rotated JSON lines segment files.
+
+  Every event is appended to the current segment as one JSON line, carrying
+  the host id, the event time and a sequence number unique across hosts. An
+  in-memory index records where each host's events are, so queries only read
+  the events they return. The index is rebuilt from the segments when the log
+  is loaded; segments beyond max_segments are deleted, oldest first.
+  """
+
+  def __init__(self, log_dir, segment_size=8 << 20, max_segments=16):
+    """Args:
+      log_dir: directory holding the segment files.
+      segment_size: size in bytes after which a new segment is started.
+      max_segments: number of segments retained.
+    """
+    self.log_dir = log_dir
+    self.segment_size = segment_size
+    self.max_segments = max_segments
+    self._lock = threading.Lock()
+    # Host index objects, keyed by host id.
+    self._index = {}
+    # Numbers of the existing segments, ascending.
+    self._segments = []
+    self._stream = None
+    self._stream_size = 0
+    self._next_seq = 0
+
+  def _GetSegmentPath(self, segment):
+    return os.path.join(self.log_dir, _SEGMENT_NAME % segment)
+
+  def _IndexSegment(self, segment):
+    """Adds the events of an existing segment to the index.
+
+    Returns:
+      The size of the segment up to the end of its last complete line.
+    """
+    offset = 0
+    with open(self._GetSegmentPath(segment), 'rb') as segment_file:
+      for line in segment_file:
+        try:
+          event = json.loads(line)
+          host_index = self._index.setdefault(event['ip'], _HostIndex())
+          host_index.Append(event['seq'], event.get('event_type'), segment,
+                            offset)
+          self._next_seq = max(self._next_seq, event['seq'] + 1)
+        except (ValueError, KeyError, TypeError):
+          # Most likely a line cut short when the devserver went down.
+          _Log('Skipping unreadable event at %s:%d', segment, offset)
+        if line.endswith('\n'):
+          offset += len(line)
+    return offset
+
+  def Load(self):
+    """Indexes existing segments and reopens the newest one for appending.
+
+    A new segment is only started if there is none, or the newest is full.
+    """
+    if not os.path.isdir(self.log_dir):
+      os.makedirs(self.log_dir)
+    with self._lock:
+      self._segments = sorted(
+          int(match.group(1)) for match in
+          (_SEGMENT_RE.match(name) for name in os.listdir(self.log_dir))
+          if match)
+      size = 0
+      for segment in self._segments:
+        size = self._IndexSegment(segment)
+      if self._segments and size < self.segment_size:
+        self._OpenSegment(self._segments[-1], size)
+      else:
+        self._StartSegment()
+      events = self._CountEvents()
+    _Log('Loaded %d events of %d hosts from %s', events, len(self._index),
+         self.log_dir)
+
+  def _CountEvents(self):
+    """Returns the number of indexed events; must hold the lock."""
+    return sum(len(host_index.seqs) for host_index in self._index.itervalues())
+
+  def _OpenSegment(self, segment, size):
+    """Opens |segment| for appending after its first |size| bytes."""
+    self._stream = open(self._GetSegmentPath(segment), 'ab')
+    # Drop a line cut short, so that the next event starts on a line of its
+    # own.
+    self._stream.truncate(size)
+    self._stream_size = size
+
+  def _StartSegment(self):
+    """Closes the current segment and starts a new one."""
+    if self._stream:
+      self._stream.close()
+    segment = self._segments[-1] + 1 if self._segments else 0
+    self._OpenSegment(segment, 0)
+    self._segments.append(segment)
+    while len(self._segments) > self.max_segments:
+      oldest = self._segments.pop(0)
+      try:
+        os.remove(self._GetSegmentPath(oldest))
+      except OSError as e:
+        _Log('Failed to remove segment %d: %s', oldest, e)
+      for host_id, host_index in self._index.items():
+        host_index.DropSegmentsUpTo(oldest)
+        if not host_index.seqs:
+          del self._index[host_id]
+
+  def Append(self, host_id, entry):
+    """Records an event of |host_id|.
+
+    Args:
+      host_id: the host the event is from, normally its IP address.
+      entry: a dictionary of event attributes; a timestamp and a sequence
+             number are added to it.
+    Returns:
+      The sequence number of the event.
+    """
+    assert not 'timestamp' in entry, 'Oops, timestamp field already in use'
+    entry['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with self._lock:
+      if self._stream_size >= self.segment_size:
+        self._StartSegment()
+      entry['seq'] = seq = self._next_seq
+      self._next_seq += 1
+      record = dict(entry, ip=host_id)
+      line = json.dumps(record, sort_keys=True) + '\n'
+      self._stream.write(line)
+      self._stream.flush()
+      self._index.setdefault(host_id, _HostIndex()).Append(
+          seq, entry.get('event_type'), self._segments[-1], self._stream_size)
+      self._stream_size += len(line)
+    return seq
+
+  def _ReadEvents(self, locations):
+    """Returns the events at (host_id, segment, offset) |locations|."""
+    events = []
+    open_files = {}
+    try:
+      for host_id, segment, offset in locations:
+        segment_file = open_files.get(segment)
+        if not segment_file:
+          try:
+            segment_file = open(self._GetSegmentPath(segment), 'rb')
+          except IOError:
+            # The segment was rotated out since the index was consulted.
+            continue
+          open_files[segment] = segment_file
+        segment_file.seek(offset)
+        event = json.loads(segment_file.readline())
+        del event['ip']
+        events.append((host_id, event))
+    finally:
+      for segment_file in open_files.itervalues():
+        segment_file.close()
+    return events
+
+  def Query(self, host_id=None, since=None, limit=None, event_type=None):
+    """Returns recorded events, oldest first.
+
+    Args:
+      host_id: the host whose events to return, None for all hosts.
+      since: only return events with a larger sequence number.
+      limit: maximum number of events to return per host.
+      event_type: only return events of this type.
+    Returns:
+      A list of (host_id, event dictionary) pairs, in sequence order.
+    """
+    since = -1 if since is None else since
+    with self._lock:
+      if host_id is None:
+        host_ids = self._index.keys()
+      else:
+        host_ids = [host_id] if host_id in self._index else []
+      matches = [[(seq, host, segment, offset) for seq, segment, offset in
+                  self._index[host].Find(since, event_type, limit)]
+                 for host in host_ids]
+    locations = [(host, segment, offset) for _, host, segment, offset in
+                 heapq.merge(*matches)]
+    return self._ReadEvents(locations)
+
+  def GetHostIds(self):
+    """Returns the ids of the hosts with recorded events."""
+    with self._lock:
+      return self._index.keys()
+
+  def GetStats(self):
+    """Returns a dictionary of event log statistics."""
+    with self._lock:
+      return {'hosts': len(self._index),
+              'events': self._CountEvents(),
+              'segments': len(self._segments),
+              'next_seq': self._next_seq}
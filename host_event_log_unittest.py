@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for host_event_log module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import host_event_log
+
+
+class HostEventLogTest(unittest.TestCase):
+
+  def setUp(self):
+    self._log_dir = tempfile.mkdtemp(prefix='host_event_log')
+
+  def tearDown(self):
+    shutil.rmtree(self._log_dir)
+
+  def _CreateLog(self, **kwargs):
+    log = host_event_log.HostEventLog(self._log_dir, **kwargs)
+    log.Load()
+    return log
+
+  def _AppendEvents(self, log):
+    for event_type in (3, 14, 3):
+      for ip in ('1.2.3.4', '5.6.7.8'):
+        log.Append(ip, {'event_type': event_type, 'event_result': 1})
+
+  def testQuery(self):
+    """Tests host, sequence number, type and count filters."""
+    log = self._CreateLog()
+    self._AppendEvents(log)
+    events = log.Query('1.2.3.4')
+    self.assertEqual([event['seq'] for _, event in events], [0, 2, 4])
+    self.assertEqual([event['event_type'] for _, event in events], [3, 14, 3])
+    self.assertTrue('timestamp' in events[0][1])
+    self.assertFalse('ip' in events[0][1])
+
+    self.assertEqual([event['seq'] for _, event in log.Query(since=2)],
+                     [3, 4, 5])
+    self.assertEqual([(ip, event['seq']) for ip, event in
+                      log.Query(event_type=3, limit=1)],
+                     [('1.2.3.4', 0), ('5.6.7.8', 1)])
+    self.assertEqual(log.Query('9.9.9.9'), [])
+    self.assertEqual(log.GetStats()['events'], 6)
+
+  def testReload(self):
+    """Tests that events survive a restart and numbering carries on."""
+    self._AppendEvents(self._CreateLog())
+    with open(os.path.join(self._log_dir, 'events-00000000.jsonl'), 'a') as f:
+      f.write('{"ip": "1.2.3.4", "se')
+
+    log = self._CreateLog()
+    self.assertEqual(len(log.Query()), 6)
+    self.assertEqual(log.Append('1.2.3.4', {}), 6)
+    self.assertEqual(log.Query('1.2.3.4', since=5)[0][1]['seq'], 6)
+    # The newest segment is appended to, past the line cut short.
+    self.assertEqual(os.listdir(self._log_dir), ['events-00000000.jsonl'])
+    self.assertEqual(len(self._CreateLog().Query()), 7)
+
+    # A full segment is not.
+    self._CreateLog(segment_size=1).Append('1.2.3.4', {})
+    self.assertEqual(len(os.listdir(self._log_dir)), 2)
+
+  def testRotation(self):
+    """Tests that old segments are removed along with their events."""
+    log = self._CreateLog(segment_size=1, max_segments=2)
+    self._AppendEvents(log)
+    self.assertEqual(len(os.listdir(self._log_dir)), 2)
+    self.assertEqual([event['seq'] for _, event in log.Query()], [4, 5])
+    self.assertEqual(log.GetStats()['hosts'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
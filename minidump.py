@@ -0,0 +1,123 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Parsing of the modules a minidump references, for symbol lookups.
+
+Only the module list stream of a minidump is read: the name of each module,
+and the debug file and identifier its symbols are filed under, in the
+layout of breakpad symbol directories.
+"""
+
+import collections
+import os
+import struct
+
+
+_HEADER = struct.Struct('<IIIIIIQ')
+_DIRECTORY_ENTRY = struct.Struct('<III')
+# MINIDUMP_MODULE: base, size, checksum, timestamp, name RVA, version info,
+# CodeView record size and RVA, misc record and reserved fields.
+_MODULE = struct.Struct('<QIIII52xII8x16x')
+_GUID = struct.Struct('<IHH8s')
+
+_SIGNATURE = 0x504d444d  # MDMP
+_MODULE_LIST_STREAM = 4
+_CV_PDB70_SIGNATURE = 0x53445352  # RSDS
+_CV_ELF_SIGNATURE = 0x4270454c  # BpEL
+
+
+class MinidumpError(Exception):
+  """Raised when a minidump is truncated or malformed."""
+  pass
+
+
+# A module of a minidump.
+#   code_file: path of the module on the crashed system.
+#   debug_file: name the symbols of the module are filed under.
+#   debug_id: identifier of the build of the module, or None if unknown.
+Module = collections.namedtuple('Module', ('code_file', 'debug_file',
+                                           'debug_id'))
+
+
+def _Unpack(layout, data, offset):
+  if offset < 0 or offset + layout.size > len(data):
+    raise MinidumpError('Truncated minidump: %d bytes needed at %d of %d.' % (
+        layout.size, offset, len(data)))
+  return layout.unpack_from(data, offset)
+
+
+def _FormatGuid(guid_bytes, age):
+  data1, data2, data3, data4 = _GUID.unpack(guid_bytes)
+  return '%08X%04X%04X%s%X' % (data1, data2, data3,
+                               data4.encode('hex').upper(), age)
+
+
+def _ReadString(data, rva):
+  """Returns the MINIDUMP_STRING at |rva|."""
+  (length,) = _Unpack(struct.Struct('<I'), data, rva)
+  if rva + 4 + length > len(data):
+    raise MinidumpError('Truncated string at %d.' % rva)
+  return data[rva + 4:rva + 4 + length].decode('utf-16-le').encode('utf-8')
+
+
+def _BaseName(path):
+  return os.path.basename(path.replace('\\', '/'))
+
+
+def _ReadModule(data, offset):
+  """Returns the Module described at |offset|."""
+  _, _, _, _, name_rva, cv_size, cv_rva = _Unpack(_MODULE, data, offset)
+  code_file = _ReadString(data, name_rva)
+  debug_file = _BaseName(code_file)
+  debug_id = None
+  if cv_size >= 4 and cv_rva + cv_size <= len(data):
+    cv_record = data[cv_rva:cv_rva + cv_size]
+    (signature,) = struct.unpack_from('<I', cv_record)
+    if signature == _CV_PDB70_SIGNATURE and cv_size >= 24:
+      (age,) = struct.unpack_from('<I', cv_record, 20)
+      debug_id = _FormatGuid(cv_record[4:20], age)
+      pdb_file = cv_record[24:].split('\0', 1)[0]
+      if pdb_file:
+        debug_file = _BaseName(pdb_file)
+    elif signature == _CV_ELF_SIGNATURE:
+      # Breakpad files ELF modules under their build id, read as a GUID.
+      build_id = cv_record[4:20].ljust(16, '\0')
+      debug_id = _FormatGuid(build_id, 0)
+  return Module(code_file, debug_file, debug_id)
+
+
+def GetModules(data):
+  """Returns the modules referenced by a minidump.
+
+  Args:
+    data: contents of the minidump.
+
+  Returns:
+    The list of Module of the module list of the minidump, in order; empty if
+    it has none.
+
+  Raises:
+    MinidumpError: if |data| isn't a valid minidump.
+  """
+  signature, _, stream_count, directory_rva, _, _, _ = _Unpack(_HEADER, data, 0)
+  if signature != _SIGNATURE:
+    raise MinidumpError('Not a minidump.')
+
+  for index in range(stream_count):
+    stream_type, _, rva = _Unpack(
+        _DIRECTORY_ENTRY, data, directory_rva + index * _DIRECTORY_ENTRY.size)
+    if stream_type != _MODULE_LIST_STREAM:
+      continue
+    (module_count,) = _Unpack(struct.Struct('<I'), data, rva)
+    return [_ReadModule(data, rva + 4 + i * _MODULE.size)
+            for i in range(module_count)]
+  return []
+
+
+def GetSymbolPath(module):
+  """Returns the path of the symbols of |module| in a breakpad symbol tree."""
+  name = module.debug_file
+  if name.endswith('.pdb'):
+    name = name[:-len('.pdb')]
+  return os.path.join(module.debug_file, module.debug_id, name + '.sym')
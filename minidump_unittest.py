@@ -0,0 +1,76 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for minidump module."""
+
+import struct
+import unittest
+
+import minidump
+
+
+_GUID = ('\x78\x56\x34\x12\x34\x12\x78\x56'
+         '\x01\x02\x03\x04\x05\x06\x07\x08')
+
+
+def _BuildMinidump(modules):
+  """Returns a minidump with a module list of (name, CodeView record)."""
+  header_size = 32 + 12
+  list_size = 4 + len(modules) * 108
+  data_offset = header_size + list_size
+  module_entries = []
+  blobs = ''
+  for name, cv_record in modules:
+    name_rva = data_offset + len(blobs)
+    encoded = name.decode('utf-8').encode('utf-16-le')
+    blobs += struct.pack('<I', len(encoded)) + encoded
+    cv_rva = data_offset + len(blobs)
+    blobs += cv_record
+    module_entries.append(struct.pack(
+        '<QIIII52xII8x16x', 0x1000, 0x100, 0, 0, name_rva, len(cv_record),
+        cv_rva))
+  return (struct.pack('<IIIIIIQ', 0x504d444d, 0xa793, 1, 32, 0, 0, 0) +
+          struct.pack('<III', 4, list_size, header_size) +
+          struct.pack('<I', len(modules)) + ''.join(module_entries) + blobs)
+
+
+class MinidumpTest(unittest.TestCase):
+
+  def testGetModules(self):
+    """Tests reading PDB and ELF modules, and modules without debug ids."""
+    data = _BuildMinidump([
+        ('C:\\Program Files\\chrome.dll',
+         struct.pack('<I', 0x53445352) + _GUID + struct.pack('<I', 2) +
+         'c:\\build\\chrome.dll.pdb\0'),
+        ('/opt/google/chrome/chrome',
+         struct.pack('<I', 0x4270454c) + _GUID + '\x09\x0a\x0b\x0c'),
+        ('/lib/libc.so.6', '')])
+    modules = minidump.GetModules(data)
+    self.assertEqual(modules, [
+        minidump.Module('C:\\Program Files\\chrome.dll', 'chrome.dll.pdb',
+                        '123456781234567801020304050607082'),
+        minidump.Module('/opt/google/chrome/chrome', 'chrome',
+                        '123456781234567801020304050607080'),
+        minidump.Module('/lib/libc.so.6', 'libc.so.6', None)])
+    self.assertEqual(minidump.GetSymbolPath(modules[0]),
+                     'chrome.dll.pdb/123456781234567801020304050607082/'
+                     'chrome.dll.sym')
+    self.assertEqual(minidump.GetSymbolPath(modules[1]),
+                     'chrome/123456781234567801020304050607080/chrome.sym')
+
+  def testGetModulesOfInvalidMinidumps(self):
+    """Tests truncated, foreign and module-less data."""
+    data = _BuildMinidump([('/lib/libc.so.6', '')])
+    self.assertRaises(minidump.MinidumpError, minidump.GetModules,
+                      'not a minidump' * 4)
+    self.assertRaises(minidump.MinidumpError, minidump.GetModules, data[:100])
+    # Minidumps without a module list stream have no modules.
+    self.assertEqual(minidump.GetModules(data[:32] + struct.pack('<I', 3) +
+                                         data[36:]), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,198 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A persistent, process-wide index of update payload metadata."""
+
+import Queue
+import json
+import os
+import threading
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_INDEX', message, *args)
+
+
+# Seconds changes to the index are batched for before it is persisted.
+_SAVE_DELAY = 1
+
+
+class PayloadIndex(object):
+  """Maps payload files to their precomputed metadata.
+
+  Entries are keyed by path and are only considered valid while the file's
+  (inode, size, mtime) triple matches the one recorded when the metadata was
+  computed. The index is persisted to a JSON file so that it survives server
+  restarts, at most once per _SAVE_DELAY seconds, and can be filled by a
+  background worker so that metadata for freshly staged payloads is ready
+  before the first update check arrives.
+
+  Members:
+    hits:   number of lookups answered from the index.
+    misses: number of lookups for files that were not indexed.
+    stale:  number of lookups for files whose index entry was outdated.
+  """
+
+  def __init__(self, index_file, compute_func):
+    """Args:
+      index_file: path to the file the index is persisted to; None disables
+                  persistence.
+      compute_func: function taking a file path and returning a dictionary of
+                    metadata attributes for it.
+    """
+    self._index_file = index_file
+    self._compute_func = compute_func
+    self._lock = threading.Lock()
+    self._save_lock = threading.Lock()
+    # A dictionary mapping paths to [key, attrs] pairs.
+    self._entries = {}
+    # Per-path locks and the number of their users, used for making sure a
+    # file is only hashed once; dropped once unused.
+    self._path_locks = {}
+    # Timer saving the index, while a save is scheduled.
+    self._save_timer = None
+    self._queue = Queue.Queue()
+    self._worker = None
+    self.hits = 0
+    self.misses = 0
+    self.stale = 0
+
+  @staticmethod
+  def _GetFileKey(path):
+    """Returns the (inode, size, mtime) key of a file, None if it is missing."""
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+  def Load(self):
+    """Loads previously persisted index entries, if any."""
+    if not (self._index_file and os.path.exists(self._index_file)):
+      return
+    try:
+      with open(self._index_file) as index_stream:
+        entries = json.load(index_stream)
+    except (IOError, ValueError) as e:
+      _Log('Ignoring unreadable payload index %s: %s', self._index_file, e)
+      return
+    with self._lock:
+      self._entries.update(entries)
+    _Log('Loaded %d entries from %s', len(entries), self._index_file)
+
+  def _ScheduleSave(self):
+    """Saves the index after a while, batching the changes made meanwhile.
+
+    Must be called with the lock held.
+    """
+    if not self._index_file or self._save_timer:
+      return
+    self._save_timer = threading.Timer(_SAVE_DELAY, self.Flush)
+    self._save_timer.daemon = True
+    self._save_timer.start()
+
+  def Flush(self):
+    """Atomically writes the index to its backing file, if it changed."""
+    with self._save_lock:
+      with self._lock:
+        if not self._save_timer:
+          return
+        self._save_timer.cancel()
+        self._save_timer = None
+        entries = dict(self._entries)
+      tmp_file = self._index_file + '.tmp'
+      try:
+        with open(tmp_file, 'w') as index_stream:
+          json.dump(entries, index_stream)
+        os.rename(tmp_file, self._index_file)
+      except (IOError, OSError) as e:
+        _Log('Failed to persist payload index to %s: %s', self._index_file, e)
+
+  def _Lookup(self, path):
+    """Returns (attrs, is_stale) for |path|; attrs is None if not indexed."""
+    key = self._GetFileKey(path)
+    with self._lock:
+      entry = self._entries.get(path)
+      if not entry:
+        return None, False
+      if entry[0] != key:
+        del self._entries[path]
+        return None, True
+      return dict(entry[1]), False
+
+  def Lookup(self, path):
+    """Returns a copy of the indexed attributes of |path|, or None."""
+    attrs, is_stale = self._Lookup(path)
+    with self._lock:
+      if attrs is not None:
+        self.hits += 1
+      elif is_stale:
+        self.stale += 1
+      else:
+        self.misses += 1
+    return attrs
+
+  def Add(self, path, attrs):
+    """Records |attrs| as the metadata of the current version of |path|."""
+    key = self._GetFileKey(path)
+    if key is None:
+      return
+    with self._lock:
+      self._entries[path] = [key, dict(attrs)]
+      self._ScheduleSave()
+
+  def Compute(self, path):
+    """Computes, indexes and returns the attributes of |path|.
+
+    Concurrent calls for the same path compute the attributes only once; the
+    ones that had to wait return the freshly indexed result.
+    """
+    with self._lock:
+      path_lock = self._path_locks.setdefault(path, [threading.Lock(), 0])
+      path_lock[1] += 1
+    try:
+      with path_lock[0]:
+        attrs, _ = self._Lookup(path)
+        if attrs is None:
+          attrs = self._compute_func(path)
+          self.Add(path, attrs)
+    finally:
+      with self._lock:
+        path_lock[1] -= 1
+        if not path_lock[1]:
+          del self._path_locks[path]
+    return attrs
+
+  def _IndexWorker(self):
+    """Indexes files placed in the background queue, forever."""
+    while True:
+      path = self._queue.get()
+      try:
+        if os.path.exists(path):
+          _Log('Indexing %s in the background', path)
+          self.Compute(path)
+      except Exception as e:
+        _Log('Failed to index %s: %s', path, e)
+
+  def IndexInBackground(self, paths):
+    """Queues |paths| for indexing by a background worker thread."""
+    with self._lock:
+      if not self._worker:
+        self._worker = threading.Thread(target=self._IndexWorker)
+        self._worker.daemon = True
+        self._worker.start()
+    for path in paths:
+      self._queue.put(path)
+
+  def GetStats(self):
+    """Returns a dictionary of index statistics."""
+    with self._lock:
+      return {'entries': len(self._entries),
+              'pending': self._queue.qsize(),
+              'hits': self.hits,
+              'misses': self.misses,
+              'stale': self.stale}
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_index module."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mox
+
+import payload_index
+
+
+class PayloadIndexTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._work_dir = tempfile.mkdtemp('payload_index_unittest')
+    self._index_file = os.path.join(self._work_dir, 'index.json')
+    self._payload = os.path.join(self._work_dir, 'update.gz')
+    with open(self._payload, 'w') as f:
+      f.write('PAYLOAD')
+    self._compute_calls = []
+
+  def tearDown(self):
+    shutil.rmtree(self._work_dir)
+
+  def _Compute(self, path):
+    """Fake metadata function that records its invocations."""
+    self._compute_calls.append(path)
+    return {'sha1': 'SHA1-%d' % len(self._compute_calls)}
+
+  def testComputeAndLookup(self):
+    """Tests that computed attributes are served from the index."""
+    index = payload_index.PayloadIndex(None, self._Compute)
+    self.assertEqual(index.Lookup(self._payload), None)
+    self.assertEqual(index.Compute(self._payload), {'sha1': 'SHA1-1'})
+    self.assertEqual(index.Lookup(self._payload), {'sha1': 'SHA1-1'})
+    self.assertEqual(index.Compute(self._payload), {'sha1': 'SHA1-1'})
+    self.assertEqual(self._compute_calls, [self._payload])
+    self.assertEqual(index._path_locks, {})
+    stats = index.GetStats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['stale']),
+                     (1, 1, 0))
+
+  def testStaleEntry(self):
+    """Tests that modified files invalidate their index entry."""
+    index = payload_index.PayloadIndex(None, self._Compute)
+    index.Compute(self._payload)
+    with open(self._payload, 'a') as f:
+      f.write('MORE')
+    self.assertEqual(index.Lookup(self._payload), None)
+    self.assertEqual(index.GetStats()['stale'], 1)
+    self.assertEqual(index.Compute(self._payload), {'sha1': 'SHA1-2'})
+
+  def testPersistence(self):
+    """Tests that the index survives being reloaded."""
+    index = payload_index.PayloadIndex(self._index_file, self._Compute)
+    index.Add(self._payload, {'sha1': 'STORED'})
+    # Saves are batched.
+    self.assertFalse(os.path.exists(self._index_file))
+    index.Flush()
+    index = payload_index.PayloadIndex(self._index_file, self._Compute)
+    index.Load()
+    self.assertEqual(index.Lookup(self._payload), {'sha1': 'STORED'})
+    self.assertEqual(self._compute_calls, [])
+
+  def testBatchedSaves(self):
+    """Tests that changes are saved once, after a while."""
+    self.mox.stubs.Set(payload_index, '_SAVE_DELAY', 0.05)
+    index = payload_index.PayloadIndex(self._index_file, self._Compute)
+    index.Add(self._payload, {'sha1': 'FIRST'})
+    index.Add(self._payload, {'sha1': 'SECOND'})
+    deadline = time.time() + 10
+    while not os.path.exists(self._index_file) and time.time() < deadline:
+      time.sleep(0.01)
+    index = payload_index.PayloadIndex(self._index_file, self._Compute)
+    index.Load()
+    self.assertEqual(index.Lookup(self._payload), {'sha1': 'SECOND'})
+
+  def testIndexInBackground(self):
+    """Tests that queued files get indexed by the background worker."""
+    index = payload_index.PayloadIndex(None, self._Compute)
+    index.IndexInBackground([self._payload])
+    deadline = time.time() + 10
+    while not index.GetStats()['entries'] and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(index.Lookup(self._payload), {'sha1': 'SHA1-1'})
+
+
+if __name__ == '__main__':
+  unittest.main()
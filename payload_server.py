@@ -0,0 +1,242 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Serving of staged payloads with byte range and conditional requests."""
+
+import collections
+import mimetypes
+import mmap
+import os
+import threading
+import time
+import uuid
+
+import cherrypy
+from cherrypy.lib import httputil
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('PAYLOAD_SERVER', message, *args)
+
+
+# Size of the slices of mapped files handed to the HTTP server.
+_CHUNK_SIZE = 1 << 20
+# Number of finished transfers kept for statistics.
+_RECENT_TRANSFERS = 20
+
+
+def ParseRange(header, size):
+  """Parses the value of a Range header against a resource of |size| bytes.
+
+  Args:
+    header: the value of the Range header, e.g. 'bytes=0-499,-500'.
+    size: the size of the resource in bytes.
+  Returns:
+    A list of (start, stop) tuples suitable for slicing, in the order they
+    were requested; an empty list if none of the ranges is satisfiable; None
+    if the header is missing or invalid, in which case it must be ignored.
+  """
+  if not header:
+    return None
+  unit, _, range_set = header.partition('=')
+  if unit.strip().lower() != 'bytes' or not range_set:
+    return None
+  ranges = []
+  for byte_range in range_set.split(','):
+    first, dash, last = byte_range.strip().partition('-')
+    try:
+      first = int(first) if first else None
+      last = int(last) if last else None
+    except ValueError:
+      return None
+    if (not dash or (first is None and last is None) or
+        (last is not None and last < 0)):
+      return None
+    if first is None:
+      # A suffix range, the last |last| bytes.
+      if last > 0 and size:
+        ranges.append((max(size - last, 0), size))
+    elif last is not None and last < first:
+      return None
+    elif first < size:
+      ranges.append((first, size if last is None else min(last + 1, size)))
+  return ranges
+
+
+class PayloadServer(object):
+  """Serves files from a directory tree to update clients.
+
+  Files are memory mapped and handed to the HTTP server in large slices of the
+  mapping, so payload bytes are not copied through Python strings on their way
+  to the socket. Single and multiple byte ranges are supported so that
+  interrupted downloads can be resumed, and strong ETags allow clients to
+  validate a resumed download with If-Range. ETags are derived from the
+  file's inode, size and mtime, so they stay the same for as long as the file
+  does.
+  """
+
+  def __init__(self, root_dir, cache_manager=None, chunk_size=_CHUNK_SIZE):
+    """Args:
+      root_dir: the directory files are served from.
+      cache_manager: CacheManager of the update cache; cache entries are
+                     touched and pinned while they are being served.
+      chunk_size: size of the slices files are sent in.
+    """
+    self.root_dir = os.path.abspath(root_dir)
+    self.cache_manager = cache_manager
+    self.chunk_size = chunk_size
+    self._lock = threading.Lock()
+    self._recent = collections.deque(maxlen=_RECENT_TRANSFERS)
+    self.active = 0
+    self.transfers = 0
+    self.bytes_sent = 0
+
+  def _GetPath(self, path_args):
+    """Returns the path of the file a request refers to."""
+    path = os.path.normpath(os.path.join(self.root_dir, *path_args))
+    if not path.startswith(self.root_dir + os.sep):
+      raise cherrypy.HTTPError(403, 'Forbidden')
+    if not os.path.isfile(path):
+      raise cherrypy.NotFound()
+    return path
+
+  @staticmethod
+  def _GetETag(stat):
+    """Returns a strong entity tag for the file of |stat|."""
+    return '"%x-%x-%x"' % (stat.st_ino, stat.st_size,
+                           int(stat.st_mtime * 1000000))
+
+  @staticmethod
+  def _IsValidatorMatch(value, etag, last_modified):
+    """Returns whether an If-Range value matches the current entity."""
+    return value == etag or value == last_modified
+
+  def _SendRanges(self, path, stat, ranges, parts=None, boundary=None):
+    """Yields slices of the mapped file for each of |ranges|.
+
+    Args:
+      path: the file to send.
+      stat: the stat of the file the response headers were computed from.
+      ranges: list of (start, stop) tuples to send.
+      parts: the part headers preceding each range in a multipart response.
+      boundary: the closing delimiter of a multipart response.
+    """
+    cache_entry = os.path.dirname(os.path.realpath(path))
+    start_time = time.time()
+    sent = 0
+    with self._lock:
+      self.active += 1
+    if self.cache_manager:
+      self.cache_manager.Pin(cache_entry)
+    try:
+      with open(path, 'rb') as payload:
+        current = os.fstat(payload.fileno())
+        if ((current.st_ino, current.st_size, current.st_mtime) !=
+            (stat.st_ino, stat.st_size, stat.st_mtime)):
+          _Log('%s changed while being served, aborting', path)
+          return
+        mapped = (mmap.mmap(payload.fileno(), 0, access=mmap.ACCESS_READ)
+                  if stat.st_size else None)
+        try:
+          for index, (start, stop) in enumerate(ranges):
+            if parts:
+              yield parts[index]
+            for offset in xrange(start, stop, self.chunk_size):
+              length = min(self.chunk_size, stop - offset)
+              yield buffer(mapped, offset, length)
+              sent += length
+          if boundary:
+            yield boundary
+        finally:
+          if mapped:
+            mapped.close()
+    finally:
+      if self.cache_manager:
+        self.cache_manager.Unpin(cache_entry)
+      elapsed = time.time() - start_time
+      throughput = sent / max(elapsed, 1e-6) / (1 << 20)
+      _Log('Sent %d bytes of %s in %.2f seconds (%.1f MB/s)', sent, path,
+           elapsed, throughput)
+      with self._lock:
+        self.active -= 1
+        self.transfers += 1
+        self.bytes_sent += sent
+        self._recent.append({'path': os.path.relpath(path, self.root_dir),
+                             'bytes': sent,
+                             'seconds': round(elapsed, 3),
+                             'mbps': round(throughput, 1)})
+
+  def Serve(self, path_args):
+    """Serves the file |path_args| refers to in the current request.
+
+    The response body is streamed, so the handler must run with
+    response.stream enabled.
+    """
+    request = cherrypy.serving.request
+    response = cherrypy.serving.response
+    path = self._GetPath(path_args)
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = self._GetETag(stat)
+    last_modified = httputil.HTTPDate(stat.st_mtime)
+    content_type = (mimetypes.guess_type(path)[0] or
+                    'application/octet-stream')
+    headers = response.headers
+    headers['ETag'] = etag
+    headers['Last-Modified'] = last_modified
+    headers['Accept-Ranges'] = 'bytes'
+
+    if self.cache_manager:
+      self.cache_manager.Touch(os.path.dirname(os.path.realpath(path)))
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (if_none_match.strip() == '*' or etag in [
+        tag.strip() for tag in if_none_match.split(',')]):
+      response.status = 304
+      return []
+
+    ranges = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or self._IsValidatorMatch(if_range.strip(), etag,
+                                              last_modified):
+      ranges = ParseRange(request.headers.get('Range'), size)
+
+    if ranges is None:
+      headers['Content-Type'] = content_type
+      headers['Content-Length'] = str(size)
+      return self._SendRanges(path, stat, [(0, size)])
+
+    if not ranges:
+      headers['Content-Range'] = 'bytes */%d' % size
+      raise cherrypy.HTTPError(416, 'Requested Range Not Satisfiable')
+
+    response.status = 206
+    if len(ranges) == 1:
+      start, stop = ranges[0]
+      headers['Content-Type'] = content_type
+      headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+      headers['Content-Length'] = str(stop - start)
+      return self._SendRanges(path, stat, ranges)
+
+    boundary = uuid.uuid4().hex
+    parts = ['\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d'
+             '\r\n\r\n' % (boundary, content_type, start, stop - 1, size)
+             for start, stop in ranges]
+    closing = '\r\n--%s--\r\n' % boundary
+    headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    headers['Content-Length'] = str(
+        sum(len(part) for part in parts) + len(closing) +
+        sum(stop - start for start, stop in ranges))
+    return self._SendRanges(path, stat, ranges, parts, closing)
+
+  def GetStats(self):
+    """Returns a dictionary of serving statistics."""
+    with self._lock:
+      return {'active': self.active,
+              'transfers': self.transfers,
+              'bytes_sent': self.bytes_sent,
+              'recent': list(self._recent)}
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for payload_server module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cache_manager
+import payload_server
+
+
+class ParseRangeTest(unittest.TestCase):
+
+  def testSingleRanges(self):
+    self.assertEqual(payload_server.ParseRange('bytes=0-9', 100), [(0, 10)])
+    self.assertEqual(payload_server.ParseRange('bytes=90-', 100), [(90, 100)])
+    self.assertEqual(payload_server.ParseRange('bytes=-10', 100), [(90, 100)])
+    # Ranges reaching past the end of the resource are truncated.
+    self.assertEqual(payload_server.ParseRange('bytes=90-200', 100),
+                     [(90, 100)])
+    self.assertEqual(payload_server.ParseRange('bytes=-200', 100), [(0, 100)])
+
+  def testMultipleRanges(self):
+    self.assertEqual(payload_server.ParseRange('bytes=0-0, -1,50-59', 100),
+                     [(0, 1), (99, 100), (50, 60)])
+    # Unsatisfiable ranges are dropped.
+    self.assertEqual(payload_server.ParseRange('bytes=0-9,100-', 100),
+                     [(0, 10)])
+
+  def testUnsatisfiableRanges(self):
+    self.assertEqual(payload_server.ParseRange('bytes=100-', 100), [])
+    self.assertEqual(payload_server.ParseRange('bytes=-0', 100), [])
+    self.assertEqual(payload_server.ParseRange('bytes=0-', 0), [])
+
+  def testInvalidRanges(self):
+    for header in (None, '', 'bytes=', 'bytes=-', 'bytes=9-0', 'bytes=a-b',
+                   'items=0-9', 'bytes=0-9,5', 'bytes=--5'):
+      self.assertEqual(payload_server.ParseRange(header, 100), None, header)
+
+
+class PayloadServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._root_dir = tempfile.mkdtemp('payload_server_unittest')
+    self._cache_dir = os.path.join(self._root_dir, 'cache')
+    self._entry_dir = os.path.join(self._cache_dir, 'entry')
+    os.makedirs(self._entry_dir)
+    self._payload = os.path.join(self._entry_dir, 'update.gz')
+    with open(self._payload, 'w') as f:
+      f.write('0123456789')
+
+  def tearDown(self):
+    shutil.rmtree(self._root_dir)
+
+  def testSendRanges(self):
+    """Tests that ranges are sent in order, with their multipart headers."""
+    manager = cache_manager.CacheManager(self._cache_dir)
+    server = payload_server.PayloadServer(self._root_dir, chunk_size=3,
+                                          cache_manager=manager)
+    body = server._SendRanges(self._payload, os.stat(self._payload),
+                              [(0, 4), (8, 10)], ['<a>', '<b>'], '<end>')
+    self.assertEqual(str(body.next()), '<a>')
+    self.assertTrue(manager.GetStats()['pinned'])
+    self.assertEqual(''.join(str(chunk) for chunk in body),
+                     '012' '3' '<b>' '89' '<end>')
+    self.assertFalse(manager.GetStats()['pinned'])
+
+    stats = server.GetStats()
+    self.assertEqual((stats['active'], stats['transfers'], stats['bytes_sent']),
+                     (0, 1, 6))
+    self.assertEqual(stats['recent'][0]['path'], 'cache/entry/update.gz')
+
+  def testSendChangedFile(self):
+    """Tests that nothing is sent if the file changed after headers were."""
+    server = payload_server.PayloadServer(self._root_dir)
+    stat = os.stat(self._payload)
+    with open(self._payload, 'a') as f:
+      f.write('more')
+    self.assertEqual(
+        list(server._SendRanges(self._payload, stat, [(0, 10)])), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,236 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Extraction of members of zip archives in Google Storage, in place.
+
+Only the central directory of an archive and the members extracted are
+fetched, with ranged reads, and members are inflated as they are received.
+"""
+
+import fnmatch
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+import download_engine
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('REMOTE_ZIP', message, *args)
+
+
+# Minimum size of ranged reads of the central directory. Spans the end of
+# central directory record with the longest comment, so that locating the
+# central directory of an archive takes a single read.
+_MIN_READ_SIZE = (64 << 10) + zipfile.sizeEndCentDir
+_UNIX_MODE_SHIFT = 16
+
+
+class RemoteZipError(Exception):
+  """Raised when an archive is corrupt or lacks requested members."""
+  pass
+
+
+class _RangeReader(object):
+  """A read-only file over an object, for zipfile to parse.
+
+  Reads are served from the last range read, ranges being at least
+  _MIN_READ_SIZE bytes long.
+  """
+
+  def __init__(self, engine, url, size):
+    self._engine = engine
+    self._url = url
+    self._size = size
+    self._pos = 0
+    self._buffer = ''
+    self._buffer_start = 0
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    if whence == os.SEEK_CUR:
+      offset += self._pos
+    elif whence == os.SEEK_END:
+      offset += self._size
+    self._pos = max(0, offset)
+
+  def tell(self):
+    return self._pos
+
+  def read(self, count=-1):
+    available = max(0, self._size - self._pos)
+    count = available if count < 0 else min(count, available)
+    if not count:
+      return ''
+
+    start = self._pos - self._buffer_start
+    if start < 0 or start + count > len(self._buffer):
+      # Read ahead, or behind at the end of the object.
+      end = min(self._size, self._pos + max(count, _MIN_READ_SIZE))
+      self._buffer_start = min(self._pos, max(0, end - _MIN_READ_SIZE))
+      parts = []
+      self._engine.Stream(self._url, parts.append, self._buffer_start,
+                          end - 1)
+      self._buffer = ''.join(parts)
+      start = self._pos - self._buffer_start
+    data = self._buffer[start:start + count]
+    self._pos += len(data)
+    return data
+
+
+class _MemberWriter(object):
+  """Inflates the data of a member into a file, as it is received."""
+
+  def __init__(self, info, dst_file):
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+      self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif info.compress_type == zipfile.ZIP_STORED:
+      self._inflater = None
+    else:
+      raise RemoteZipError('Unsupported compression method %d of %s.' % (
+          info.compress_type, info.filename))
+    self._info = info
+    self._file = dst_file
+    self._crc = 0
+    self._size = 0
+
+  def _Output(self, data):
+    self._crc = zlib.crc32(data, self._crc)
+    self._size += len(data)
+    self._file.write(data)
+
+  def write(self, data):
+    if self._inflater:
+      try:
+        data = self._inflater.decompress(data)
+      except zlib.error as e:
+        raise RemoteZipError('Failed to inflate %s: %s' % (self._info.filename,
+                                                          e))
+    self._Output(data)
+
+  def Close(self):
+    """Checks that the member was received whole and intact."""
+    if self._inflater:
+      self._Output(self._inflater.flush())
+    if (self._size != self._info.file_size or
+        self._crc & 0xffffffff != self._info.CRC):
+      raise RemoteZipError('Bad CRC or size of %s.' % self._info.filename)
+
+
+class RemoteZipFile(object):
+  """A zip archive in Google Storage, read over a download engine."""
+
+  def __init__(self, url, size, engine=None):
+    """Reads the central directory of the archive.
+
+    Args:
+      url: gs_url of the archive.
+      size: size of the archive.
+      engine: DownloadEngine the archive is read with; the default by default.
+
+    Raises:
+      GSUtilError: if reading the archive fails.
+      RemoteZipError: if the archive is corrupt.
+    """
+    self._url = url
+    self._engine = engine or download_engine.GetDownloadEngine()
+    try:
+      self._infos = zipfile.ZipFile(
+          _RangeReader(self._engine, url, size)).infolist()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+      raise RemoteZipError('Failed to read %s: %s' % (url, e))
+
+  def namelist(self):
+    """Returns the names of the members of the archive."""
+    return [info.filename for info in self._infos]
+
+  def _GetMembers(self, patterns):
+    """Returns the members matching |patterns|, each of which must match."""
+    if not patterns:
+      return list(self._infos)
+
+    members = []
+    for pattern in patterns:
+      matches = [info for info in self._infos
+                 if fnmatch.fnmatchcase(info.filename, pattern)]
+      if not matches:
+        raise RemoteZipError('No member of %s matches %s.' % (self._url,
+                                                              pattern))
+      members.extend(info for info in matches if info not in members)
+    return members
+
+  def _ExtractMember(self, info, dest_dir):
+    """Fetches, inflates and writes |info| under |dest_dir|."""
+    name = os.path.normpath(info.filename)
+    if os.path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+      raise RemoteZipError('Refusing to extract %s outside of %s.' % (
+          info.filename, dest_dir))
+    path = os.path.join(dest_dir, name)
+    if info.filename.endswith('/'):
+      if not os.path.isdir(path):
+        os.makedirs(path)
+      return
+    if info.flag_bits & 0x1:
+      raise RemoteZipError('%s is encrypted.' % info.filename)
+
+    # The local header may have extra fields of its own; read their length.
+    header = []
+    self._engine.Stream(self._url, header.append, info.header_offset,
+                        info.header_offset + zipfile.sizeFileHeader - 1)
+    header = struct.unpack(zipfile.structFileHeader, ''.join(header))
+    if header[0] != zipfile.stringFileHeader:
+      raise RemoteZipError('Bad local header of %s.' % info.filename)
+    data_start = info.header_offset + zipfile.sizeFileHeader + sum(header[-2:])
+
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    try:
+      with open(path, 'wb') as dst_file:
+        writer = _MemberWriter(info, dst_file)
+        if info.compress_size:
+          self._engine.Stream(self._url, writer.write, data_start,
+                              data_start + info.compress_size - 1)
+        writer.Close()
+    except:
+      os.remove(path)
+      raise
+    mode = info.external_attr >> _UNIX_MODE_SHIFT & 0777
+    if mode:
+      os.chmod(path, mode)
+
+  def Extract(self, dest_dir, patterns=None):
+    """Extracts members of the archive into |dest_dir|, concurrently.
+
+    Args:
+      dest_dir: directory the members are extracted into.
+      patterns: shell patterns, as taken by unzip, of the members to
+                extract; all of them by default.
+
+    Raises:
+      GSUtilError: if reading the archive fails.
+      RemoteZipError: if a member is corrupt, or a pattern matches none.
+    """
+    members = self._GetMembers(patterns)
+    errors = []
+
+    def _Extract(info):
+      try:
+        self._ExtractMember(info, dest_dir)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=_Extract, args=(info,))
+               for info in members]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+    _Log('Extracted %d members of %s (%d of %d bytes)', len(members),
+         self._url, sum(info.compress_size for info in members),
+         sum(info.compress_size for info in self._infos))
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for remote_zip module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import download_engine
+import gsutil_util
+import remote_zip
+
+
+class _CountingBackend(gsutil_util.LocalBackend):
+  """Records the number of bytes of ranged reads."""
+
+  def __init__(self, root_dir):
+    gsutil_util.LocalBackend.__init__(self, root_dir)
+    self.bytes_read = 0
+
+  def CopyRange(self, url, start, end, dst_file):
+    self.bytes_read += end + 1 - start
+    gsutil_util.LocalBackend.CopyRange(self, url, start, end, dst_file)
+
+
+class RemoteZipFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self._tmp_dir = tempfile.mkdtemp(prefix='remote_zip')
+    os.makedirs(os.path.join(self._tmp_dir, 'gs', 'bucket'))
+    self._archive_path = os.path.join(self._tmp_dir, 'gs', 'bucket',
+                                      'image.zip')
+    # Random, so that the images don't deflate to nothing.
+    self._images = dict((name, os.urandom(256 << 10)) for name in
+                        ('base.bin', 'recovery.bin', 'test.bin'))
+    archive = zipfile.ZipFile(self._archive_path, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in sorted(self._images.iteritems()):
+      archive.writestr(name, data)
+    archive.writestr(zipfile.ZipInfo('README'), 'stored')
+    archive.close()
+    self._backend = _CountingBackend(os.path.join(self._tmp_dir, 'gs'))
+    gsutil_util.SetStorageBackend(self._backend)
+    self._dest_dir = os.path.join(self._tmp_dir, 'dest')
+
+  def tearDown(self):
+    gsutil_util.SetStorageBackend(gsutil_util.GSUtilBackend())
+    shutil.rmtree(self._tmp_dir)
+
+  def _Open(self):
+    return remote_zip.RemoteZipFile(
+        'gs://bucket/image.zip', os.path.getsize(self._archive_path),
+        download_engine.DownloadEngine(max_transfers=2))
+
+  def testExtractMembers(self):
+    """Tests that only the requested members are fetched."""
+    self._Open().Extract(self._dest_dir, ['test.bin', 'READ*'])
+    self.assertEqual(sorted(os.listdir(self._dest_dir)),
+                     ['README', 'test.bin'])
+    with open(os.path.join(self._dest_dir, 'test.bin'), 'rb') as f:
+      self.assertEqual(f.read(), self._images['test.bin'])
+    with open(os.path.join(self._dest_dir, 'README'), 'rb') as f:
+      self.assertEqual(f.read(), 'stored')
+    self.assertTrue(self._backend.bytes_read <
+                    os.path.getsize(self._archive_path) / 2)
+
+  def testExtractAll(self):
+    archive = self._Open()
+    self.assertEqual(sorted(archive.namelist()),
+                     ['README', 'base.bin', 'recovery.bin', 'test.bin'])
+    archive.Extract(self._dest_dir)
+    self.assertEqual(sorted(os.listdir(self._dest_dir)),
+                     sorted(archive.namelist()))
+
+  def testMissingMember(self):
+    self.assertRaises(remote_zip.RemoteZipError, self._Open().Extract,
+                      self._dest_dir, ['missing.bin'])
+
+  def testCorruptMember(self):
+    """Tests that corrupt members fail, leaving no file behind."""
+    archive = self._Open()
+    info = zipfile.ZipFile(self._archive_path).getinfo('test.bin')
+    with open(self._archive_path, 'r+b') as f:
+      f.seek(info.header_offset + info.compress_size / 2)
+      f.write('\0' * 32)
+    self.assertRaises(remote_zip.RemoteZipError, archive.Extract,
+                      self._dest_dir, ['recovery.bin', 'test.bin'])
+    self.assertFalse(os.path.exists(os.path.join(self._dest_dir, 'test.bin')))
+    self.assertTrue(os.path.exists(os.path.join(self._dest_dir,
+                                                'recovery.bin')))
+
+  def testNotAZipfile(self):
+    with open(self._archive_path, 'wb') as f:
+      f.write('not a zipfile' * 1000)
+    self.assertRaises(remote_zip.RemoteZipError, self._Open)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,306 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A bounded pool of workers for prioritized, deduplicated staging jobs."""
+
+import Queue
+import collections
+import itertools
+import threading
+import time
+
+import log_util
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('STAGING', message, *args)
+
+
+# Priorities of staging jobs; jobs with lower values run first.
+PRIORITY_PAYLOADS = 0
+PRIORITY_IMAGES = 1
+PRIORITY_SYMBOLS = 2
+PRIORITY_BACKGROUND = 3
+
+# Default number of concurrent staging jobs, other than background ones.
+MAX_WORKERS = 4
+# Default number of concurrent background staging jobs.
+MAX_BACKGROUND_WORKERS = 2
+
+# States of staging jobs.
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# Number of finished jobs kept for listing.
+_HISTORY_SIZE = 100
+
+
+class StagingJobCancelled(Exception):
+  """Raised by the results of jobs cancelled before they ran."""
+  pass
+
+
+class StagingJob(object):
+  """A unit of staging work submitted to the scheduler.
+
+  Members:
+    job_id:      number identifying the job.
+    key:         the key the job is deduplicated by.
+    priority:    the priority the job is queued with.
+    state:       one of QUEUED, RUNNING, SUCCEEDED, FAILED and CANCELLED.
+    submit_time: time the job was submitted at.
+    start_time:  time a worker started running the job, or None.
+    end_time:    time the job finished or was cancelled, or None.
+  """
+
+  def __init__(self, job_id, key, priority, func, args, cancel_func):
+    self.job_id = job_id
+    self.key = key
+    self.priority = priority
+    self.state = QUEUED
+    self._func = func
+    self._args = args
+    self._cancel_func = cancel_func
+    self._done = threading.Event()
+    self._result = None
+    self._error = None
+    self.submit_time = time.time()
+    self.start_time = None
+    self.end_time = None
+
+  def Run(self, finish_func=None):
+    """Runs the job, recording its return value or the exception it raises.
+
+    Args:
+      finish_func: function called with the job after it ran, but before
+                   anybody waiting for it is woken up.
+    """
+    try:
+      self._result = self._func(*self._args)
+      self.state = SUCCEEDED
+    except Exception as e:
+      self._error = e
+      self.state = FAILED
+    finally:
+      # The arguments may be large, and finished jobs are referenced for as
+      # long as their results are waited for.
+      self._func = self._args = self._cancel_func = None
+      self.end_time = time.time()
+      if finish_func:
+        finish_func(self)
+      self._done.set()
+
+  def Cancel(self, finish_func=None):
+    """Finishes the job without running it; see StagingScheduler.Cancel.
+
+    Args:
+      finish_func: function called with the job after its cancel function,
+                   but before anybody waiting for it is woken up.
+    """
+    self._error = StagingJobCancelled('Staging job %d (%s) was cancelled.' %
+                                      (self.job_id, self.key))
+    try:
+      if self._cancel_func:
+        self._cancel_func()
+    finally:
+      self._func = self._args = self._cancel_func = None
+      if finish_func:
+        finish_func(self)
+      self._done.set()
+
+  def Wait(self, timeout=None):
+    """Waits for the job to finish; returns whether it did."""
+    self._done.wait(timeout)
+    return self._done.is_set()
+
+  def Result(self):
+    """Waits for the job; returns its return value or re-raises its error."""
+    self.Wait()
+    if self._error:
+      raise self._error
+    return self._result
+
+  def ToDict(self):
+    """Returns a JSON serializable description of the job."""
+    now = time.time()
+    return {'id': self.job_id,
+            'key': self.key,
+            'priority': self.priority,
+            'state': self.state,
+            'submit_time': self.submit_time,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'queued_seconds': (self.start_time or self.end_time or now) -
+                              self.submit_time,
+            'running_seconds': (self.start_time and
+                                (self.end_time or now) - self.start_time),
+            'error': str(self._error) if self._error else None}
+
+
+class StagingScheduler(object):
+  """Runs staging jobs on bounded sets of worker threads.
+
+  Queued jobs run by priority, then in submission order. Jobs of priority
+  PRIORITY_BACKGROUND or lower run on workers of their own, so that they
+  never hold up the staging requests clients wait for. Like generation
+  jobs, staging jobs are deduplicated by key: submitting a job while one for
+  the same key is in flight returns the in-flight one, raising its priority
+  if the new submission's is higher. Jobs can be cancelled until they start
+  running.
+  """
+
+  def __init__(self, max_workers=MAX_WORKERS,
+               max_background_workers=MAX_BACKGROUND_WORKERS):
+    self._lock = threading.Lock()
+    # Queue, maximum number of workers and workers of the foreground and the
+    # background lanes, keyed by whether they are the background ones.
+    self._queues = {False: Queue.PriorityQueue(), True: Queue.PriorityQueue()}
+    self._max_workers = {False: max_workers, True: max_background_workers}
+    self._workers = {False: [], True: []}
+    self._job_ids = itertools.count(1)
+    # In-flight jobs, keyed by their deduplication key.
+    self._jobs = {}
+    # Descriptions of the finished jobs, most recent last. Jobs themselves are
+    # not kept, lest their results outlive their waiters.
+    self._finished = collections.deque(maxlen=_HISTORY_SIZE)
+    self.completed = 0
+    self.failed = 0
+    self.cancelled = 0
+
+  def _Worker(self, queue):
+    """Runs the jobs queued in |queue|, forever."""
+    while True:
+      priority, _, job = queue.get()
+      with self._lock:
+        # Skip cancelled jobs, and entries superseded by a priority raise,
+        # which may have moved the job to the foreground lane.
+        if job.state != QUEUED or priority != job.priority:
+          continue
+        job.state = RUNNING
+        job.start_time = time.time()
+      _Log('Running staging job %d (%s)', job.job_id, job.key)
+      job.Run(finish_func=self._FinishJob)
+      _Log('Finished staging job %d (%s) in %.1f seconds: %s', job.job_id,
+           job.key, job.end_time - job.start_time, job.state)
+      # Idle workers are not to keep the result of their last job alive.
+      del job
+
+  def _FinishJob(self, job):
+    """Retires a job, so that its key can be submitted again."""
+    with self._lock:
+      del self._jobs[job.key]
+      self._finished.append(job.ToDict())
+      if job.state == FAILED:
+        self.failed += 1
+      elif job.state == CANCELLED:
+        self.cancelled += 1
+      else:
+        self.completed += 1
+
+  def _Enqueue(self, job):
+    """Queues |job| in the lane of its priority, adding a worker if allowed.
+
+    Must be called with the lock held.
+    """
+    background = job.priority >= PRIORITY_BACKGROUND
+    self._queues[background].put((job.priority, job.job_id, job))
+    workers = self._workers[background]
+    if len(workers) < self._max_workers[background]:
+      worker = threading.Thread(target=self._Worker,
+                                args=(self._queues[background],))
+      worker.daemon = True
+      worker.start()
+      workers.append(worker)
+
+  def Submit(self, key, func, args=(), priority=PRIORITY_BACKGROUND,
+             cancel_func=None):
+    """Schedules func(*args) under |key|, unless a job for it is in flight.
+
+    Args:
+      key: string the job is deduplicated by.
+      func: function doing the staging work.
+      args: arguments of func.
+      priority: one of the PRIORITY_* values; lower values run first.
+      cancel_func: function called if the job is cancelled before running.
+
+    Returns:
+      The StagingJob object that is in charge of |key|.
+    """
+    with self._lock:
+      job = self._jobs.get(key)
+      if job:
+        if job.state == QUEUED and priority < job.priority:
+          job.priority = priority
+          self._Enqueue(job)
+        return job
+      job = StagingJob(next(self._job_ids), key, priority, func, args,
+                       cancel_func)
+      self._jobs[key] = job
+      self._Enqueue(job)
+    return job
+
+  def Cancel(self, job_id):
+    """Cancels the queued job |job_id|.
+
+    Returns:
+      Whether the job was cancelled; running and finished jobs are not.
+    """
+    with self._lock:
+      job = self._GetJob(job_id)
+      if not job or job.state != QUEUED:
+        return False
+      job.state = CANCELLED
+      job.end_time = time.time()
+    _Log('Cancelled staging job %d (%s)', job.job_id, job.key)
+    job.Cancel(finish_func=self._FinishJob)
+    return True
+
+  def _GetJob(self, job_id):
+    for job in self._jobs.itervalues():
+      if job.job_id == job_id:
+        return job
+    return None
+
+  def GetJob(self, job_id):
+    """Returns the in-flight job |job_id|, or None."""
+    with self._lock:
+      return self._GetJob(job_id)
+
+  def FindJob(self, key):
+    """Returns the in-flight job for |key|, or None."""
+    with self._lock:
+      return self._jobs.get(key)
+
+  def GetJobs(self):
+    """Returns descriptions of the queued, running and recent finished jobs.
+
+    Returns:
+      A dictionary mapping each of 'queued', 'running' and 'finished' to a
+      list of job descriptions (see StagingJob.ToDict), ordered by priority
+      for queued jobs and by recency for finished ones.
+    """
+    with self._lock:
+      in_flight = sorted(self._jobs.itervalues(),
+                         key=lambda job: (job.priority, job.job_id))
+      return {
+          'queued': [job.ToDict() for job in in_flight
+                     if job.state == QUEUED],
+          'running': [job.ToDict() for job in in_flight
+                      if job.state == RUNNING],
+          'finished': list(reversed(self._finished))}
+
+  def GetStats(self):
+    """Returns a dictionary of scheduler statistics."""
+    with self._lock:
+      running = len([job for job in self._jobs.itervalues()
+                     if job.state == RUNNING])
+      return {'queued': len(self._jobs) - running,
+              'running': running,
+              'completed': self.completed,
+              'failed': self.failed,
+              'cancelled': self.cancelled}
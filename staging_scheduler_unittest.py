@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for staging_scheduler module."""
+
+import threading
+import time
+import unittest
+import weakref
+
+import staging_scheduler
+
+
+class StagingSchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self._release = threading.Event()
+    self._started = threading.Event()
+    self._calls = []
+
+  def _BlockingJob(self, name):
+    """Fake staging that waits until the test releases it."""
+    self._calls.append(name)
+    self._started.set()
+    self._release.wait(10)
+    return name
+
+  def testPriorities(self):
+    """Tests that queued jobs run by priority, then submission order."""
+    scheduler = staging_scheduler.StagingScheduler(max_workers=1)
+    blocker = scheduler.Submit('blocker', self._BlockingJob, ('blocker',),
+                               priority=staging_scheduler.PRIORITY_SYMBOLS)
+    self._started.wait(10)
+    jobs = [scheduler.Submit('autotest', self._BlockingJob, ('autotest',),
+                             priority=staging_scheduler.PRIORITY_SYMBOLS),
+            scheduler.Submit('images', self._BlockingJob, ('images',),
+                             priority=staging_scheduler.PRIORITY_IMAGES),
+            scheduler.Submit('payloads', self._BlockingJob, ('payloads',),
+                             priority=staging_scheduler.PRIORITY_PAYLOADS),
+            scheduler.Submit('symbols', self._BlockingJob, ('symbols',),
+                             priority=staging_scheduler.PRIORITY_SYMBOLS)]
+    # Resubmitting raises the priority of the queued job.
+    self.assertTrue(scheduler.Submit(
+        'autotest', self._BlockingJob, ('again',),
+        priority=staging_scheduler.PRIORITY_PAYLOADS) is jobs[0])
+    self.assertEqual([job['key'] for job in scheduler.GetJobs()['queued']],
+                     ['autotest', 'payloads', 'images', 'symbols'])
+    self._release.set()
+    self.assertEqual(blocker.Result(), 'blocker')
+    for job in jobs:
+      job.Result()
+    self.assertEqual(self._calls, ['blocker', 'autotest', 'payloads', 'images',
+                                   'symbols'])
+    self.assertEqual(scheduler.GetStats()['completed'], 5)
+
+  def testBackgroundLane(self):
+    """Tests that background jobs don't hold up the other jobs."""
+    scheduler = staging_scheduler.StagingScheduler(max_workers=1,
+                                                   max_background_workers=1)
+    background = scheduler.Submit('background', self._BlockingJob,
+                                  ('background',))
+    self._started.wait(10)
+    queued = scheduler.Submit('queued', self._calls.append, ('queued',))
+    payloads = scheduler.Submit('payloads', lambda: 'payloads',
+                                priority=staging_scheduler.PRIORITY_PAYLOADS)
+    self.assertEqual(payloads.Result(), 'payloads')
+    # Raising the priority of a queued background job moves it to the
+    # foreground.
+    self.assertTrue(scheduler.Submit(
+        'queued', self._calls.append, ('queued',),
+        priority=staging_scheduler.PRIORITY_IMAGES) is queued)
+    self.assertTrue(queued.Wait(10))
+    self.assertFalse(background.Wait(0))
+    self._release.set()
+    self.assertEqual(background.Result(), 'background')
+    self.assertEqual(self._calls, ['background', 'queued'])
+
+  def testCancel(self):
+    """Tests that queued jobs can be cancelled, running ones can't."""
+    cancelled = []
+    scheduler = staging_scheduler.StagingScheduler(max_background_workers=1)
+    running = scheduler.Submit('running', self._BlockingJob, ('running',))
+    queued = scheduler.Submit('queued', self._BlockingJob, ('queued',),
+                              cancel_func=lambda: cancelled.append(True))
+    self._started.wait(10)
+    self.assertFalse(scheduler.Cancel(running.job_id))
+    self.assertTrue(scheduler.Cancel(queued.job_id))
+    self.assertFalse(scheduler.Cancel(queued.job_id))
+    self.assertEqual(cancelled, [True])
+    self.assertRaises(staging_scheduler.StagingJobCancelled, queued.Result)
+
+    self._release.set()
+    running.Result()
+    jobs = scheduler.GetJobs()
+    self.assertEqual(jobs['queued'] + jobs['running'], [])
+    self.assertEqual([(job['key'], job['state']) for job in jobs['finished']],
+                     [('running', staging_scheduler.SUCCEEDED),
+                      ('queued', staging_scheduler.CANCELLED)])
+    self.assertEqual(self._calls, ['running'])
+
+  def testFailure(self):
+    """Tests that job failures are propagated and listed."""
+    def _FailingJob():
+      raise ValueError('staging failed')
+
+    scheduler = staging_scheduler.StagingScheduler()
+    job = scheduler.Submit('key', _FailingJob)
+    self.assertRaises(ValueError, job.Result)
+    [finished] = scheduler.GetJobs()['finished']
+    self.assertEqual(finished['state'], staging_scheduler.FAILED)
+    self.assertEqual(finished['error'], 'staging failed')
+    self.assertEqual(scheduler.GetStats()['failed'], 1)
+
+
+  def testFinishedJobsReleased(self):
+    """Tests that the arguments and results of jobs are not kept around."""
+    class _Data(object):
+      pass
+
+    scheduler = staging_scheduler.StagingScheduler()
+    data = _Data()
+    data_ref = weakref.ref(data)
+    job = scheduler.Submit('key', lambda data: _Data(), (data,))
+    result_ref = weakref.ref(job.Result())
+    del data
+    self.assertEqual(data_ref(), None)
+    self.assertNotEqual(result_ref(), None)
+    del job
+    # The worker lets go of the job right after waking up its waiters.
+    deadline = time.time() + 5
+    while result_ref() and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(result_ref(), None)
+    self.assertEqual(len(scheduler.GetJobs()['finished']), 1)
+
+if __name__ == '__main__':
+  unittest.main()
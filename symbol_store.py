@@ -0,0 +1,390 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Breakpad symbols extracted from debug tarballs as minidumps need them.
+
+stage_debug repacks the breakpad symbol files of the debug tarball of a build
+into a symbol pack, where each is compressed on its own, along with an index
+of their offsets, instead of extracting all of them. The symbols of the
+modules a minidump references are extracted from packs when it is
+symbolicated, into a directory whose size is bounded by removing the symbols
+least recently used.
+"""
+
+import collections
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+import log_util
+import minidump
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('SYMBOLS', message, *args)
+
+
+# Directories of symbol packs and of the symbols extracted from them, relative
+# to the static directory.
+PACK_DIR = os.path.join('debug', 'symbol_packs')
+SYMBOL_DIR = os.path.join('debug', 'symbol_cache')
+# Suffix of the index of a symbol pack, stored next to it.
+INDEX_SUFFIX = '.index'
+# Default number of bytes of extracted symbols kept.
+MAX_BYTES = 1 << 30
+
+# Directory of breakpad symbols in debug tarballs.
+_BREAKPAD_DIR = 'debug/breakpad/'
+# Version of the index format; indexes of other versions are ignored.
+_INDEX_VERSION = 1
+# Prefix of files being written.
+_TEMP_PREFIX = '.writing'
+# Directory mtimes this close to the time of the last listing may hide later
+# changes on file systems with coarse timestamps.
+_MTIME_SLACK = 2
+# Symbol files are compressed as gzip members, favoring speed over size.
+_COMPRESSION_LEVEL = 1
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_CHUNK_SIZE = 1 << 20
+
+
+def GetPackName(archive_url):
+  """Returns the name of the symbol pack of the build at |archive_url|."""
+  return archive_url.partition('://')[2].strip('/').replace('/', '_') + '.pack'
+
+
+def _WriteFile(path, write_func):
+  """Atomically writes the file at |path| with write_func(file)."""
+  fd, temp_path = tempfile.mkstemp(prefix=_TEMP_PREFIX,
+                                   dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      write_func(f)
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, path)
+  except Exception:
+    os.remove(temp_path)
+    raise
+
+
+def _Compress(source, dest):
+  """Appends the contents of |source| to |dest| as a gzip member."""
+  compressor = zlib.compressobj(_COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+  while True:
+    data = source.read(_CHUNK_SIZE)
+    if not data:
+      break
+    dest.write(compressor.compress(data))
+  dest.write(compressor.flush())
+
+
+def _Decompress(source, offset, length, size, dest):
+  """Writes the gzip member of |length| bytes at |offset| of |source| to |dest|.
+  """
+  source.seek(offset)
+  decompressor = zlib.decompressobj(_GZIP_WBITS)
+  written = 0
+  while length:
+    data = source.read(min(length, _CHUNK_SIZE))
+    if not data:
+      raise IOError('Truncated symbol pack')
+    length -= len(data)
+    data = decompressor.decompress(data)
+    written += len(data)
+    dest.write(data)
+  data = decompressor.flush()
+  dest.write(data)
+  if written + len(data) != size:
+    raise IOError('Corrupt symbol pack')
+
+
+def WritePack(tarball_path, pack_path):
+  """Repacks the breakpad symbol files of a debug tarball, and indexes them.
+
+  The index is written next to the pack, see INDEX_SUFFIX, once the pack is
+  complete. Tarballs are read in a single pass.
+
+  Returns:
+    The index, a dictionary mapping the path of each symbol file relative to
+    the breakpad symbol directory to its offset and length in the pack, and
+    its size.
+  """
+  symbols = {}
+
+  def _WritePack(pack):
+    tarball = tarfile.open(tarball_path, 'r|*')
+    try:
+      for member in tarball:
+        name = os.path.normpath(member.name)
+        if (member.isfile() and name.startswith(_BREAKPAD_DIR) and
+            name.endswith('.sym')):
+          offset = pack.tell()
+          _Compress(tarball.extractfile(member), pack)
+          symbols[name[len(_BREAKPAD_DIR):]] = (offset, pack.tell() - offset,
+                                                member.size)
+        # Don't keep the members of large tarballs around.
+        tarball.members = []
+    finally:
+      tarball.close()
+
+  _WriteFile(pack_path, _WritePack)
+  _WriteFile(pack_path + INDEX_SUFFIX, lambda f: json.dump(
+      {'version': _INDEX_VERSION, 'symbols': symbols}, f))
+  _Log('Packed %d symbol files of %s', len(symbols), tarball_path)
+  return symbols
+
+
+class SymbolStore(object):
+  """Extracts the symbols of modules from symbol packs, on demand."""
+
+  def __init__(self, static_dir, max_bytes=MAX_BYTES):
+    """Args:
+      static_dir: directory symbol packs are staged under, see PACK_DIR.
+      max_bytes: number of bytes of extracted symbols to keep.
+    """
+    self.pack_dir = os.path.join(static_dir, PACK_DIR)
+    self.symbol_dir = os.path.join(static_dir, SYMBOL_DIR)
+    self._max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # Events set once the symbol files being extracted are, by path, so that
+    # each is extracted once.
+    self._extracting = {}
+    self._mtime = None
+    self._listing_time = None
+    # Inode and mtime of the loaded indexes, by name.
+    self._indexes = {}
+    # Pack, offset, length and size of each indexed symbol file, by path.
+    self._symbols = {}
+    # Paths of the symbol files of each loaded pack, by pack path.
+    self._pack_symbols = {}
+    # Sizes of extracted symbol files by path, least recently used first;
+    # None until the symbol directory was scanned.
+    self._extracted = None
+    self._size = 0
+    # Number of requests using each symbol file, by path.
+    self._pins = collections.Counter()
+    self._stats = dict.fromkeys(('hits', 'extractions', 'evictions',
+                                 'errors'), 0)
+
+  def _ScanExtracted(self):
+    """Picks up the symbols extracted before a restart, oldest first."""
+    extracted = []
+    for dir_path, _, files in os.walk(self.symbol_dir):
+      for name in files:
+        path = os.path.join(dir_path, name)
+        if name.startswith(_TEMP_PREFIX):
+          os.remove(path)
+          continue
+        stat = os.stat(path)
+        extracted.append((stat.st_mtime, os.path.relpath(path, self.symbol_dir),
+                          stat.st_size))
+    self._extracted = collections.OrderedDict(
+        (path, size) for _, path, size in sorted(extracted))
+    self._size = sum(self._extracted.itervalues())
+
+  def _DropPack(self, pack_path):
+    """Forgets the symbol files indexed for the pack at |pack_path|."""
+    for path in self._pack_symbols.pop(pack_path, ()):
+      if self._symbols.get(path, (None,))[0] == pack_path:
+        del self._symbols[path]
+
+  def _LoadIndexes(self):
+    """Loads the indexes of the packs staged or restaged since the last call.
+    """
+    try:
+      mtime = os.stat(self.pack_dir).st_mtime
+    except OSError:
+      return
+    if mtime == self._mtime and self._listing_time - mtime > _MTIME_SLACK:
+      return
+    self._mtime = mtime
+    self._listing_time = time.time()
+    indexes = {}
+    for name in os.listdir(self.pack_dir):
+      if not name.endswith(INDEX_SUFFIX):
+        continue
+      index_path = os.path.join(self.pack_dir, name)
+      try:
+        stat = os.stat(index_path)
+      except OSError:
+        continue
+      indexes[name] = (stat.st_ino, stat.st_mtime)
+      if self._indexes.get(name) == indexes[name]:
+        continue
+      pack_path = index_path[:-len(INDEX_SUFFIX)]
+      self._DropPack(pack_path)
+      try:
+        with open(index_path) as f:
+          index = json.load(f)
+      except (IOError, ValueError) as e:
+        _Log('Ignoring unreadable index %s: %s', index_path, e)
+        continue
+      if index.get('version') != _INDEX_VERSION:
+        continue
+      paths = self._pack_symbols[pack_path] = []
+      for path, (offset, length, size) in index['symbols'].iteritems():
+        path = path.encode('utf-8')
+        self._symbols[path] = (pack_path, offset, length, size)
+        paths.append(path)
+    # Forget the packs whose index is gone.
+    for name in set(self._indexes) - set(indexes):
+      self._DropPack(os.path.join(self.pack_dir, name[:-len(INDEX_SUFFIX)]))
+    self._indexes = indexes
+
+  def _Extract(self, pack_path, symbols):
+    """Extracts symbol files from a symbol pack.
+
+    Args:
+      pack_path: path of the symbol pack.
+      symbols: list of the path, offset, length and size of each symbol file.
+
+    Returns:
+      The list of the path and size of the symbol files extracted.
+    """
+    extracted = []
+    try:
+      with open(pack_path, 'rb') as pack:
+        for path, offset, length, size in symbols:
+          dest_path = os.path.join(self.symbol_dir, path)
+          if not os.path.isdir(os.path.dirname(dest_path)):
+            os.makedirs(os.path.dirname(dest_path))
+          _WriteFile(dest_path, lambda dest: _Decompress(pack, offset, length,
+                                                         size, dest))
+          extracted.append((path, size))
+    except (EnvironmentError, zlib.error) as e:
+      _Log('Failed to extract symbols from %s: %s', pack_path, e)
+      self._Count('errors')
+    return extracted
+
+  def _Evict(self):
+    """Removes the least recently used symbols beyond the size budget.
+
+    Pinned symbol files are kept, as they are being used.
+    """
+    for path in self._extracted.keys():
+      if self._size <= self._max_bytes:
+        break
+      if self._pins[path]:
+        continue
+      self._size -= self._extracted.pop(path)
+      self._stats['evictions'] += 1
+      full_path = os.path.join(self.symbol_dir, path)
+      try:
+        os.remove(full_path)
+        # Remove the debug identifier and debug file directories, if empty.
+        os.rmdir(os.path.dirname(full_path))
+        os.rmdir(os.path.dirname(os.path.dirname(full_path)))
+      except OSError:
+        pass
+
+  def _Count(self, name):
+    with self._lock:
+      self._stats[name] += 1
+
+  def Fetch(self, modules):
+    """Makes the symbols of |modules| available in the symbol directory.
+
+    Symbols not extracted yet are extracted from the symbol packs indexing
+    them, unless another request is extracting them already, in which case
+    it is waited for.
+
+    Args:
+      modules: list of minidump.Module.
+
+    Returns:
+      A dictionary mapping each module whose symbols are available to the
+      path of its symbol file. The symbol files are kept until released, see
+      Release().
+    """
+    wanted = dict((minidump.GetSymbolPath(module), module)
+                  for module in modules if module.debug_id)
+    if not wanted:
+      return {}
+
+    # Symbol files to extract, by pack, and the extractions by other requests
+    # to wait for.
+    to_extract = collections.defaultdict(list)
+    others = set()
+    extracting = threading.Event()
+    # Symbol files that are, or are about to be, extracted are pinned right
+    # away, lest other requests evict them before they are returned.
+    pinned = []
+    with self._lock:
+      if self._extracted is None:
+        self._ScanExtracted()
+      # Packs may have been staged, or restaged, since indexes were loaded.
+      if not set(wanted).issubset(self._extracted):
+        self._LoadIndexes()
+      for path in wanted:
+        if path in self._extracted:
+          self._extracted[path] = self._extracted.pop(path)
+          self._stats['hits'] += 1
+        elif path in self._extracting:
+          others.add(self._extracting[path])
+        elif path in self._symbols:
+          self._extracting[path] = extracting
+          pack_path = self._symbols[path][0]
+          to_extract[pack_path].append((path,) + self._symbols[path][1:])
+        else:
+          continue
+        pinned.append(path)
+      self._pins.update(pinned)
+
+    try:
+      try:
+        for pack_path, symbols in to_extract.iteritems():
+          extracted = self._Extract(pack_path, symbols)
+          with self._lock:
+            self._stats['extractions'] += len(extracted)
+            for path, size in extracted:
+              self._size += size - self._extracted.pop(path, 0)
+              self._extracted[path] = size
+      finally:
+        with self._lock:
+          for symbols in to_extract.itervalues():
+            for symbol in symbols:
+              del self._extracting[symbol[0]]
+        extracting.set()
+      for event in others:
+        event.wait()
+    except Exception:
+      with self._lock:
+        self._Unpin(pinned)
+      raise
+
+    with self._lock:
+      available = [path for path in pinned if path in self._extracted]
+      self._Unpin(set(pinned) - set(available))
+      self._Evict()
+      return dict((wanted[path], os.path.join(self.symbol_dir, path))
+                  for path in available)
+
+  def _Unpin(self, paths):
+    """Lets the symbol files at |paths| be evicted by this request."""
+    for path in paths:
+      self._pins[path] -= 1
+      if not self._pins[path]:
+        del self._pins[path]
+
+  def Release(self, fetched):
+    """Lets the symbol files returned by Fetch() be removed again.
+
+    Args:
+      fetched: the dictionary returned by Fetch().
+    """
+    with self._lock:
+      self._Unpin(minidump.GetSymbolPath(module) for module in fetched)
+
+  def GetStats(self):
+    """Returns a dictionary of symbol store statistics."""
+    with self._lock:
+      return dict(self._stats, packs=len(self._indexes),
+                  indexed=len(self._symbols),
+                  extracted=len(self._extracted or ()),
+                  extracted_bytes=self._size)
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for symbol_store module."""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+import minidump
+import symbol_store
+
+
+_CHROME = minidump.Module('/opt/google/chrome/chrome', 'chrome',
+                          '123456781234567801020304050607080')
+_LIBC = minidump.Module('/lib/libc.so.6', 'libc.so.6',
+                        'ABCDEF01ABCDEF01ABCDEF01ABCDEF010')
+_UNKNOWN = minidump.Module('/lib/libm.so.6', 'libm.so.6',
+                           '000000000000000000000000000000000')
+
+
+class SymbolStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self._static_dir = tempfile.mkdtemp(prefix='symbol_store_unittest')
+    self._tarball_path = os.path.join(self._static_dir, 'debug.tgz')
+    self._WriteTarball('MODULE chrome\n' + 'x' * 1000,
+                       'MODULE libc.so.6\n' + 'y' * 1000)
+    pack_dir = os.path.join(self._static_dir, symbol_store.PACK_DIR)
+    os.makedirs(pack_dir)
+    self._pack_path = os.path.join(pack_dir, symbol_store.GetPackName(
+        'gs://bucket/board-release/R20-2000.0.0'))
+
+  def tearDown(self):
+    shutil.rmtree(self._static_dir)
+
+  def _WriteTarball(self, chrome_symbols, libc_symbols):
+    """Writes a debug tarball with the given symbols of chrome and libc."""
+    content_dir = os.path.join(self._static_dir, 'content')
+    for name, contents in ((minidump.GetSymbolPath(_CHROME), chrome_symbols),
+                           (minidump.GetSymbolPath(_LIBC), libc_symbols)):
+      path = os.path.join(content_dir, 'debug', 'breakpad', name)
+      os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(contents)
+    with open(os.path.join(content_dir, 'debug', 'chrome.debug'), 'w') as f:
+      f.write('unwanted')
+
+    tarball = tarfile.open(self._tarball_path, 'w:gz')
+    tarball.add(os.path.join(content_dir, 'debug'), './debug')
+    tarball.close()
+    shutil.rmtree(content_dir)
+
+  def _ReadSymbols(self, path):
+    with open(path) as f:
+      return f.readline().strip()
+
+  def testFetch(self):
+    """Tests that only the symbols of the modules fetched are extracted."""
+    self.assertEqual(
+        sorted(symbol_store.WritePack(self._tarball_path, self._pack_path)),
+        sorted([minidump.GetSymbolPath(_CHROME),
+                minidump.GetSymbolPath(_LIBC)]))
+    store = symbol_store.SymbolStore(self._static_dir)
+    paths = store.Fetch([_LIBC, _UNKNOWN, _LIBC._replace(debug_id=None)])
+    self.assertEqual(paths.keys(), [_LIBC])
+    self.assertEqual(self._ReadSymbols(paths[_LIBC]), 'MODULE libc.so.6')
+    self.assertEqual(os.listdir(store.symbol_dir), ['libc.so.6'])
+
+    paths = store.Fetch([_CHROME, _LIBC])
+    self.assertEqual(self._ReadSymbols(paths[_CHROME]), 'MODULE chrome')
+    stats = store.GetStats()
+    self.assertEqual((stats['packs'], stats['indexed'], stats['extracted'],
+                      stats['hits'], stats['extractions']), (1, 2, 2, 1, 2))
+
+    # Symbols extracted before a restart are used as they are.
+    os.remove(self._pack_path)
+    paths = symbol_store.SymbolStore(self._static_dir).Fetch([_CHROME])
+    self.assertEqual(self._ReadSymbols(paths[_CHROME]), 'MODULE chrome')
+
+  def testConcurrentFetches(self):
+    """Tests that symbols are extracted once, without blocking other ones."""
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    store = symbol_store.SymbolStore(self._static_dir)
+    started = threading.Event()
+    release = threading.Event()
+    extract = store._Extract
+
+    def _SlowExtract(pack_path, symbols):
+      if symbols[0][0] == minidump.GetSymbolPath(_CHROME):
+        started.set()
+        release.wait(10)
+      return extract(pack_path, symbols)
+
+    store._Extract = _SlowExtract
+    results = {}
+    threads = [threading.Thread(target=lambda name=name, modules=modules:
+                                results.update({name: store.Fetch(modules)}))
+               for name, modules in (('chrome', [_CHROME]),
+                                     ('both', [_CHROME, _LIBC]))]
+    threads[0].start()
+    started.wait(10)
+    threads[1].start()
+    # The symbols of libc are extracted while those of chrome are.
+    deadline = time.time() + 10
+    while not store.GetStats()['extractions'] and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(store.GetStats()['extractions'], 1)
+    self.assertEqual(results, {})
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results['chrome'].keys(), [_CHROME])
+    self.assertEqual(sorted(results['both']), sorted([_CHROME, _LIBC]))
+    self.assertEqual(store.GetStats()['extractions'], 2)
+
+  def testConcurrentFetchesOverBudget(self):
+    """Tests that symbols are not evicted before they are returned."""
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    # Any symbol file is over budget, and evicted once not in use.
+    store = symbol_store.SymbolStore(self._static_dir, max_bytes=1)
+    started = threading.Event()
+    release = threading.Event()
+    extract = store._Extract
+
+    def _SlowExtract(pack_path, symbols):
+      if symbols[0][0] == minidump.GetSymbolPath(_CHROME):
+        started.set()
+        release.wait(10)
+      return extract(pack_path, symbols)
+
+    store._Extract = _SlowExtract
+    results = {}
+    threads = [threading.Thread(target=lambda name=name, modules=modules:
+                                results.update({name: store.Fetch(modules)}))
+               for name, modules in (('chrome', [_CHROME]),
+                                     ('both', [_CHROME, _LIBC]))]
+    threads[0].start()
+    started.wait(10)
+    threads[1].start()
+    deadline = time.time() + 10
+    while not store.GetStats()['extractions'] and time.time() < deadline:
+      time.sleep(0.01)
+    # The fetch of chrome symbols finishes while the symbols of libc, which
+    # are extracted, wait for them.
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(sorted(results['both']), sorted([_CHROME, _LIBC]))
+    for path in results['both'].itervalues():
+      self.assertTrue(os.path.exists(path))
+    store.Release(results['chrome'])
+    store.Release(results['both'])
+    self.assertEqual(store.Fetch([_UNKNOWN]), {})
+    self.assertEqual(store.GetStats()['extracted'], 0)
+
+  def testEviction(self):
+    """Tests that the symbols least recently used are removed first."""
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    store = symbol_store.SymbolStore(self._static_dir, max_bytes=1500)
+    chrome = store.Fetch([_CHROME])
+    chrome_path = chrome[_CHROME]
+    # Symbols in use are kept, even over budget.
+    both = store.Fetch([_CHROME, _LIBC])
+    self.assertEqual(len(both), 2)
+    store.Release(both)
+    libc = store.Fetch([_LIBC])
+    self.assertTrue(os.path.exists(chrome_path))
+    store.Release(chrome)
+    store.Release(libc)
+    libc_path = store.Fetch([_LIBC])[_LIBC]
+    self.assertFalse(os.path.exists(chrome_path))
+    self.assertEqual(os.listdir(store.symbol_dir), ['libc.so.6'])
+    store.Release({_LIBC: libc_path})
+    self.assertEqual(store.Fetch([_CHROME])[_CHROME], chrome_path)
+    self.assertFalse(os.path.exists(libc_path))
+    stats = store.GetStats()
+    self.assertEqual((stats['extracted'], stats['extractions'],
+                      stats['evictions']), (1, 3, 2))
+
+  def testRestagedPacks(self):
+    """Tests that the indexes of restaged packs are read again."""
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    store = symbol_store.SymbolStore(self._static_dir)
+    store.Fetch([_LIBC])
+    self._WriteTarball('MODULE chrome 2\n', 'MODULE libc.so.6 2\n')
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    self.assertEqual(self._ReadSymbols(store.Fetch([_CHROME])[_CHROME]),
+                     'MODULE chrome 2')
+
+    # The symbols of packs that are gone are forgotten.
+    os.remove(self._pack_path)
+    os.remove(self._pack_path + symbol_store.INDEX_SUFFIX)
+    self.assertEqual(store.Fetch([_LIBC, _UNKNOWN]).keys(), [_LIBC])
+    stats = store.GetStats()
+    self.assertEqual((stats['packs'], stats['indexed'], stats['errors']),
+                     (0, 0, 0))
+
+  def testMissingPacks(self):
+    """Tests that packs are used once staged, and may be corrupt or vanish."""
+    store = symbol_store.SymbolStore(self._static_dir)
+    self.assertEqual(store.Fetch([_CHROME]), {})
+    symbol_store.WritePack(self._tarball_path, self._pack_path)
+    with open(self._pack_path, 'r+') as pack:
+      pack.truncate(20)
+    self.assertEqual(store.Fetch([_CHROME, _LIBC]), {})
+    os.remove(self._pack_path)
+    self.assertEqual(store.Fetch([_CHROME]), {})
+    self.assertEqual(store.GetStats()['errors'], 2)
+    # Symbol files partially extracted are removed.
+    self.assertEqual([files for _, _, files in os.walk(store.symbol_dir)
+                      if files], [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,271 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Symbolication of minidumps on a bounded pool of workers.
+
+Minidumps are symbolicated by minidump_stackwalk against the breakpad symbols
+staged by stage_debug, which are extracted from symbol packs as needed if
+a SymbolStore is given. Identical minidumps are symbolicated once: those
+submitted while one is in flight share its job, and the stack traces of
+recent ones are cached for as long as the symbols of their modules don't
+change.
+"""
+
+import collections
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import log_util
+import minidump
+import staging_scheduler
+
+
+# Module-local log function.
+def _Log(message, *args):
+  return log_util.LogWithTag('SYMBOLICATE', message, *args)
+
+
+# Default number of concurrent symbolications.
+MAX_WORKERS = 2
+# Number of stack traces, and of symbol lookups, cached.
+_RESULT_CACHE_SIZE = 256
+_SYMBOL_CACHE_SIZE = 4096
+# Seconds a module without symbols is assumed to still have none.
+_MISSING_SYMBOLS_TTL = 30
+# Number of recent symbolications latency statistics are computed over.
+_LATENCY_HISTORY = 100
+
+
+class SymbolicationError(Exception):
+  """Raised when a minidump can't be symbolicated."""
+  pass
+
+
+class SymbolCache(object):
+  """Locates the symbols of modules, by module and debug identifier.
+
+  Symbol files are identified by the MODULE record they start with, which is
+  checked against the module looked up; the outcome of a lookup is cached,
+  briefly for modules without symbols, as these may be staged later.
+  """
+
+  def __init__(self, symbol_dir, size=_SYMBOL_CACHE_SIZE):
+    self._symbol_dir = symbol_dir
+    self._size = size
+    self._lock = threading.Lock()
+    # Paths of symbol files, or None and the time of the lookup, by key.
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def _Locate(self, module):
+    """Returns the path of the symbols of |module|, or None if missing."""
+    path = os.path.join(self._symbol_dir, minidump.GetSymbolPath(module))
+    try:
+      with open(path) as symbol_file:
+        record = symbol_file.readline().split(None, 4)
+    except IOError:
+      return None
+    if (len(record) < 4 or record[0] != 'MODULE' or
+        record[3].upper() != module.debug_id):
+      _Log('Ignoring symbols %s of another module: %s', path, record[:4])
+      return None
+    return path
+
+  def Lookup(self, module):
+    """Returns the path of the symbols of |module|, or None if missing."""
+    if not module.debug_id:
+      return None
+    key = (module.debug_file, module.debug_id)
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry and (entry[0] or
+                    time.time() - entry[1] < _MISSING_SYMBOLS_TTL):
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+      self.misses += 1
+
+    path = self._Locate(module)
+    with self._lock:
+      self._entries[key] = (path, time.time())
+      while len(self._entries) > self._size:
+        self._entries.popitem(last=False)
+    return path
+
+  def __len__(self):
+    return len(self._entries)
+
+
+class Symbolicator(object):
+  """Symbolicates minidumps on a bounded pool of workers."""
+
+  def __init__(self, symbol_dir, max_workers=MAX_WORKERS,
+               stackwalk='minidump_stackwalk', symbol_store=None):
+    """Args:
+      symbol_dir: breakpad symbol directory, as staged by stage_debug.
+      max_workers: maximum number of concurrent symbolications.
+      stackwalk: the minidump_stackwalk command.
+      symbol_store: SymbolStore the symbols missing from |symbol_dir| are
+                    extracted from, if any.
+    """
+    self._symbol_dirs = [symbol_dir]
+    if symbol_store:
+      self._symbol_dirs.append(symbol_store.symbol_dir)
+    self._stackwalk = stackwalk
+    self._symbol_store = symbol_store
+    self._scheduler = staging_scheduler.StagingScheduler(max_workers)
+    self._symbols = SymbolCache(symbol_dir)
+    self._lock = threading.Lock()
+    # Stack traces by minidump digest and symbols, least recently used first.
+    self._results = collections.OrderedDict()
+    self._latencies = collections.deque(maxlen=_LATENCY_HISTORY)
+    self._stats = dict.fromkeys(('requests', 'cache_hits', 'coalesced',
+                                 'unparsable'), 0)
+
+  def _Run(self, data):
+    """Runs minidump_stackwalk on a minidump; returns its stack trace."""
+    with tempfile.NamedTemporaryFile(prefix='minidump') as local:
+      local.write(data)
+      local.flush()
+      try:
+        stackwalk = subprocess.Popen([self._stackwalk, local.name] +
+                                     self._symbol_dirs,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+      except OSError as e:
+        raise SymbolicationError('Failed to run %s: %s' % (self._stackwalk, e))
+      stack, error_text = stackwalk.communicate()
+    if stackwalk.returncode != 0:
+      raise SymbolicationError("Can't generate stack trace: %s (rc=%d)" % (
+          error_text, stackwalk.returncode))
+    return stack
+
+  def _Submit(self, data):
+    """Starts symbolicating a minidump.
+
+    Returns:
+      A function waiting for the stack trace of the minidump, and returning
+      it or raising the SymbolicationError.
+    """
+    start = time.time()
+    digest = hashlib.sha1(data).hexdigest()
+    try:
+      modules = minidump.GetModules(data)
+    except minidump.MinidumpError as e:
+      # Let minidump_stackwalk tell what is wrong with the minidump.
+      _Log('Failed to read the modules of minidump %s: %s', digest, e)
+      self._Count('unparsable')
+      modules = []
+    symbols = [self._symbols.Lookup(module) for module in modules]
+    # Symbols fetched from the store, which are kept until symbolicated with.
+    fetched = {}
+    if self._symbol_store and None in symbols:
+      fetched = self._symbol_store.Fetch(
+          [module for module, path in zip(modules, symbols) if not path])
+      symbols = [path or fetched.get(module)
+                 for module, path in zip(modules, symbols)]
+    # The stack trace of a minidump changes as symbols of its modules arrive.
+    key = (digest, tuple(symbols))
+
+    with self._lock:
+      self._stats['requests'] += 1
+      stack = self._results.pop(key, None)
+      if stack is not None:
+        self._results[key] = stack
+        self._stats['cache_hits'] += 1
+    if stack is not None:
+      self._Release(fetched)
+      return lambda: stack
+
+    job_key = 'symbolicate:%s:%s' % (digest, hash(key[1]))
+    in_flight = self._scheduler.FindJob(job_key)
+    job = self._scheduler.Submit(
+        job_key, self._Run, (data,),
+        priority=staging_scheduler.PRIORITY_SYMBOLS)
+    if job is in_flight:
+      self._Count('coalesced')
+
+    def _Wait():
+      try:
+        stack = job.Result()
+      finally:
+        self._Release(fetched)
+      with self._lock:
+        self._latencies.append(time.time() - start)
+        self._results[key] = stack
+        while len(self._results) > _RESULT_CACHE_SIZE:
+          self._results.popitem(last=False)
+      return stack
+
+    return _Wait
+
+  def _Release(self, fetched):
+    """Lets the symbols fetched from the store for a minidump go."""
+    if fetched:
+      self._symbol_store.Release(fetched)
+
+  def _Count(self, name):
+    with self._lock:
+      self._stats[name] += 1
+
+  def Symbolicate(self, data):
+    """Returns the stack trace of a minidump.
+
+    Args:
+      data: contents of the minidump.
+
+    Raises:
+      SymbolicationError: if minidump_stackwalk fails.
+    """
+    return self._Submit(data)()
+
+  def SymbolicateMany(self, dumps):
+    """Symbolicates minidumps concurrently.
+
+    Args:
+      dumps: contents of the minidumps.
+
+    Returns:
+      A list of the stack trace, or the SymbolicationError, of each minidump.
+    """
+    waits = [self._Submit(data) for data in dumps]
+    results = []
+    for wait in waits:
+      try:
+        results.append(wait())
+      except SymbolicationError as e:
+        results.append(e)
+    return results
+
+  def GetStats(self):
+    """Returns a dictionary of symbolication statistics.
+
+    Latencies are in seconds, over the recent symbolications that were not
+    cached.
+    """
+    scheduler_stats = self._scheduler.GetStats()
+    with self._lock:
+      latencies = sorted(self._latencies)
+      stats = dict(self._stats,
+                   queued=scheduler_stats['queued'],
+                   running=scheduler_stats['running'],
+                   completed=scheduler_stats['completed'],
+                   failed=scheduler_stats['failed'],
+                   cached_results=len(self._results),
+                   cached_symbols=len(self._symbols),
+                   symbol_hits=self._symbols.hits,
+                   symbol_misses=self._symbols.misses)
+    if latencies:
+      stats.update(latency_mean=sum(latencies) / len(latencies),
+                   latency_p50=latencies[len(latencies) / 2],
+                   latency_p90=latencies[int(len(latencies) * .9)],
+                   latency_max=latencies[-1])
+    if self._symbol_store:
+      stats['symbol_store'] = self._symbol_store.GetStats()
+    return stats
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for symbolicator module."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mox
+
+import minidump
+import symbolicator
+
+
+# Fake minidump_stackwalk, printing the minidump it is given after a while and
+# logging its runs; minidumps starting with 'bad' fail.
+_STACKWALK = """#!/bin/sh
+echo "run $3" >> %(runs)s
+sleep 0.2
+if grep -q '^bad' "$1"; then
+  echo 'corrupt minidump' >&2
+  exit 1
+fi
+cat "$1"
+"""
+
+_MODULE = minidump.Module('/opt/google/chrome/chrome', 'chrome',
+                          '123456781234567801020304050607080')
+
+
+class SymbolicatorTest(mox.MoxTestBase):
+
+  def setUp(self):
+    mox.MoxTestBase.setUp(self)
+    self._temp_dir = tempfile.mkdtemp(prefix='symbolicator_unittest')
+    self._symbol_dir = os.path.join(self._temp_dir, 'breakpad')
+    self._runs = os.path.join(self._temp_dir, 'runs')
+    self._stackwalk = os.path.join(self._temp_dir, 'stackwalk')
+    with open(self._stackwalk, 'w') as f:
+      f.write(_STACKWALK % {'runs': self._runs})
+    os.chmod(self._stackwalk, 0755)
+
+  def tearDown(self):
+    mox.MoxTestBase.tearDown(self)
+    shutil.rmtree(self._temp_dir)
+
+  def _GetRuns(self):
+    if not os.path.exists(self._runs):
+      return []
+    with open(self._runs) as f:
+      return f.read().splitlines()
+
+  def _WriteSymbols(self, module, debug_id):
+    path = os.path.join(self._symbol_dir, minidump.GetSymbolPath(module))
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write('MODULE Linux x86_64 %s chrome\nFUNC 0 4 0 main\n' % debug_id)
+    return path
+
+  def testSymbolicate(self):
+    """Tests that identical minidumps are symbolicated once, and cached."""
+    symbolicate = symbolicator.Symbolicator(self._symbol_dir, max_workers=2,
+                                            stackwalk=self._stackwalk)
+    results = symbolicate.SymbolicateMany(['dump1', 'dump1', 'bad', 'dump2'])
+    self.assertEqual(results[:2], ['dump1', 'dump1'])
+    self.assertTrue(isinstance(results[2], symbolicator.SymbolicationError))
+    self.assertTrue('corrupt minidump' in str(results[2]))
+    self.assertEqual(results[3], 'dump2')
+    self.assertEqual(len(self._GetRuns()), 3)
+
+    self.assertEqual(symbolicate.Symbolicate('dump2'), 'dump2')
+    self.assertRaises(symbolicator.SymbolicationError,
+                      symbolicate.Symbolicate, 'bad')
+    self.assertEqual(len(self._GetRuns()), 4)
+
+    stats = symbolicate.GetStats()
+    self.assertEqual((stats['requests'], stats['cache_hits'],
+                      stats['coalesced'], stats['unparsable']), (6, 1, 1, 6))
+    self.assertEqual((stats['completed'], stats['failed'],
+                      stats['cached_results']), (2, 2, 2))
+    self.assertTrue(0.2 <= stats['latency_p50'] <= stats['latency_max'])
+
+  def testSymbolStore(self):
+    """Tests that symbols missing from the symbol directory are fetched."""
+    libc = minidump.Module('/lib/libc.so.6', 'libc.so.6', _MODULE.debug_id)
+    self._WriteSymbols(_MODULE, _MODULE.debug_id)
+    store = self.mox.CreateMockAnything()
+    store.symbol_dir = os.path.join(self._temp_dir, 'symbol_cache')
+    self.mox.StubOutWithMock(minidump, 'GetModules')
+    minidump.GetModules('dump').AndReturn([_MODULE, libc])
+    fetched = {libc: os.path.join(store.symbol_dir, 'libc.so.6.sym')}
+    store.Fetch([libc]).AndReturn(fetched)
+    # The fetched symbols are released once the minidump is symbolicated.
+    store.Release(fetched)
+    store.GetStats().AndReturn({'packs': 1})
+    self.mox.ReplayAll()
+
+    symbolicate = symbolicator.Symbolicator(
+        self._symbol_dir, stackwalk=self._stackwalk, symbol_store=store)
+    self.assertEqual(symbolicate.Symbolicate('dump'), 'dump')
+    self.assertEqual(self._GetRuns(), ['run ' + store.symbol_dir])
+    self.assertEqual(symbolicate.GetStats()['symbol_store'], {'packs': 1})
+    self.mox.VerifyAll()
+
+  def testMissingStackwalk(self):
+    """Tests that failing to run minidump_stackwalk is reported."""
+    symbolicate = symbolicator.Symbolicator(
+        self._symbol_dir, stackwalk=os.path.join(self._temp_dir, 'missing'))
+    self.assertRaises(symbolicator.SymbolicationError,
+                      symbolicate.Symbolicate, 'dump')
+
+  def testSymbolCache(self):
+    """Tests that symbols are looked up by debug id, and missing ones again."""
+    cache = symbolicator.SymbolCache(self._symbol_dir)
+    self.assertEqual(cache.Lookup(_MODULE), None)
+    self.assertEqual(cache.Lookup(_MODULE._replace(debug_id=None)), None)
+    path = self._WriteSymbols(_MODULE, _MODULE.debug_id)
+    # Missing symbols are only looked up again after a while.
+    self.assertEqual(cache.Lookup(_MODULE), None)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    cache = symbolicator.SymbolCache(self._symbol_dir)
+    self.assertEqual(cache.Lookup(_MODULE), path)
+    self.assertEqual(cache.Lookup(_MODULE), path)
+    self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+
+    # Symbols of another build of the module are ignored.
+    self._WriteSymbols(_MODULE, '0' * 33)
+    cache = symbolicator.SymbolCache(self._symbol_dir)
+    self.assertEqual(cache.Lookup(_MODULE), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Matching of artifact name patterns against the artifacts of a build.
+
+The names of the artifacts uploaded to an archive are joined into a single
+text once per manifest, so that each pattern is searched for with one scan
+of the whole manifest, and the payloads and autotest packages of the build
+are classified with one scan as well, instead of a match per name.
+"""
+
+import re
+
+import build_artifact
+
+
+# Classes of artifacts, tried in this order on each name.
+FULL = 'full'
+DELTA = 'delta'
+FIRMWARE = 'firmware'
+AUTOTEST = 'autotest'
+
+_CLASSIFIER = re.compile(
+    r'^(?:(?=.*_full_)(?P<%s>)|(?=.*_delta_)(?P<%s>)|(?=.*%s)(?P<%s>)|'
+    r'(?=(?:%s|%s)$)(?P<%s>)).*$' % (
+        FULL, DELTA, re.escape(build_artifact.FIRMWARE_ARCHIVE), FIRMWARE,
+        re.escape(build_artifact.AUTOTEST_PACKAGE),
+        re.escape(build_artifact.AUTOTEST_ZIPPED_PACKAGE), AUTOTEST),
+    re.MULTILINE)
+
+
+class UploadedManifest(list):
+  """The names of the artifacts uploaded to an archive.
+
+  Indexes are computed on first use and kept with the list, so it must not be
+  modified afterwards.
+  """
+
+  def __init__(self, names=()):
+    list.__init__(self, names)
+    self._text = None
+    self._classes = None
+    # Whether each pattern searched for has a match, by pattern.
+    self._searches = {}
+
+  def _GetText(self):
+    if self._text is None:
+      self._text = '\n'.join(self)
+    return self._text
+
+  def Search(self, pattern):
+    """Returns whether an artifact name has a match for |pattern|.
+
+    Args:
+      pattern: regular expression, compiled with re.MULTILINE.
+    """
+    found = self._searches.get(pattern)
+    if found is None:
+      match = pattern.search(self._GetText())
+      if match and '\n' in match.group(0):
+        # The match straddles names; fall back to matching each one.
+        found = any(pattern.search(name) for name in self)
+      else:
+        found = bool(match)
+      self._searches[pattern] = found
+    return found
+
+  def Classify(self):
+    """Returns the names of the artifacts of each class, in manifest order.
+
+    Returns:
+      A dictionary mapping each of FULL, DELTA, FIRMWARE and AUTOTEST to a
+      list of artifact names. A name belongs to the first class it matches.
+    """
+    if self._classes is None:
+      classes = dict((name, []) for name in (FULL, DELTA, FIRMWARE, AUTOTEST))
+      for match in _CLASSIFIER.finditer(self._GetText()):
+        classes[match.lastgroup].append(match.group(0))
+      self._classes = classes
+    return self._classes
+
+
+def GetManifest(names):
+  """Returns |names| as an UploadedManifest, which they may already be."""
+  if isinstance(names, UploadedManifest):
+    return names
+  return UploadedManifest(names)
+
+
+def IsAvailable(pattern_list, names):
+  """Returns whether each of |pattern_list| matches an artifact name."""
+  manifest = GetManifest(names)
+  # re caches compiled patterns.
+  return all(manifest.Search(re.compile(pattern, re.MULTILINE))
+             for pattern in pattern_list)
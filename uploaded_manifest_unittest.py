@@ -0,0 +1,47 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for uploaded_manifest module."""
+
+import unittest
+
+import uploaded_manifest
+
+
+_FULL = 'chromeos_R17-1413.0.0-a1_x86-mario_full_dev.bin'
+_NTON = 'chromeos_R17-1413.0.0-a1_R17-1413.0.0-a1_x86-mario_delta_dev.bin'
+
+
+class UploadedManifestTest(unittest.TestCase):
+
+  def testClassify(self):
+    """Tests that names belong to the first class they match, in order."""
+    manifest = uploaded_manifest.UploadedManifest(
+        ['debug.tgz', _NTON, '', 'firmware_from_source.tar.bz2', _FULL,
+         'autotest.tar.bz2', 'autotest.tar', 'test_full_delta.bin',
+         'autotest.tar.gz'])
+    self.assertEqual(manifest.Classify(), {
+        uploaded_manifest.FULL: [_FULL, 'test_full_delta.bin'],
+        uploaded_manifest.DELTA: [_NTON],
+        uploaded_manifest.FIRMWARE: ['firmware_from_source.tar.bz2'],
+        uploaded_manifest.AUTOTEST: ['autotest.tar.bz2', 'autotest.tar']})
+    self.assertTrue(manifest.Classify() is manifest.Classify())
+
+  def testIsAvailable(self):
+    """Tests that patterns are matched against each name, as with re.search."""
+    names = [_FULL, 'debug.tgz', 'autotest.tar.bz2']
+    self.assertTrue(uploaded_manifest.IsAvailable(
+        ['_full_', r'^debug\.tgz$', 'autotest.tar'], names))
+    self.assertFalse(uploaded_manifest.IsAvailable(['^tar'], names))
+    # Matches of the joined names that straddle two names don't count.
+    self.assertFalse(uploaded_manifest.IsAvailable([r'bin\sdebug'], names))
+    self.assertTrue(uploaded_manifest.IsAvailable(['tgz[^x]*tar.bz2$'],
+                                                  names + ['a.tgz-tar.bz2']))
+    self.assertTrue(uploaded_manifest.IsAvailable([], []))
+
+
+if __name__ == '__main__':
+  unittest.main()